@@ -23,6 +23,10 @@ AZURE_TENANT_ID = os.getenv("AZURE_TENANT_ID", "")
 AZURE_AUTHORITY_HOST = os.getenv("AZURE_AUTHORITY_HOST", "")
 AZURE_FEDERATED_TOKEN_FILE = os.getenv("AZURE_FEDERATED_TOKEN_FILE", "")
 SERVICE_BUS_NAMESPACE = os.getenv("SERVICE_BUS_NAMESPACE", "")
+# Number of messages the SDK receives ahead of receive_messages calls (0 disables prefetch).
+# Prefetched messages are locked as soon as they arrive but can't be registered for lock renewal until they are
+# returned by receive_messages, so keep this to what the handlers get through well within the lock duration.
+PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", "0"))
 
 
 TOPIC_NAME = "task-created"
@@ -61,7 +65,7 @@ async def process_messages(handler):
         async with servicebus_client:
             print("Creating service bus receiver...", flush=True)
             receiver = servicebus_client.get_subscription_receiver(
-                topic_name=TOPIC_NAME, subscription_name=SUBSCRIPTION_NAME
+                topic_name=TOPIC_NAME, subscription_name=SUBSCRIPTION_NAME, prefetch_count=PREFETCH_COUNT
             )
             async with receiver:
                 # AutoLockRenewer performs message lock renewal (for long message processing)
@@ -64,4 +64,5 @@ async def on_user_created(state_changed_event: models.UserCreatedStateChangeEven
 #     print(f"🔔 new notification (subscriber-2): id={message_id}")
 
 
-asyncio.run(consumer_app.run())
+# uses uvloop if it is installed (see EVENT_LOOP)
+consumer_app.run_sync()
@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import logging
+from timeit import default_timer as timer
+from unittest.mock import AsyncMock, patch
+
+from azure.servicebus.aio import ServiceBusReceiver
+
+from pubsub import ConsumerApp, MetricsRegistry, StateChangeEventBase
+from pubsub.test_helpers import MockServiceBusClientBuilder
+
+#
+# Benchmark comparing ConsumerApp throughput for different ServiceBusClient pool sizes
+#
+# Usage (from src/subscriber-sdk-simplified): python -m benchmarks.bench_client_pool
+#
+
+
+class ConnectionLimitedClientBuilder(MockServiceBusClientBuilder):
+    """ConnectionLimitedClientBuilder builds fake clients that each model a single AMQP connection
+
+    Every receive and settle on a client takes frame_time seconds and frames for all of the links on a client
+    are processed one at a time (as they share one socket and frame-processing path).
+    Clients built by the same builder share the underlying topic/subscription messages.
+    """
+
+    completed_count: int
+
+    def __init__(self, frame_time: float):
+        super().__init__()
+        self._frame_time = frame_time
+        self.completed_count = 0
+
+    def build(self):
+        client = super().build()
+        connection = asyncio.Lock()
+        frame_time = self._frame_time
+
+        async def process_frame():
+            async with connection:
+                await asyncio.sleep(frame_time)
+
+        def get_subscription_receiver(topic_name, subscription_name, **kwargs):
+            inner_receiver = self.get_subscription_receiver(topic_name, subscription_name)
+            receiver = AsyncMock(spec=ServiceBusReceiver)
+
+            async def receive_messages(max_message_count=None, max_wait_time=None):
+                await process_frame()
+                return await inner_receiver.receive_messages(
+                    max_message_count=max_message_count, max_wait_time=max_wait_time
+                )
+
+            async def complete_message(message):
+                await process_frame()
+                self.completed_count += 1
+
+            receiver.receive_messages = receive_messages
+            receiver.complete_message = complete_message
+            return receiver
+
+        client.get_subscription_receiver.side_effect = get_subscription_receiver
+        return client
+
+
+SUBSCRIPTION_COUNT = 8
+
+# Create an event class per topic (named to match the topic naming conventions)
+event_classes = [
+    type(f"BenchPool{i}StateChangeEvent", (StateChangeEventBase,), {"__module__": __name__})
+    for i in range(SUBSCRIPTION_COUNT)
+]
+
+
+async def run_benchmark(pool_size: int, message_count: int, frame_time: float) -> float:
+    builder = ConnectionLimitedClientBuilder(frame_time=frame_time)
+    for i in range(SUBSCRIPTION_COUNT):
+        messages = [f'{{"entity_id": "{j}"}}' for j in range(message_count)]
+        builder.add_messages_for_topic_subscription(f"bench-pool{i}", "BENCH_SUB", messages=messages)
+
+    with patch(
+        "azure.servicebus.aio.ServiceBusClient.from_connection_string", side_effect=lambda conn_str: builder.build()
+    ):
+        app = ConsumerApp(
+            default_subscription_name="BENCH_SUB",
+            max_message_count=10,
+            max_wait_time=0.01,
+            client_pool_size=pool_size,
+            client_pool_strategy="load",
+            metrics=MetricsRegistry(),
+        )
+        for i in range(SUBSCRIPTION_COUNT):
+
+            async def on_bench_pool(message):
+                pass
+
+            on_bench_pool.__name__ = f"on_bench_pool{i}"
+            app.consume(on_bench_pool, topic_name=f"bench-pool{i}")
+
+        total = SUBSCRIPTION_COUNT * message_count
+
+        async def cancel_when_done():
+            while builder.completed_count < total:
+                await asyncio.sleep(0.001)
+            app.cancel()
+
+        start = timer()
+        await asyncio.gather(app.run(), cancel_when_done())
+        duration = timer() - start
+
+    return total / duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare ConsumerApp throughput for different client pool sizes")
+    parser.add_argument("--messages", type=int, default=200, help="Messages per subscription")
+    parser.add_argument("--frame-time", type=float, default=0.0005, help="Simulated time per AMQP frame (seconds)")
+    parser.add_argument("--pool-sizes", type=str, default="1,2,4,8")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    print(f"{SUBSCRIPTION_COUNT} subscriptions, {args.messages} messages each, frame time {args.frame_time}s")
+    print(f"{'pool size':>10} {'messages/sec':>14}")
+    for pool_size in [int(size) for size in args.pool_sizes.split(",")]:
+        throughput = asyncio.run(run_benchmark(pool_size, args.messages, args.frame_time))
+        print(f"{pool_size:>10} {throughput:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import argparse
+import datetime
+import timeit
+from typing import Optional
+
+from pydantic import BaseModel, parse_obj_as
+
+from pubsub import StateChangeEventBase
+from pubsub.codecs import _codecs_by_name, get_codec_for_content_type
+from pubsub.models import TaskCreatedStateChangeEvent
+
+# jsons is only used to time the previous decoding path for comparison (pip install jsons to include it)
+try:
+    import jsons
+except ImportError:
+    jsons = None
+
+#
+# Benchmark comparing the CPU time per message and bytes on the wire for the registered codecs
+# (install orjson and msgpack to include the orjson and msgpack codecs)
+#
+# Usage (from src/subscriber-sdk-simplified): python -m benchmarks.bench_codecs
+#
+
+
+class BenchTaskSnapshot(BaseModel):
+    task_id: str
+    title: str
+    description: str
+    assignee: Optional[str]
+    priority: int
+    tags: list[str]
+    created_at: datetime.datetime
+    updated_at: datetime.datetime
+
+
+class BenchCodecsSnapshotStateChangeEvent(StateChangeEventBase):
+    """Event carrying a snapshot of a task and its history (to represent larger events)"""
+
+    snapshot: BenchTaskSnapshot
+    history: list[BenchTaskSnapshot]
+
+
+def create_snapshot(i: int) -> BenchTaskSnapshot:
+    return BenchTaskSnapshot(
+        task_id=f"task-{i}",
+        title=f"Task {i}",
+        description="Lorem ipsum dolor sit amet, consectetur adipiscing elit " * 4,
+        assignee=f"user-{i % 7}",
+        priority=i % 5,
+        tags=["alpha", "beta", "gamma"],
+        created_at=datetime.datetime(2024, 1, 1, 12, 0, 0),
+        updated_at=datetime.datetime(2024, 1, 2, 12, 0, 0),
+    )
+
+
+def create_events() -> dict:
+    return {
+        "small": TaskCreatedStateChangeEvent(entity_id="123"),
+        "snapshot": BenchCodecsSnapshotStateChangeEvent(
+            entity_id="123", snapshot=create_snapshot(0), history=[create_snapshot(i) for i in range(1, 20)]
+        ),
+    }
+
+
+def time_per_call(func, number: int) -> float:
+    """Return the best time per call in microseconds"""
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=2000, help="Number of encode/decode calls per timing run")
+    args = parser.parse_args()
+
+    print(f"{'event':<10} {'codec':<10} {'bytes':>8} {'encode (us)':>12} {'decode (us)':>12}")
+    for event_name, event in create_events().items():
+        event_class = type(event)
+
+        # the previous wire format/decoding path, for comparison
+        if jsons is not None:
+            legacy_body = event.json()
+            legacy_encode = time_per_call(lambda: event.json(), args.number)
+            legacy_decode = time_per_call(
+                lambda: parse_obj_as(event_class, jsons.loads(legacy_body, dict)), args.number
+            )
+            print(
+                f"{event_name:<10} {'(jsons)':<10} {len(legacy_body):>8} {legacy_encode:>12.2f} {legacy_decode:>12.2f}"
+            )
+
+        for codec_name, codec in _codecs_by_name.items():
+            encoded = codec.encode(event)
+            body = encoded.encode("utf-8") if isinstance(encoded, str) else encoded
+            decoder = get_codec_for_content_type(codec.content_type)
+            assert parse_obj_as(event_class, decoder.decode(body)) == event, f"Round trip failed for {codec_name}"
+
+            encode_time = time_per_call(lambda: codec.encode(event), args.number)
+            decode_time = time_per_call(lambda: parse_obj_as(event_class, decoder.decode(body)), args.number)
+            print(f"{event_name:<10} {codec_name:<10} {len(body):>8} {encode_time:>12.2f} {decode_time:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
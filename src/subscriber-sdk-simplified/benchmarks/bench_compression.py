@@ -0,0 +1,63 @@
+import argparse
+import timeit
+
+from pubsub.codecs import _codecs_by_name
+from pubsub.compression import COMPRESSION_ALGORITHMS, compress, decompress, zstandard
+
+from benchmarks.bench_codecs import BenchCodecsSnapshotStateChangeEvent, create_snapshot
+
+#
+# Benchmark comparing the compression ratio and CPU overhead of each compression algorithm for each codec
+# (install zstandard to include zstd, and orjson/msgpack to include those codecs)
+#
+# Usage (from src/subscriber-sdk-simplified): python -m benchmarks.bench_compression
+#
+
+
+def time_per_call(func, number: int) -> float:
+    """Return the best time per call in microseconds"""
+    return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=200, help="Number of compress/decompress calls per timing run")
+    parser.add_argument(
+        "--history-lengths",
+        type=int,
+        nargs="+",
+        default=[10, 100, 1000],
+        help="Number of snapshots in the event history (controls the event size)",
+    )
+    args = parser.parse_args()
+
+    algorithms = [algorithm for algorithm in COMPRESSION_ALGORITHMS if algorithm != "none"]
+    if zstandard is None:
+        print("zstandard is not installed - skipping zstd")
+        algorithms.remove("zstd")
+
+    print(
+        f"{'history':>8} {'codec':<8} {'algorithm':<10} {'bytes':>9} {'compressed':>11} {'ratio':>6} "
+        f"{'compress (us)':>14} {'decompress (us)':>16}"
+    )
+    for history_length in args.history_lengths:
+        event = BenchCodecsSnapshotStateChangeEvent(
+            entity_id="123", snapshot=create_snapshot(0), history=[create_snapshot(i) for i in range(history_length)]
+        )
+        for codec_name, codec in _codecs_by_name.items():
+            encoded = codec.encode(event)
+            body = encoded.encode("utf-8") if isinstance(encoded, str) else encoded
+            for algorithm in algorithms:
+                compressed = compress(body, algorithm)
+                assert decompress(compressed, algorithm) == body, f"Round trip failed for {algorithm}"
+
+                compress_time = time_per_call(lambda: compress(body, algorithm), args.number)
+                decompress_time = time_per_call(lambda: decompress(compressed, algorithm), args.number)
+                print(
+                    f"{history_length:>8} {codec_name:<8} {algorithm:<10} {len(body):>9} {len(compressed):>11} "
+                    f"{len(body) / len(compressed):>6.1f} {compress_time:>14.1f} {decompress_time:>16.1f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
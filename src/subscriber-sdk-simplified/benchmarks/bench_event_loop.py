@@ -0,0 +1,121 @@
+import argparse
+import asyncio
+from timeit import default_timer as timer
+from unittest.mock import AsyncMock, patch
+
+from azure.servicebus.aio import ServiceBusReceiver
+
+from pubsub import ConsumerApp, MetricsRegistry, StateChangeEventBase
+from pubsub import event_loop
+from pubsub.test_helpers import MockServiceBusClientBuilder
+
+#
+# Benchmark comparing messages/sec and per-message latency for ConsumerApp on the asyncio and uvloop event loops.
+# Messages are delivered by the mock Service Bus client, and the handler awaits a short sleep to model I/O.
+# Latency is measured from the batch being received to the message being completed.
+#
+# Usage (from src/subscriber-sdk-simplified): python -m benchmarks.bench_event_loop
+#
+
+
+class BenchEventLoopStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+class LatencyClientBuilder(MockServiceBusClientBuilder):
+    """Mock client builder that records the time from receive to completion for each message"""
+
+    latencies: list[float]
+
+    def __init__(self):
+        super().__init__()
+        self.latencies = []
+
+    def build(self):
+        client = super().build()
+
+        def get_subscription_receiver(topic_name, subscription_name, **kwargs):
+            inner_receiver = self.get_subscription_receiver(topic_name, subscription_name)
+            receiver = AsyncMock(spec=ServiceBusReceiver)
+            received_at = {}
+
+            async def receive_messages(max_message_count=None, max_wait_time=None):
+                msgs = await inner_receiver.receive_messages(max_message_count, max_wait_time)
+                now = timer()
+                for msg in msgs:
+                    received_at[id(msg)] = now
+                return msgs
+
+            async def complete_message(message):
+                self.latencies.append(timer() - received_at.pop(id(message)))
+
+            receiver.receive_messages = receive_messages
+            receiver.complete_message = complete_message
+            return receiver
+
+        client.get_subscription_receiver.side_effect = get_subscription_receiver
+        return client
+
+
+async def run_benchmark(message_count: int, batch_size: int, handler_time: float) -> dict:
+    builder = LatencyClientBuilder()
+    messages = [f'{{"entity_id": "{i}"}}' for i in range(message_count)]
+    builder.add_messages_for_topic_subscription("bench-event-loop", "BENCH_SUB", messages=messages)
+
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=builder.build()):
+        app = ConsumerApp(
+            default_subscription_name="BENCH_SUB",
+            max_message_count=batch_size,
+            max_wait_time=0.01,
+            metrics=MetricsRegistry(),
+            queue_logging=False,
+        )
+
+        @app.consume
+        async def on_bench_event_loop(message: BenchEventLoopStateChangeEvent):
+            await asyncio.sleep(handler_time)
+
+        duration = None
+
+        async def cancel_when_done():
+            nonlocal duration
+            while len(builder.latencies) < message_count:
+                await asyncio.sleep(0.001)
+            duration = timer() - start
+            app.cancel()
+
+        start = timer()
+        await asyncio.gather(app.run(), cancel_when_done())
+
+    latencies = sorted(builder.latencies)
+    return {
+        "throughput": message_count / duration,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare ConsumerApp throughput and latency on asyncio and uvloop")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--handler-time", type=float, default=0.001, help="Time each handler awaits (s)")
+    parser.add_argument("--runs", type=int, default=3, help="Runs per event loop (the best run is reported)")
+    args = parser.parse_args()
+
+    print(f"{args.messages} messages, batch size {args.batch_size}, handler time {args.handler_time * 1000:.1f}ms")
+    print(f"{'event loop':<12} {'messages/sec':>13} {'p50 (ms)':>10} {'p99 (ms)':>10}")
+    for name in [event_loop.EVENT_LOOP_ASYNCIO, event_loop.EVENT_LOOP_UVLOOP]:
+        if name == event_loop.EVENT_LOOP_UVLOOP and event_loop.uvloop is None:
+            print(f"{name:<12} (not installed - pip install uvloop)")
+            continue
+        results = [
+            event_loop.run(run_benchmark(args.messages, args.batch_size, args.handler_time), event_loop=name)
+            for _ in range(args.runs)
+        ]
+        best = max(results, key=lambda result: result["throughput"])
+        print(f"{name:<12} {best['throughput']:>13.1f} {best['p50_ms']:>10.2f} {best['p99_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
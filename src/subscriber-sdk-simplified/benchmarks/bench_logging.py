@@ -0,0 +1,145 @@
+import argparse
+import asyncio
+import logging
+import time
+from timeit import default_timer as timer
+from unittest.mock import AsyncMock, patch
+
+from azure.servicebus.aio import ServiceBusReceiver
+
+from pubsub import ConsumerApp, MetricsRegistry, StateChangeEventBase
+from pubsub.log_pipeline import LogSampler
+from pubsub.test_helpers import MockServiceBusClientBuilder
+
+#
+# Benchmark showing the event loop time spent on per-message logging, comparing logging on the event loop with
+# logging through the queue (off-loop) handler, with and without the per-message rate limit.
+# The log output goes to a handler that models a slow sink (e.g. stdout piped to a busy log collector).
+#
+# Usage (from src/subscriber-sdk-simplified): python -m benchmarks.bench_logging
+#
+
+
+class BenchLoggingStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+class SlowSinkHandler(logging.Handler):
+    """Handler that formats records and then blocks for sink_time seconds per record (like a blocking write)"""
+
+    def __init__(self, sink_time: float):
+        super().__init__()
+        self._sink_time = sink_time
+        self.count = 0
+
+    def emit(self, record):
+        self.format(record)
+        self.count += 1
+        time.sleep(self._sink_time)
+
+
+class CountingClientBuilder(MockServiceBusClientBuilder):
+    completed_count: int
+
+    def __init__(self):
+        super().__init__()
+        self.completed_count = 0
+
+    def build(self):
+        client = super().build()
+
+        def get_subscription_receiver(topic_name, subscription_name, **kwargs):
+            inner_receiver = self.get_subscription_receiver(topic_name, subscription_name)
+            receiver = AsyncMock(spec=ServiceBusReceiver)
+            receiver.receive_messages = inner_receiver.receive_messages
+
+            async def complete_message(message):
+                self.completed_count += 1
+
+            receiver.complete_message = complete_message
+            return receiver
+
+        client.get_subscription_receiver.side_effect = get_subscription_receiver
+        return client
+
+
+async def run_benchmark(message_count: int, queue_logging: bool, rate_limit: float) -> dict:
+    builder = CountingClientBuilder()
+    messages = [f'{{"entity_id": "{i}"}}' for i in range(message_count)]
+    builder.add_messages_for_topic_subscription("bench-logging", "BENCH_SUB", messages=messages)
+
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=builder.build()):
+        app = ConsumerApp(
+            default_subscription_name="BENCH_SUB",
+            max_message_count=50,
+            max_wait_time=0.01,
+            metrics=MetricsRegistry(),
+            queue_logging=queue_logging,
+            message_log_sampler=LogSampler(sample_rate=1, rate_limit=rate_limit),
+        )
+
+        @app.consume
+        async def on_bench_logging(message: BenchLoggingStateChangeEvent):
+            pass
+
+        # measure how late a 1ms ticker runs, i.e. how long the loop is blocked between iterations
+        lags = []
+
+        async def measure_loop_lag():
+            while not app.is_cancelled:
+                start = timer()
+                await asyncio.sleep(0.001)
+                lags.append(timer() - start - 0.001)
+
+        duration = None
+
+        async def cancel_when_done():
+            nonlocal duration
+            while builder.completed_count < message_count:
+                await asyncio.sleep(0.001)
+            # measured when the messages have been processed (the queue listener may still be writing records)
+            duration = timer() - start
+            app.cancel()
+
+        start = timer()
+        await asyncio.gather(app.run(), cancel_when_done(), measure_loop_lag())
+
+    lags.sort()
+    return {
+        "throughput": message_count / duration,
+        "p99_lag_ms": lags[int(len(lags) * 0.99)] * 1000 if lags else 0,
+        "max_lag_ms": lags[-1] * 1000 if lags else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare event loop time spent on per-message logging")
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--sink-time", type=float, default=0.00005, help="Time the log sink blocks per record (s)")
+    args = parser.parse_args()
+
+    handler = SlowSinkHandler(args.sink_time)
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    logging.basicConfig(level=logging.WARNING, handlers=[handler])
+    logging.getLogger("pubsub.consumer_app").setLevel(logging.INFO)
+
+    print(f"{args.messages} messages, log sink time {args.sink_time * 1000000:.0f}us per record")
+    print(
+        f"{'configuration':<26} {'messages/sec':>13} {'p99 loop lag (ms)':>18} {'max loop lag (ms)':>18} {'records':>8}"
+    )
+    configurations = [
+        ("on loop, every message", False, 0),
+        ("queue, every message", True, 0),
+        ("queue, 100 records/sec", True, 100),
+    ]
+    for name, queue_logging, rate_limit in configurations:
+        handler.count = 0
+        result = asyncio.run(run_benchmark(args.messages, queue_logging, rate_limit))
+        print(
+            f"{name:<26} {result['throughput']:>13.1f} {result['p99_lag_ms']:>18.2f} {result['max_lag_ms']:>18.2f} "
+            f"{handler.count:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
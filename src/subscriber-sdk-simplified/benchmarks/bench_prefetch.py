@@ -0,0 +1,238 @@
+import argparse
+import asyncio
+import collections
+from datetime import timedelta
+from timeit import default_timer as timer
+from unittest.mock import patch
+
+from azure.servicebus._common.utils import utc_now
+
+from pubsub import ConsumerApp, MetricsRegistry, StateChangeEventBase
+from pubsub.test_helpers import create_received_message
+
+#
+# Benchmark of the time handlers spend idle waiting for messages, with and without prefetching, for:
+#   - the subscriber-sdk-direct receive loop (receive a batch, handle it, repeat), with and without the SDK
+#     prefetch_count (the loop is reproduced here as src/subscriber-sdk-direct/app.py runs on import)
+#   - ConsumerApp, with and without the prefetch_count option on consume (see pubsub.prefetch)
+# Each receive (or, with SDK prefetch, each link credit top-up) takes a simulated network round trip.
+# Messages are locked from the time the broker delivers them, so the report includes the oldest lock age at
+# settlement (as a fraction of the lock duration) and the number of messages settled after their lock expired.
+#
+# Usage (from src/subscriber-sdk-simplified): python -m benchmarks.bench_prefetch
+#
+
+
+class BenchPrefetchStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+class FakeReceiver:
+    """Receiver where each receive takes round_trip seconds
+
+    With prefetch_count (modelling the SDK prefetch), a background link keeps up to prefetch_count messages in a
+    local buffer, each top-up taking a round trip, and receive_messages returns the buffered messages. The lock of a
+    message starts when it is delivered to the receiver, whether or not it has been returned by receive_messages.
+    """
+
+    def __init__(self, message_count: int, round_trip: float, lock_duration: float, prefetch_count: int = 0):
+        self.remaining = message_count
+        self.settled = 0
+        self.expired = 0
+        self.renewals = 0
+        self.max_lock_age = 0
+        self._round_trip = round_trip
+        self._lock_duration = lock_duration
+        self._prefetch_count = prefetch_count
+        self._buffer = collections.deque()
+        self._buffered = asyncio.Event()
+        self._space = asyncio.Event()
+        self._link_task = None
+        self._sequence_number = 0
+        self._delivered_at = {}  # key: id(message), value: time the message was delivered (its lock started)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def _deliver(self, count: int) -> list:
+        count = min(count, self.remaining)
+        self.remaining -= count
+        msgs = []
+        for _ in range(count):
+            self._sequence_number += 1
+            msg = create_received_message(
+                f'{{"entity_id": "{self._sequence_number}"}}',
+                self,
+                self._sequence_number,
+                lock_duration=self._lock_duration,
+            )
+            self._delivered_at[id(msg)] = timer()
+            msgs.append(msg)
+        return msgs
+
+    async def _run_link(self):
+        while self.remaining > 0:
+            if len(self._buffer) >= self._prefetch_count:
+                self._space.clear()
+                await self._space.wait()
+                continue
+            await asyncio.sleep(self._round_trip)
+            self._buffer.extend(self._deliver(self._prefetch_count - len(self._buffer)))
+            self._buffered.set()
+
+    async def receive_messages(self, max_message_count=None, max_wait_time=None):
+        max_message_count = max_message_count or 1
+        if self._prefetch_count == 0:
+            if self.remaining == 0:
+                await asyncio.sleep(max_wait_time or 1)
+                return []
+            await asyncio.sleep(self._round_trip)
+            return self._deliver(max_message_count)
+
+        if self._link_task is None:
+            self._link_task = asyncio.create_task(self._run_link())
+        if len(self._buffer) == 0:
+            self._buffered.clear()
+            try:
+                await asyncio.wait_for(self._buffered.wait(), timeout=max_wait_time)
+            except asyncio.TimeoutError:
+                return []
+        msgs = [self._buffer.popleft() for _ in range(min(max_message_count, len(self._buffer)))]
+        self._space.set()
+        return msgs
+
+    def _settle(self, message):
+        lock_age = timer() - self._delivered_at.pop(id(message))
+        self.max_lock_age = max(self.max_lock_age, lock_age)
+        if message.locked_until_utc <= utc_now():
+            self.expired += 1
+        self.settled += 1
+
+    async def complete_message(self, message):
+        self._settle(message)
+
+    async def abandon_message(self, message, **kwargs):
+        # e.g. prefetched messages released when ConsumerApp stops
+        self._delivered_at.pop(id(message), None)
+        self.remaining += 1
+
+    async def renew_message_lock(self, message, timeout=None):
+        self.renewals += 1
+        message.locked_until_utc = utc_now() + timedelta(seconds=self._lock_duration)
+        return message.locked_until_utc
+
+    async def close(self):
+        if self._link_task is not None:
+            self._link_task.cancel()
+
+
+class FakeClient:
+    def __init__(self, receiver: FakeReceiver):
+        self._receiver = receiver
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def get_subscription_receiver(self, topic_name, subscription_name, **kwargs):
+        return self._receiver
+
+    async def close(self):
+        pass
+
+
+async def run_direct(receiver: FakeReceiver, message_count: int, batch_size: int, handler_time: float) -> dict:
+    """The subscriber-sdk-direct loop: receive a batch, handle the messages concurrently, repeat"""
+
+    async def handle(msg):
+        await asyncio.sleep(handler_time)
+        await receiver.complete_message(msg)
+
+    idle = 0
+    start = timer()
+    async with receiver:
+        while receiver.settled < message_count:
+            wait_start = timer()
+            received_msgs = await receiver.receive_messages(max_message_count=batch_size, max_wait_time=1)
+            idle += timer() - wait_start
+            await asyncio.gather(*[handle(msg) for msg in received_msgs])
+    return {"duration": timer() - start, "idle": idle}
+
+
+async def run_consumer_app(
+    receiver: FakeReceiver, message_count: int, batch_size: int, handler_time: float, prefetch_count: int
+) -> dict:
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=FakeClient(receiver)):
+        app = ConsumerApp(
+            default_subscription_name="BENCH_SUB",
+            max_message_count=batch_size,
+            max_wait_time=1,
+            metrics=MetricsRegistry(),
+            queue_logging=False,
+            prefetch_count=prefetch_count,
+        )
+
+        @app.consume
+        async def on_bench_prefetch(message: BenchPrefetchStateChangeEvent):
+            await asyncio.sleep(handler_time)
+
+        result = {}
+
+        async def cancel_when_done():
+            while receiver.settled < message_count:
+                await asyncio.sleep(0.001)
+            # measured before stopping, as the app waits for the receive in progress (up to max_wait_time) to stop
+            result["duration"] = timer() - start
+            result["idle"] = app.metrics.get(
+                "receive_wait_seconds_total", topic="bench-prefetch", subscription="BENCH_SUB"
+            )
+            app.cancel()
+
+        start = timer()
+        await asyncio.gather(app.run(), cancel_when_done())
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare handler idle time with and without prefetching")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=10)
+    parser.add_argument("--round-trip", type=float, default=0.02, help="Simulated receive round trip (s)")
+    parser.add_argument("--handler-time", type=float, default=0.02, help="Time each handler awaits (s)")
+    parser.add_argument("--lock-duration", type=float, default=30, help="Message lock duration (s)")
+    parser.add_argument("--prefetch-count", type=int, default=100)
+    args = parser.parse_args()
+
+    print(
+        f"{args.messages} messages, batch size {args.batch_size}, round trip {args.round_trip * 1000:.0f}ms, "
+        f"handler time {args.handler_time * 1000:.0f}ms, lock duration {args.lock_duration:.0f}s"
+    )
+    print(f"{'path':<36} {'messages/sec':>13} {'idle (%)':>9} {'max lock age (%)':>17} {'expired':>8} {'renewals':>9}")
+    scenarios = [
+        ("sdk-direct", 0),
+        ("sdk-direct (SDK prefetch_count)", args.prefetch_count),
+        ("simplified ConsumerApp", 0),
+        ("simplified ConsumerApp (prefetch)", args.prefetch_count),
+    ]
+    for name, prefetch_count in scenarios:
+        if name.startswith("sdk-direct"):
+            receiver = FakeReceiver(args.messages, args.round_trip, args.lock_duration, prefetch_count=prefetch_count)
+            result = asyncio.run(run_direct(receiver, args.messages, args.batch_size, args.handler_time))
+        else:
+            receiver = FakeReceiver(args.messages, args.round_trip, args.lock_duration)
+            result = asyncio.run(
+                run_consumer_app(receiver, args.messages, args.batch_size, args.handler_time, prefetch_count)
+            )
+        print(
+            f"{name:<36} {args.messages / result['duration']:>13.1f} {100 * result['idle'] / result['duration']:>9.1f} "
+            f"{100 * receiver.max_lock_age / args.lock_duration:>17.1f} {receiver.expired:>8} {receiver.renewals:>9}"
+        )
+
+
+if __name__ == "__main__":
+    main()
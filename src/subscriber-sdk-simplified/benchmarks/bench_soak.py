@@ -0,0 +1,286 @@
+import argparse
+import asyncio
+import gc
+import os
+import resource
+import sys
+import tracemalloc
+from datetime import timedelta
+from timeit import default_timer as timer
+from typing import Optional
+from unittest.mock import patch
+
+from azure.servicebus._common.utils import utc_now
+
+from pubsub import ConsumerApp, ConsumerResult, MetricsRegistry, Publisher, StateChangeEventBase
+from pubsub.allocations import start_allocation_tracing
+from pubsub.test_helpers import create_received_message
+
+#
+# Soak benchmark that runs ConsumerApp against an in-process fake broker for millions of messages to catch slow
+# memory growth (e.g. closures, lock renewal registrations or publisher senders that are never released).
+# Two subscriptions receive messages, one handler publishes an event per message (so the Publisher is exercised
+# too) and the other retries a fraction of the messages. RSS and allocated block counts are sampled periodically,
+# and the benchmark exits with status 1 if memory grows by more than the thresholds after the warm-up.
+#
+# tracemalloc slows message processing by an order of magnitude, so it is opt-in (--tracemalloc): use it with fewer
+# messages to find the allocation sites responsible for growth found by a full run.
+#
+# Usage (from src/subscriber-sdk-simplified): python -m benchmarks.bench_soak [--messages 1000000] [--tracemalloc]
+#
+
+
+class BenchSoakStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+class BenchSoakPublishedStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+class FakeBroker:
+    """In-process broker that generates messages for each subscription on demand and counts settled messages"""
+
+    remaining: dict  # key: subscription name, value: number of messages still to deliver
+    settled: int
+    sent: int
+    _sequence_number: int
+
+    def __init__(self, subscription_names: list[str], messages_per_subscription: int):
+        self.remaining = {name: messages_per_subscription for name in subscription_names}
+        self.settled = 0
+        self.sent = 0
+        self._sequence_number = 0
+
+    def receive(self, subscription_name: str, max_message_count: int, receiver) -> list:
+        count = min(max_message_count, self.remaining[subscription_name])
+        self.remaining[subscription_name] -= count
+        msgs = []
+        for _ in range(count):
+            self._sequence_number += 1
+            body = f'{{"entity_id": "{self._sequence_number}"}}'
+            msgs.append(create_received_message(body, receiver, self._sequence_number))
+        return msgs
+
+
+class FakeReceiver:
+    """Receiver for a FakeBroker subscription (plain async methods rather than mocks, which record every call)"""
+
+    def __init__(self, broker: FakeBroker, subscription_name: str):
+        self._broker = broker
+        self._subscription_name = subscription_name
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def receive_messages(self, max_message_count=None, max_wait_time=None):
+        msgs = self._broker.receive(self._subscription_name, max_message_count or 1, self)
+        if len(msgs) == 0:
+            await asyncio.sleep(min(max_wait_time or 1, 0.01))
+        return msgs
+
+    async def complete_message(self, message):
+        self._broker.settled += 1
+
+    async def abandon_message(self, message):
+        self._broker.settled += 1
+
+    async def dead_letter_message(self, message, reason=None, error_description=None):
+        self._broker.settled += 1
+
+    async def renew_message_lock(self, message, timeout=None):
+        message.locked_until_utc = utc_now() + timedelta(seconds=message._lock_duration)
+        return message.locked_until_utc
+
+    async def close(self):
+        pass
+
+
+class FakeSender:
+    def __init__(self, broker: FakeBroker):
+        self._broker = broker
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def send_messages(self, message):
+        self._broker.sent += len(message) if isinstance(message, list) else 1
+
+    async def close(self):
+        pass
+
+
+class FakeClient:
+    def __init__(self, broker: FakeBroker):
+        self._broker = broker
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def get_subscription_receiver(self, topic_name, subscription_name, **kwargs):
+        return FakeReceiver(self._broker, subscription_name)
+
+    def get_topic_sender(self, topic_name):
+        return FakeSender(self._broker)
+
+    async def close(self):
+        pass
+
+
+def get_rss_bytes() -> int:
+    """The current resident set size (falls back to the peak RSS where /proc isn't available)"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+class MemorySample:
+    settled: int
+    allocated_blocks: int
+    rss_bytes: int
+    traced_bytes: Optional[int]
+
+    def __init__(self, settled: int):
+        # collect garbage first so that only memory that is still referenced is counted
+        gc.collect()
+        self.settled = settled
+        self.allocated_blocks = sys.getallocatedblocks()
+        self.rss_bytes = get_rss_bytes()
+        self.traced_bytes = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+
+    def format(self) -> str:
+        traced = f"{self.traced_bytes / 2**20:.2f}" if self.traced_bytes is not None else "-"
+        return f"{self.settled:>12} {self.allocated_blocks:>12} {self.rss_bytes / 2**20:>10.1f} {traced:>12}"
+
+
+def get_growth(samples: list[MemorySample], attribute: str) -> float:
+    """The growth in the floor of a measure between the first and second halves of the samples
+
+    Samples taken mid-batch include the in-flight messages, so the minimum in each half is compared rather than
+    the first and last samples: leaks raise the floor, in-flight work doesn't.
+    """
+    middle = max(len(samples) // 2, 1)
+    return min(getattr(sample, attribute) for sample in samples[middle:]) - min(
+        getattr(sample, attribute) for sample in samples[:middle]
+    )
+
+
+async def run_soak(args) -> tuple:
+    """Run the soak, returning the samples, the baseline and final snapshots and the app's allocation report"""
+    total = args.messages
+    broker = FakeBroker(["SOAK_SUB_A", "SOAK_SUB_B"], total // 2)
+    total = sum(broker.remaining.values())
+    samples = []
+    snapshots = {}
+    report = None
+
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=FakeClient(broker)):
+        publisher = Publisher(topics=["bench-soak-published"], metrics=MetricsRegistry())
+        app = ConsumerApp(
+            default_subscription_name="SOAK_SUB_A",
+            max_message_count=args.batch_size,
+            max_wait_time=1,
+            metrics=MetricsRegistry(),
+            queue_logging=False,
+        )
+
+        @app.consume
+        async def on_bench_soak(message: BenchSoakStateChangeEvent):
+            await publisher.publish(BenchSoakPublishedStateChangeEvent(entity_id=message.entity_id))
+
+        @app.consume(topic_name="bench-soak", subscription_name="SOAK_SUB_B")
+        async def on_bench_soak_retry(message: BenchSoakStateChangeEvent):
+            if int(message.entity_id) % 100 == 0:
+                return ConsumerResult.RETRY
+            await asyncio.sleep(0)
+
+        async def monitor():
+            nonlocal report
+            next_sample_at = 0
+            warmup = int(total * args.warmup)
+            while broker.settled < total:
+                await asyncio.sleep(0.05)
+                if broker.settled < max(warmup, next_sample_at):
+                    continue
+                if len(samples) == 0 and tracemalloc.is_tracing():
+                    snapshots["baseline"] = tracemalloc.take_snapshot()
+                samples.append(MemorySample(broker.settled))
+                print(samples[-1].format(), flush=True)
+                next_sample_at = broker.settled + args.sample_every
+            samples.append(MemorySample(broker.settled))
+            print(samples[-1].format(), flush=True)
+            if tracemalloc.is_tracing():
+                snapshots["final"] = tracemalloc.take_snapshot()
+                report = app.get_allocation_report(limit=5)
+            app.cancel()
+
+        await publisher.start()
+        try:
+            await asyncio.gather(app.run(), monitor())
+        finally:
+            await publisher.close()
+
+    return samples, snapshots, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak ConsumerApp against a fake broker and check memory growth")
+    parser.add_argument("--messages", type=int, default=1_000_000, help="Total messages across both subscriptions")
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--warmup", type=float, default=0.1, help="Fraction of messages before the baseline")
+    parser.add_argument("--sample-every", type=int, default=100_000, help="Messages between memory samples")
+    parser.add_argument("--tracemalloc", action="store_true", help="Trace allocations to report growth by site")
+    parser.add_argument("--frames", type=int, default=10, help="tracemalloc frames per allocation")
+    parser.add_argument("--max-block-growth", type=int, default=50_000, help="Allowed growth in allocated blocks")
+    parser.add_argument("--max-rss-growth-mb", type=float, default=50, help="Allowed RSS growth (MiB)")
+    parser.add_argument("--max-traced-growth-mb", type=float, default=5, help="Allowed tracemalloc growth (MiB)")
+    args = parser.parse_args()
+
+    if args.tracemalloc:
+        start_allocation_tracing(args.frames)
+    print(f"{args.messages} messages, batch size {args.batch_size}, tracemalloc {'on' if args.tracemalloc else 'off'}")
+    print(f"{'settled':>12} {'blocks':>12} {'RSS (MiB)':>10} {'traced (MiB)':>12}")
+    start = timer()
+    samples, snapshots, report = asyncio.run(run_soak(args))
+    duration = timer() - start
+
+    final = samples[-1]
+    block_growth = get_growth(samples, "allocated_blocks")
+    rss_growth = get_growth(samples, "rss_bytes") / 2**20
+    print(f"{final.settled} messages in {duration:.1f}s ({final.settled / duration:.0f} messages/sec)")
+    print(f"Growth after warm-up: {block_growth:+} blocks, RSS {rss_growth:+.1f} MiB")
+    failed = block_growth > args.max_block_growth or rss_growth > args.max_rss_growth_mb
+    if args.tracemalloc:
+        traced_growth = get_growth(samples, "traced_bytes") / 2**20
+        print(f"Traced growth after warm-up: {traced_growth:+.2f} MiB")
+        failed = failed or traced_growth > args.max_traced_growth_mb
+
+    if failed and not args.tracemalloc:
+        print("Memory growth exceeded the threshold - run with --tracemalloc (and fewer messages) to find the sites")
+    elif failed:
+        print("Memory growth exceeded the threshold - top growth since the baseline:")
+        for statistic in snapshots["final"].compare_to(snapshots["baseline"], "lineno")[:10]:
+            print(f"  {statistic}")
+    if args.tracemalloc:
+        for key, sites in report["subscriptions"].items():
+            print(f"Top allocation sites for {key}:")
+            for site in sites:
+                print(f"  {site['site']}: {site['size_bytes'] / 1024:.1f} KiB in {site['count']} allocations")
+    print("FAILED" if failed else "PASSED")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import time
+
+_child_start = time.perf_counter()
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+#
+# Benchmark tracking cold start: the time to import pubsub (and ConsumerApp/Publisher) and the time from
+# process start to the first message being handled. Each measurement runs in a new interpreter.
+#
+# Usage (from src/subscriber-sdk-simplified): python -m benchmarks.bench_startup
+#
+
+MODES = ["import", "import-consumer", "import-publisher", "first-message"]
+
+
+def run_child(mode: str) -> dict:
+    """Run the measurement for mode in this process and return the timings in seconds"""
+    if mode == "import":
+        import pubsub
+
+        return {"import": time.perf_counter() - _child_start}
+
+    if mode == "import-consumer":
+        from pubsub import ConsumerApp
+
+        return {"import": time.perf_counter() - _child_start}
+
+    if mode == "import-publisher":
+        from pubsub import Publisher
+
+        return {"import": time.perf_counter() - _child_start}
+
+    # first-message
+    import asyncio
+    from unittest.mock import patch
+
+    from pubsub import ConsumerApp, MetricsRegistry
+    from pubsub.models import TaskCreatedStateChangeEvent
+
+    imported = time.perf_counter()
+
+    # the mock client is created up-front (importing the test helpers also imports the azure packages, as
+    # creating the real client would) - import time for it is included in the first message time
+    from pubsub.test_helpers import MockServiceBusClientBuilder
+
+    mock_sb_client = (
+        MockServiceBusClientBuilder()
+        .add_messages_for_topic_subscription("task-created", "BENCH_SUB", messages=['{"entity_id": "123"}'])
+        .build()
+    )
+    timings = {"import": imported - _child_start}
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        app = ConsumerApp(default_subscription_name="BENCH_SUB", metrics=MetricsRegistry())
+
+        @app.consume(max_wait_time=0.1)
+        async def on_task_created(message: TaskCreatedStateChangeEvent):
+            timings["first_message"] = time.perf_counter() - _child_start
+            app.cancel()
+
+        asyncio.run(app.run())
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10, help="Number of processes to start for each measurement")
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(args.child)))
+        return
+
+    print(f"{'measurement':<18} {'process (ms)':>13} {'import (ms)':>12} {'first message (ms)':>19}")
+    for mode in MODES:
+        process_times = []
+        results = []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_startup", "--child", mode],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            process_times.append(time.perf_counter() - start)
+            results.append(json.loads(output.strip().splitlines()[-1]))
+
+        def median_ms(values):
+            return f"{statistics.median(values) * 1000:.1f}" if values else "-"
+
+        print(
+            f"{mode:<18} {median_ms(process_times):>13} {median_ms([r['import'] for r in results]):>12} "
+            f"{median_ms([r['first_message'] for r in results if 'first_message' in r]):>19}"
+        )
+
+
+if __name__ == "__main__":
+    main()
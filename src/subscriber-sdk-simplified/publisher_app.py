@@ -1,34 +1,28 @@
-import asyncio
 import logging
 import sys
-import uuid
-from timeit import default_timer as timer
 
-from pubsub import models, publish
+from pubsub import loadgen
 
 #
-# This application demonstrates how the Service Bus SDK API could be abstracted to
-# provde a simplified dev experience for subscribing to messages through
-# the use of helper code and conventions.
+# This application publishes events to a topic using the pubsub Publisher.
+# It is a thin wrapper around the load generator (python -m pubsub.loadgen --help), which publishes
+# concurrently (open-loop at a fixed rate with --rate) and reports the send latency and achieved rate.
+#
+# Usage: python publisher_app.py <topic> <count> [--rate <sends/sec>] [--concurrency <n>] [--fake] ...
 #
 
 
 logging.basicConfig(level=logging.INFO)
 logging.getLogger("azure.servicebus._pyamqp.aio").setLevel(logging.WARNING)
-logging.getLogger("PubSub.ConsumerApp").setLevel(logging.DEBUG)
+# the publisher logs every publish at INFO, which would slow down the load generator
+logging.getLogger("pubsub.publisher").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 
 allowed_topics = ["task-created", "task-updated", "user-created"]
 
-topic_types = {
-    "task-created": models.TaskCreatedStateChangeEvent,
-    "task-updated": models.TaskUpdatedStateChangeEvent,
-    "user-created": models.UserCreatedStateChangeEvent,
-}
-
-if len(sys.argv) != 3:
-    print(f"ℹ  Usage: {sys.argv[0]} <{'|'.join(allowed_topics)}> <count>")
+if len(sys.argv) < 3 or sys.argv[1].startswith("-") or sys.argv[2].startswith("-"):
+    print(f"ℹ  Usage: {sys.argv[0]} <{'|'.join(allowed_topics)}> <count> [load generator options]")
     sys.exit(1)
 
 topic_name = sys.argv[1]
@@ -36,25 +30,6 @@ if topic_name not in allowed_topics:
     print(f"ℹ Invalid topic: {topic_name}")
     sys.exit(1)
 
-count = int(sys.argv[2])
-
-
-async def run_publish():
-    print(f"🏃 Publishing {count} message(s) to topic '{topic_name}'...")
-    start = timer()
-    for i in range(0, count):
-        # generate a new uuid
-        id = str(uuid.uuid4())
-        try:
-            message = topic_types[topic_name](entity_id=id)
-            await publish(message)
-            print(f"✅ Published message with id {id}")
-        except Exception as e:
-            print(f"ℹ❌ Failed to publish message. Error: {e}")
-
-    end = timer()
-    duration = end - start
-    print(f"👋 Done! (took {duration} seconds for {count} messages)")
-
+count = sys.argv[2]
 
-asyncio.run(run_publish())
+sys.exit(loadgen.main(["--topics", topic_name, "--count", count, *sys.argv[3:]]))
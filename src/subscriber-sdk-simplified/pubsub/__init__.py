@@ -1,5 +1,44 @@
-from .consumer_app import ConsumerApp as ConsumerApp
-from .consumer_app import ConsumerResult as ConsumerResult
-from .consumer_app import StateChangeEventBase as StateChangeEventBase
-from . import models as models
-from .publisher import publish as publish
+# Load config (and the .env file) before any other module reads settings
+from . import config as config
+
+# Exports are imported on first use (PEP 562) so that importing pubsub is cheap and, for example, a publisher
+# doesn't pay for importing the consumer (see benchmarks/bench_startup.py)
+_exports = {
+    # name: (module, attribute)
+    "ConsumerApp": (".consumer_app", "ConsumerApp"),
+    "ConsumerResult": (".events", "ConsumerResult"),
+    "StateChangeEventBase": (".events", "StateChangeEventBase"),
+    "field": (".filters", "field"),
+    "AutotuneConfig": (".autotune", "AutotuneConfig"),
+    "MetricsRegistry": (".metrics", "MetricsRegistry"),
+    "AsyncCache": (".cache", "AsyncCache"),
+    "models": (".models", None),
+    "event_loop": (".event_loop", None),
+    "Publisher": (".publisher", "Publisher"),
+    "publish": (".publisher", "publish"),
+    "close_default_publisher": (".publisher", "close_default_publisher"),
+    "SyncPublisher": (".sync_publisher", "SyncPublisher"),
+    "OutboxPublisher": (".outbox", "OutboxPublisher"),
+    "BlobStore": (".claim_check", "BlobStore"),
+    "LocalFileBlobStore": (".claim_check", "LocalFileBlobStore"),
+}
+
+__all__ = list(_exports.keys())
+
+
+def __getattr__(name: str):
+    export = _exports.get(name)
+    if export is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    import importlib
+
+    module_name, attribute = export
+    module = importlib.import_module(module_name, __name__)
+    value = module if attribute is None else getattr(module, attribute)
+    # cache on the package so that __getattr__ isn't called again for this name
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
@@ -0,0 +1,119 @@
+import inspect
+import logging
+import os
+import tracemalloc
+from typing import Optional
+
+ALLOCATION_TRACING = os.getenv("ALLOCATION_TRACING", "false").lower() == "true"
+ALLOCATION_TRACING_FRAMES = int(os.getenv("ALLOCATION_TRACING_FRAMES", "25"))
+ALLOCATION_REPORT_LIMIT = int(os.getenv("ALLOCATION_REPORT_LIMIT", "10"))
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_logger = logging.getLogger(__name__)
+
+
+def start_allocation_tracing(frames: Optional[int] = None) -> bool:
+    """Start tracing allocations with tracemalloc, returning False if allocations are already being traced
+
+    Tracing slows down allocation-heavy code and holds a traceback for every live allocation, so it is opt-in.
+
+    Args:
+        frames (Optional[int]): The number of frames to keep for each allocation (defaults to ALLOCATION_TRACING_FRAMES). Allocations are only attributed to a subscription if its handler is within this many frames of the allocation
+    """
+    if tracemalloc.is_tracing():
+        return False
+    tracemalloc.start(frames or ALLOCATION_TRACING_FRAMES)
+    _logger.info(f"🧮 Started allocation tracing ({tracemalloc.get_traceback_limit()} frames)")
+    return True
+
+
+def stop_allocation_tracing():
+    """Stop tracing allocations and free the traces"""
+    tracemalloc.stop()
+
+
+def _get_handler_lines(funcs: list) -> set:
+    """Get the (filename, line number) of each line in the bodies of the functions
+
+    The first line (the def or first decorator) is excluded as it is also the line that defines the function in the
+    enclosing scope, i.e. it would match allocations made when the handler is registered.
+    """
+    lines = set()
+    for func in funcs:
+        code = getattr(inspect.unwrap(func), "__code__", None)
+        if code is not None:
+            lines.update(
+                (code.co_filename, line)
+                for _, _, line in code.co_lines()
+                if line is not None and line != code.co_firstlineno
+            )
+    return lines
+
+
+def _to_allocation_sites(statistics: list[tracemalloc.Statistic], limit: int) -> list[dict]:
+    return [
+        {
+            "site": f"{statistic.traceback[0].filename}:{statistic.traceback[0].lineno}",
+            "size_bytes": statistic.size,
+            "count": statistic.count,
+        }
+        for statistic in statistics[:limit]
+    ]
+
+
+def _get_handler_allocation_sites(snapshot: tracemalloc.Snapshot, handlers: dict, limit: int) -> dict:
+    """Get the top allocation sites for the allocations made with each subscription's handlers on the stack
+
+    This matches the frames against a set of handler lines in a single pass rather than using tracemalloc filters,
+    which match every frame against every filter.
+    """
+    handler_lines = {key: _get_handler_lines(funcs) for key, funcs in handlers.items()}
+    sites = {key: {} for key in handlers}  # value: dict of [size, count] keyed on the allocation site
+    for trace in snapshot.traces:
+        frames = {(frame.filename, frame.lineno) for frame in trace.traceback}
+        for key, lines in handler_lines.items():
+            if frames.isdisjoint(lines):
+                continue
+            # the traceback is ordered from the oldest frame, so the allocation site is the last frame
+            frame = trace.traceback[-1]
+            site = sites[key].setdefault(f"{frame.filename}:{frame.lineno}", [0, 0])
+            site[0] += trace.size
+            site[1] += 1
+    return {
+        key: [
+            {"site": site, "size_bytes": size, "count": count}
+            for site, (size, count) in sorted(key_sites.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+        ]
+        for key, key_sites in sites.items()
+    }
+
+
+def get_allocation_report(
+    handlers: dict, limit: Optional[int] = None, snapshot: Optional[tracemalloc.Snapshot] = None
+) -> dict:
+    """Get the top allocation sites (by the size of the live allocations) overall, in pubsub and for each subscription
+
+    The allocations for a subscription are those made with one of its handlers on the stack.
+    Taking the snapshot blocks the event loop for a time proportional to the number of live allocations.
+
+    Args:
+        handlers (dict): The handler functions for each subscription, keyed on the subscription key
+        limit (Optional[int]): The number of allocation sites to include in each list (defaults to ALLOCATION_REPORT_LIMIT)
+        snapshot (Optional[tracemalloc.Snapshot]): The snapshot to report on (defaults to a new snapshot)
+    """
+    if not tracemalloc.is_tracing():
+        raise Exception("Allocation tracing hasn't been started (see start_allocation_tracing)")
+    limit = limit or ALLOCATION_REPORT_LIMIT
+    snapshot = (snapshot or tracemalloc.take_snapshot()).filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+    traced_bytes, peak_traced_bytes = tracemalloc.get_traced_memory()
+    pubsub_snapshot = snapshot.filter_traces([tracemalloc.Filter(True, os.path.join(_PACKAGE_DIR, "*"))])
+    return {
+        "traced_bytes": traced_bytes,
+        "peak_traced_bytes": peak_traced_bytes,
+        "all": _to_allocation_sites(snapshot.statistics("lineno"), limit),
+        "pubsub": _to_allocation_sites(pubsub_snapshot.statistics("lineno"), limit),
+        "subscriptions": _get_handler_allocation_sites(snapshot, handlers, limit),
+    }
@@ -0,0 +1,219 @@
+import collections
+import logging
+import math
+from typing import Optional
+
+from .metrics import MetricsRegistry
+
+_logger = logging.getLogger(__name__)
+
+
+class AutotuneConfig:
+    """AutotuneConfig holds the bounds and targets for an AutotuneController"""
+
+    min_batch_size: int
+    max_batch_size: int
+    target_p99_latency: Optional[float]
+    max_error_rate: float
+    additive_increase: int
+    multiplicative_decrease: float
+    tune_concurrency: bool
+    min_concurrency: int
+    max_concurrency: int
+    window_size: int
+
+    def __init__(
+        self,
+        min_batch_size: int = 1,
+        max_batch_size: int = 100,
+        target_p99_latency: Optional[float] = None,
+        max_error_rate: float = 0.05,
+        additive_increase: int = 1,
+        multiplicative_decrease: float = 0.5,
+        tune_concurrency: bool = False,
+        min_concurrency: int = 1,
+        max_concurrency: int = 100,
+        window_size: int = 200,
+    ):
+        """
+        Args:
+            min_batch_size (int): The smallest batch size the controller will use
+            max_batch_size (int): The largest batch size the controller will use
+            target_p99_latency (Optional[float]): The handler p99 latency (in seconds) above which the batch size is reduced. If None, latency is only used to detect throughput regressions
+            max_error_rate (float): The proportion of failed messages (RETRY or exception) above which the batch size is reduced
+            additive_increase (int): The amount the batch size is increased by when the subscription is healthy and batches are full
+            multiplicative_decrease (float): The factor the batch size is multiplied by when latency or errors are too high
+            tune_concurrency (bool): Whether to also tune the number of messages processed concurrently
+            min_concurrency (int): The smallest concurrency the controller will use (when tune_concurrency is set)
+            max_concurrency (int): The largest concurrency the controller will use (when tune_concurrency is set)
+            window_size (int): The number of recent handler latencies used to calculate the p99
+        """
+        if min_batch_size < 1 or max_batch_size < min_batch_size:
+            raise Exception("Autotune batch size bounds must satisfy 1 <= min_batch_size <= max_batch_size")
+        if min_concurrency < 1 or max_concurrency < min_concurrency:
+            raise Exception("Autotune concurrency bounds must satisfy 1 <= min_concurrency <= max_concurrency")
+        if not 0 < multiplicative_decrease < 1:
+            raise Exception("multiplicative_decrease must be between 0 and 1")
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_p99_latency = target_p99_latency
+        self.max_error_rate = max_error_rate
+        self.additive_increase = additive_increase
+        self.multiplicative_decrease = multiplicative_decrease
+        self.tune_concurrency = tune_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.window_size = window_size
+
+    def __eq__(self, other) -> bool:
+        # compared when several handlers share a subscription
+        return isinstance(other, AutotuneConfig) and vars(self) == vars(other)
+
+    def __repr__(self) -> str:
+        return f"AutotuneConfig({', '.join(f'{name}={value!r}' for name, value in vars(self).items())})"
+
+
+class AutotuneDecision:
+    """AutotuneDecision records a change made by an AutotuneController"""
+
+    batch_size: int
+    concurrency: Optional[int]
+    direction: str  # "increase", "decrease" or "hold"
+    reason: str
+
+    def __init__(self, batch_size: int, concurrency: Optional[int], direction: str, reason: str):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.direction = direction
+        self.reason = reason
+
+    def __repr__(self):
+        return f"AutotuneDecision(batch_size={self.batch_size}, concurrency={self.concurrency}, direction={self.direction}, reason={self.reason})"
+
+
+def percentile(values, p: float) -> float:
+    """Calculate the p-th percentile (0-100) of values using the nearest-rank method"""
+    ordered = sorted(values)
+    if len(ordered) == 0:
+        return 0
+    rank = max(math.ceil(p / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+class AutotuneController:
+    """AutotuneController adjusts the batch size (and optionally concurrency) for a subscription using AIMD
+
+    After each batch, the controller is given the batch outcome and decides whether to:
+    - decrease the batch size multiplicatively if the handler p99 latency or error rate exceed the configured targets
+    - decrease the batch size by one step if the last increase reduced throughput
+    - increase the batch size additively if the batch was full (i.e. there is more work waiting) and the subscription is healthy
+    - otherwise hold the current batch size
+    """
+
+    config: AutotuneConfig
+    batch_size: int
+    concurrency: Optional[int]
+    _latencies: collections.deque
+    _last_throughput: Optional[float]
+    _last_direction: str
+    _metrics: MetricsRegistry
+    _metric_labels: dict
+
+    def __init__(
+        self,
+        config: AutotuneConfig,
+        initial_batch_size: int,
+        metrics: MetricsRegistry,
+        metric_labels: Optional[dict] = None,
+    ):
+        self.config = config
+        self.batch_size = min(max(initial_batch_size, config.min_batch_size), config.max_batch_size)
+        self.concurrency = self.batch_size if config.tune_concurrency else None
+        if self.concurrency is not None:
+            self.concurrency = min(max(self.concurrency, config.min_concurrency), config.max_concurrency)
+        self._latencies = collections.deque(maxlen=config.window_size)
+        self._last_throughput = None
+        self._last_direction = "hold"
+        self._metrics = metrics
+        self._metric_labels = metric_labels or {}
+        self._export_settings()
+
+    def record_batch(
+        self, received_count: int, requested_count: int, duration: float, latencies: list[float], error_count: int
+    ) -> AutotuneDecision:
+        """Record the outcome of a batch and adjust the batch size/concurrency for the next receive
+
+        Args:
+            received_count (int): The number of messages received in the batch
+            requested_count (int): The max_message_count used for the receive
+            duration (float): The time in seconds taken to process the batch
+            latencies (list[float]): The handler latency in seconds for each message in the batch
+            error_count (int): The number of messages in the batch that failed (RETRY or exception)
+        """
+        self._latencies.extend(latencies)
+        throughput = received_count / duration if duration > 0 else 0
+        p99 = percentile(self._latencies, 99)
+        error_rate = error_count / received_count if received_count > 0 else 0
+
+        config = self.config
+        if error_rate > config.max_error_rate:
+            decision = self._decrease(f"error rate {error_rate:.2%} above {config.max_error_rate:.2%}")
+        elif config.target_p99_latency is not None and p99 > config.target_p99_latency:
+            decision = self._decrease(f"p99 latency {p99:.3f}s above target {config.target_p99_latency}s")
+            # discard the latencies that triggered the decrease so that the next decision reflects the new batch size
+            self._latencies.clear()
+        elif (
+            self._last_direction == "increase"
+            and self._last_throughput is not None
+            and throughput < self._last_throughput * 0.9
+        ):
+            decision = self._step_back(f"throughput fell from {self._last_throughput:.1f}/s to {throughput:.1f}/s")
+        elif received_count >= requested_count:
+            decision = self._increase(f"batch full at {throughput:.1f}/s")
+        else:
+            decision = AutotuneDecision(self.batch_size, self.concurrency, "hold", "batch not full")
+
+        self._last_throughput = throughput
+        self._last_direction = decision.direction
+
+        labels = self._metric_labels
+        self._metrics.set_gauge("autotune_handler_p99_seconds", p99, **labels)
+        self._metrics.set_gauge("autotune_throughput_messages_per_second", throughput, **labels)
+        self._metrics.set_gauge("autotune_error_rate", error_rate, **labels)
+        self._metrics.increment("autotune_decisions_total", direction=decision.direction, **labels)
+        self._export_settings()
+        if decision.direction != "hold":
+            _logger.info(f"🎛️ Autotune {labels}: {decision}")
+        else:
+            _logger.debug(f"🎛️ Autotune {labels}: {decision}")
+        return decision
+
+    def _decrease(self, reason: str) -> AutotuneDecision:
+        config = self.config
+        self.batch_size = max(int(self.batch_size * config.multiplicative_decrease), config.min_batch_size)
+        if self.concurrency is not None:
+            self.concurrency = max(int(self.concurrency * config.multiplicative_decrease), config.min_concurrency)
+        return AutotuneDecision(self.batch_size, self.concurrency, "decrease", reason)
+
+    def _step_back(self, reason: str) -> AutotuneDecision:
+        config = self.config
+        self.batch_size = max(self.batch_size - config.additive_increase, config.min_batch_size)
+        if self.concurrency is not None:
+            self.concurrency = max(self.concurrency - config.additive_increase, config.min_concurrency)
+        return AutotuneDecision(self.batch_size, self.concurrency, "decrease", reason)
+
+    def _increase(self, reason: str) -> AutotuneDecision:
+        config = self.config
+        if self.batch_size >= config.max_batch_size and (
+            self.concurrency is None or self.concurrency >= config.max_concurrency
+        ):
+            return AutotuneDecision(self.batch_size, self.concurrency, "hold", f"{reason}, at upper bound")
+        self.batch_size = min(self.batch_size + config.additive_increase, config.max_batch_size)
+        if self.concurrency is not None:
+            self.concurrency = min(self.concurrency + config.additive_increase, config.max_concurrency)
+        return AutotuneDecision(self.batch_size, self.concurrency, "increase", reason)
+
+    def _export_settings(self):
+        self._metrics.set_gauge("autotune_batch_size", self.batch_size, **self._metric_labels)
+        if self.concurrency is not None:
+            self._metrics.set_gauge("autotune_concurrency", self.concurrency, **self._metric_labels)
@@ -0,0 +1,198 @@
+import asyncio
+import collections
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from .metrics import MetricsRegistry, default_registry
+
+CACHE_TTL = float(os.getenv("CACHE_TTL", "60"))
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "10000"))
+
+_logger = logging.getLogger(__name__)
+
+
+def _retrieve_exception(future: asyncio.Future):
+    # retrieve the exception for loads whose waiters have all been cancelled (the error is raised from get)
+    future.cancelled() or future.exception()
+
+
+class AsyncCache:
+    """AsyncCache is an in-process cache for values loaded from a downstream service (e.g. the entity for an entity_id)
+
+    Values are kept for ttl seconds, with the least recently used values evicted once max_size is reached.
+    Concurrent misses for the same key share a single load (single-flight), so a batch of messages for the same
+    entity results in one lookup. With a batch_loader, the keys missed in the same event loop iteration (or within
+    batch_delay) are loaded with one call, e.g. so that a batch of messages issues one bulk lookup (DataLoader-style).
+
+    Hit, miss and coalesced (i.e. waited on a load started for another caller) counts are recorded as
+    cache_hits_total, cache_misses_total and cache_coalesced_total with a cache label.
+    """
+
+    name: str
+    _loader: Optional[Callable[[Hashable], Awaitable[Any]]]
+    _batch_loader: Optional[Callable[[list], Awaitable[dict]]]
+    _ttl: float
+    _max_size: int
+    _batch_delay: float
+    _max_batch_size: Optional[int]
+    _entries: collections.OrderedDict  # key: cache key, value: (monotonic expiry time, value)
+    _in_flight: dict  # key: cache key, value: asyncio.Future for the load
+    _pending_batch: dict  # key: cache key, value: asyncio.Future, for keys waiting for the next batch load
+    _dispatch_handle: Optional[asyncio.Handle]
+    _batch_tasks: set  # references to the running batch loads (the event loop only keeps weak references to tasks)
+    _metrics: MetricsRegistry
+
+    def __init__(
+        self,
+        name: str,
+        loader: Optional[Callable[[Hashable], Awaitable[Any]]] = None,
+        batch_loader: Optional[Callable[[list], Awaitable[dict]]] = None,
+        ttl: Optional[float] = None,
+        max_size: Optional[int] = None,
+        batch_delay: float = 0,
+        max_batch_size: Optional[int] = None,
+        metrics: Optional[MetricsRegistry] = None,
+    ):
+        """
+        Args:
+            name (str): The name of the cache (used as the cache label for metrics)
+            loader (Optional[Callable]): Async function to load the value for a key
+            batch_loader (Optional[Callable]): Async function to load the values for a list of keys, returning a dict keyed on key (keys missing from the dict load as None). Either loader or batch_loader must be given
+            ttl (Optional[float]): The time in seconds to keep values for (defaults to CACHE_TTL). With 0, values aren't cached but concurrent loads are still coalesced
+            max_size (Optional[int]): The maximum number of cached values (defaults to CACHE_MAX_SIZE)
+            batch_delay (float): How long in seconds to collect keys for a batch load (defaults to 0, i.e. the keys requested in the same event loop iteration)
+            max_batch_size (Optional[int]): The maximum number of keys in a batch load (defaults to no limit)
+            metrics (Optional[MetricsRegistry]): The registry to record cache metrics in
+        """
+        if (loader is None) == (batch_loader is None):
+            raise Exception("Exactly one of loader and batch_loader must be provided")
+        self.name = name
+        self._loader = loader
+        self._batch_loader = batch_loader
+        self._ttl = ttl if ttl is not None else CACHE_TTL
+        self._max_size = max_size or CACHE_MAX_SIZE
+        self._batch_delay = batch_delay
+        self._max_batch_size = max_batch_size
+        self._entries = collections.OrderedDict()
+        self._in_flight = {}
+        self._pending_batch = {}
+        self._dispatch_handle = None
+        self._batch_tasks = set()
+        self._metrics = metrics or default_registry
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def get(self, key: Hashable):
+        """Get the value for a key, loading it if it isn't cached (or has expired)"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self._metrics.increment("cache_hits_total", cache=self.name)
+                return value
+            del self._entries[key]
+
+        future = self._in_flight.get(key)
+        if future is not None:
+            self._metrics.increment("cache_coalesced_total", cache=self.name)
+        else:
+            self._metrics.increment("cache_misses_total", cache=self.name)
+            future = self._start_load(key)
+        # shield so that a cancelled caller doesn't cancel a load shared with other callers
+        return await asyncio.shield(future)
+
+    async def get_many(self, keys: list) -> dict:
+        """Get the values for several keys (loaded together when using a batch_loader), keyed on key"""
+        values = await asyncio.gather(*[self.get(key) for key in keys])
+        return dict(zip(keys, values))
+
+    def prime(self, key: Hashable, value):
+        """Add a value to the cache (e.g. a value included in a message, or returned by an update)"""
+        self._set(key, value)
+
+    def invalidate(self, key: Hashable):
+        """Remove the value for a key (a load in progress for the key isn't affected)"""
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def _set(self, key: Hashable, value):
+        if self._ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self._ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self._metrics.increment("cache_evictions_total", cache=self.name)
+        self._metrics.set_gauge("cache_size", len(self._entries), cache=self.name)
+
+    def _start_load(self, key: Hashable) -> asyncio.Future:
+        if self._loader is not None:
+            future = asyncio.ensure_future(self._load(key))
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._pending_batch[key] = future
+            if self._max_batch_size is not None and len(self._pending_batch) >= self._max_batch_size:
+                self._dispatch_batch()
+            elif self._dispatch_handle is None:
+                loop = asyncio.get_running_loop()
+                self._dispatch_handle = (
+                    loop.call_later(self._batch_delay, self._dispatch_batch)
+                    if self._batch_delay > 0
+                    else loop.call_soon(self._dispatch_batch)
+                )
+        future.add_done_callback(_retrieve_exception)
+        self._in_flight[key] = future
+        return future
+
+    async def _load(self, key: Hashable):
+        self._metrics.increment("cache_loads_total", cache=self.name)
+        try:
+            value = await self._loader(key)
+        except Exception:
+            self._metrics.increment("cache_load_failures_total", cache=self.name)
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+        self._set(key, value)
+        return value
+
+    def _dispatch_batch(self):
+        if self._dispatch_handle is not None:
+            self._dispatch_handle.cancel()
+            self._dispatch_handle = None
+        pending, self._pending_batch = self._pending_batch, {}
+        if pending:
+            task = asyncio.ensure_future(self._load_batch(pending))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _load_batch(self, pending: dict):
+        self._metrics.increment("cache_loads_total", cache=self.name)
+        self._metrics.observe(
+            "cache_batch_size", len(pending), buckets=[1, 2, 5, 10, 25, 50, 100, 250], cache=self.name
+        )
+        try:
+            values = await self._batch_loader(list(pending.keys()))
+        except asyncio.CancelledError:
+            for key, future in pending.items():
+                self._in_flight.pop(key, None)
+                future.cancel()
+            raise
+        except Exception as e:
+            self._metrics.increment("cache_load_failures_total", cache=self.name)
+            _logger.debug(f"Batch load failed for cache '{self.name}': {e!r}")
+            for key, future in pending.items():
+                self._in_flight.pop(key, None)
+                future.set_exception(e)
+            return
+        for key, future in pending.items():
+            self._in_flight.pop(key, None)
+            value = values.get(key)
+            self._set(key, value)
+            future.set_result(value)
@@ -0,0 +1,189 @@
+import asyncio
+import collections
+import logging
+import os
+import re
+from timeit import default_timer as timer
+from typing import Optional
+
+from .message_properties import get_application_property
+from .metrics import MetricsRegistry, default_registry
+
+CLAIM_CHECK_PROPERTY = "claim-check-key"
+"""The application property holding the blob store key for a message whose body has been offloaded"""
+
+CLAIM_CHECK_CACHE_MAX_BYTES = int(os.getenv("CLAIM_CHECK_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+CLAIM_CHECK_DELETE_ON_COMPLETE = os.getenv("CLAIM_CHECK_DELETE_ON_COMPLETE", "false").lower() == "true"
+
+_logger = logging.getLogger(__name__)
+
+_VALID_KEY = re.compile(r"^[A-Za-z0-9_.\-]+$")
+
+
+class BlobStore:
+    """BlobStore is the interface for the object store used to hold offloaded (claim-check) message bodies"""
+
+    async def put(self, key: str, data: bytes):
+        raise NotImplementedError()
+
+    async def get(self, key: str) -> bytes:
+        raise NotImplementedError()
+
+    async def delete(self, key: str):
+        """Delete a body (deleting a key that doesn't exist is not an error)"""
+        raise NotImplementedError()
+
+    async def close(self):
+        pass
+
+
+class LocalFileBlobStore(BlobStore):
+    """LocalFileBlobStore stores bodies as files in a local directory (e.g. for local dev, tests, or a shared volume)"""
+
+    _root_path: str
+
+    def __init__(self, root_path: str):
+        self._root_path = root_path
+        os.makedirs(root_path, exist_ok=True)
+
+    def _get_path(self, key: str) -> str:
+        # keys are generated by the publisher, but validate them as they are read from received messages
+        if not _VALID_KEY.match(key) or key.startswith("."):
+            raise Exception(f"Invalid blob key '{key}'")
+        return os.path.join(self._root_path, key)
+
+    def _write(self, path: str, data: bytes):
+        # write to a temporary file and rename so that readers never see a partial body
+        temp_path = path + ".tmp"
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def _read(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    async def put(self, key: str, data: bytes):
+        await asyncio.to_thread(self._write, self._get_path(key), data)
+
+    async def get(self, key: str) -> bytes:
+        return await asyncio.to_thread(self._read, self._get_path(key))
+
+    async def delete(self, key: str):
+        path = self._get_path(key)
+        try:
+            await asyncio.to_thread(os.remove, path)
+        except FileNotFoundError:
+            pass
+
+
+def get_claim_check_key(msg) -> Optional[str]:
+    """Get the blob store key for a message whose body has been offloaded (or None if the body is in the message)"""
+    return get_application_property(msg, CLAIM_CHECK_PROPERTY)
+
+
+class ClaimCheckResolver:
+    """ClaimCheckResolver fetches offloaded message bodies from a BlobStore
+
+    prefetch() starts fetching the bodies for a batch of messages concurrently, and get_body() waits for the body
+    of a single message (starting the fetch if it hasn't already been started). Concurrent requests for the same key
+    share a single fetch, and recently fetched bodies are kept in an LRU cache (bounded by total size in bytes).
+    If delete_on_complete is set, complete() deletes the body once its message has been completed.
+    """
+
+    _blob_store: BlobStore
+    _cache: collections.OrderedDict  # key: blob key, value: bytes
+    _cache_bytes: int
+    _cache_max_bytes: int
+    _in_flight: dict  # key: blob key, value: asyncio.Task
+    _delete_on_complete: bool
+    _metrics: MetricsRegistry
+
+    def __init__(
+        self,
+        blob_store: BlobStore,
+        cache_max_bytes: Optional[int] = None,
+        metrics: Optional[MetricsRegistry] = None,
+        delete_on_complete: Optional[bool] = None,
+    ):
+        """
+        Args:
+            blob_store (BlobStore): The store to fetch bodies from
+            cache_max_bytes (Optional[int]): The maximum total size of cached bodies (defaults to CLAIM_CHECK_CACHE_MAX_BYTES)
+            metrics (Optional[MetricsRegistry]): The registry to record fetch and cache metrics in
+            delete_on_complete (Optional[bool]): Delete bodies once their messages are completed (defaults to CLAIM_CHECK_DELETE_ON_COMPLETE)
+        """
+        self._blob_store = blob_store
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = 0
+        self._cache_max_bytes = cache_max_bytes if cache_max_bytes is not None else CLAIM_CHECK_CACHE_MAX_BYTES
+        self._in_flight = {}
+        self._delete_on_complete = (
+            delete_on_complete if delete_on_complete is not None else CLAIM_CHECK_DELETE_ON_COMPLETE
+        )
+        self._metrics = metrics or default_registry
+
+    def prefetch(self, messages: list):
+        """Start fetching the offloaded bodies for messages (messages without an offloaded body are ignored)"""
+        for msg in messages:
+            key = get_claim_check_key(msg)
+            if key is not None and key not in self._cache:
+                self._start_fetch(key)
+
+    def _start_fetch(self, key: str) -> asyncio.Task:
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(key))
+            # retrieve the exception for prefetches that are never awaited (the error is raised from get_body)
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+            self._in_flight[key] = task
+        return task
+
+    async def _fetch(self, key: str) -> bytes:
+        start = timer()
+        try:
+            data = await self._blob_store.get(key)
+        except Exception:
+            self._metrics.increment("claim_check_fetch_failures_total")
+            raise
+        finally:
+            self._in_flight.pop(key, None)
+        self._metrics.observe("claim_check_fetch_seconds", timer() - start)
+        self._add_to_cache(key, data)
+        return data
+
+    def _add_to_cache(self, key: str, data: bytes):
+        if len(data) > self._cache_max_bytes:
+            return
+        self._cache[key] = data
+        self._cache_bytes += len(data)
+        while self._cache_bytes > self._cache_max_bytes:
+            _, evicted = self._cache.popitem(last=False)
+            self._cache_bytes -= len(evicted)
+
+    async def get_body(self, key: str) -> bytes:
+        """Get an offloaded body, from the cache if it has been fetched recently"""
+        data = self._cache.get(key)
+        if data is not None:
+            self._cache.move_to_end(key)
+            self._metrics.increment("claim_check_cache_hits_total")
+            return data
+        self._metrics.increment("claim_check_cache_misses_total")
+        # shield so that a cancelled handler doesn't cancel a fetch shared with other handlers
+        return await asyncio.shield(self._start_fetch(key))
+
+    async def complete(self, key: str):
+        """Called once a message with an offloaded body has been completed (deletes the body if delete_on_complete)"""
+        if not self._delete_on_complete:
+            return
+        data = self._cache.pop(key, None)
+        if data is not None:
+            self._cache_bytes -= len(data)
+        try:
+            await self._blob_store.delete(key)
+        except Exception as e:
+            # the message has already been completed, so leave the body for the store's lifecycle policy to remove
+            _logger.warning(f"⚠️ Error deleting claim-check body '{key}': {e}")
+            self._metrics.increment("claim_check_delete_failures_total")
+            return
+        self._metrics.increment("claim_check_deletes_total")
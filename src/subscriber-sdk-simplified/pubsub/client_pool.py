@@ -0,0 +1,78 @@
+import logging
+import zlib
+from typing import Callable
+
+_logger = logging.getLogger(__name__)
+
+POOL_STRATEGIES = ["hash", "load"]
+
+
+class ServiceBusClientPool:
+    """ServiceBusClientPool spreads receivers/senders across several ServiceBusClient instances
+
+    Each ServiceBusClient has a single AMQP connection, so all of the links created from it share one socket and
+    one frame-processing path. Assigning keys (e.g. subscriptions or topics) across a pool of clients removes that
+    bottleneck on pods with multiple cores/high throughput.
+
+    Keys are assigned to a pool slot on first use and stay on that slot (even if the client in the slot is replaced):
+    - "hash": the slot is chosen from a stable hash of the key, so the assignment is the same across processes
+    - "load": the slot with the fewest keys assigned is chosen, giving an even spread within a process
+    """
+
+    _client_factory: Callable
+    _clients: list
+    _strategy: str
+    _assignments: dict  # key: assigned key, value: slot index
+
+    def __init__(self, client_factory: Callable, size: int = 1, strategy: str = "hash"):
+        if size < 1:
+            raise Exception("Service bus client pool size must be at least 1")
+        if strategy not in POOL_STRATEGIES:
+            raise Exception(
+                f"Unknown service bus client pool strategy '{strategy}' (expected one of {POOL_STRATEGIES})"
+            )
+        self._client_factory = client_factory
+        self._strategy = strategy
+        self._assignments = {}
+        self._clients = [client_factory() for _ in range(size)]
+        _logger.info(f"Created service bus client pool (size={size}, strategy={strategy})")
+
+    @property
+    def size(self) -> int:
+        return len(self._clients)
+
+    def _get_slot(self, key: str) -> int:
+        slot = self._assignments.get(key)
+        if slot is None:
+            if self._strategy == "hash":
+                slot = zlib.crc32(key.encode("utf-8")) % len(self._clients)
+            else:
+                loads = [0] * len(self._clients)
+                for assigned_slot in self._assignments.values():
+                    loads[assigned_slot] += 1
+                slot = loads.index(min(loads))
+            self._assignments[key] = slot
+        return slot
+
+    def get_client(self, key: str):
+        """Get the client to use for a key (e.g. "<topic-name>|<subscription-name>" or a topic name)"""
+        return self._clients[self._get_slot(key)]
+
+    def get_slot_loads(self) -> list[int]:
+        """Get the number of keys assigned to each slot in the pool"""
+        loads = [0] * len(self._clients)
+        for slot in self._assignments.values():
+            loads[slot] += 1
+        return loads
+
+    def reset_client(self, failed_client) -> bool:
+        """Replace failed_client with a new client. Returns False if the client is not in the pool (e.g. it has already been replaced)"""
+        for slot, client in enumerate(self._clients):
+            if client is failed_client:
+                self._clients[slot] = self._client_factory()
+                return True
+        return False
+
+    async def close(self):
+        for client in self._clients:
+            await client.close()
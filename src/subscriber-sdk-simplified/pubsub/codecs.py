@@ -0,0 +1,152 @@
+import json
+from typing import Optional, Union
+
+from pydantic import BaseModel
+from pydantic.json import pydantic_encoder
+
+from .compression import decompress, get_content_encoding
+
+# orjson and msgpack are optional - the codecs that use them are only registered if they are installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+DEFAULT_CONTENT_TYPE = "application/json"
+"""The content type assumed for messages that don't have a content_type (e.g. from other publishers)"""
+
+
+class Codec:
+    """Codec converts events to and from message bodies for a content type
+
+    name is used to select the codec when publishing (e.g. PUBLISHER_CODEC), content_type is stamped on
+    published messages and used by the consumer to pick the codec to decode with
+    """
+
+    name: str
+    content_type: str
+
+    def encode(self, message: BaseModel) -> Union[str, bytes]:
+        raise NotImplementedError()
+
+    def decode(self, body: bytes) -> dict:
+        raise NotImplementedError()
+
+
+class JsonCodec(Codec):
+    """JsonCodec encodes with pydantic's json() (the original wire format) and decodes with orjson when it is installed"""
+
+    name = "json"
+    content_type = "application/json"
+
+    def encode(self, message: BaseModel) -> str:
+        return message.json()
+
+    def decode(self, body: bytes) -> dict:
+        if orjson is not None:
+            return orjson.loads(body)
+        return json.loads(body)
+
+
+class OrjsonCodec(Codec):
+    """OrjsonCodec encodes compact JSON with orjson (decoded by any JSON decoder)"""
+
+    name = "orjson"
+    content_type = "application/json"
+
+    def encode(self, message: BaseModel) -> bytes:
+        return orjson.dumps(message.dict(), default=pydantic_encoder)
+
+    def decode(self, body: bytes) -> dict:
+        return orjson.loads(body)
+
+
+class MsgpackCodec(Codec):
+    """MsgpackCodec encodes binary MessagePack"""
+
+    name = "msgpack"
+    content_type = "application/msgpack"
+
+    def encode(self, message: BaseModel) -> bytes:
+        return msgpack.packb(message.dict(), default=pydantic_encoder)
+
+    def decode(self, body: bytes) -> dict:
+        return msgpack.unpackb(body, raw=False)
+
+
+_codecs_by_name = {}  # key: codec name, value: Codec
+_codecs_by_content_type = {}  # key: content type, value: Codec used to decode
+
+
+def register_codec(codec: Codec, decode_content_type: bool = True):
+    """Register a codec so that it can be selected by name for publishing
+
+    Args:
+        codec (Codec): The codec to register
+        decode_content_type (bool): Whether to use the codec to decode messages with its content_type (replacing any existing codec for the content type)
+    """
+    _codecs_by_name[codec.name] = codec
+    if decode_content_type:
+        _codecs_by_content_type[codec.content_type] = codec
+
+
+def get_codec(name: str) -> Codec:
+    """Get a registered codec by name"""
+    codec = _codecs_by_name.get(name)
+    if codec is None:
+        raise Exception(
+            f"Unknown codec '{name}' (registered codecs: {list(_codecs_by_name.keys())} - orjson and msgpack codecs require the orjson/msgpack packages)"
+        )
+    return codec
+
+
+def get_codec_for_content_type(content_type: Optional[str]) -> Codec:
+    """Get the codec to decode a message body with (messages without a content type are treated as JSON)"""
+    if not content_type:
+        content_type = DEFAULT_CONTENT_TYPE
+    else:
+        # ignore parameters such as "; charset=utf-8"
+        content_type = content_type.split(";", 1)[0].strip().lower()
+    codec = _codecs_by_content_type.get(content_type)
+    if codec is None:
+        raise Exception(f"No codec registered for content type '{content_type}'")
+    return codec
+
+
+def get_message_body_bytes(msg) -> bytes:
+    """Get the body of a received message as bytes"""
+    body = msg.body
+    if isinstance(body, bytes):
+        return body
+    if isinstance(body, str):
+        return body.encode("utf-8")
+    # data bodies are returned as an iterable of byte sections
+    return b"".join(body)
+
+
+def decode_message(msg, body: Optional[bytes] = None) -> dict:
+    """Decode the body of a received message using the codec for its content type (decompressing it first if needed)
+
+    Args:
+        msg: The received message
+        body (Optional[bytes]): The message body, if it isn't in the message itself (e.g. a claim-check body fetched from a blob store)
+    """
+    if body is None:
+        body = get_message_body_bytes(msg)
+    content_encoding = get_content_encoding(msg)
+    if content_encoding is not None:
+        body = decompress(body, content_encoding)
+    return get_codec_for_content_type(msg.content_type).decode(body)
+
+
+register_codec(JsonCodec())
+if orjson is not None:
+    # JsonCodec already decodes with orjson when it is installed
+    register_codec(OrjsonCodec(), decode_content_type=False)
+if msgpack is not None:
+    register_codec(MsgpackCodec())
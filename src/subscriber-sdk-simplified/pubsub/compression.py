@@ -0,0 +1,70 @@
+import gzip
+import threading
+from typing import Optional
+
+from .message_properties import get_application_property
+
+# zstandard is optional - zstd compression is only available if it is installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CONTENT_ENCODING_PROPERTY = "content-encoding"
+"""The application property used to flag the compression applied to a message body"""
+
+COMPRESSION_ALGORITHMS = ["none", "gzip", "zstd"]
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# zstandard compressor/decompressor objects are reusable but not thread-safe, so they are cached per thread
+_zstd_contexts = threading.local()
+
+
+def _get_zstd_compressor():
+    compressor = getattr(_zstd_contexts, "compressor", None)
+    if compressor is None:
+        compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        _zstd_contexts.compressor = compressor
+    return compressor
+
+
+def _get_zstd_decompressor():
+    decompressor = getattr(_zstd_contexts, "decompressor", None)
+    if decompressor is None:
+        decompressor = zstandard.ZstdDecompressor()
+        _zstd_contexts.decompressor = decompressor
+    return decompressor
+
+
+def validate_compression(algorithm: str):
+    """Raise an exception if the compression algorithm is unknown or not available"""
+    if algorithm not in COMPRESSION_ALGORITHMS:
+        raise Exception(f"Unknown compression '{algorithm}' (expected one of {COMPRESSION_ALGORITHMS})")
+    if algorithm == "zstd" and zstandard is None:
+        raise Exception("zstd compression requires the zstandard package")
+
+
+def compress(body: bytes, algorithm: str) -> bytes:
+    if algorithm == "gzip":
+        # mtime=0 so that the same body always compresses to the same bytes
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    if algorithm == "zstd":
+        return _get_zstd_compressor().compress(body)
+    raise Exception(f"Unsupported compression '{algorithm}'")
+
+
+def decompress(body: bytes, encoding: str) -> bytes:
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    if encoding == "zstd":
+        if zstandard is None:
+            raise Exception("Received a zstd compressed message but the zstandard package is not installed")
+        return _get_zstd_decompressor().decompress(body)
+    raise Exception(f"Unsupported content encoding '{encoding}'")
+
+
+def get_content_encoding(msg) -> Optional[str]:
+    """Get the compression flagged in a message's application properties (or None if the body isn't compressed)"""
+    return get_application_property(msg, CONTENT_ENCODING_PROPERTY)
@@ -0,0 +1,18 @@
+import os
+
+from dotenv import load_dotenv
+
+# Load the .env file once, before any settings are read (pubsub/__init__.py imports this module first so that
+# settings read by other modules at import time also see the values from the .env file)
+load_dotenv()
+
+# Service Bus connection settings (shared by ConsumerApp and Publisher)
+CONNECTION_STR = os.environ.get("SERVICE_BUS_CONNECTION_STRING")
+AZURE_CLIENT_ID = os.getenv("AZURE_CLIENT_ID", "")
+AZURE_TENANT_ID = os.getenv("AZURE_TENANT_ID", "")
+AZURE_AUTHORITY_HOST = os.getenv("AZURE_AUTHORITY_HOST", "")
+AZURE_FEDERATED_TOKEN_FILE = os.getenv("AZURE_FEDERATED_TOKEN_FILE", "")
+SERVICE_BUS_NAMESPACE = os.getenv("SERVICE_BUS_NAMESPACE", "")
+
+SERVICE_BUS_CLIENT_POOL_SIZE = int(os.getenv("SERVICE_BUS_CLIENT_POOL_SIZE", "1"))
+SERVICE_BUS_CLIENT_POOL_STRATEGY = os.getenv("SERVICE_BUS_CLIENT_POOL_STRATEGY", "hash")
@@ -1,111 +1,177 @@
 import asyncio
 import functools
 import inspect
-import jsons
+import json
 import logging
 import os
+import random
 import signal
-from enum import Enum
-from typing import Optional
-from azure.servicebus.aio import ServiceBusClient, AutoLockRenewer, ServiceBusReceiver
-from azure.servicebus import ServiceBusReceivedMessage
-from azure.identity.aio import WorkloadIdentityCredential
-from pydantic import BaseModel, parse_obj_as
+import time
+import typing
+from typing import Optional, Union
+from pydantic import parse_obj_as
 from timeit import default_timer as timer
 
 from . import case
-from dotenv import load_dotenv
-
-# TODO - refactor config storage/handling
-load_dotenv()
-
-CONNECTION_STR = os.environ.get("SERVICE_BUS_CONNECTION_STRING")
-AZURE_CLIENT_ID = os.getenv("AZURE_CLIENT_ID", "")
-AZURE_TENANT_ID = os.getenv("AZURE_TENANT_ID", "")
-AZURE_AUTHORITY_HOST = os.getenv("AZURE_AUTHORITY_HOST", "")
-AZURE_FEDERATED_TOKEN_FILE = os.getenv("AZURE_FEDERATED_TOKEN_FILE", "")
-SERVICE_BUS_NAMESPACE = os.getenv("SERVICE_BUS_NAMESPACE", "")
+from .allocations import ALLOCATION_TRACING, get_allocation_report, start_allocation_tracing
+from .autotune import AutotuneConfig, AutotuneController
+from .cache import AsyncCache
+from .claim_check import BlobStore, ClaimCheckResolver, get_claim_check_key
+from .client_pool import ServiceBusClientPool
+from .codecs import decode_message
+from .config import (
+    AZURE_AUTHORITY_HOST,
+    AZURE_CLIENT_ID,
+    AZURE_FEDERATED_TOKEN_FILE,
+    AZURE_TENANT_ID,
+    CONNECTION_STR,
+    SERVICE_BUS_CLIENT_POOL_SIZE,
+    SERVICE_BUS_CLIENT_POOL_STRATEGY,
+    SERVICE_BUS_NAMESPACE,
+)
+from .event_loop import run as run_on_event_loop
+from .events import EVENT_TYPE_PROPERTY, ConsumerResult, StateChangeEventBase, event_registry
+from .events import get_topic_name_from_event_class, get_topic_name_from_method
+from .filters import Filter, any_of, get_rule_name, to_filter, to_rule_filter
+from .health import HEALTH_PORT, HealthServer, SubscriptionHealth
+from .lock_renewal import LockRenewalScheduler
+from .log_pipeline import LOG_QUEUE, LogSampler, QueueLogging
+from .message_properties import DLQ_TARGET_SUBSCRIPTION_PROPERTY, get_application_properties, get_application_property
+from .metrics import MetricsRegistry, default_registry
+from .prefetch import PrefetchBuffer
+from .publisher import close_default_publisher
+from .runtime_config import RuntimeConfigWatcher, SUBSCRIPTION_SETTING_NAMES, validate_subscription_settings
+from .tracing import NOOP_TRACE, TRACEPARENT_PROPERTY, Tracer, get_default_tracer
+from .tracing import reset_current_traceparent, set_current_traceparent
 
 MAX_MESSAGE_COUNT = int(os.getenv("MAX_MESSAGE_COUNT", "10"))
 MAX_WAIT_TIME = int(os.getenv("MAX_WAIT_TIME", "30"))
 MAX_LOCK_RENEWAL_DURATION = int(os.getenv("MAX_LOCK_RENEWAL_DURATION", "300"))
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "0"))
+MAX_CONCURRENT_SESSIONS = int(os.getenv("MAX_CONCURRENT_SESSIONS", "8"))
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", "1"))
+PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", "0"))
 
-SUBSCRIBER_FILTER = os.getenv("SUBSCRIBER_FILTER", None)
-
-
-class ConsumerResult(Enum):
-    """ConsumerResult is used to indicate the result when a consumer processes a message"""
-
-    SUCCESS = 0
-    """The message was processed successfully and should be marked as completed"""
-
-    RETRY = 1
-    """The message was not processed successfully and should be marked as abandoned and retried"""
+RUNTIME_CONFIG_FILE = os.getenv("RUNTIME_CONFIG_FILE", None)
+AUTOTUNE = os.getenv("AUTOTUNE", "false").lower() == "true"
 
-    DROP = 2
-    """The message was not processed successfully but is invalid and should be sent to the dead-letter queue"""
+RECONNECT_INITIAL_BACKOFF = float(os.getenv("RECONNECT_INITIAL_BACKOFF", "1"))
+RECONNECT_MAX_BACKOFF = float(os.getenv("RECONNECT_MAX_BACKOFF", "60"))
+CLIENT_RESET_AFTER_FAILURES = int(os.getenv("CLIENT_RESET_AFTER_FAILURES", "5"))
 
+SUBSCRIBER_FILTER = os.getenv("SUBSCRIBER_FILTER", None)
+MANAGE_SUBSCRIPTION_RULES = os.getenv("MANAGE_SUBSCRIPTION_RULES", "true").lower() == "true"
 
-class StateChangeEventBase(BaseModel):
-    """StateChangeEventBase is the base type for state change events"""
 
-    entity_id: str
+class SubscriptionHandler:
+    """SubscriptionHandler is a handler function registered for a subscription"""
 
-    def get_event_classes():
-        event_classes = []
-        StateChangeEventBase._append_event_classes_for_type(event_classes, StateChangeEventBase)
-        return event_classes
+    func: callable
+    func_name: str
+    payload_types: Optional[list]  # None (any event class for the topic), [dict] or a list of event classes
+    filter: Optional[Filter]  # messages that don't match the filter aren't passed to the handler
+    dependencies: list[str]  # the names of the arguments after the notification (see ConsumerApp.add_dependency)
 
-    def _append_event_classes_for_type(event_classes, type):
-        for event_class in type.__subclasses__():
-            if not event_class.__name__.endswith("Base"):
-                event_classes.append(event_class)
-            StateChangeEventBase._append_event_classes_for_type(event_classes, event_class)
+    def __init__(
+        self,
+        func: callable,
+        func_name: str,
+        payload_types: Optional[list] = None,
+        filter: Optional[Filter] = None,
+        dependencies: Optional[list[str]] = None,
+    ):
+        self.func = func
+        self.func_name = func_name
+        self.payload_types = payload_types
+        self.filter = filter
+        self.dependencies = dependencies or []
 
 
 class Subscription:
     topic: str
     subscription_name: str
-    handler: callable
+    handlers: list[SubscriptionHandler]  # messages are passed to all of the handlers for the subscription
     max_message_count: Optional[int]
     max_wait_time: Optional[int]
-    func_name: str
+    max_lock_renewal_duration: Optional[int]
+    max_concurrency: Optional[int]
+    autotune: Union[AutotuneConfig, bool, None]  # False to disable autotune, None for the app's default
+    sessions: Optional[bool]  # receive from a session-enabled subscription, processing each session in order
+    max_concurrent_sessions: Optional[int]
+    # the maximum number of messages to receive ahead of the handlers (see PrefetchBuffer), 0 to disable
+    prefetch_count: Optional[int]
+    runtime_overrides: dict  # key: setting name, value: override applied while running (see RuntimeConfigWatcher)
+    autotune_controller: Optional[AutotuneController]  # set while the subscription is being processed with autotune
+    rule_applied: bool  # set once the subscription rule for the handler filters has been applied (or attempted)
+    health: SubscriptionHealth  # receiver state, lag and throughput (see the HealthServer)
 
     def __init__(
         self,
         topic: str,
         subscription_name,
-        handler: callable,
-        func_name: str,
+        handlers: list[SubscriptionHandler],
         max_message_count: Optional[int] = None,
         max_wait_time: Optional[int] = None,
         max_lock_renewal_duration: Optional[int] = None,
+        max_concurrency: Optional[int] = None,
+        autotune: Union[AutotuneConfig, bool, None] = None,
+        sessions: Optional[bool] = None,
+        max_concurrent_sessions: Optional[int] = None,
+        prefetch_count: Optional[int] = None,
     ):
         self.topic = topic
         self.subscription_name = subscription_name
-        self.handler = handler
-        self.func_name = func_name
+        self.handlers = handlers
         self.max_message_count = max_message_count
         self.max_wait_time = max_wait_time
         self.max_lock_renewal_duration = max_lock_renewal_duration
+        self.max_concurrency = max_concurrency
+        self.autotune = autotune
+        self.sessions = sessions
+        self.max_concurrent_sessions = max_concurrent_sessions
+        self.prefetch_count = prefetch_count
+        self.runtime_overrides = {}
+        self.autotune_controller = None
+        self.rule_applied = False
+        self.health = SubscriptionHealth()
+
+    @property
+    def func_name(self) -> str:
+        """The names of the handler functions (for logging)"""
+        return ", ".join(handler.func_name for handler in self.handlers)
+
+    @property
+    def filter(self) -> Optional[Filter]:
+        """The filter for the messages to deliver to the subscription (None if any handler has no filter)"""
+        if any(handler.filter is None for handler in self.handlers):
+            return None
+        return any_of([handler.filter for handler in self.handlers])
+
+    @property
+    def key(self):
+        """The key used to identify the subscription in filters and runtime config, i.e. <topic-name>|<subscription-name>"""
+        return f"{self.topic}|{self.subscription_name}"
+
+
+class SubscriptionSettings:
+    """SubscriptionSettings holds the effective receive settings for a subscription at a point in time"""
+
+    max_message_count: int
+    max_wait_time: int
+    max_lock_renewal_duration: int
+    max_concurrency: Optional[int]
 
-
-def get_topic_name_from_method(func):
-    function_name = func.__name__
-    if not function_name.startswith("on_"):
-        raise Exception(f"Function name must be in the form on_<entity-name>_<event-name>")
-    topic_name = case.snake_to_kebab_case(function_name[3:])
-    return topic_name
-
-
-def get_topic_name_from_event_class(event_class):
-    event_class_name = event_class.__name__
-    if not event_class_name.endswith("StateChangeEvent"):
-        raise Exception(f"Event class name must end with StateChangeEvent")
-
-    topic_name = event_class_name.replace("StateChangeEvent", "")
-
-    return case.pascal_to_kebab_case(topic_name)
+    def __init__(
+        self,
+        max_message_count: int,
+        max_wait_time: int,
+        max_lock_renewal_duration: int,
+        max_concurrency: Optional[int] = None,
+    ):
+        self.max_message_count = max_message_count
+        self.max_wait_time = max_wait_time
+        self.max_lock_renewal_duration = max_lock_renewal_duration
+        self.max_concurrency = max_concurrency
 
 
 class ConsumerApp:
@@ -116,10 +182,38 @@ class ConsumerApp:
     _default_subscription_name: str
     _logger: logging.Logger
     _payload_type_converters: dict
-    _topic_to_event_class_map: dict
     _default_max_message_count: int
     _default_max_wait_time: int
     _default_max_lock_renewal_duration: int
+    _default_max_concurrency: int
+    _default_max_concurrent_sessions: int
+    _default_prefetch_count: int
+    _session_idle_timeout: float
+    _runtime_default_overrides: dict
+    _runtime_config_file: Optional[str]
+    _default_autotune: Optional[AutotuneConfig]
+    _lock_renewal_scheduler: Optional[LockRenewalScheduler]
+    _cancelled_event: asyncio.Event
+    _credential: Optional["WorkloadIdentityCredential"]
+    _client_pool: Optional[ServiceBusClientPool]
+    _client_pool_size: int
+    _client_pool_strategy: str
+    _reconnect_initial_backoff: float
+    _reconnect_max_backoff: float
+    _client_reset_after_failures: int
+    _claim_check_resolver: Optional[ClaimCheckResolver]
+    _manage_subscription_rules: bool
+    _queue_logging: Optional[QueueLogging]
+    _message_log_sampler: LogSampler
+    _tracer: Tracer
+    _health_port: Optional[int]
+    _event_loop: Optional[str]
+    _running_subscriptions: list[Subscription]
+    _active_session_counts: dict  # key: subscription key, value: number of sessions currently accepted
+    _allocation_tracing: bool
+    _dependencies: dict  # key: handler argument name, value: the value to pass (see add_dependency)
+    health_server: Optional[HealthServer]
+    metrics: MetricsRegistry
 
     def __init__(
         self,
@@ -127,6 +221,27 @@ class ConsumerApp:
         max_message_count: int = None,
         max_wait_time: int = None,
         max_lock_renewal_duration: int = None,
+        max_concurrency: int = None,
+        runtime_config_file: str = None,
+        autotune: Optional[AutotuneConfig] = None,
+        metrics: Optional[MetricsRegistry] = None,
+        reconnect_initial_backoff: Optional[float] = None,
+        reconnect_max_backoff: Optional[float] = None,
+        client_reset_after_failures: Optional[int] = None,
+        client_pool_size: Optional[int] = None,
+        client_pool_strategy: Optional[str] = None,
+        blob_store: Optional[BlobStore] = None,
+        claim_check_delete_on_complete: Optional[bool] = None,
+        manage_subscription_rules: Optional[bool] = None,
+        queue_logging: Optional[bool] = None,
+        message_log_sampler: Optional[LogSampler] = None,
+        tracer: Optional[Tracer] = None,
+        health_port: Optional[int] = None,
+        event_loop: Optional[str] = None,
+        max_concurrent_sessions: Optional[int] = None,
+        session_idle_timeout: Optional[float] = None,
+        allocation_tracing: Optional[bool] = None,
+        prefetch_count: Optional[int] = None,
     ):
         self._logger = logging.getLogger(__name__)
         self._logger.info("SubscriberApp initialized")
@@ -140,19 +255,51 @@ class ConsumerApp:
         self._default_max_message_count = max_message_count or MAX_MESSAGE_COUNT
         self._default_max_wait_time = max_wait_time or MAX_WAIT_TIME
         self._default_max_lock_renewal_duration = max_lock_renewal_duration or MAX_LOCK_RENEWAL_DURATION
-
-        self._init_event_classes()
-
-    def _init_event_classes(self):
-        event_classes = StateChangeEventBase.get_event_classes()
-
-        self._topic_to_event_class_map = {
-            get_topic_name_from_event_class(event_class): event_class for event_class in event_classes
-        }
-
-        for event_class in event_classes:
+        self._default_max_concurrency = max_concurrency or MAX_CONCURRENCY
+        self._default_max_concurrent_sessions = max_concurrent_sessions or MAX_CONCURRENT_SESSIONS
+        self._session_idle_timeout = session_idle_timeout or SESSION_IDLE_TIMEOUT
+        self._default_prefetch_count = prefetch_count if prefetch_count is not None else PREFETCH_COUNT
+        self._runtime_default_overrides = {}
+        self._runtime_config_file = runtime_config_file or RUNTIME_CONFIG_FILE
+        self._default_autotune = autotune or (AutotuneConfig() if AUTOTUNE else None)
+        self.metrics = metrics or default_registry
+        self._lock_renewal_scheduler = None
+        self._cancelled_event = asyncio.Event()
+        self._credential = None
+        self._client_pool = None
+        self._client_pool_size = client_pool_size or SERVICE_BUS_CLIENT_POOL_SIZE
+        self._client_pool_strategy = client_pool_strategy or SERVICE_BUS_CLIENT_POOL_STRATEGY
+        self._reconnect_initial_backoff = reconnect_initial_backoff or RECONNECT_INITIAL_BACKOFF
+        self._reconnect_max_backoff = reconnect_max_backoff or RECONNECT_MAX_BACKOFF
+        self._client_reset_after_failures = client_reset_after_failures or CLIENT_RESET_AFTER_FAILURES
+        self._claim_check_resolver = (
+            ClaimCheckResolver(blob_store, metrics=self.metrics, delete_on_complete=claim_check_delete_on_complete)
+            if blob_store is not None
+            else None
+        )
+        self._manage_subscription_rules = (
+            manage_subscription_rules if manage_subscription_rules is not None else MANAGE_SUBSCRIPTION_RULES
+        )
+        # while running, pubsub log records are handled on a separate thread rather than on the event loop
+        self._queue_logging = QueueLogging() if (queue_logging if queue_logging is not None else LOG_QUEUE) else None
+        self._message_log_sampler = message_log_sampler or LogSampler()
+        self._tracer = tracer or get_default_tracer()
+        self._health_port = health_port if health_port is not None else HEALTH_PORT
+        self._event_loop = event_loop
+        self._running_subscriptions = []
+        self._active_session_counts = {}
+        self._allocation_tracing = allocation_tracing if allocation_tracing is not None else ALLOCATION_TRACING
+        self._dependencies = {}
+        self.health_server = None
+
+        for event_class in event_registry.get_event_classes():
             self._logger.info(f"🔎 Found state event class: {event_class}")
 
+    @property
+    def _topic_to_event_class_map(self) -> dict:
+        """The default event class for each topic (kept up to date as event classes are defined)"""
+        return event_registry.get_default_event_classes()
+
     def _get_event_class_from_method(self, func):
         topic_name = get_topic_name_from_method(func)
         return self._topic_to_event_class_map[topic_name]
@@ -160,13 +307,74 @@ class ConsumerApp:
     def _get_payload_type_from_method(self, func):
         argspec = inspect.getfullargspec(func)
 
-        # For simplicity currently, limit to a single argument that is the notification payload
-        if len(argspec.args) != 1:
-            raise Exception("Function must have exactly one argument (the notification)")
+        # The first argument is the notification payload, any others are dependencies (see add_dependency)
+        if len(argspec.args) == 0:
+            raise Exception("Function must have at least one argument (the notification)")
 
         event_class = argspec.annotations.get(argspec.args[0], None)
         return event_class
 
+    def _get_dependencies_from_method(self, func) -> list[str]:
+        argspec = inspect.getfullargspec(func)
+        return argspec.args[1:] + argspec.kwonlyargs
+
+    def add_dependency(self, name: str, value):
+        """Register a value to pass to handlers that have an argument with the given name (after the notification)
+
+        For example, after app.add_dependency("task_client", client), a handler declared as
+        on_task_created(notification: TaskCreatedStateChangeEvent, task_client) is called with the client.
+        """
+        self._dependencies[name] = value
+
+    def add_cache(
+        self,
+        name: str,
+        loader: Optional[typing.Callable] = None,
+        batch_loader: Optional[typing.Callable] = None,
+        **kwargs,
+    ) -> AsyncCache:
+        """Create an AsyncCache and register it as a dependency for handlers with an argument with the given name
+
+        Args:
+            name (str): The handler argument name (and the cache label for the cache metrics)
+            loader (Optional[Callable]): Async function to load the value for a key
+            batch_loader (Optional[Callable]): Async function to load the values for a list of keys, so that the keys missed by a batch of messages are loaded with one call
+            **kwargs: Other AsyncCache options (ttl, max_size, batch_delay, max_batch_size)
+        """
+        cache = AsyncCache(name, loader=loader, batch_loader=batch_loader, metrics=self.metrics, **kwargs)
+        self.add_dependency(name, cache)
+        return cache
+
+    def _validate_dependencies(self, subscriptions: list[Subscription]):
+        """Check that there is a registered dependency for each handler argument without a default value"""
+        for subscription in subscriptions:
+            for handler in subscription.handlers:
+                parameters = inspect.signature(handler.func).parameters
+                for name in handler.dependencies:
+                    if name not in self._dependencies and parameters[name].default is inspect.Parameter.empty:
+                        raise Exception(
+                            f"No dependency registered for argument '{name}' of {handler.func_name} (see add_dependency)"
+                        )
+
+    def _get_payload_types_from_method(self, func, topic_name: str) -> Optional[list]:
+        """Get the payload types accepted by a handler: None (any event class for the topic), [dict] or a list of event classes"""
+        payload_type = self._get_payload_type_from_method(func)
+        if payload_type is None:
+            return None
+        if payload_type is dict:
+            return [dict]
+        # a Union annotation accepts several event classes for the topic (e.g. schema versions)
+        payload_types = (
+            list(typing.get_args(payload_type)) if typing.get_origin(payload_type) is Union else [payload_type]
+        )
+        topic_event_classes = event_registry.get_event_classes_for_topic(topic_name)
+        for event_class in payload_types:
+            if event_class not in topic_event_classes:
+                raise Exception(
+                    f"Unsupported payload type: {event_class} is not an event class for topic '{topic_name}'"
+                )
+        return payload_types
+
     def consume(
         self,
         func=None,
@@ -176,6 +384,12 @@ class ConsumerApp:
         max_message_count: Optional[int] = None,
         max_wait_time: Optional[int] = None,
         max_lock_renewal_duration: Optional[int] = None,
+        max_concurrency: Optional[int] = None,
+        autotune: Union[bool, AutotuneConfig, None] = None,
+        filter: Union[Filter, dict, None] = None,
+        sessions: Optional[bool] = None,
+        max_concurrent_sessions: Optional[int] = None,
+        prefetch_count: Optional[int] = None,
     ):
         """Decorator for consuming messages from a Service Bus topic/subscription
 
@@ -183,6 +397,27 @@ class ConsumerApp:
         For this, the function name should be in the for on_<entity-name>_<event-name>, e.g. on_task_created.
 
         Alternatively, the topic and subscription names can be provided as arguments to the decorator.
+
+        max_concurrency limits the number of messages from a batch that are processed at the same time
+        (defaults to processing the whole batch concurrently).
+
+        autotune enables automatic adjustment of the batch size (and optionally concurrency) based on observed
+        handler latency, throughput and errors. Pass True to use the app's autotune config (or the default config),
+        an AutotuneConfig to customise the bounds, or False to disable autotune when it is enabled for the app.
+
+        filter limits the messages passed to the handler, e.g. field("status") == "open" (see pubsub.filters), or a
+        dict of field values to match. The filter is applied as a subscription rule so that the broker only delivers
+        matching messages, provided that the fields are listed in promoted_fields on the event class (so that publishers
+        send them as application properties). Otherwise the filter is only evaluated in-process.
+
+        sessions receives from a session-enabled subscription: up to max_concurrent_sessions sessions (defaults to
+        MAX_CONCURRENT_SESSIONS) are accepted at a time and the messages for each session are handled one at a time,
+        in order. A session is released once no messages are received for it within SESSION_IDLE_TIMEOUT so that
+        the next available session can be accepted. The Publisher sets the session id to the event's entity_id.
+
+        prefetch_count enables receiving messages ahead of the handlers into a local buffer of up to prefetch_count
+        messages (defaults to PREFETCH_COUNT, 0 to disable), so the next batch is ready when the handlers finish the
+        current one. The buffer depth adapts to the handler throughput and the lock duration (see PrefetchBuffer).
         """
 
         @functools.wraps(func)
@@ -192,9 +427,20 @@ class ConsumerApp:
 
             # Generate Subscription to capture func ready for use in run() later
             subscription = self._get_subscription_from_method(
-                func, topic_name, subscription_name, max_message_count, max_wait_time, max_lock_renewal_duration
+                func,
+                topic_name,
+                subscription_name,
+                max_message_count,
+                max_wait_time,
+                max_lock_renewal_duration,
+                max_concurrency,
+                autotune,
+                filter,
+                sessions,
+                max_concurrent_sessions,
+                prefetch_count,
             )
-            self._subscriptions.append(subscription)
+            self._add_subscription(subscription)
             return func
 
         if func is None:
@@ -212,6 +458,12 @@ class ConsumerApp:
         max_message_count: Optional[int] = None,
         max_wait_time: Optional[int] = None,
         max_lock_renewal_duration: Optional[int] = None,
+        max_concurrency: Optional[int] = None,
+        autotune: Union[bool, AutotuneConfig, None] = None,
+        filter: Union[Filter, dict, None] = None,
+        sessions: Optional[bool] = None,
+        max_concurrent_sessions: Optional[int] = None,
+        prefetch_count: Optional[int] = None,
     ):
         notification_type = get_topic_name_from_method(func)
 
@@ -222,106 +474,849 @@ class ConsumerApp:
             topic_name = notification_type
             self._logger.debug(f"topic_name not set, using topic_name from function name: {topic_name}")
 
-        event_class = self._topic_to_event_class_map.get(topic_name, None)
-        if event_class is None:
+        if len(event_registry.get_event_classes_for_topic(topic_name)) == 0:
             raise Exception(f"No event class found to match topic name '{topic_name}'")
+        filter = to_filter(filter)
+        handler = SubscriptionHandler(
+            func,
+            func.__qualname__,
+            payload_types=self._get_payload_types_from_method(func, topic_name),
+            filter=filter,
+            dependencies=self._get_dependencies_from_method(func),
+        )
 
         self._logger.info(
             f"🔎 Found consumer {func.__qualname__} (topic={topic_name}, subscription={subscription_name}"
         )
 
-        async def wrap_handler(receiver: ServiceBusReceiver, msg: ServiceBusReceivedMessage):
-            # Convert message to correct payload type
-            parsed_message = jsons.loads(str(msg), dict)
-            payload_type = self._get_payload_type_from_method(func)
-            if payload_type is dict:
-                payload = parsed_message
-            elif payload_type is None or payload_type is event_class:
-                payload = parse_obj_as(event_class, parsed_message)
-            else:
-                raise Exception(f"Unsupported payload type: {payload_type}")
+        # the app's default is applied when the subscription is processed (see _get_autotune_config) so that
+        # autotune=False on any of the handlers for a subscription disables it
+        autotune_config = (self._default_autotune or AutotuneConfig()) if autotune is True else autotune
 
-            try:
-                # Call the decorated function
-                result = await func(payload)
-
-                # Handle the response
-                if result == ConsumerResult.RETRY:
-                    self._logger.info(f"Handler returned RETRY ({msg.message_id}) - abandoning")
-                    await receiver.abandon_message(msg)
-                elif result == ConsumerResult.DROP:
-                    self._logger.info(f"Handler returned DROP ({msg.message_id}) - deadlettering")
-                    await receiver.dead_letter_message(msg, reason="dropped by subscriber")
-                else:
-                    # Other return values are treated as success
-                    self._logger.info(f"Handler returned successfully ({msg.message_id}) - completing")
-                    await receiver.complete_message(msg)
-            except Exception as e:
-                self._logger.info(f"Error processing message ({msg.message_id}) - abandoning: {e}")
-                await receiver.abandon_message(msg)
-
-        func_name = func.__qualname__
         subscription = Subscription(
             topic=topic_name,
             subscription_name=subscription_name,
-            handler=wrap_handler,
-            func_name=func_name,
+            handlers=[handler],
             max_message_count=max_message_count,
             max_wait_time=max_wait_time,
             max_lock_renewal_duration=max_lock_renewal_duration,
+            max_concurrency=max_concurrency,
+            autotune=autotune_config,
+            sessions=sessions,
+            max_concurrent_sessions=max_concurrent_sessions,
+            prefetch_count=prefetch_count,
         )
         return subscription
 
-    async def _process_subscription(self, servicebus_client: ServiceBusClient, subscription: Subscription):
-        # AutoLockRenewer performs message lock renewal (for long message processing)
-        max_message_count = subscription.max_message_count or self._default_max_message_count
-        max_wait_time = subscription.max_wait_time or self._default_max_wait_time
-        max_lock_renewal_duration = subscription.max_lock_renewal_duration or self._default_max_lock_renewal_duration
+    def _add_subscription(self, subscription: Subscription):
+        """Add a subscription, or add its handler to the existing subscription for the same topic/subscription
+
+        Handlers that share a topic/subscription share a receiver: each message is received and decoded once and
+        passed to all of the handlers. Settings given for the later handlers must match those already set.
+        """
+        existing = next((s for s in self._subscriptions if s.key == subscription.key), None)
+        if existing is None:
+            self._subscriptions.append(subscription)
+            return
+
+        for name in [
+            "max_message_count",
+            "max_wait_time",
+            "max_lock_renewal_duration",
+            "max_concurrency",
+            "autotune",
+            "sessions",
+            "max_concurrent_sessions",
+            "prefetch_count",
+        ]:
+            value = getattr(subscription, name)
+            current = getattr(existing, name)
+            if value is None or value is current:
+                continue
+            if current is None:
+                setattr(existing, name, value)
+            elif value != current:
+                raise Exception(
+                    f"Conflicting {name} for {subscription.func_name} on subscription '{subscription.key}' "
+                    + f"(already set to {current} for {existing.func_name})"
+                )
+        existing.handlers.extend(subscription.handlers)
+        self._logger.info(f"🔎 Subscription '{existing.key}' is shared by {existing.func_name}")
+
+    def _log_message(self, level: int, subscription: Subscription, msg, message: str, *args, sampled: bool = True):
+        """Log a per-message (or per-batch) record, sampled and rate limited by the app's LogSampler
+
+        message is %-formatted with args when the record is handled (i.e. on the log queue thread when queue logging
+        is enabled), and the topic, subscription and message_id are added to the record as fields.
+        """
+        if not self._logger.isEnabledFor(level) or not self._message_log_sampler.allow(sampled):
+            return
+        suppressed_count = self._message_log_sampler.take_suppressed_count()
+        if suppressed_count:
+            message += " [%d similar records suppressed]"
+            args = args + (suppressed_count,)
+        self._logger.log(
+            level,
+            message,
+            *args,
+            extra={
+                "topic": subscription.topic,
+                "subscription": subscription.subscription_name,
+                "message_id": msg.message_id if msg is not None else None,
+            },
+        )
+
+    async def _call_handler(
+        self, subscription: Subscription, handler: "SubscriptionHandler", payload, msg
+    ) -> ConsumerResult:
+        """Call a handler function and convert its return value (or exception) to a ConsumerResult"""
+        try:
+            if handler.dependencies:
+                dependencies = {
+                    name: self._dependencies[name] for name in handler.dependencies if name in self._dependencies
+                }
+                result = await handler.func(payload, **dependencies)
+            else:
+                result = await handler.func(payload)
+        except Exception as e:
+            self._log_message(
+                logging.INFO,
+                subscription,
+                msg,
+                "Error in handler %s (%s): %s",
+                handler.func_name,
+                msg.message_id,
+                e,
+                sampled=False,
+            )
+            return ConsumerResult.RETRY
+        if result == ConsumerResult.RETRY or result == ConsumerResult.DROP:
+            return result
+        # Other return values are treated as success
+        return ConsumerResult.SUCCESS
+
+    async def _handle_message(
+        self,
+        subscription: Subscription,
+        receiver: "ServiceBusReceiver",
+        msg: "ServiceBusReceivedMessage",
+        received_time_ns: Optional[int] = None,
+    ) -> ConsumerResult:
+        """Process a message, continuing the trace from the publisher (see pubsub.tracing)"""
+        trace = self._tracer.start_message_trace(
+            get_application_property(msg, TRACEPARENT_PROPERTY),
+            subscription.topic,
+            subscription.subscription_name,
+            msg.message_id,
+            enqueued_time=msg.enqueued_time_utc,
+            received_time_ns=received_time_ns,
+        )
+        try:
+            result = await self._process_message(subscription, receiver, msg, trace)
+        except BaseException:
+            trace.end(error=True)
+            raise
+        trace.end(error=result != ConsumerResult.SUCCESS, **{"pubsub.result": result.name})
+        return result
+
+    async def _process_message(
+        self, subscription: Subscription, receiver: "ServiceBusReceiver", msg: "ServiceBusReceivedMessage", trace
+    ) -> ConsumerResult:
+        """Decode a message, pass it to the subscription's handlers and settle it based on their results"""
+        # Messages resubmitted from a dead-letter queue are only for the subscription they were dead-lettered from
+        target_subscription = get_application_property(msg, DLQ_TARGET_SUBSCRIPTION_PROPERTY)
+        if target_subscription is not None and target_subscription != subscription.subscription_name:
+            self.metrics.increment(
+                "messages_filtered_total", topic=subscription.topic, subscription=subscription.subscription_name
+            )
+            return await self._settle_message(receiver, msg, ConsumerResult.SUCCESS, trace=trace)
+
+        # Fetch the body if it has been offloaded to the blob store (claim-check)
+        body = None
+        claim_check_key = get_claim_check_key(msg)
+        if claim_check_key is not None:
+            try:
+                if self._claim_check_resolver is None:
+                    raise Exception("Message body is in a blob store but no blob_store was passed to ConsumerApp")
+                with trace.stage("fetch"):
+                    body = await self._claim_check_resolver.get_body(claim_check_key)
+            except Exception as e:
+                self._log_message(
+                    logging.INFO,
+                    subscription,
+                    msg,
+                    "Error fetching message body (%s) - abandoning: %s",
+                    msg.message_id,
+                    e,
+                    sampled=False,
+                )
+                return await self._settle_message(receiver, msg, ConsumerResult.RETRY, trace=trace)
+
+        try:
+            with trace.stage("decode"):
+                handlers = subscription.handlers
+                parsed_message = None
+                if any(handler.filter is not None for handler in handlers):
+                    # Filters are evaluated locally as well as by the broker, e.g. for messages received before the
+                    # subscription rule was applied, or if the rule couldn't be applied
+                    values = get_application_properties(msg)
+                    if any(not handler.filter.get_fields() <= values.keys() for handler in handlers if handler.filter):
+                        # fall back to the event fields for fields that weren't promoted to application properties
+                        parsed_message = decode_message(msg, body)
+                        if isinstance(parsed_message, dict):
+                            values = {**parsed_message, **values}
+                    handlers = [
+                        handler for handler in handlers if handler.filter is None or handler.filter.evaluate(values)
+                    ]
+                    if len(handlers) == 0:
+                        self._log_message(
+                            logging.DEBUG,
+                            subscription,
+                            msg,
+                            "Message doesn't match the subscription filters (%s) - completing",
+                            msg.message_id,
+                        )
+                        self.metrics.increment(
+                            "messages_filtered_total",
+                            topic=subscription.topic,
+                            subscription=subscription.subscription_name,
+                        )
+                        return await self._complete_message(receiver, msg, claim_check_key, trace)
+
+                # The message is decoded (and parsed to its event class) once and shared by all of the handlers
+                if parsed_message is None:
+                    parsed_message = decode_message(msg, body)
+                event_type = None
+                event_class = None
+                payload = None
+                if any(handler.payload_types != [dict] for handler in handlers):
+                    # O(1) lookup of the event class from the topic and the event type set by the publisher
+                    event_type = get_application_property(msg, EVENT_TYPE_PROPERTY)
+                    event_class = event_registry.get_event_class(subscription.topic, event_type)
+                    if event_class is None:
+                        # e.g. a renamed class, or a new event type published before this consumer was deployed:
+                        # parse it with the topic's default class (as for messages without an event type) rather
+                        # than dead-lettering live traffic
+                        self._log_message(
+                            logging.INFO,
+                            subscription,
+                            msg,
+                            "Unknown event type '%s' (%s) - using the topic's default class",
+                            event_type,
+                            msg.message_id,
+                        )
+                        self.metrics.increment(
+                            "messages_unknown_event_type_total",
+                            topic=subscription.topic,
+                            subscription=subscription.subscription_name,
+                        )
+                        event_class = event_registry.get_event_class(subscription.topic)
+                    if event_class is None:
+                        raise Exception(f"No event class registered for topic '{subscription.topic}'")
+                    payload = parse_obj_as(event_class, parsed_message)
+        except Exception as e:
+            self._log_message(
+                logging.INFO,
+                subscription,
+                msg,
+                "Error decoding message (%s) - abandoning: %s",
+                msg.message_id,
+                e,
+                sampled=False,
+            )
+            return await self._settle_message(receiver, msg, ConsumerResult.RETRY, trace=trace)
+
+        calls = []
+        for handler in handlers:
+            if handler.payload_types == [dict]:
+                calls.append(self._call_handler(subscription, handler, parsed_message, msg))
+            elif handler.payload_types is None or event_class in handler.payload_types:
+                calls.append(self._call_handler(subscription, handler, payload, msg))
+            else:
+                # the handler only accepts some of the event types on the topic
+                self._log_message(
+                    logging.DEBUG,
+                    subscription,
+                    msg,
+                    "Skipping event type '%s' for %s (%s)",
+                    event_type,
+                    handler.func_name,
+                    msg.message_id,
+                )
+                self.metrics.increment(
+                    "messages_skipped_total", topic=subscription.topic, subscription=subscription.subscription_name
+                )
+
+        # Fan out to the handlers concurrently and combine the results: RETRY if any handler needs a retry (all
+        # handlers are called again on redelivery), otherwise DROP if any handler dropped the message
+        # handlers run with the message's trace context so that events they publish continue the trace
+        token = set_current_traceparent(trace.traceparent)
+        try:
+            with trace.stage("handler"):
+                results = await asyncio.gather(*calls)
+        finally:
+            reset_current_traceparent(token)
+        if ConsumerResult.RETRY in results:
+            self._log_message(
+                logging.INFO,
+                subscription,
+                msg,
+                "Handler returned RETRY (%s) - abandoning",
+                msg.message_id,
+                sampled=False,
+            )
+            return await self._settle_message(receiver, msg, ConsumerResult.RETRY, trace=trace)
+        if ConsumerResult.DROP in results:
+            self._log_message(
+                logging.INFO,
+                subscription,
+                msg,
+                "Handler returned DROP (%s) - deadlettering",
+                msg.message_id,
+                sampled=False,
+            )
+            return await self._settle_message(receiver, msg, ConsumerResult.DROP, trace=trace)
+        self._log_message(
+            logging.INFO, subscription, msg, "Handler returned successfully (%s) - completing", msg.message_id
+        )
+        return await self._complete_message(receiver, msg, claim_check_key, trace)
+
+    async def _complete_message(
+        self, receiver: "ServiceBusReceiver", msg: "ServiceBusReceivedMessage", claim_check_key: Optional[str], trace
+    ) -> ConsumerResult:
+        """Complete a message that has been processed, then let the claim-check resolver clean up its body"""
+        result = await self._settle_message(receiver, msg, ConsumerResult.SUCCESS, trace=trace)
+        if claim_check_key is not None:
+            await self._claim_check_resolver.complete(claim_check_key)
+        return result
+
+    async def _settle_message(
+        self,
+        receiver: "ServiceBusReceiver",
+        msg: "ServiceBusReceivedMessage",
+        result: ConsumerResult,
+        reason: str = "dropped by subscriber",
+        trace=NOOP_TRACE,
+    ) -> ConsumerResult:
+        """Complete, abandon or dead-letter a message based on result"""
+        # Stop lock renewal before settling so that a renewal isn't attempted on a settled message
+        self._lock_renewal_scheduler.settle(msg)
+        with trace.stage("settle"):
+            if result == ConsumerResult.RETRY:
+                await receiver.abandon_message(msg)
+            elif result == ConsumerResult.DROP:
+                await receiver.dead_letter_message(msg, reason=reason)
+            else:
+                await receiver.complete_message(msg)
+        return result
+
+    def _get_autotune_config(self, subscription: Subscription) -> Optional[AutotuneConfig]:
+        """The autotune config for a subscription (None if autotune is disabled)"""
+        if subscription.autotune is None:
+            return self._default_autotune
+        return subscription.autotune or None
 
-        renewer = AutoLockRenewer(max_lock_renewal_duration=max_lock_renewal_duration)
+    def _get_subscription_settings(self, subscription: Subscription) -> SubscriptionSettings:
+        """Resolve the settings to use for the next receive for a subscription
+
+        Settings are resolved in order of precedence: runtime overrides for the subscription,
+        values passed to the consume decorator, runtime overrides for the defaults, and finally the app defaults
+        """
+
+        def resolve(name: str):
+            # compare with None so that falsy values apply (e.g. max_concurrency 0 to remove the limit)
+            for value in (
+                subscription.runtime_overrides.get(name),
+                getattr(subscription, name),
+                self._runtime_default_overrides.get(name),
+            ):
+                if value is not None:
+                    return value
+            return getattr(self, f"_default_{name}")
+
+        settings = SubscriptionSettings(**{name: resolve(name) for name in SUBSCRIPTION_SETTING_NAMES})
+
+        # Autotune replaces the configured batch size/concurrency, but explicit runtime overrides still take precedence
+        controller = subscription.autotune_controller
+        if controller is not None:
+            if "max_message_count" not in subscription.runtime_overrides:
+                settings.max_message_count = controller.batch_size
+            if controller.concurrency is not None and "max_concurrency" not in subscription.runtime_overrides:
+                settings.max_concurrency = controller.concurrency
+        return settings
+
+    def update_subscription_settings(self, subscription_key: Optional[str] = None, **settings):
+        """Replace the runtime setting overrides for a subscription (or the defaults if subscription_key is None)
+
+        subscription_key is in the form "<topic-name>|<subscription-name>" and settings are any of
+        max_message_count, max_wait_time, max_lock_renewal_duration and max_concurrency.
+        Changes take effect on the next receive for the affected subscriptions, messages currently being processed are not affected.
+        """
+        validate_subscription_settings(settings)
+        overrides = {name: value for name, value in settings.items() if value is not None}
+
+        if subscription_key is None:
+            self._runtime_default_overrides = overrides
+            self._logger.info(f"🔧 Updated default subscription settings: {overrides}")
+            return
+
+        subscriptions = [subscription for subscription in self._subscriptions if subscription.key == subscription_key]
+        if len(subscriptions) == 0:
+            raise Exception(f"No subscription registered for '{subscription_key}'")
+        for subscription in subscriptions:
+            subscription.runtime_overrides = overrides
+        self._logger.info(f"🔧 Updated subscription settings for {subscription_key}: {overrides}")
+
+    def get_subscription_keys(self) -> list[str]:
+        """Get the keys (in the form "<topic-name>|<subscription-name>") for the registered subscriptions"""
+        return [subscription.key for subscription in self._subscriptions]
+
+    async def _process_subscription(self, servicebus_client: "ServiceBusClient", subscription: Subscription):
         receiver = servicebus_client.get_subscription_receiver(
             topic_name=subscription.topic,
             subscription_name=subscription.subscription_name,
-            auto_lock_renewer=renewer,
         )
         # TODO - set up a logger for the subscription that includes the topic and subscription with log output
 
+        if subscription.filter is not None and self._manage_subscription_rules and not subscription.rule_applied:
+            await self._apply_subscription_rule(subscription)
+
+        autotune_config = self._get_autotune_config(subscription)
+        if autotune_config is not None:
+            subscription.autotune_controller = AutotuneController(
+                autotune_config,
+                initial_batch_size=self._get_subscription_settings(subscription).max_message_count,
+                metrics=self.metrics,
+                metric_labels={"topic": subscription.topic, "subscription": subscription.subscription_name},
+            )
+
+        labels = {"topic": subscription.topic, "subscription": subscription.subscription_name}
         async with receiver:
+            # reset by _supervise_subscription when processing stops (or fails)
+            subscription.health.receiver_attached = True
             self._logger.info(
                 f"👂 Starting message receiver for {subscription.func_name} (topic={subscription.topic}, subscription={subscription.subscription_name}..."
             )
-            while not self._is_cancelled:
-                # TODO: Add back-off logic when no messages?
-                #       This could allow longer wait times with more efficient termination
-                #       But it would increase the time to process new messages after a period of inactivity
+            prefetch = self._create_prefetch_buffer(subscription, receiver)
+            try:
+                while not self._is_cancelled:
+                    # TODO: Add back-off logic when no messages?
+                    #       This could allow longer wait times with more efficient termination
+                    #       But it would increase the time to process new messages after a period of inactivity
+
+                    # Settings are resolved for each receive so that runtime changes are picked up
+                    settings = self._get_subscription_settings(subscription)
+
+                    self._logger.debug("Receiving messages...")
+                    wait_start = timer()
+                    if prefetch is not None:
+                        received_msgs = await prefetch.take(settings.max_message_count, settings.max_wait_time)
+                    else:
+                        received_msgs = await receiver.receive_messages(
+                            max_message_count=settings.max_message_count, max_wait_time=settings.max_wait_time
+                        )
+                    # the time the handlers are idle waiting for messages (reduced by prefetching)
+                    self.metrics.increment("receive_wait_seconds_total", timer() - wait_start, **labels)
+
+                    received_time_ns = time.time_ns()
+                    if len(received_msgs) == 0:
+                        self._logger.debug("No messages received(topic=%s)", subscription.topic)
+                        subscription.health.receive_empty()
+                        continue
+                    batch_id = subscription.health.batch_started(received_msgs)
+
+                    self._log_message(
+                        logging.INFO, subscription, None, "📦 Batch received, size =  %d", len(received_msgs)
+                    )
+                    start = timer()
+
+                    # Track messages for lock renewal (for long message processing)
+                    # Locks are only renewed for messages that are still being processed when the lock is close to expiry
+                    # (prefetched messages are registered when they are added to the buffer)
+                    if prefetch is None:
+                        for msg in received_msgs:
+                            self._lock_renewal_scheduler.register(
+                                receiver, msg, max_lock_renewal_duration=settings.max_lock_renewal_duration
+                            )
+
+                    # Start fetching any offloaded (claim-check) bodies for the batch concurrently
+                    if self._claim_check_resolver is not None:
+                        self._claim_check_resolver.prefetch(received_msgs)
+
+                    # process messages in parallel
+                    latencies = []
+                    semaphore = None
+                    if settings.max_concurrency and settings.max_concurrency < len(received_msgs):
+                        semaphore = asyncio.Semaphore(settings.max_concurrency)
+
+                    async def handle_message(msg):
+                        if semaphore is not None:
+                            await semaphore.acquire()
+                        try:
+                            handler_start = timer()
+                            result = await self._handle_message(subscription, receiver, msg, received_time_ns)
+                            latencies.append(timer() - handler_start)
+                            return result
+                        finally:
+                            if semaphore is not None:
+                                semaphore.release()
+
+                    results = await asyncio.gather(*[handle_message(msg) for msg in received_msgs])
+                    subscription.health.batch_completed(batch_id)
+                    end = timer()
+                    duration = end - start
+                    self._log_message(
+                        logging.INFO,
+                        subscription,
+                        None,
+                        "📦 Batch done, size=%d, duration=%ss",
+                        len(received_msgs),
+                        duration,
+                    )
+
+                    if prefetch is not None:
+                        prefetch.record_processed(len(received_msgs), duration)
+                    if subscription.autotune_controller is not None:
+                        subscription.autotune_controller.record_batch(
+                            received_count=len(received_msgs),
+                            requested_count=settings.max_message_count,
+                            duration=duration,
+                            latencies=latencies,
+                            error_count=sum(1 for result in results if result == ConsumerResult.RETRY),
+                        )
+            finally:
+                if prefetch is not None:
+                    await self._release_prefetched_messages(receiver, prefetch)
 
-                self._logger.debug("Receiving messages...")
-                received_msgs = await receiver.receive_messages(
-                    max_message_count=max_message_count, max_wait_time=max_wait_time
+            self._logger.info(
+                f"Finished processing messages for {subscription.func_name} (topic={subscription.topic}, subscription={subscription.subscription_name})"
+            )
+
+    def _get_prefetch_count(self, subscription: Subscription) -> int:
+        # prefetch_count=0 on consume disables prefetch even when it is enabled for the app
+        if subscription.prefetch_count is not None:
+            return subscription.prefetch_count
+        return self._default_prefetch_count
+
+    def _create_prefetch_buffer(self, subscription: Subscription, receiver) -> Optional[PrefetchBuffer]:
+        """Create and start the PrefetchBuffer for a subscription (or return None if prefetch isn't enabled)"""
+        prefetch_count = self._get_prefetch_count(subscription)
+        if prefetch_count == 0:
+            return None
+
+        def register_for_lock_renewal(msgs: list):
+            max_lock_renewal_duration = self._get_subscription_settings(subscription).max_lock_renewal_duration
+            for msg in msgs:
+                self._lock_renewal_scheduler.register(
+                    receiver, msg, max_lock_renewal_duration=max_lock_renewal_duration
                 )
 
+        prefetch = PrefetchBuffer(
+            receiver,
+            prefetch_count,
+            get_settings=lambda: self._get_subscription_settings(subscription),
+            on_received=register_for_lock_renewal,
+            on_discarded=self._lock_renewal_scheduler.settle,
+            metrics=self.metrics,
+            metric_labels={"topic": subscription.topic, "subscription": subscription.subscription_name},
+        )
+        prefetch.start()
+        return prefetch
+
+    async def _release_prefetched_messages(self, receiver: "ServiceBusReceiver", prefetch: PrefetchBuffer):
+        """Stop prefetching and abandon the buffered messages so that they are redelivered straight away"""
+        for msg in await prefetch.close():
+            self._lock_renewal_scheduler.settle(msg)
+            try:
+                await receiver.abandon_message(msg)
+            except Exception as e:
+                # the lock expires (and the message is redelivered) if it can't be abandoned
+                self._logger.debug(f"Failed to abandon prefetched message {msg.message_id}: {e!r}")
+
+    async def _process_session_subscription(self, servicebus_client: "ServiceBusClient", subscription: Subscription):
+        """Process a session-enabled subscription with a worker for each of the max_concurrent_sessions sessions
+
+        Each worker accepts the next available session, handles its messages in order and releases it once it is idle,
+        so the workers move on to sessions with pending messages rather than waiting on idle ones.
+        """
+        if subscription.filter is not None and self._manage_subscription_rules and not subscription.rule_applied:
+            await self._apply_subscription_rule(subscription)
+        if self._get_autotune_config(subscription) is not None:
+            self._logger.warning(
+                f"Autotune isn't supported for session subscriptions - ignored for {subscription.key}"
+            )
+        if self._get_prefetch_count(subscription) > 0:
+            self._logger.warning(
+                f"Prefetch isn't supported for session subscriptions - ignored for {subscription.key}"
+            )
+
+        max_concurrent_sessions = subscription.max_concurrent_sessions or self._default_max_concurrent_sessions
+        # reset by _supervise_subscription when processing stops (or fails)
+        subscription.health.receiver_attached = True
+        self._logger.info(
+            f"👂 Starting {max_concurrent_sessions} session receiver(s) for {subscription.func_name} (topic={subscription.topic}, subscription={subscription.subscription_name}..."
+        )
+        try:
+            async with asyncio.TaskGroup() as task_group:
+                for _ in range(max_concurrent_sessions):
+                    task_group.create_task(self._process_sessions(servicebus_client, subscription))
+        except ExceptionGroup as e:
+            # the other workers have been cancelled, so restart the subscription for the first failure
+            raise e.exceptions[0]
+        self._logger.info(
+            f"Finished processing messages for {subscription.func_name} (topic={subscription.topic}, subscription={subscription.subscription_name})"
+        )
+
+    async def _process_sessions(self, servicebus_client: "ServiceBusClient", subscription: Subscription):
+        """Accept and process sessions for a subscription, one at a time, until the app is cancelled"""
+        from azure.servicebus import NEXT_AVAILABLE_SESSION
+        from azure.servicebus.exceptions import OperationTimeoutError, SessionLockLostError
+
+        labels = {"topic": subscription.topic, "subscription": subscription.subscription_name}
+        while not self._is_cancelled:
+            # max_wait_time is how long to wait for a session with messages to become available
+            receiver = servicebus_client.get_subscription_receiver(
+                topic_name=subscription.topic,
+                subscription_name=subscription.subscription_name,
+                session_id=NEXT_AVAILABLE_SESSION,
+                max_wait_time=self._get_subscription_settings(subscription).max_wait_time,
+            )
+            try:
+                async with receiver:
+                    await self._process_session(subscription, receiver)
+            except OperationTimeoutError:
+                self._logger.debug("No sessions available (topic=%s)", subscription.topic)
+                subscription.health.receive_empty()
+            except SessionLockLostError as e:
+                # unsettled messages are redelivered with the session, so move on to the next available session
+                self.metrics.increment("session_lock_lost_total", **labels)
+                self._logger.warning(f"Session lock lost for {subscription.key}: {e!r}")
+
+    async def _process_session(self, subscription: Subscription, receiver: "ServiceBusReceiver"):
+        """Handle the messages for an accepted session in order, returning once the session is idle"""
+        labels = {"topic": subscription.topic, "subscription": subscription.subscription_name}
+        session_id = receiver.session.session_id
+        self.metrics.increment("sessions_accepted_total", **labels)
+        self._active_session_counts[subscription.key] = self._active_session_counts.get(subscription.key, 0) + 1
+        self.metrics.set_gauge("sessions_active", self._active_session_counts[subscription.key], **labels)
+        self._logger.debug("🔐 Accepted session %s (topic=%s)", session_id, subscription.topic)
+        try:
+            while not self._is_cancelled:
+                settings = self._get_subscription_settings(subscription)
+                received_msgs = await receiver.receive_messages(
+                    max_message_count=settings.max_message_count, max_wait_time=self._session_idle_timeout
+                )
+                received_time_ns = time.time_ns()
                 if len(received_msgs) == 0:
-                    self._logger.debug(f"No messages received(topic={subscription.topic})")
-                    continue
+                    # release the idle session so that the worker can accept a session with pending messages
+                    break
+                batch_id = subscription.health.batch_started(received_msgs)
+                self._log_message(
+                    logging.INFO,
+                    subscription,
+                    None,
+                    "📦 Session batch received, session=%s, size=%d",
+                    session_id,
+                    len(received_msgs),
+                )
 
-                self._logger.info(f"📦 Batch received, size =  {len(received_msgs)}")
-                start = timer()
+                # the session lock covers the session's messages, so it is renewed rather than the message locks
+                self._lock_renewal_scheduler.register_session(
+                    receiver, max_lock_renewal_duration=settings.max_lock_renewal_duration
+                )
+                if self._claim_check_resolver is not None:
+                    self._claim_check_resolver.prefetch(received_msgs)
+
+                # messages are handled one at a time to preserve their order within the session
+                retrying = False
+                for index, msg in enumerate(received_msgs):
+                    result = await self._handle_message(subscription, receiver, msg, received_time_ns)
+                    if result == ConsumerResult.RETRY:
+                        # the abandoned message is redelivered, so the later messages are abandoned rather than
+                        # handled ahead of it
+                        retrying = True
+                        for remaining_msg in received_msgs[index + 1 :]:
+                            await self._settle_message(receiver, remaining_msg, ConsumerResult.RETRY)
+                        break
+                subscription.health.batch_completed(batch_id)
+                if retrying:
+                    # release the session so that the retry is picked up when the session is next accepted
+                    self._logger.debug(
+                        "🔁 Releasing session %s after a retry (topic=%s)", session_id, subscription.topic
+                    )
+                    break
+        finally:
+            self._lock_renewal_scheduler.settle(receiver.session)
+            self._active_session_counts[subscription.key] -= 1
+            self.metrics.set_gauge("sessions_active", self._active_session_counts[subscription.key], **labels)
+        self._logger.debug("🔓 Released session %s (topic=%s)", session_id, subscription.topic)
 
-                # process messages in parallel
-                await asyncio.gather(*[subscription.handler(receiver, msg) for msg in received_msgs])
-                end = timer()
-                duration = end - start
-                self._logger.info(f"📦 Batch done, size={len(received_msgs)}, duration={duration}s")
+    async def _supervise_subscription(self, subscription: Subscription):
+        """Run _process_subscription (or _process_session_subscription) for a subscription, restarting it with jittered exponential backoff if it fails
 
-            self._logger.info(
-                f"Finished processing messages for {subscription.func_name} (topic={subscription.topic}, subscription={subscription.subscription_name})"
+        This isolates failures (e.g. a link detach or token refresh failure) to the affected subscription
+        rather than stopping all subscriptions. The existing ServiceBusClient is reused for restarts unless
+        the subscription keeps failing, in which case the client (i.e. the subscription's slot in the client pool) is recreated.
+        """
+        labels = {"topic": subscription.topic, "subscription": subscription.subscription_name}
+        consecutive_failures = 0
+        while not self._is_cancelled:
+            servicebus_client = self._client_pool.get_client(subscription.key)
+            self.metrics.set_gauge("subscription_up", 1, **labels)
+            started_at = timer()
+            try:
+                if subscription.sessions:
+                    await self._process_session_subscription(servicebus_client, subscription)
+                else:
+                    await self._process_subscription(servicebus_client, subscription)
+                break
+            except Exception as e:
+                failed_at = timer()
+                subscription.health.detach()
+                self.metrics.set_gauge("subscription_up", 0, **labels)
+                self.metrics.increment("subscription_restarts_total", **labels)
+                if failed_at - started_at > self._reconnect_max_backoff:
+                    # the subscription was healthy for a while, so treat this as a new run of failures
+                    consecutive_failures = 0
+                consecutive_failures += 1
+
+                backoff = min(
+                    self._reconnect_initial_backoff * 2 ** (consecutive_failures - 1), self._reconnect_max_backoff
+                )
+                # full jitter avoids subscriptions (and pods) reconnecting in lockstep
+                delay = random.uniform(0, backoff)
+                self._logger.error(
+                    f"❌ Subscription processor failed for {subscription.func_name} (topic={subscription.topic}, subscription={subscription.subscription_name}) - restarting in {delay:.1f}s (failure {consecutive_failures}): {e!r}"
+                )
+
+                await self._wait_unless_cancelled(delay)
+                if consecutive_failures % self._client_reset_after_failures == 0:
+                    await self._reset_servicebus_client(servicebus_client)
+                self.metrics.increment("subscription_downtime_seconds_total", timer() - failed_at, **labels)
+        self.metrics.set_gauge("subscription_up", 0, **labels)
+        subscription.health.detach()
+
+    async def _wait_unless_cancelled(self, delay: float):
+        try:
+            await asyncio.wait_for(self._cancelled_event.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+    def _create_servicebus_client(self) -> "ServiceBusClient":
+        # imported on first use as the azure packages are slow to import (see benchmarks/bench_startup.py)
+        from azure.identity.aio import WorkloadIdentityCredential
+        from azure.servicebus.aio import ServiceBusClient
+
+        if AZURE_CLIENT_ID and AZURE_TENANT_ID and AZURE_AUTHORITY_HOST and AZURE_FEDERATED_TOKEN_FILE:
+            self._logger.info("Using workload identity credentials")
+            if self._credential is None:
+                self._credential = WorkloadIdentityCredential(
+                    client_id=AZURE_CLIENT_ID,
+                    tenant_id=AZURE_TENANT_ID,
+                    token_file_path=AZURE_FEDERATED_TOKEN_FILE,
+                )
+            return ServiceBusClient(
+                fully_qualified_namespace=SERVICE_BUS_NAMESPACE,
+                credential=self._credential,
+            )
+        else:
+            self._logger.info("No workload identity credentials found, using connection string")
+            return ServiceBusClient.from_connection_string(conn_str=CONNECTION_STR)
+
+    def _create_administration_client(self) -> "ServiceBusAdministrationClient":
+        from azure.servicebus.aio.management import ServiceBusAdministrationClient
+
+        if self._credential is not None:
+            return ServiceBusAdministrationClient(
+                fully_qualified_namespace=SERVICE_BUS_NAMESPACE, credential=self._credential
+            )
+        return ServiceBusAdministrationClient.from_connection_string(conn_str=CONNECTION_STR)
+
+    async def _apply_subscription_rule(self, subscription: Subscription):
+        """Replace the rules for a subscription with a rule for the subscription's filter
+
+        The new rule is created before the other rules (e.g. $Default, or the rule for a previous filter) are
+        deleted so that there is no window in which matching messages are dropped by the broker.
+        If the rule can't be applied (e.g. the credentials don't have Manage rights), messages are still filtered
+        locally, but they are all delivered by the broker.
+
+        The broker can only filter on application properties, and publishers in other processes only send the fields
+        listed in promoted_fields on the event class, so a rule that uses other fields would match no messages. In
+        that case the rules are left unchanged and messages are filtered locally.
+        """
+        subscription.rule_applied = True
+        filter = subscription.filter
+        unpromoted_fields = filter.get_fields() - event_registry.get_promoted_fields(subscription.topic)
+        if unpromoted_fields:
+            self._logger.warning(
+                f"Not applying a subscription rule for {subscription.key} as the filter uses fields that aren't "
+                + f"promoted ({', '.join(sorted(unpromoted_fields))}) - filtering messages locally. "
+                + "Add the fields to promoted_fields on the event class to filter in the broker"
+            )
+            return
+        rule_name = get_rule_name(filter)
+        try:
+            async with self._create_administration_client() as admin_client:
+                rule_names = [
+                    rule.name
+                    async for rule in admin_client.list_rules(
+                        topic_name=subscription.topic, subscription_name=subscription.subscription_name
+                    )
+                ]
+                if rule_name not in rule_names:
+                    self._logger.info(f"Creating subscription rule {rule_name} for {subscription.key}: {filter}")
+                    await admin_client.create_rule(
+                        subscription.topic, subscription.subscription_name, rule_name, filter=to_rule_filter(filter)
+                    )
+                for name in rule_names:
+                    if name != rule_name:
+                        self._logger.info(f"Deleting subscription rule {name} for {subscription.key}")
+                        await admin_client.delete_rule(subscription.topic, subscription.subscription_name, name)
+        except Exception as e:
+            self.metrics.increment(
+                "subscription_rule_failures_total",
+                topic=subscription.topic,
+                subscription=subscription.subscription_name,
+            )
+            self._logger.warning(
+                f"Unable to apply subscription rule for {subscription.key} - filtering messages locally: {e!r}"
             )
 
+    async def _reset_servicebus_client(self, failed_client: "ServiceBusClient"):
+        """Replace the ServiceBusClient if it is still in the pool (another subscription may have already replaced it)"""
+        if self._is_cancelled:
+            return
+        self._logger.warning("Recreating service bus client after repeated failures...")
+        if not self._client_pool.reset_client(failed_client):
+            return
+        self.metrics.increment("servicebus_client_resets_total")
+        try:
+            await failed_client.close()
+        except Exception as e:
+            self._logger.warning(f"Error closing failed service bus client: {e!r}")
+
     def _sigterm_handler(self, sig: int, frame):
         """Handle a SIGTERM by cancelling the consumer app"""
         self._logger.info(f"Received SIGTERM, calling cancel")
         self.cancel()
 
+    def _sigusr2_handler(self, sig: int, frame):
+        """Handle a SIGUSR2 by starting allocation tracing, or logging the top allocation sites if already started"""
+        if start_allocation_tracing():
+            return
+        self._logger.info(f"🧮 Top allocation sites: {json.dumps(self.get_allocation_report())}")
+
+    def run_sync(self, filter: Optional[list[str]] = None):
+        """Run the consumer app on a new event loop, blocking until it completes (use instead of asyncio.run(app.run()))
+
+        The event loop is selected by the event_loop constructor arg or the EVENT_LOOP environment variable:
+        "auto" (the default) uses uvloop if it is installed, "uvloop" or "asyncio" (see pubsub.event_loop).
+
+        Args:
+            filter (Optional[list[str]]): A list of topic+subscription filters (see run)
+        """
+        run_on_event_loop(self.run(filter), event_loop=self._event_loop)
+
     async def run(self, filter: Optional[list[str]] = None):
         """Run the consumer app, i.e. begin processing messages from the Service Bus subscriptions
 
@@ -334,52 +1329,102 @@ class ConsumerApp:
         if len(self._subscriptions) == 0:
             raise Exception("No consumers registered - ensure you have added @consumer decorators to your handlers")
 
-        workload_identity_credential = None
-        servicebus_client = None
-
         self._logger.info("Connecting to service bus...")
-        if AZURE_CLIENT_ID and AZURE_TENANT_ID and AZURE_AUTHORITY_HOST and AZURE_FEDERATED_TOKEN_FILE:
-            self._logger.info("Using workload identity credentials")
-            workload_identity_credential = WorkloadIdentityCredential(
-                client_id=AZURE_CLIENT_ID,
-                tenant_id=AZURE_TENANT_ID,
-                token_file_path=AZURE_FEDERATED_TOKEN_FILE,
-            )
-            servicebus_client = ServiceBusClient(
-                fully_qualified_namespace=SERVICE_BUS_NAMESPACE,
-                credential=workload_identity_credential,
-            )
-        else:
-            self._logger.info("No workload identity credentials found, using connection string")
-            servicebus_client = ServiceBusClient.from_connection_string(conn_str=CONNECTION_STR)
+        self._client_pool = ServiceBusClientPool(
+            self._create_servicebus_client, size=self._client_pool_size, strategy=self._client_pool_strategy
+        )
 
         signal.signal(signal.SIGTERM, self._sigterm_handler)
+        if hasattr(signal, "SIGUSR2"):
+            signal.signal(signal.SIGUSR2, self._sigusr2_handler)
+        if self._allocation_tracing:
+            start_allocation_tracing()
 
+        if self._queue_logging is not None:
+            self._queue_logging.start()
         try:
-            async with servicebus_client:
-                self._logger.info("Starting subscription processors...")
-                if filter is None:
-                    if not SUBSCRIBER_FILTER is None:
-                        self._logger.info(
-                            f"Using filter from SUBSCRIBER_FILTER environment variable: {SUBSCRIBER_FILTER}"
-                        )
-                        filter = SUBSCRIBER_FILTER.split(",")
-                else:
-                    self._logger.info(f"Using filter from argument: {filter}")
+            # the clients are closed in the finally block rather than with "async with" as they may be replaced during run
+            self._logger.info("Starting subscription processors...")
+            if filter is None:
+                if not SUBSCRIBER_FILTER is None:
+                    self._logger.info(f"Using filter from SUBSCRIBER_FILTER environment variable: {SUBSCRIBER_FILTER}")
+                    filter = SUBSCRIBER_FILTER.split(",")
+            else:
+                self._logger.info(f"Using filter from argument: {filter}")
 
+            self._running_subscriptions = [
+                subscription for subscription in self._subscriptions if filter is None or subscription.key in filter
+            ]
+            self._validate_dependencies(self._running_subscriptions)
+
+            runtime_config_task = None
+            if self._runtime_config_file:
+                self._logger.info(f"Watching runtime config file: {self._runtime_config_file}")
+                watcher = RuntimeConfigWatcher(self, self._runtime_config_file)
+                watcher.load()
+                runtime_config_task = asyncio.create_task(watcher.run())
+
+            # A single lock renewal scheduler is shared across all subscriptions
+            self._lock_renewal_scheduler = LockRenewalScheduler(metrics=self.metrics)
+            lock_renewal_task = asyncio.create_task(self._lock_renewal_scheduler.run())
+
+            if self._health_port is not None:
+                self.health_server = HealthServer(self, self._health_port)
+                await self.health_server.start()
+
+            try:
                 await asyncio.gather(
-                    *[
-                        self._process_subscription(servicebus_client, subscription)
-                        for subscription in self._subscriptions
-                        if filter is None or f"{subscription.topic}|{subscription.subscription_name}" in filter
-                    ]
+                    *[self._supervise_subscription(subscription) for subscription in self._running_subscriptions]
                 )
-                self._logger.info("Subscription processors completed")
+            finally:
+                if runtime_config_task:
+                    runtime_config_task.cancel()
+                self._lock_renewal_scheduler.close()
+                await lock_renewal_task
+                if self.health_server is not None:
+                    await self.health_server.close()
+            self._logger.info("Subscription processors completed")
 
         finally:
-            if workload_identity_credential:
-                await workload_identity_credential.close()
+            # e.g. opened by handlers calling the module-level publish
+            await close_default_publisher()
+            if self._tracer.enabled:
+                # send the queued spans now rather than losing them if the process exits
+                await asyncio.to_thread(self._tracer.flush)
+            await self._client_pool.close()
+            if self._credential:
+                await self._credential.close()
+            if self._queue_logging is not None:
+                self._queue_logging.stop()
 
     def cancel(self):
         """Mark the consumer app as cancelled to shut down processing loops"""
         self._is_cancelled = True
+        self._cancelled_event.set()
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self._is_cancelled
+
+    @property
+    def is_ready(self) -> bool:
+        """True while running (and not cancelled) with a receiver attached for every running subscription"""
+        if self._is_cancelled or len(self._running_subscriptions) == 0:
+            return False
+        return all(subscription.health.receiver_attached for subscription in self._running_subscriptions)
+
+    def get_allocation_report(self, limit: Optional[int] = None) -> dict:
+        """Get the top allocation sites overall, in pubsub and for each running subscription (see pubsub.allocations)
+
+        Allocation tracing must have been started: by the allocation_tracing constructor arg, the ALLOCATION_TRACING
+        environment variable, a SIGUSR2 signal, or calling pubsub.allocations.start_allocation_tracing.
+        """
+        handlers = {
+            subscription.key: [handler.func for handler in subscription.handlers]
+            for subscription in self._running_subscriptions
+        }
+        return get_allocation_report(handlers, limit=limit)
+
+    def get_subscription_health(self) -> dict:
+        """Get the SubscriptionHealth for each running subscription, keyed on the subscription key"""
+        return {subscription.key: subscription.health for subscription in self._running_subscriptions}
@@ -0,0 +1,534 @@
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime, timezone
+from timeit import default_timer as timer
+from typing import Callable, Optional
+
+from pydantic.json import pydantic_encoder
+
+from .claim_check import get_claim_check_key
+from .codecs import decode_message, get_message_body_bytes
+from .compression import CONTENT_ENCODING_PROPERTY
+from .config import (
+    AZURE_AUTHORITY_HOST,
+    AZURE_CLIENT_ID,
+    AZURE_FEDERATED_TOKEN_FILE,
+    AZURE_TENANT_ID,
+    CONNECTION_STR,
+    SERVICE_BUS_NAMESPACE,
+)
+from .events import EVENT_TYPE_PROPERTY, StateChangeEventBase, event_registry
+from .message_properties import DLQ_TARGET_SUBSCRIPTION_PROPERTY, get_application_properties
+from .metrics import MetricsRegistry, default_registry
+
+DLQ_RESUBMIT_COUNT_PROPERTY = "dlq-resubmit-count"
+"""The application property counting how many times a message has been resubmitted from a dead-letter queue"""
+
+DLQ_CONCURRENCY = int(os.getenv("DLQ_CONCURRENCY", "8"))
+DLQ_BATCH_SIZE = int(os.getenv("DLQ_BATCH_SIZE", "100"))
+DLQ_MAX_WAIT_TIME = float(os.getenv("DLQ_MAX_WAIT_TIME", "5"))
+
+# properties added by the broker when a message is dead-lettered (not copied to resubmitted messages)
+_DEAD_LETTER_PROPERTIES = {"DeadLetterReason", "DeadLetterErrorDescription"}
+
+_logger = logging.getLogger(__name__)
+
+_transforms = {}  # key: name, value: transform function
+
+
+def register_transform(name: Optional[str] = None):
+    """Decorator to register a function that transforms dead-lettered messages before they are resubmitted
+
+    The function is passed the decoded message body (a dict) and returns the new body (a dict or an event),
+    or None to leave the message in the dead-letter queue. Registered transforms can be selected by name
+    with the --transform arg of the CLI (python -m pubsub.dlq).
+
+    Args:
+        name (Optional[str]): The name to register the transform as (defaults to the function name)
+    """
+
+    def decorator(func):
+        _transforms[name or func.__name__] = func
+        return func
+
+    return decorator
+
+
+def get_transform(name: str) -> Callable:
+    """Get a registered transform by name, or a function by "<module>:<function>" (importing the module registers its transforms)"""
+    if ":" in name:
+        module_name, func_name = name.split(":", 1)
+        module = importlib.import_module(module_name)
+        return _transforms.get(func_name) or getattr(module, func_name)
+    transform = _transforms.get(name)
+    if transform is None:
+        raise Exception(f"Unknown transform '{name}' (registered transforms: {list(_transforms.keys())})")
+    return transform
+
+
+class DeadLetterReprocessResult:
+    """DeadLetterReprocessResult counts the messages handled by DeadLetterReprocessor.run"""
+
+    received: int  # messages received (or peeked, for a dry run) from the dead-letter queue
+    resubmitted: int  # messages resubmitted to the topic (or that would be resubmitted, for a dry run)
+    skipped: int  # messages left in the dead-letter queue as they didn't match the filters (or weren't transformed)
+    failed: int  # messages left in the dead-letter queue as they couldn't be transformed or resubmitted
+    duration: float
+    dry_run: bool
+
+    def __init__(self, dry_run: bool = False):
+        self.received = 0
+        self.resubmitted = 0
+        self.skipped = 0
+        self.failed = 0
+        self.duration = 0
+        self.dry_run = dry_run
+
+    @property
+    def throughput(self) -> float:
+        """The number of messages received per second"""
+        return self.received / self.duration if self.duration > 0 else 0
+
+    def __repr__(self) -> str:
+        return (
+            f"DeadLetterReprocessResult(received={self.received}, resubmitted={self.resubmitted}, "
+            f"skipped={self.skipped}, failed={self.failed}, duration={self.duration:.1f}s, "
+            f"throughput={self.throughput:.1f}/s, dry_run={self.dry_run})"
+        )
+
+
+class _RateLimiter:
+    """Paces sends to a maximum number of messages per second (shared by the receivers)"""
+
+    _rate: float
+    _next_time: float
+
+    def __init__(self, rate: Optional[float]):
+        self._rate = rate or 0
+        self._next_time = time.monotonic()
+
+    async def acquire(self, count: int):
+        if self._rate <= 0:
+            return
+        now = time.monotonic()
+        start = max(self._next_time, now)
+        self._next_time = start + count / self._rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def release(self, count: int):
+        """Return tokens acquired for messages that weren't sent (e.g. a receive returned fewer messages)"""
+        if self._rate <= 0 or count <= 0:
+            return
+        self._next_time = max(self._next_time - count / self._rate, time.monotonic())
+
+
+class DeadLetterReprocessor:
+    """DeadLetterReprocessor drains the dead-letter queue for a subscription and resubmits the messages to the topic
+
+    The dead-letter queue is received with several concurrent receivers. Messages that match the filters are
+    (optionally) transformed and resubmitted in batches, and each batch is completed in the dead-letter queue
+    once it has been sent. Messages that don't match the filters (or fail) are left locked rather than abandoned
+    so that they aren't received again straight away, and they return to the dead-letter queue when their lock expires
+    (they are skipped if they are received again during the run). A receiver finishes when a receive returns nothing.
+
+    With a rate limit, the rate is acquired for a batch before it is received (and receivers don't prefetch) so that
+    messages aren't held locked while waiting for the rate limiter.
+
+    Resubmitted messages are sent to the topic (so they are also delivered to its other subscriptions),
+    with the DLQ_TARGET_SUBSCRIPTION_PROPERTY set so that ConsumerApp only handles them for the original subscription.
+
+    A dry run peeks the messages (without locking them) and reports what would be resubmitted.
+    """
+
+    _topic_name: str
+    _subscription_name: str
+    _target_topic_name: str
+    _reason: Optional[re.Pattern]
+    _older_than: Optional[float]
+    _newer_than: Optional[float]
+    _transform: Optional[Callable]
+    _dry_run: bool
+    _rate_limit: Optional[float]
+    _concurrency: int
+    _batch_size: int
+    _max_wait_time: float
+    _max_messages: Optional[int]
+    _progress_interval: float
+    _on_progress: Optional[Callable[[DeadLetterReprocessResult], None]]
+    _seen: set  # sequence numbers of messages left in the dead-letter queue during this run
+    _reserved: int  # messages being resubmitted or resubmitted (for max_messages)
+    _result: Optional[DeadLetterReprocessResult]
+    _credential: Optional["WorkloadIdentityCredential"]
+    metrics: MetricsRegistry
+
+    def __init__(
+        self,
+        topic_name: str,
+        subscription_name: str,
+        reason: Optional[str] = None,
+        older_than: Optional[float] = None,
+        newer_than: Optional[float] = None,
+        transform: Optional[Callable] = None,
+        dry_run: bool = False,
+        rate_limit: Optional[float] = None,
+        concurrency: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        max_wait_time: Optional[float] = None,
+        max_messages: Optional[int] = None,
+        target_topic_name: Optional[str] = None,
+        progress_interval: float = 10,
+        on_progress: Optional[Callable[[DeadLetterReprocessResult], None]] = None,
+        metrics: Optional[MetricsRegistry] = None,
+    ):
+        """
+        Args:
+            topic_name (str): The topic for the subscription
+            subscription_name (str): The subscription whose dead-letter queue is reprocessed
+            reason (Optional[str]): Only reprocess messages whose dead-letter reason matches this regular expression (e.g. "dropped by subscriber")
+            older_than (Optional[float]): Only reprocess messages enqueued at least this many seconds ago
+            newer_than (Optional[float]): Only reprocess messages enqueued at most this many seconds ago
+            transform (Optional[Callable]): A function to transform the message body before it is resubmitted (see register_transform)
+            dry_run (bool): Peek the messages and report what would be resubmitted without changing anything
+            rate_limit (Optional[float]): The maximum number of messages to resubmit per second (defaults to no limit)
+            concurrency (Optional[int]): The number of concurrent receivers (defaults to DLQ_CONCURRENCY)
+            batch_size (Optional[int]): The maximum number of messages per receive and resubmit batch (defaults to DLQ_BATCH_SIZE)
+            max_wait_time (Optional[float]): The time in seconds to wait for messages before a receiver finishes (defaults to DLQ_MAX_WAIT_TIME)
+            max_messages (Optional[int]): The maximum number of messages to resubmit (defaults to no limit)
+            target_topic_name (Optional[str]): The topic to resubmit to (defaults to topic_name)
+            progress_interval (float): The time in seconds between progress reports
+            on_progress (Optional[Callable]): Called with the DeadLetterReprocessResult so far for each progress report (defaults to logging it)
+            metrics (Optional[MetricsRegistry]): The registry to record reprocessing metrics in
+        """
+        self._topic_name = topic_name
+        self._subscription_name = subscription_name
+        self._target_topic_name = target_topic_name or topic_name
+        self._reason = re.compile(reason) if reason is not None else None
+        self._older_than = older_than
+        self._newer_than = newer_than
+        self._transform = transform
+        self._dry_run = dry_run
+        self._rate_limit = rate_limit
+        self._concurrency = concurrency or DLQ_CONCURRENCY
+        self._batch_size = batch_size or DLQ_BATCH_SIZE
+        self._max_wait_time = max_wait_time or DLQ_MAX_WAIT_TIME
+        self._max_messages = max_messages
+        self._progress_interval = progress_interval
+        self._on_progress = on_progress
+        self._seen = set()
+        self._reserved = 0
+        self._result = None
+        self._credential = None
+        self.metrics = metrics or default_registry
+
+    def _create_servicebus_client(self) -> "ServiceBusClient":
+        # imported on first use as the azure packages are slow to import (see benchmarks/bench_startup.py)
+        from azure.identity.aio import WorkloadIdentityCredential
+        from azure.servicebus.aio import ServiceBusClient
+
+        if AZURE_CLIENT_ID and AZURE_TENANT_ID and AZURE_AUTHORITY_HOST and AZURE_FEDERATED_TOKEN_FILE:
+            _logger.info("Using workload identity credentials")
+            self._credential = WorkloadIdentityCredential(
+                client_id=AZURE_CLIENT_ID,
+                tenant_id=AZURE_TENANT_ID,
+                token_file_path=AZURE_FEDERATED_TOKEN_FILE,
+            )
+            return ServiceBusClient(fully_qualified_namespace=SERVICE_BUS_NAMESPACE, credential=self._credential)
+        _logger.info("No workload identity credentials found, using connection string")
+        return ServiceBusClient.from_connection_string(conn_str=CONNECTION_STR)
+
+    def _matches(self, msg) -> bool:
+        """Check whether a dead-lettered message matches the reason and age filters"""
+        if self._reason is not None and not self._reason.search(msg.dead_letter_reason or ""):
+            return False
+        if self._older_than is not None or self._newer_than is not None:
+            if msg.enqueued_time_utc is None:
+                return False
+            age = (datetime.now(timezone.utc) - msg.enqueued_time_utc).total_seconds()
+            if self._older_than is not None and age < self._older_than:
+                return False
+            if self._newer_than is not None and age > self._newer_than:
+                return False
+        return True
+
+    def _to_resubmit_message(self, msg) -> Optional["ServiceBusMessage"]:
+        """Create the message to resubmit for a dead-lettered message (or None if the transform skipped it)"""
+        from azure.servicebus import ServiceBusMessage
+
+        application_properties = {
+            key: value for key, value in get_application_properties(msg).items() if key not in _DEAD_LETTER_PROPERTIES
+        }
+        application_properties[DLQ_TARGET_SUBSCRIPTION_PROPERTY] = self._subscription_name
+        application_properties[DLQ_RESUBMIT_COUNT_PROPERTY] = (
+            int(application_properties.get(DLQ_RESUBMIT_COUNT_PROPERTY, 0)) + 1
+        )
+        body = get_message_body_bytes(msg)
+        content_type = msg.content_type
+        if self._transform is not None:
+            if get_claim_check_key(msg) is not None:
+                raise Exception("Messages with claim-check bodies can't be transformed")
+            transformed = self._transform(decode_message(msg))
+            if transformed is None:
+                return None
+            if isinstance(transformed, StateChangeEventBase):
+                event_type = event_registry.get_event_type(type(transformed))
+                if event_type is not None:
+                    application_properties[EVENT_TYPE_PROPERTY] = event_type
+                body = transformed.json()
+            else:
+                body = json.dumps(transformed, default=pydantic_encoder)
+            # the new body is uncompressed JSON
+            content_type = "application/json"
+            application_properties.pop(CONTENT_ENCODING_PROPERTY, None)
+        return ServiceBusMessage(
+            body,
+            content_type=content_type,
+            message_id=msg.message_id,
+            correlation_id=msg.correlation_id,
+            subject=msg.subject,
+            session_id=msg.session_id,
+            application_properties=application_properties,
+        )
+
+    def _leave(self, msg, outcome: str):
+        """Leave a message in the dead-letter queue (it is skipped if received again during this run)"""
+        self._seen.add(msg.sequence_number)
+        if outcome == "skipped":
+            self._result.skipped += 1
+        else:
+            self._result.failed += 1
+        self.metrics.increment(
+            f"dlq_messages_{outcome}_total", topic=self._topic_name, subscription=self._subscription_name
+        )
+
+    def _prepare_batch(self, msgs: list) -> tuple:
+        """Filter and transform received messages, returning (originals, messages to resubmit)"""
+        originals = []
+        to_send = []
+        for msg in msgs:
+            if msg.sequence_number in self._seen:
+                continue
+            self._result.received += 1
+            if not self._matches(msg):
+                self._leave(msg, "skipped")
+                continue
+            if self._max_messages is not None and self._reserved >= self._max_messages:
+                self._leave(msg, "skipped")
+                continue
+            try:
+                resubmit_message = self._to_resubmit_message(msg)
+            except Exception as e:
+                _logger.warning(f"Failed to transform message {msg.message_id} ({msg.sequence_number}): {e!r}")
+                self._leave(msg, "failed")
+                continue
+            if resubmit_message is None:
+                self._leave(msg, "skipped")
+                continue
+            originals.append(msg)
+            to_send.append(resubmit_message)
+            self._reserved += 1
+        return originals, to_send
+
+    async def _send(self, sender, messages: list):
+        """Send messages, splitting the batch if it is too large for a single send"""
+        from azure.servicebus.exceptions import MessageSizeExceededError
+
+        try:
+            await sender.send_messages(messages)
+        except MessageSizeExceededError:
+            if len(messages) == 1:
+                raise
+            middle = len(messages) // 2
+            await self._send(sender, messages[:middle])
+            await self._send(sender, messages[middle:])
+
+    async def _run_receiver(self, client, sender, rate_limiter: _RateLimiter):
+        from azure.servicebus import ServiceBusSubQueue
+
+        receiver = client.get_subscription_receiver(
+            topic_name=self._topic_name,
+            subscription_name=self._subscription_name,
+            sub_queue=ServiceBusSubQueue.DEAD_LETTER,
+            # prefetched messages would be locked while waiting for the rate limiter
+            prefetch_count=0 if self._rate_limit else self._batch_size,
+        )
+        async with receiver:
+            while not self._is_done():
+                await rate_limiter.acquire(self._batch_size)
+                msgs = await receiver.receive_messages(
+                    max_message_count=self._batch_size, max_wait_time=self._max_wait_time
+                )
+                # finish when the queue is empty (messages left earlier in the run are skipped if they are returned
+                # again once their locks expire, so that the rest of the queue is still scanned)
+                if len(msgs) == 0:
+                    rate_limiter.release(self._batch_size)
+                    break
+                originals, to_send = self._prepare_batch(msgs)
+                rate_limiter.release(self._batch_size - len(to_send))
+                if len(to_send) == 0:
+                    continue
+                try:
+                    await self._send(sender, to_send)
+                except Exception as e:
+                    _logger.warning(
+                        f"Failed to resubmit {len(to_send)} message(s) to '{self._target_topic_name}': {e!r}"
+                    )
+                    for msg in originals:
+                        self._leave(msg, "failed")
+                    self._reserved -= len(originals)
+                    continue
+                # the messages are completed once they have been resubmitted (so a failure can only duplicate them)
+                results = await asyncio.gather(
+                    *[receiver.complete_message(msg) for msg in originals], return_exceptions=True
+                )
+                completed_count = 0
+                for msg, result in zip(originals, results):
+                    if isinstance(result, Exception):
+                        # e.g. the lock was lost: the message has been resubmitted but is still in the dead-letter queue
+                        _logger.warning(
+                            f"Failed to complete resubmitted message {msg.message_id} ({msg.sequence_number}): {result!r}"
+                        )
+                        self._leave(msg, "failed")
+                    else:
+                        completed_count += 1
+                self._result.resubmitted += completed_count
+                self.metrics.increment(
+                    "dlq_messages_resubmitted_total",
+                    completed_count,
+                    topic=self._topic_name,
+                    subscription=self._subscription_name,
+                )
+
+    def _is_done(self) -> bool:
+        return self._max_messages is not None and self._reserved >= self._max_messages
+
+    async def _run_dry_run(self, client):
+        from azure.servicebus import ServiceBusSubQueue
+
+        receiver = client.get_subscription_receiver(
+            topic_name=self._topic_name,
+            subscription_name=self._subscription_name,
+            sub_queue=ServiceBusSubQueue.DEAD_LETTER,
+        )
+        async with receiver:
+            next_sequence_number = 0
+            while not self._is_done():
+                msgs = await receiver.peek_messages(
+                    max_message_count=self._batch_size, sequence_number=next_sequence_number
+                )
+                if len(msgs) == 0:
+                    break
+                next_sequence_number = max(msg.sequence_number for msg in msgs) + 1
+                originals, _ = self._prepare_batch(msgs)
+                self._result.resubmitted += len(originals)
+
+    async def _report_progress(self, start: float):
+        while True:
+            await asyncio.sleep(self._progress_interval)
+            self._result.duration = timer() - start
+            self._notify_progress()
+
+    def _notify_progress(self):
+        if self._on_progress is not None:
+            self._on_progress(self._result)
+        else:
+            _logger.info(f"📊 {self._result}")
+
+    async def run(self) -> DeadLetterReprocessResult:
+        """Reprocess the dead-letter queue until it is empty (or max_messages have been resubmitted)"""
+        self._result = DeadLetterReprocessResult(dry_run=self._dry_run)
+        self._seen = set()
+        self._reserved = 0
+        _logger.info(
+            f"{'Dry run: peeking' if self._dry_run else 'Reprocessing'} dead-letter queue for {self._topic_name}|{self._subscription_name}..."
+        )
+        start = timer()
+        progress_task = asyncio.create_task(self._report_progress(start))
+        client = self._create_servicebus_client()
+        try:
+            async with client:
+                if self._dry_run:
+                    await self._run_dry_run(client)
+                else:
+                    sender = client.get_topic_sender(topic_name=self._target_topic_name)
+                    async with sender:
+                        rate_limiter = _RateLimiter(self._rate_limit)
+                        await asyncio.gather(
+                            *[self._run_receiver(client, sender, rate_limiter) for _ in range(self._concurrency)]
+                        )
+        finally:
+            progress_task.cancel()
+            if self._credential is not None:
+                await self._credential.close()
+                self._credential = None
+            self._result.duration = timer() - start
+        self._notify_progress()
+        return self._result
+
+
+def main(args: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pubsub.dlq",
+        description="Resubmit messages from a subscription's dead-letter queue to its topic",
+    )
+    parser.add_argument("topic", help="The topic name")
+    parser.add_argument("subscription", help="The subscription name")
+    parser.add_argument("--reason", help="Only resubmit messages whose dead-letter reason matches this regex")
+    parser.add_argument(
+        "--older-than", type=float, help="Only resubmit messages enqueued at least this many seconds ago"
+    )
+    parser.add_argument(
+        "--newer-than", type=float, help="Only resubmit messages enqueued at most this many seconds ago"
+    )
+    parser.add_argument("--transform", help="A registered transform name or <module>:<function> to transform messages")
+    parser.add_argument("--dry-run", action="store_true", help="Report what would be resubmitted without changes")
+    parser.add_argument("--rate-limit", type=float, help="The maximum messages to resubmit per second")
+    parser.add_argument("--concurrency", type=int, help="The number of concurrent receivers")
+    parser.add_argument("--batch-size", type=int, help="The maximum messages per receive/resubmit batch")
+    parser.add_argument("--max-messages", type=int, help="The maximum number of messages to resubmit")
+    parser.add_argument("--target-topic", help="The topic to resubmit to (defaults to the subscription's topic)")
+    parser.add_argument("--progress-interval", type=float, default=10, help="Seconds between progress reports")
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("azure").setLevel(logging.WARNING)
+
+    def print_progress(result: DeadLetterReprocessResult):
+        print(
+            f"{'[dry run] ' if result.dry_run else ''}received={result.received} "
+            f"{'would resubmit' if result.dry_run else 'resubmitted'}={result.resubmitted} "
+            f"skipped={result.skipped} failed={result.failed} "
+            f"({result.duration:.1f}s, {result.throughput:.1f} msg/s)",
+            flush=True,
+        )
+
+    reprocessor = DeadLetterReprocessor(
+        args.topic,
+        args.subscription,
+        reason=args.reason,
+        older_than=args.older_than,
+        newer_than=args.newer_than,
+        transform=get_transform(args.transform) if args.transform else None,
+        dry_run=args.dry_run,
+        rate_limit=args.rate_limit,
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        max_messages=args.max_messages,
+        target_topic_name=args.target_topic,
+        progress_interval=args.progress_interval,
+        on_progress=print_progress,
+    )
+    from .event_loop import run
+
+    result = run(reprocessor.run())
+    return 1 if result.failed > 0 else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import os
+from typing import Callable, Optional
+
+# uvloop is optional - the uvloop event loop is only used if it is installed
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+EVENT_LOOP = os.getenv("EVENT_LOOP", "auto").lower()
+
+EVENT_LOOP_AUTO = "auto"  # uvloop if it is installed, otherwise asyncio
+EVENT_LOOP_UVLOOP = "uvloop"
+EVENT_LOOP_ASYNCIO = "asyncio"
+EVENT_LOOP_NAMES = [EVENT_LOOP_AUTO, EVENT_LOOP_UVLOOP, EVENT_LOOP_ASYNCIO]
+
+_logger = logging.getLogger(__name__)
+
+
+def resolve_event_loop(event_loop: Optional[str] = None) -> str:
+    """Resolve an event loop option ("auto", "uvloop" or "asyncio") to the event loop that will be used
+
+    Args:
+        event_loop (Optional[str]): The event loop option (defaults to EVENT_LOOP)
+    """
+    name = (event_loop or EVENT_LOOP).lower()
+    if name not in EVENT_LOOP_NAMES:
+        raise Exception(f"Unknown event loop '{name}' (expected one of {EVENT_LOOP_NAMES})")
+    if name == EVENT_LOOP_ASYNCIO:
+        return EVENT_LOOP_ASYNCIO
+    if uvloop is None:
+        if name == EVENT_LOOP_UVLOOP:
+            _logger.warning("uvloop event loop requested but uvloop isn't installed - using the asyncio event loop")
+        return EVENT_LOOP_ASYNCIO
+    return EVENT_LOOP_UVLOOP
+
+
+def get_loop_factory(event_loop: Optional[str] = None) -> Callable[[], asyncio.AbstractEventLoop]:
+    """Get the function that creates new event loops for an event loop option (see resolve_event_loop)"""
+    if resolve_event_loop(event_loop) == EVENT_LOOP_UVLOOP:
+        return uvloop.new_event_loop
+    return asyncio.new_event_loop
+
+
+def new_event_loop(event_loop: Optional[str] = None) -> asyncio.AbstractEventLoop:
+    """Create a new event loop for an event loop option (see resolve_event_loop)"""
+    return get_loop_factory(event_loop)()
+
+
+def run(main, event_loop: Optional[str] = None):
+    """Run a coroutine on a new event loop (like asyncio.run), using uvloop if selected and installed
+
+    Args:
+        main: The coroutine to run
+        event_loop (Optional[str]): "auto" (uvloop if installed), "uvloop" or "asyncio" (defaults to EVENT_LOOP)
+    """
+    name = resolve_event_loop(event_loop)
+    _logger.info(f"Using {name} event loop")
+    with asyncio.Runner(loop_factory=get_loop_factory(name)) as runner:
+        return runner.run(main)
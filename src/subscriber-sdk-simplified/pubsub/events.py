@@ -0,0 +1,193 @@
+import logging
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel
+
+from . import case
+
+EVENT_TYPE_PROPERTY = "event-type"
+"""The application property that identifies the event type of a message (for topics with several event classes)"""
+
+_logger = logging.getLogger(__name__)
+
+
+class ConsumerResult(Enum):
+    """ConsumerResult is used to indicate the result when a consumer processes a message"""
+
+    SUCCESS = 0
+    """The message was processed successfully and should be marked as completed"""
+
+    RETRY = 1
+    """The message was not processed successfully and should be marked as abandoned and retried"""
+
+    DROP = 2
+    """The message was not processed successfully but is invalid and should be sent to the dead-letter queue"""
+
+
+class EventRegistry:
+    """EventRegistry indexes the StateChangeEventBase subclasses by topic and event type
+
+    Event classes are registered when they are defined (so classes defined or imported after a ConsumerApp
+    is created are also found). A topic can have several event classes (e.g. different event types or schema
+    versions), identified by the event type that the publisher stamps in the "event-type" application property.
+    Messages without an event type are mapped to the default class for the topic, which is the class whose name
+    matches the topic (or the first class registered for the topic).
+    """
+
+    _event_classes: list
+    _topics: dict  # key: event class, value: topic name
+    _event_types: dict  # key: event class, value: event type
+    _by_topic: dict  # key: topic name, value: list of event classes
+    _by_topic_and_event_type: dict  # key: (topic name, event type), value: event class
+    _default_by_topic: dict  # key: topic name, value: event class for messages without an event type
+    _promoted_fields: dict  # key: topic name, value: set of field names sent as application properties
+
+    def __init__(self):
+        self._event_classes = []
+        self._topics = {}
+        self._event_types = {}
+        self._by_topic = {}
+        self._by_topic_and_event_type = {}
+        self._default_by_topic = {}
+        self._promoted_fields = {}
+
+    def register(self, event_class, topic: Optional[str] = None, event_type: Optional[str] = None):
+        """Register an event class
+
+        Args:
+            event_class: The event class to register
+            topic (Optional[str]): The topic for the event class (defaults to the topic from the class name, e.g. TaskCreatedStateChangeEvent -> task-created)
+            event_type (Optional[str]): The event type used to identify the class on the topic (defaults to the class name)
+        """
+        is_default = topic is None
+        if topic is None:
+            topic = _get_topic_name_from_class_name(event_class)
+        if event_type is None:
+            event_type = event_class.__name__
+
+        existing = self._by_topic_and_event_type.get((topic, event_type))
+        if existing is not None:
+            # e.g. a module that has been reloaded
+            _logger.warning(
+                f"Replacing event class {existing} for topic '{topic}' and event type '{event_type}' with {event_class}"
+            )
+            self._unregister(existing)
+
+        self._event_classes.append(event_class)
+        self._topics[event_class] = topic
+        self._event_types[event_class] = event_type
+        self._by_topic.setdefault(topic, []).append(event_class)
+        self._by_topic_and_event_type[(topic, event_type)] = event_class
+        if is_default or topic not in self._default_by_topic:
+            self._default_by_topic[topic] = event_class
+
+    def _unregister(self, event_class):
+        topic = self._topics.pop(event_class)
+        event_type = self._event_types.pop(event_class)
+        self._event_classes.remove(event_class)
+        self._by_topic[topic].remove(event_class)
+        del self._by_topic_and_event_type[(topic, event_type)]
+        if self._default_by_topic.get(topic) is event_class:
+            if len(self._by_topic[topic]) > 0:
+                self._default_by_topic[topic] = self._by_topic[topic][0]
+            else:
+                del self._default_by_topic[topic]
+                del self._by_topic[topic]
+
+    def get_event_classes(self) -> list:
+        """Get all registered event classes (in registration order)"""
+        return list(self._event_classes)
+
+    def get_topics(self) -> list[str]:
+        return list(self._by_topic.keys())
+
+    def get_event_classes_for_topic(self, topic: str) -> list:
+        return list(self._by_topic.get(topic, []))
+
+    def get_default_event_classes(self) -> dict:
+        """Get the default event class for each topic (keyed on topic name)"""
+        return self._default_by_topic
+
+    def get_event_class(self, topic: str, event_type: Optional[str] = None):
+        """Get the event class for a message on a topic (or None if the event type isn't registered for the topic)
+
+        Args:
+            topic (str): The topic the message was received from
+            event_type (Optional[str]): The event type from the message's "event-type" application property (if set)
+        """
+        if event_type is None:
+            return self._default_by_topic.get(topic)
+        return self._by_topic_and_event_type.get((topic, event_type))
+
+    def get_topic(self, event_class) -> Optional[str]:
+        return self._topics.get(event_class)
+
+    def get_event_type(self, event_class) -> Optional[str]:
+        return self._event_types.get(event_class)
+
+    def promote_fields(self, topic: str, fields):
+        """Mark event fields on a topic to be sent as application properties (e.g. for use in subscription filters)"""
+        self._promoted_fields.setdefault(topic, set()).update(fields)
+
+    def get_promoted_fields(self, topic: str) -> set:
+        return self._promoted_fields.get(topic, set())
+
+
+event_registry = EventRegistry()
+"""The registry that StateChangeEventBase subclasses are registered in when they are defined"""
+
+
+class StateChangeEventBase(BaseModel):
+    """StateChangeEventBase is the base type for state change events
+
+    Subclasses are registered in event_registry when they are defined (classes with names ending in "Base" are
+    treated as abstract and not registered). The topic and event type can be set with class keyword arguments, e.g.
+    class TaskCreatedV2StateChangeEvent(StateChangeEventBase, topic="task-created", event_type="task-created.v2")
+
+    promoted_fields lists fields that the publisher sends as application properties so that subscriptions can
+    filter on them, e.g. class TaskCreatedStateChangeEvent(StateChangeEventBase, promoted_fields=["status"])
+    """
+
+    entity_id: str
+
+    def __init_subclass__(
+        cls,
+        topic: Optional[str] = None,
+        event_type: Optional[str] = None,
+        promoted_fields: Optional[list[str]] = None,
+        **kwargs,
+    ):
+        super().__init_subclass__(**kwargs)
+        if not cls.__name__.endswith("Base"):
+            event_registry.register(cls, topic=topic, event_type=event_type)
+            if promoted_fields:
+                event_registry.promote_fields(event_registry.get_topic(cls), promoted_fields)
+
+    def get_event_classes():
+        return event_registry.get_event_classes()
+
+
+def get_topic_name_from_method(func):
+    function_name = func.__name__
+    if not function_name.startswith("on_"):
+        raise Exception(f"Function name must be in the form on_<entity-name>_<event-name>")
+    topic_name = case.snake_to_kebab_case(function_name[3:])
+    return topic_name
+
+
+def _get_topic_name_from_class_name(event_class):
+    event_class_name = event_class.__name__
+    if not event_class_name.endswith("StateChangeEvent"):
+        raise Exception(f"Event class name must end with StateChangeEvent")
+
+    topic_name = event_class_name.replace("StateChangeEvent", "")
+
+    return case.pascal_to_kebab_case(topic_name)
+
+
+def get_topic_name_from_event_class(event_class):
+    topic_name = event_registry.get_topic(event_class)
+    if topic_name is None:
+        topic_name = _get_topic_name_from_class_name(event_class)
+    return topic_name
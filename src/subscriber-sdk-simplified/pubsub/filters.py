@@ -0,0 +1,304 @@
+import enum
+import hashlib
+import re
+from typing import Optional, Union
+
+#
+# Declarative message filters for consume(filter=...)
+#
+# A filter is built from fields of the event (promoted to application properties by the publisher), e.g.
+#   field("status") == "open"
+#   (field("priority") >= 3) & field("region").is_in(["uk", "eu"])
+# and is converted to a Service Bus subscription rule (a correlation filter for simple equality checks, otherwise a
+# SQL filter) so that the broker only delivers matching messages. Filters can also be evaluated in-process against
+# the properties of a received message (using SQL semantics: comparisons with a missing property are not matched).
+#
+
+FILTER_RULE_PREFIX = "pubsub-filter-"
+"""The prefix for the names of the subscription rules created for filters"""
+
+_VALID_FIELD_NAME = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+_OPERATORS = {
+    "=": lambda a, b: a == b,
+    "<>": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+
+
+def to_property_value(value):
+    """Convert a field value to a value that can be sent as an application property (or None to omit it)"""
+    if isinstance(value, enum.Enum):
+        value = value.value
+    if value is None or isinstance(value, (str, bool, int, float)):
+        return value
+    return str(value)
+
+
+def _to_sql_literal(value) -> str:
+    value = to_property_value(value)
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    raise Exception(f"Unsupported filter value: {value!r}")
+
+
+class Filter:
+    """Filter is the base class for filter expressions (combine filters with &, | and ~)"""
+
+    def get_fields(self) -> set:
+        """The names of the fields used by the filter"""
+        raise NotImplementedError()
+
+    def to_sql(self) -> str:
+        """The Service Bus SQL filter expression for the filter"""
+        raise NotImplementedError()
+
+    def get_correlation_properties(self) -> Optional[dict]:
+        """The properties for an equivalent correlation filter (or None if the filter can't be expressed as one)"""
+        return None
+
+    def _evaluate(self, values: dict) -> Optional[bool]:
+        # returns None for unknown (e.g. comparing a missing value), as SQL does
+        raise NotImplementedError()
+
+    def evaluate(self, values: dict) -> bool:
+        """Evaluate the filter against a dict of field values"""
+        return self._evaluate(values) is True
+
+    def __and__(self, other: "Filter") -> "Filter":
+        return AndFilter([self, other])
+
+    def __or__(self, other: "Filter") -> "Filter":
+        return OrFilter([self, other])
+
+    def __invert__(self) -> "Filter":
+        return NotFilter(self)
+
+    def __repr__(self) -> str:
+        return self.to_sql()
+
+
+class ComparisonFilter(Filter):
+    name: str
+    operator: str
+    value: Union[str, bool, int, float]
+
+    def __init__(self, name: str, operator: str, value):
+        if to_property_value(value) is None:
+            raise Exception(f"Filter values can't be None (use ~field('{name}').exists() to match missing values)")
+        self.name = name
+        self.operator = operator
+        self.value = to_property_value(value)
+
+    def get_fields(self) -> set:
+        return {self.name}
+
+    def to_sql(self) -> str:
+        return f"user.{self.name} {self.operator} {_to_sql_literal(self.value)}"
+
+    def get_correlation_properties(self) -> Optional[dict]:
+        if self.operator == "=":
+            return {self.name: self.value}
+        return None
+
+    def _evaluate(self, values: dict) -> Optional[bool]:
+        value = values.get(self.name)
+        if value is None:
+            return None
+        try:
+            return _OPERATORS[self.operator](value, self.value)
+        except TypeError:
+            # e.g. comparing a string property with a number
+            return None
+
+
+class InFilter(Filter):
+    name: str
+    values: list
+
+    def __init__(self, name: str, values: list):
+        if len(values) == 0:
+            raise Exception(f"is_in for field '{name}' needs at least one value")
+        self.name = name
+        self.values = [to_property_value(value) for value in values]
+
+    def get_fields(self) -> set:
+        return {self.name}
+
+    def to_sql(self) -> str:
+        return f"user.{self.name} IN ({', '.join(_to_sql_literal(value) for value in self.values)})"
+
+    def _evaluate(self, values: dict) -> Optional[bool]:
+        value = values.get(self.name)
+        if value is None:
+            return None
+        return value in self.values
+
+
+class ExistsFilter(Filter):
+    name: str
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def get_fields(self) -> set:
+        return {self.name}
+
+    def to_sql(self) -> str:
+        return f"EXISTS(user.{self.name})"
+
+    def _evaluate(self, values: dict) -> Optional[bool]:
+        return values.get(self.name) is not None
+
+
+class AndFilter(Filter):
+    filters: list[Filter]
+
+    def __init__(self, filters: list[Filter]):
+        self.filters = filters
+
+    def get_fields(self) -> set:
+        return set().union(*[f.get_fields() for f in self.filters])
+
+    def to_sql(self) -> str:
+        return " AND ".join(f"({f.to_sql()})" for f in self.filters)
+
+    def get_correlation_properties(self) -> Optional[dict]:
+        properties = {}
+        for f in self.filters:
+            filter_properties = f.get_correlation_properties()
+            if filter_properties is None:
+                return None
+            for name, value in filter_properties.items():
+                if name in properties and properties[name] != value:
+                    return None
+                properties[name] = value
+        return properties
+
+    def _evaluate(self, values: dict) -> Optional[bool]:
+        results = [f._evaluate(values) for f in self.filters]
+        if False in results:
+            return False
+        if None in results:
+            return None
+        return True
+
+
+class OrFilter(Filter):
+    filters: list[Filter]
+
+    def __init__(self, filters: list[Filter]):
+        self.filters = filters
+
+    def get_fields(self) -> set:
+        return set().union(*[f.get_fields() for f in self.filters])
+
+    def to_sql(self) -> str:
+        return " OR ".join(f"({f.to_sql()})" for f in self.filters)
+
+    def _evaluate(self, values: dict) -> Optional[bool]:
+        results = [f._evaluate(values) for f in self.filters]
+        if True in results:
+            return True
+        if None in results:
+            return None
+        return False
+
+
+class NotFilter(Filter):
+    filter: Filter
+
+    def __init__(self, filter: Filter):
+        self.filter = filter
+
+    def get_fields(self) -> set:
+        return self.filter.get_fields()
+
+    def to_sql(self) -> str:
+        return f"NOT ({self.filter.to_sql()})"
+
+    def _evaluate(self, values: dict) -> Optional[bool]:
+        result = self.filter._evaluate(values)
+        return None if result is None else not result
+
+
+class Field:
+    """Field refers to an event field in a filter expression (see field())"""
+
+    name: str
+
+    def __init__(self, name: str):
+        if not _VALID_FIELD_NAME.match(name):
+            raise Exception(f"Invalid filter field name '{name}' (expected a top-level event field name)")
+        self.name = name
+
+    def __eq__(self, value) -> Filter:
+        return ComparisonFilter(self.name, "=", value)
+
+    def __ne__(self, value) -> Filter:
+        return ComparisonFilter(self.name, "<>", value)
+
+    def __lt__(self, value) -> Filter:
+        return ComparisonFilter(self.name, "<", value)
+
+    def __le__(self, value) -> Filter:
+        return ComparisonFilter(self.name, "<=", value)
+
+    def __gt__(self, value) -> Filter:
+        return ComparisonFilter(self.name, ">", value)
+
+    def __ge__(self, value) -> Filter:
+        return ComparisonFilter(self.name, ">=", value)
+
+    def is_in(self, values: list) -> Filter:
+        return InFilter(self.name, values)
+
+    def exists(self) -> Filter:
+        return ExistsFilter(self.name)
+
+    __hash__ = None
+
+
+def field(name: str) -> Field:
+    """Refer to an event field in a filter, e.g. field("status") == "open" """
+    return Field(name)
+
+
+def to_filter(filter: Union[Filter, dict, None]) -> Optional[Filter]:
+    """Convert a filter argument to a Filter (a dict is shorthand for fields that must equal the given values)"""
+    if filter is None or isinstance(filter, Filter):
+        return filter
+    if isinstance(filter, dict):
+        if len(filter) == 0:
+            return None
+        filters = [field(name) == value for name, value in filter.items()]
+        return filters[0] if len(filters) == 1 else AndFilter(filters)
+    raise Exception(f"Unsupported filter: {filter!r} (expected a Filter or a dict)")
+
+
+def any_of(filters: list[Filter]) -> Filter:
+    """Combine filters so that a message matches if it matches any of them"""
+    return filters[0] if len(filters) == 1 else OrFilter(filters)
+
+
+def get_rule_name(filter: Filter) -> str:
+    """The subscription rule name for a filter (the name changes when the filter changes)"""
+    return FILTER_RULE_PREFIX + hashlib.sha1(filter.to_sql().encode("utf-8")).hexdigest()[:12]
+
+
+def to_rule_filter(filter: Filter):
+    """Convert a filter to a CorrelationRuleFilter (for simple equality checks) or a SqlRuleFilter"""
+    from azure.servicebus.management import CorrelationRuleFilter, SqlRuleFilter
+
+    correlation_properties = filter.get_correlation_properties()
+    if correlation_properties is not None:
+        # correlation filters are matched with a hash lookup, which is cheaper for the broker than evaluating SQL
+        return CorrelationRuleFilter(properties=correlation_properties)
+    return SqlRuleFilter(filter.to_sql())
@@ -0,0 +1,230 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import time
+import tracemalloc
+from typing import Optional
+
+HEALTH_PORT = int(os.getenv("HEALTH_PORT")) if os.getenv("HEALTH_PORT") else None
+HEALTH_HOST = os.getenv("HEALTH_HOST", "0.0.0.0")
+HEALTH_THROUGHPUT_WINDOW = float(os.getenv("HEALTH_THROUGHPUT_WINDOW", "60"))
+
+_REQUEST_TIMEOUT = 5
+_STATUS_TEXT = {200: "OK", 404: "Not Found", 405: "Method Not Allowed", 409: "Conflict", 503: "Service Unavailable"}
+
+
+def _get_enqueued_timestamp(msg) -> Optional[float]:
+    enqueued_time = msg.enqueued_time_utc
+    return enqueued_time.timestamp() if enqueued_time is not None else None
+
+
+class SubscriptionHealth:
+    """SubscriptionHealth tracks the receiver state, lag and throughput for a subscription
+
+    This is updated once per receive (not per message), and the lag and ages are computed when they are read.
+    Lag is the time from a message being enqueued to its batch completing, using the first (oldest) and
+    last (newest) messages in the batch as the broker delivers messages in the order they were enqueued.
+    """
+
+    receiver_attached: bool
+    completed_total: int
+    lag_seconds: Optional[float]  # lag of the oldest message in the last batch (0 when the subscription is idle)
+    min_lag_seconds: Optional[float]  # lag of the newest message in the last batch
+    _in_flight: dict  # key: batch id, value: (message count, oldest enqueued timestamp, newest enqueued timestamp)
+    _next_batch_id: int
+    _completions: collections.deque  # (monotonic time, count) for batches completed in the throughput window
+    _throughput_window: float
+
+    def __init__(self, throughput_window: Optional[float] = None):
+        self.receiver_attached = False
+        self.completed_total = 0
+        self.lag_seconds = None
+        self.min_lag_seconds = None
+        self._in_flight = {}
+        self._next_batch_id = 0
+        self._completions = collections.deque()
+        self._throughput_window = throughput_window or HEALTH_THROUGHPUT_WINDOW
+
+    def batch_started(self, msgs: list) -> int:
+        """Record a received batch, returning the batch id to pass to batch_completed (batches can overlap, e.g. for sessions)"""
+        batch_id = self._next_batch_id
+        self._next_batch_id += 1
+        self._in_flight[batch_id] = (len(msgs), _get_enqueued_timestamp(msgs[0]), _get_enqueued_timestamp(msgs[-1]))
+        return batch_id
+
+    def batch_completed(self, batch_id: int):
+        batch = self._in_flight.pop(batch_id, None)
+        if batch is None:
+            return
+        count, oldest_enqueued, newest_enqueued = batch
+        now = time.time()
+        if oldest_enqueued is not None:
+            self.lag_seconds = max(now - oldest_enqueued, 0)
+        if newest_enqueued is not None:
+            self.min_lag_seconds = max(now - newest_enqueued, 0)
+        self.completed_total += count
+        self._completions.append((time.monotonic(), count))
+        self._trim_completions(time.monotonic())
+
+    def detach(self):
+        """Record that the receiver has closed (or failed), discarding any in-flight batches"""
+        self.receiver_attached = False
+        self._in_flight = {}
+
+    def receive_empty(self):
+        """Record an empty receive (i.e. the subscription has caught up)"""
+        self.lag_seconds = 0
+        self.min_lag_seconds = 0
+
+    def _trim_completions(self, now: float):
+        while self._completions and self._completions[0][0] < now - self._throughput_window:
+            self._completions.popleft()
+
+    @property
+    def in_flight_count(self) -> int:
+        """The number of messages being processed"""
+        return sum(count for count, _, _ in self._in_flight.values())
+
+    @property
+    def oldest_in_flight_age_seconds(self) -> Optional[float]:
+        """The time since the oldest message being processed was enqueued (None if no messages are being processed)"""
+        oldest_enqueued = [oldest for _, oldest, _ in self._in_flight.values() if oldest is not None]
+        if len(oldest_enqueued) == 0:
+            return None
+        return max(time.time() - min(oldest_enqueued), 0)
+
+    @property
+    def throughput(self) -> float:
+        """The number of messages completed per second over the throughput window"""
+        self._trim_completions(time.monotonic())
+        return sum(count for _, count in self._completions) / self._throughput_window
+
+    def to_dict(self) -> dict:
+        return {
+            "receiver_attached": self.receiver_attached,
+            "lag_seconds": self.lag_seconds,
+            "min_lag_seconds": self.min_lag_seconds,
+            "oldest_in_flight_age_seconds": self.oldest_in_flight_age_seconds,
+            "in_flight": self.in_flight_count,
+            "throughput_per_second": self.throughput,
+            "completed_total": self.completed_total,
+        }
+
+
+class HealthServer:
+    """HealthServer is a minimal HTTP server for liveness/readiness probes, lag and metrics
+
+    Endpoints:
+        /live: 200 while the event loop is responsive
+        /ready: 200 when every running subscription has a receiver attached and the app isn't cancelled (503 otherwise)
+        /lag: JSON with the lag, oldest in-flight message age and throughput for each subscription
+        /metrics: the app's metrics in Prometheus text format (including the lag gauges)
+        /allocations: JSON with the top allocation sites for each subscription (409 unless allocation tracing is enabled)
+    """
+
+    _app: "ConsumerApp"
+    _host: str
+    _port: int
+    _server: Optional[asyncio.AbstractServer]
+
+    def __init__(self, app: "ConsumerApp", port: int, host: Optional[str] = None):
+        """
+        Args:
+            app (ConsumerApp): The app to report on
+            port (int): The port to listen on (0 to use a free port, see the port property)
+            host (Optional[str]): The host to listen on (defaults to HEALTH_HOST)
+        """
+        self._app = app
+        self._host = host or HEALTH_HOST
+        self._port = port
+        self._server = None
+        self._logger = logging.getLogger(__name__)
+
+    @property
+    def port(self) -> int:
+        """The port the server is listening on"""
+        if self._server is not None and self._server.sockets:
+            return self._server.sockets[0].getsockname()[1]
+        return self._port
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self._host, self._port)
+        self._logger.info(f"🩺 Health endpoint listening on {self._host}:{self.port}")
+
+    async def close(self):
+        if self._server is None:
+            return
+        self._server.close()
+        await self._server.wait_closed()
+        self._server = None
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=_REQUEST_TIMEOUT)
+            # the request body (if any) is ignored, but the headers are read so that the client sees a clean close
+            while True:
+                line = await asyncio.wait_for(reader.readline(), timeout=_REQUEST_TIMEOUT)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            parts = request_line.decode("latin-1").split()
+            method, path = (parts[0], parts[1].split("?")[0]) if len(parts) >= 2 else ("", "")
+            status, content_type, body = self._get_response(method, path)
+            writer.write(
+                (
+                    f"HTTP/1.1 {status} {_STATUS_TEXT[status]}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\n"
+                    "Connection: close\r\n\r\n"
+                ).encode("latin-1")
+                + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            self._logger.debug(f"Health endpoint connection error: {e!r}")
+        finally:
+            writer.close()
+
+    def _get_response(self, method: str, path: str) -> tuple:
+        """Get the (status, content type, body) for a request"""
+        if method != "GET":
+            return 405, "text/plain", b"method not allowed\n"
+        if path == "/live":
+            return 200, "text/plain", b"ok\n"
+        if path == "/ready":
+            ready = self._app.is_ready
+            body = {
+                "ready": ready,
+                "cancelled": self._app.is_cancelled,
+                "subscriptions": {
+                    key: health.receiver_attached for key, health in self._app.get_subscription_health().items()
+                },
+            }
+            return (200 if ready else 503), "application/json", json.dumps(body).encode("utf-8")
+        if path == "/lag":
+            body = {"subscriptions": {key: h.to_dict() for key, h in self._app.get_subscription_health().items()}}
+            return 200, "application/json", json.dumps(body).encode("utf-8")
+        if path == "/allocations":
+            if not tracemalloc.is_tracing():
+                return (
+                    409,
+                    "text/plain",
+                    b"allocation tracing is not enabled (set ALLOCATION_TRACING or send SIGUSR2)\n",
+                )
+            return 200, "application/json", json.dumps(self._app.get_allocation_report()).encode("utf-8")
+        if path == "/metrics":
+            self._update_metrics()
+            return 200, "text/plain; version=0.0.4", self._app.metrics.render_prometheus().encode("utf-8")
+        return 404, "text/plain", b"not found\n"
+
+    def _update_metrics(self):
+        """Set the lag gauges (computed when metrics are scraped rather than for each message)"""
+        for key, health in self._app.get_subscription_health().items():
+            topic, subscription = key.split("|", 1)
+            labels = {"topic": topic, "subscription": subscription}
+            self._app.metrics.set_gauge("subscription_lag_seconds", health.lag_seconds or 0, **labels)
+            self._app.metrics.set_gauge(
+                "subscription_oldest_in_flight_age_seconds", health.oldest_in_flight_age_seconds or 0, **labels
+            )
+            self._app.metrics.set_gauge("subscription_throughput_per_second", health.throughput, **labels)
@@ -0,0 +1,398 @@
+import argparse
+import asyncio
+import logging
+import math
+import random
+import uuid
+from timeit import default_timer as timer
+from typing import Optional
+
+from .events import StateChangeEventBase, event_registry
+from .metrics import MetricsRegistry
+from .publisher import Publisher
+
+_logger = logging.getLogger(__name__)
+
+#
+# Load generator for publishing events to stress subscribers (python -m pubsub.loadgen --help).
+#
+# With a target rate, the generator runs open-loop: each send is scheduled at a fixed time (start + i / rate)
+# regardless of how long earlier sends took, and its latency is measured from that scheduled time. A closed loop
+# (send, wait, send) slows down when the broker does, so a stall only delays one measured send and the sends that
+# should have happened during it are never measured (coordinated omission). The service time (from when the send
+# actually started) is reported too, so the difference shows the queueing.
+#
+
+
+class LatencyHistogram:
+    """LatencyHistogram records latencies in log-spaced buckets (about 1% apart) to report percentiles
+
+    Unlike the metrics Histogram, the buckets adapt to the range of the values, so percentiles are accurate
+    (to the bucket precision) from microseconds to minutes without keeping every value.
+    """
+
+    _base: float
+    _counts: dict  # key: bucket index, value: count
+    count: int
+    sum: float
+    min: float
+    max: float
+
+    _MIN_VALUE = 1e-6  # values are recorded with microsecond resolution
+
+    def __init__(self, precision: float = 0.01):
+        self._base = 1 + precision
+        self._counts = {}
+        self.count = 0
+        self.sum = 0
+        self.min = math.inf
+        self.max = 0
+
+    def record(self, value: float):
+        index = int(math.log(max(value, self._MIN_VALUE) / self._MIN_VALUE, self._base))
+        self._counts[index] = self._counts.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count > 0 else 0
+
+    def percentile(self, percentile: float) -> float:
+        """Get the value at a percentile (0-100), i.e. the upper bound of the bucket it falls in"""
+        if self.count == 0:
+            return 0
+        target = math.ceil(self.count * percentile / 100)
+        seen = 0
+        for index in sorted(self._counts):
+            seen += self._counts[index]
+            if seen >= target:
+                return min(self._MIN_VALUE * self._base ** (index + 1), self.max)
+        return self.max
+
+    def get_buckets(self, bounds: list[float]) -> list[int]:
+        """Get the count of values at or below each bound (and above the last bound), to render a histogram"""
+        counts = [0] * (len(bounds) + 1)
+        for index, count in self._counts.items():
+            value = self._MIN_VALUE * self._base**index
+            slot = next((i for i, bound in enumerate(bounds) if value <= bound), len(bounds))
+            counts[slot] += count
+        return counts
+
+
+class LoadReport:
+    """LoadReport summarises a LoadGenerator run"""
+
+    target_rate: Optional[float]  # None when running at maximum throughput
+    sent: int
+    failed: int
+    duration: float  # from the first scheduled send until the last send completed
+    max_schedule_lag: float  # the longest the generator was behind schedule starting a send
+    latency: LatencyHistogram  # from the scheduled send time (open-loop) until the send completed
+    service_time: LatencyHistogram  # from the actual start of the send until it completed
+    latency_by_topic: dict  # key: topic name, value: LatencyHistogram
+
+    def __init__(self, target_rate: Optional[float]):
+        self.target_rate = target_rate
+        self.sent = 0
+        self.failed = 0
+        self.duration = 0
+        self.max_schedule_lag = 0
+        self.latency = LatencyHistogram()
+        self.service_time = LatencyHistogram()
+        self.latency_by_topic = {}
+
+    @property
+    def achieved_rate(self) -> float:
+        return self.sent / self.duration if self.duration > 0 else 0
+
+    def format(self) -> str:
+        target = f"{self.target_rate:.0f}/s" if self.target_rate else "max"
+        lines = [
+            f"sent={self.sent} failed={self.failed} in {self.duration:.2f}s "
+            f"(target rate {target}, achieved {self.achieved_rate:.1f}/s, max schedule lag {self.max_schedule_lag * 1000:.1f}ms)",
+            f"{'':<24} {'count':>8} {'mean':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'p99.9':>9} {'max':>9}  (ms)",
+        ]
+        rows = [("latency", self.latency), ("service time", self.service_time)]
+        rows += [(f"latency {topic}", histogram) for topic, histogram in sorted(self.latency_by_topic.items())]
+        for name, histogram in rows:
+            values = [histogram.mean] + [histogram.percentile(p) for p in [50, 90, 99, 99.9]] + [histogram.max]
+            lines.append(f"{name:<24} {histogram.count:>8} " + " ".join(f"{value * 1000:>9.2f}" for value in values))
+
+        bounds = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5]
+        counts = self.latency.get_buckets(bounds)
+        widest = max(counts) or 1
+        lines.append("latency histogram:")
+        labels = [f"<= {bound * 1000:g}ms" for bound in bounds] + [f"> {bounds[-1] * 1000:g}ms"]
+        for label, count in zip(labels, counts):
+            lines.append(f"  {label:>10} {count:>8} {'#' * round(40 * count / widest)}")
+        return "\n".join(lines)
+
+
+def parse_weights(value: str) -> dict:
+    """Parse a weighted mix like "task-created=3,task-updated=1" (the weight defaults to 1)"""
+    weights = {}
+    for item in value.split(","):
+        name, _, weight = item.strip().partition("=")
+        weights[name.strip()] = float(weight) if weight else 1
+    return weights
+
+
+class LoadGenerator:
+    """LoadGenerator publishes a mix of events at a target rate (or at maximum throughput) and measures send latency
+
+    With a rate, sends are scheduled open-loop (see the module comment) with at most concurrency sends in flight:
+    when the sends can't keep up, the generator falls behind schedule and the wait is included in the latency.
+    Without a rate, concurrency workers each send back-to-back (a closed loop), so latency equals service time.
+    """
+
+    _publisher: Publisher
+    _topics: dict  # key: topic name, value: weight
+    _payload_sizes: dict  # key: payload size in bytes, value: weight
+    _rate: Optional[float]
+    _concurrency: int
+    _duration: Optional[float]
+    _count: Optional[int]
+    _random: random.Random
+    _report: LoadReport
+
+    def __init__(
+        self,
+        publisher: Publisher,
+        topics: dict,
+        payload_sizes: Optional[dict] = None,
+        rate: Optional[float] = None,
+        concurrency: int = 64,
+        duration: Optional[float] = None,
+        count: Optional[int] = None,
+        seed: Optional[int] = None,
+    ):
+        """
+        Args:
+            publisher (Publisher): The (started) publisher to publish with
+            topics (dict): The weight of each topic in the mix, keyed on topic name (events are created with the topic's default event class)
+            payload_sizes (Optional[dict]): The weight of each payload size in bytes (the size of a padding field added to the event). Defaults to no padding
+            rate (Optional[float]): The target number of sends per second. If not set, sends as fast as possible
+            concurrency (int): The maximum number of sends in flight
+            duration (Optional[float]): How long to generate load for in seconds
+            count (Optional[int]): The number of events to send (the run stops at whichever of duration and count comes first)
+            seed (Optional[int]): Seed for choosing the topic and payload size of each event
+        """
+        if duration is None and count is None:
+            raise Exception("One of duration and count must be provided")
+        event_classes = event_registry.get_default_event_classes()
+        unknown_topics = [topic for topic in topics if topic not in event_classes]
+        if unknown_topics:
+            raise Exception(
+                f"No event class registered for topic(s) {unknown_topics} (known topics: {list(event_classes)})"
+            )
+        self._publisher = publisher
+        self._topics = topics
+        self._payload_sizes = payload_sizes or {0: 1}
+        self._rate = rate
+        self._concurrency = concurrency
+        self._duration = duration
+        self._count = count
+        self._random = random.Random(seed)
+
+    def _create_event(self) -> StateChangeEventBase:
+        topic = self._random.choices(list(self._topics), weights=list(self._topics.values()))[0]
+        size = self._random.choices(list(self._payload_sizes), weights=list(self._payload_sizes.values()))[0]
+        event_class = event_registry.get_default_event_classes()[topic]
+        fields = {"entity_id": str(uuid.uuid4())}
+        if size > 0:
+            fields["payload"] = "x" * size
+        # construct skips validation, so the padding is kept (and encoded) even though the class doesn't declare it
+        return event_class.construct(**fields)
+
+    def _is_done(self, index: int, now: float, start: float) -> bool:
+        return (self._count is not None and index >= self._count) or (
+            self._duration is not None and now - start >= self._duration
+        )
+
+    async def _send(self, event: StateChangeEventBase, scheduled_at: float):
+        started_at = timer()
+        try:
+            await self._publisher.publish(event)
+        except Exception as e:
+            self._report.failed += 1
+            _logger.debug(f"Failed to publish load generator event: {e!r}")
+            return
+        completed_at = timer()
+        latency = completed_at - scheduled_at
+        self._report.sent += 1
+        self._report.latency.record(latency)
+        self._report.service_time.record(completed_at - started_at)
+        topic = event_registry.get_topic(type(event))
+        self._report.latency_by_topic.setdefault(topic, LatencyHistogram()).record(latency)
+
+    async def _run_open_loop(self, start: float):
+        interval = 1 / self._rate
+        slots = asyncio.Semaphore(self._concurrency)
+        tasks = set()
+
+        async def send(event: StateChangeEventBase, scheduled_at: float):
+            try:
+                await self._send(event, scheduled_at)
+            finally:
+                slots.release()
+
+        index = 0
+        while True:
+            scheduled_at = start + index * interval
+            now = timer()
+            if self._is_done(index, scheduled_at, start):
+                break
+            if scheduled_at > now:
+                await asyncio.sleep(scheduled_at - now)
+            # waiting for a slot puts the generator behind schedule, which is counted in the latency
+            await slots.acquire()
+            self._report.max_schedule_lag = max(self._report.max_schedule_lag, timer() - scheduled_at)
+            task = asyncio.create_task(send(self._create_event(), scheduled_at))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            index += 1
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def _run_closed_loop(self, start: float):
+        index = 0
+
+        async def worker():
+            nonlocal index
+            while not self._is_done(index, timer(), start):
+                index += 1
+                await self._send(self._create_event(), timer())
+
+        await asyncio.gather(*[worker() for _ in range(self._concurrency)])
+
+    async def run(self) -> LoadReport:
+        self._report = LoadReport(self._rate)
+        start = timer()
+        if self._rate:
+            await self._run_open_loop(start)
+        else:
+            await self._run_closed_loop(start)
+        self._report.duration = timer() - start
+        return self._report
+
+
+class FakeServiceBusClient:
+    """FakeServiceBusClient is a local transport for offline benchmarking: sends take a simulated time and are dropped
+
+    Each send takes latency seconds plus a random jitter (up to jitter seconds), and every stall_every sends
+    (counted across the client's senders) a send stalls for stall_time seconds, holding up the following sends on
+    the same sender (as a broker throttling or a link reconnect would).
+    """
+
+    sent: int
+
+    def __init__(
+        self, latency: float = 0.001, jitter: float = 0, stall_every: Optional[int] = None, stall_time: float = 0
+    ):
+        self._latency = latency
+        self._jitter = jitter
+        self._stall_every = stall_every
+        self._stall_time = stall_time
+        self._random = random.Random()
+        self.sent = 0
+
+    def get_topic_sender(self, topic_name: str):
+        return _FakeSender(self)
+
+    async def close(self):
+        pass
+
+
+class _FakeSender:
+    def __init__(self, client: FakeServiceBusClient):
+        self._client = client
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def send_messages(self, message):
+        client = self._client
+        client.sent += 1
+        if client._stall_every and client.sent % client._stall_every == 0:
+            async with self._lock:
+                await asyncio.sleep(client._stall_time)
+        else:
+            # sends wait behind a stall in progress on the sender
+            async with self._lock:
+                pass
+        await asyncio.sleep(client._latency + client._random.random() * client._jitter)
+
+    async def close(self):
+        pass
+
+
+def main(args: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pubsub.loadgen",
+        description="Publish a mix of events at a target rate (open-loop) or at maximum throughput and report send latency",
+    )
+    parser.add_argument("--topics", default="task-created", help='The topic mix, e.g. "task-created=3,task-updated=1"')
+    parser.add_argument("--payload-sizes", default="0", help='The payload size mix in bytes, e.g. "100=9,10000=1"')
+    parser.add_argument("--rate", type=float, help="The target sends per second (defaults to maximum throughput)")
+    parser.add_argument("--concurrency", type=int, default=64, help="The maximum number of sends in flight")
+    parser.add_argument("--duration", type=float, help="Seconds to generate load for (defaults to 10 without --count)")
+    parser.add_argument("--count", type=int, help="The number of events to send")
+    parser.add_argument("--seed", type=int, help="Seed for the topic and payload size choices")
+    parser.add_argument("--fake", action="store_true", help="Publish to a local fake transport (offline benchmarking)")
+    parser.add_argument("--fake-latency", type=float, default=0.001, help="Fake transport send time in seconds")
+    parser.add_argument("--fake-jitter", type=float, default=0.001, help="Fake transport random extra send time")
+    parser.add_argument("--fake-stall-every", type=int, help="Fake transport sends between stalls (defaults to none)")
+    parser.add_argument("--fake-stall-time", type=float, default=0.5, help="Fake transport stall time in seconds")
+    args = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.WARNING)
+    # the event classes are registered when the models are imported
+    from . import models  # noqa: F401
+
+    topics = parse_weights(args.topics)
+    payload_sizes = {int(size): weight for size, weight in parse_weights(args.payload_sizes).items()}
+
+    def create_fake_client():
+        return FakeServiceBusClient(
+            latency=args.fake_latency,
+            jitter=args.fake_jitter,
+            stall_every=args.fake_stall_every,
+            stall_time=args.fake_stall_time,
+        )
+
+    client_factory = create_fake_client if args.fake else None
+
+    async def run_load() -> LoadReport:
+        async with Publisher(
+            topics=list(topics), metrics=MetricsRegistry(), client_factory=client_factory
+        ) as publisher:
+            generator = LoadGenerator(
+                publisher,
+                topics,
+                payload_sizes=payload_sizes,
+                rate=args.rate,
+                concurrency=args.concurrency,
+                duration=args.duration if args.duration is not None or args.count is not None else 10,
+                count=args.count,
+                seed=args.seed,
+            )
+            target = f"{args.rate:.0f}/s" if args.rate else "maximum throughput"
+            print(f"🏃 Publishing to {', '.join(topics)} at {target} (concurrency {args.concurrency})...", flush=True)
+            return await generator.run()
+
+    from .event_loop import run
+
+    report = run(run_load())
+    print(report.format())
+    return 1 if report.failed > 0 else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
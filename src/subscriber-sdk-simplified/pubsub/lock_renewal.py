@@ -0,0 +1,226 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from .metrics import MetricsRegistry, default_registry
+
+_logger = logging.getLogger(__name__)
+
+MIN_RENEWAL_INTERVAL = 1
+"""The minimum time in seconds between renewals for a message (guards against locks that don't move forward)"""
+
+
+class _RenewalEntry:
+    receiver: Optional["ServiceBusReceiver"]
+    message: Optional["ServiceBusReceivedMessage"]  # or the ServiceBusSession for a session lock (None once settled)
+    is_session: bool
+    renew_at: float  # monotonic time at which the lock should next be renewed
+    renew_until: float  # monotonic time after which the lock is no longer renewed (max_lock_renewal_duration)
+    settled: bool
+    in_heap: bool  # False while a renewal is in flight
+
+    def __init__(self, receiver, message, renew_at: float, renew_until: float, is_session: bool = False):
+        self.receiver = receiver
+        self.message = message
+        self.is_session = is_session
+        self.renew_at = renew_at
+        self.renew_until = renew_until
+        self.settled = False
+        self.in_heap = False
+
+    def settle(self):
+        # drop the references so that a settled message (and its body) isn't kept alive by the heap
+        self.settled = True
+        self.receiver = None
+        self.message = None
+
+    @property
+    def description(self) -> str:
+        """The lock being renewed (for logging)"""
+        if self.is_session:
+            return f"session {self.message.session_id}"
+        return f"message {self.message.message_id}"
+
+    def renew(self):
+        if self.is_session:
+            return self.message.renew_lock()
+        return self.receiver.renew_message_lock(self.message)
+
+
+class LockRenewalScheduler:
+    """LockRenewalScheduler renews message locks for all subscriptions from a single background task
+
+    Rather than polling every message (as AutoLockRenewer does), registered messages are kept in a heap ordered
+    by the time their lock needs renewing. Messages that are settled before that point are never renewed, so
+    only messages whose handlers are still running close to lock expiry cost anything.
+    Messages that are due at the same time are renewed together, grouped per receiver, in background tasks so that
+    a slow renewal doesn't hold up the others. Settled entries are discarded lazily, and the heap is rebuilt when
+    more than half of it is settled entries.
+    """
+
+    _renew_margin: float
+    _heap: list  # entries of (renew_at, sequence, _RenewalEntry)
+    _entries: dict  # key: id(message), value: _RenewalEntry
+    _settled_in_heap: int  # the number of settled entries still in the heap
+    _renewal_tasks: set  # renewals in flight (see _renew_due)
+    _sequence: itertools.count
+    _wake: asyncio.Event
+    _closed: bool
+    _metrics: MetricsRegistry
+
+    def __init__(self, renew_margin: float = 10, metrics: Optional[MetricsRegistry] = None):
+        """
+        Args:
+            renew_margin (float): How long in seconds before lock expiry to renew the lock. For locks shorter than twice this value, the lock is renewed halfway through its remaining duration
+            metrics (Optional[MetricsRegistry]): The registry to record renewal metrics in
+        """
+        self._renew_margin = renew_margin
+        self._heap = []
+        self._entries = {}
+        self._settled_in_heap = 0
+        self._renewal_tasks = set()
+        self._sequence = itertools.count()
+        self._wake = asyncio.Event()
+        self._closed = False
+        self._metrics = metrics or default_registry
+
+    @property
+    def tracked_count(self) -> int:
+        """The number of messages currently tracked for renewal"""
+        return len(self._entries)
+
+    def register(self, receiver, message, max_lock_renewal_duration: float):
+        """Track a received message so that its lock is renewed until it is settled (or max_lock_renewal_duration elapses)"""
+        now = time.monotonic()
+        entry = _RenewalEntry(receiver, message, self._get_renew_at(message, now), now + max_lock_renewal_duration)
+        self._entries[id(message)] = entry
+        self._push(entry)
+
+    def register_session(self, receiver, max_lock_renewal_duration: float):
+        """Track the session lock for a session receiver so that it is renewed until it is settled (see settle)
+
+        Messages received from a session are covered by the session lock rather than having their own locks.
+        Registering the session again restarts the max_lock_renewal_duration (e.g. for each batch from the session).
+        """
+        session = receiver.session
+        existing = self._entries.get(id(session))
+        if existing is not None:
+            self._settle_entry(existing)
+        now = time.monotonic()
+        entry = _RenewalEntry(
+            receiver, session, self._get_renew_at(session, now), now + max_lock_renewal_duration, is_session=True
+        )
+        self._entries[id(session)] = entry
+        self._push(entry)
+
+    def settle(self, message):
+        """Stop tracking a message (called when the message is completed/abandoned/dead-lettered) or session"""
+        entry = self._entries.pop(id(message), None)
+        if entry is not None:
+            self._settle_entry(entry)
+
+    def _settle_entry(self, entry: _RenewalEntry):
+        entry.settle()
+        if not entry.in_heap:
+            return
+        # the heap entry is discarded lazily when it reaches the top of the heap, unless settled entries make up
+        # most of the heap (e.g. at high throughput, with locks much longer than the processing time)
+        self._settled_in_heap += 1
+        if self._settled_in_heap > len(self._heap) / 2:
+            self._heap = [item for item in self._heap if not item[2].settled]
+            heapq.heapify(self._heap)
+            self._settled_in_heap = 0
+
+    def _get_renew_at(self, message, now: float) -> float:
+        remaining = (message.locked_until_utc - datetime.now(timezone.utc)).total_seconds()
+        margin = min(self._renew_margin, remaining / 2)
+        return now + max(remaining - margin, 0)
+
+    def _push(self, entry: _RenewalEntry):
+        is_earliest = len(self._heap) == 0 or entry.renew_at < self._heap[0][0]
+        entry.in_heap = True
+        heapq.heappush(self._heap, (entry.renew_at, next(self._sequence), entry))
+        if is_earliest:
+            self._wake.set()
+
+    def _pop(self) -> _RenewalEntry:
+        _, _, entry = heapq.heappop(self._heap)
+        entry.in_heap = False
+        if entry.settled:
+            self._settled_in_heap -= 1
+        return entry
+
+    async def run(self):
+        """Process renewals until close() is called"""
+        while not self._closed:
+            # discard settled entries so that the next wait is for a message that still needs renewal
+            while self._heap and self._heap[0][2].settled:
+                self._pop()
+
+            self._wake.clear()
+            if len(self._heap) == 0:
+                await self._wake.wait()
+                continue
+
+            delay = self._heap[0][0] - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._renew_due()
+
+        for task in self._renewal_tasks:
+            task.cancel()
+        await asyncio.gather(*self._renewal_tasks, return_exceptions=True)
+
+    def _renew_due(self):
+        now = time.monotonic()
+        due_by_receiver = {}  # key: id(receiver), value: list of entries
+        while self._heap and self._heap[0][0] <= now:
+            entry = self._pop()
+            if entry.settled:
+                continue
+            if now >= entry.renew_until:
+                _logger.debug(f"Reached max lock renewal duration for {entry.description}")
+                self._entries.pop(id(entry.message), None)
+                self._metrics.increment("lock_renewal_expired_total")
+                continue
+            due_by_receiver.setdefault(id(entry.receiver), []).append(entry)
+
+        # entries are out of the heap while their renewal is in flight, so they aren't renewed again until it finishes
+        for entries in due_by_receiver.values():
+            task = asyncio.create_task(self._renew_for_receiver(entries))
+            self._renewal_tasks.add(task)
+            task.add_done_callback(self._renewal_tasks.discard)
+        self._metrics.set_gauge("lock_renewal_tracked_messages", len(self._entries))
+
+    async def _renew_for_receiver(self, entries: list[_RenewalEntry]):
+        results = await asyncio.gather(*[entry.renew() for entry in entries], return_exceptions=True)
+        now = time.monotonic()
+        for entry, result in zip(entries, results):
+            if entry.settled:
+                # settled while the renewal was in flight
+                continue
+            if isinstance(result, Exception):
+                _logger.warning(f"Failed to renew lock for {entry.description}: {result}")
+                self._entries.pop(id(entry.message), None)
+                self._metrics.increment("lock_renewal_failures_total")
+                continue
+            self._metrics.increment("lock_renewals_total")
+            entry.renew_at = max(self._get_renew_at(entry.message, now), now + MIN_RENEWAL_INTERVAL)
+            self._push(entry)
+
+    def close(self):
+        """Stop the scheduler and stop tracking all messages"""
+        self._closed = True
+        self._entries.clear()
+        self._heap.clear()
+        self._settled_in_heap = 0
+        self._wake.set()
@@ -0,0 +1,153 @@
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+LOG_QUEUE = os.getenv("LOG_QUEUE", "false").lower() == "true"
+LOG_QUEUE_MAX_SIZE = int(os.getenv("LOG_QUEUE_MAX_SIZE", "10000"))
+LOG_MESSAGE_SAMPLE_RATE = float(os.getenv("LOG_MESSAGE_SAMPLE_RATE", "1"))
+LOG_MESSAGE_RATE_LIMIT = float(os.getenv("LOG_MESSAGE_RATE_LIMIT", "100"))
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """QueueHandler that defers formatting to the listener thread and drops records when the queue is full"""
+
+    dropped_count: int
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped_count = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The queue is in-process, so (unlike QueueHandler) the record is queued as-is rather than being formatted
+        # on the calling thread (i.e. the event loop). Log arguments are formatted later on the listener thread.
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # never block the event loop on logging
+            self.dropped_count += 1
+
+
+class _RootForwardingHandler(logging.Handler):
+    """Passes queued records to the root logger's handlers (on the listener thread)"""
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        handlers = logging.getLogger().handlers or [logging.lastResort]
+        for handler in handlers:
+            if handler is not None and record.levelno >= handler.level:
+                handler.handle(record)
+        return True
+
+
+class QueueLogging:
+    """QueueLogging moves the output of a logger (and its children) off the calling thread
+
+    While started, records for the logger are put on a bounded queue (without formatting) and a listener thread
+    formats them and passes them to the root logger's handlers, so slow handlers (e.g. writing to a pipe that is
+    being read slowly) don't block the event loop. Records are dropped if the queue is full.
+    """
+
+    _logger_name: str
+    _max_queue_size: int
+    _handler: Optional[_DeferredQueueHandler]
+    _listener: Optional[QueueListener]
+    _previous_propagate: bool
+
+    def __init__(self, logger_name: str = "pubsub", max_queue_size: Optional[int] = None):
+        """
+        Args:
+            logger_name (str): The logger to send through the queue (defaults to the pubsub package logger)
+            max_queue_size (Optional[int]): The maximum number of queued records (defaults to LOG_QUEUE_MAX_SIZE)
+        """
+        self._logger_name = logger_name
+        self._max_queue_size = max_queue_size or LOG_QUEUE_MAX_SIZE
+        self._handler = None
+        self._listener = None
+
+    @property
+    def dropped_count(self) -> int:
+        """The number of records dropped because the queue was full"""
+        return self._handler.dropped_count if self._handler is not None else 0
+
+    def start(self):
+        if self._listener is not None:
+            return
+        logger = logging.getLogger(self._logger_name)
+        log_queue = queue.Queue(self._max_queue_size)
+        self._handler = _DeferredQueueHandler(log_queue)
+        self._listener = QueueListener(log_queue, _RootForwardingHandler())
+        self._listener.start()
+        logger.addHandler(self._handler)
+        self._previous_propagate = logger.propagate
+        logger.propagate = False
+
+    def stop(self):
+        """Stop sending records through the queue (after handling the records already queued)"""
+        if self._listener is None:
+            return
+        logger = logging.getLogger(self._logger_name)
+        logger.removeHandler(self._handler)
+        logger.propagate = self._previous_propagate
+        self._listener.stop()
+        self._listener = None
+
+
+class LogSampler:
+    """LogSampler decides whether to emit high-volume (e.g. per-message) log records
+
+    Sampled records are kept with probability sample_rate and then rate limited with a token bucket (allowing bursts
+    of up to one second's worth of records). Unsampled records (e.g. errors) are always emitted. The number of records suppressed by the rate limit
+    is reported so that it can be included in the next record that is emitted.
+    """
+
+    _sample_rate: float
+    _rate_limit: float
+    _tokens: float
+    _last_refill: float
+    _suppressed_count: int
+    _lock: threading.Lock
+
+    def __init__(self, sample_rate: Optional[float] = None, rate_limit: Optional[float] = None):
+        """
+        Args:
+            sample_rate (Optional[float]): The fraction of sampled records to keep (defaults to LOG_MESSAGE_SAMPLE_RATE)
+            rate_limit (Optional[float]): The maximum records per second, or 0 for no limit (defaults to LOG_MESSAGE_RATE_LIMIT)
+        """
+        self._sample_rate = sample_rate if sample_rate is not None else LOG_MESSAGE_SAMPLE_RATE
+        self._rate_limit = rate_limit if rate_limit is not None else LOG_MESSAGE_RATE_LIMIT
+        self._tokens = self._rate_limit
+        self._last_refill = time.monotonic()
+        self._suppressed_count = 0
+        self._lock = threading.Lock()
+
+    def allow(self, sampled: bool = True) -> bool:
+        """Return True if a record should be emitted (sampled=False for records that shouldn't be sampled or rate limited, e.g. errors)"""
+        if not sampled:
+            return True
+        if self._sample_rate < 1 and random.random() >= self._sample_rate:
+            return False
+        if self._rate_limit <= 0:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._rate_limit, self._tokens + (now - self._last_refill) * self._rate_limit)
+            self._last_refill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            self._suppressed_count += 1
+            return False
+
+    def take_suppressed_count(self) -> int:
+        """Get (and reset) the number of records suppressed by the rate limit since the last call"""
+        with self._lock:
+            count = self._suppressed_count
+            self._suppressed_count = 0
+            return count
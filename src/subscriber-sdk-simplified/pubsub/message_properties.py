@@ -0,0 +1,31 @@
+from typing import Optional
+
+DLQ_TARGET_SUBSCRIPTION_PROPERTY = "dlq-target-subscription"
+"""The application property naming the subscription a resubmitted message is for (other subscriptions ignore it)"""
+
+
+def get_application_property(msg, name: str) -> Optional[str]:
+    """Get a string application property from a message (or None if the property isn't set)"""
+    application_properties = msg.application_properties
+    if not application_properties:
+        return None
+    # received application properties can have bytes keys/values
+    value = application_properties.get(name)
+    if value is None:
+        value = application_properties.get(name.encode("utf-8"))
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    return value
+
+
+def get_application_properties(msg) -> dict:
+    """Get a message's application properties as a dict with string keys (and string values for bytes values)"""
+    application_properties = msg.application_properties
+    if not application_properties:
+        return {}
+    return {
+        (key.decode("utf-8") if isinstance(key, bytes) else key): (
+            value.decode("utf-8") if isinstance(value, bytes) else value
+        )
+        for key, value in application_properties.items()
+    }
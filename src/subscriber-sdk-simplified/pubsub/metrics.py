@@ -0,0 +1,111 @@
+import bisect
+import threading
+from typing import Optional
+
+DEFAULT_HISTOGRAM_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+def _labels_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+class Histogram:
+    """Histogram tracks the count, sum and bucketed distribution of observed values"""
+
+    buckets: list[float]
+    bucket_counts: list[int]
+    count: int
+    sum: float
+
+    def __init__(self, buckets: list[float]):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)  # final bucket is +Inf
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value: float):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    """MetricsRegistry is a lightweight in-process store for counters, gauges and histograms
+
+    Metrics are identified by name plus a set of labels (e.g. topic and subscription),
+    and can be read back with get() or exported in Prometheus text format with render_prometheus()
+    """
+
+    _counters: dict  # key: (name, labels key), value: float
+    _gauges: dict  # key: (name, labels key), value: float
+    _histograms: dict  # key: (name, labels key), value: Histogram
+    _lock: threading.Lock
+
+    def __init__(self):
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        # metrics can be updated from background threads (e.g. the sync publisher) as well as the event loop
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[(name, _labels_key(labels))] = value
+
+    def observe(self, name: str, value: float, buckets: Optional[list[float]] = None, **labels):
+        key = (name, _labels_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = Histogram(buckets or DEFAULT_HISTOGRAM_BUCKETS)
+                self._histograms[key] = histogram
+            histogram.observe(value)
+
+    def get(self, name: str, **labels):
+        """Get the current value of a counter or gauge (or the Histogram for a histogram), or None if not recorded"""
+        key = (name, _labels_key(labels))
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            if key in self._gauges:
+                return self._gauges[key]
+            return self._histograms.get(key)
+
+    def render_prometheus(self) -> str:
+        """Render the metrics in the Prometheus text exposition format"""
+
+        def format_labels(labels_key: tuple, extra: Optional[tuple] = None):
+            items = list(labels_key) + list(extra or [])
+            if len(items) == 0:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+        lines = []
+        with self._lock:
+            for metric_type, values in [("counter", self._counters), ("gauge", self._gauges)]:
+                for name in sorted({name for name, _ in values}):
+                    lines.append(f"# TYPE {name} {metric_type}")
+                    for (metric_name, labels_key), value in values.items():
+                        if metric_name == name:
+                            lines.append(f"{name}{format_labels(labels_key)} {value}")
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (metric_name, labels_key), histogram in self._histograms.items():
+                    if metric_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ["+Inf"], histogram.bucket_counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{format_labels(labels_key, (('le', bound),))} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels_key)} {histogram.sum}")
+                    lines.append(f"{name}_count{format_labels(labels_key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+
+default_registry = MetricsRegistry()
+"""The registry used by ConsumerApp and the publisher when no registry is provided"""
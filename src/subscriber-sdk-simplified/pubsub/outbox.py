@@ -0,0 +1,374 @@
+import asyncio
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Optional
+
+from .events import StateChangeEventBase, event_registry
+from .events import get_topic_name_from_event_class
+from .metrics import MetricsRegistry, default_registry
+from .publisher import Publisher
+
+OUTBOX_PATH = os.getenv("OUTBOX_PATH", "pubsub-outbox.db")
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+OUTBOX_SYNCHRONOUS = os.getenv("OUTBOX_SYNCHRONOUS", "NORMAL")
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+
+_logger = logging.getLogger(__name__)
+
+
+class OutboxPublisher:
+    """OutboxPublisher appends events to a local SQLite spool and ships them to Service Bus from a background drainer
+
+    publish() only writes to the spool (a single local transaction), so producers get low, stable latency
+    regardless of broker availability or round-trip time. The drainer sends spooled events in batches (oldest first)
+    and removes them from the spool once they have been sent. If sending fails, the events stay in the spool and
+    are retried with jittered exponential backoff.
+
+    An event that fails on its own (it can't be parsed, or is rejected as invalid, e.g. too large to send) would
+    block the events behind it, so it is skipped and retried on the next drain, and moved to the outbox_dead table
+    after max_attempts attempts. Failures for a whole batch (e.g. the broker is unavailable) are retried indefinitely.
+
+    Each event is given a message_id when it is spooled, and the same id is used for every send attempt, so
+    enabling duplicate detection on the topic discards duplicates caused by retries (e.g. a crash between sending
+    and removing events from the spool).
+
+    The spool uses WAL journaling. With OUTBOX_SYNCHRONOUS=NORMAL (the default), spooled events survive a process
+    crash; set OUTBOX_SYNCHRONOUS=FULL to also survive power loss (at the cost of an fsync per publish).
+    """
+
+    _path: str
+    _publisher: Optional[Publisher]
+    _owns_publisher: bool
+    _batch_size: int
+    _poll_interval: float
+    _retry_initial_backoff: float
+    _retry_max_backoff: float
+    _max_attempts: int
+    _connection: sqlite3.Connection
+    _lock: threading.Lock  # serialises access to the connection (publish can be called from any thread)
+    _depth: int
+    _loop: Optional[asyncio.AbstractEventLoop]
+    _wake: Optional[asyncio.Event]
+    _drain_task: Optional[asyncio.Task]
+    _closed: bool
+    _rate_window_start: float
+    _rate_window_count: int
+    metrics: MetricsRegistry
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        publisher: Optional[Publisher] = None,
+        batch_size: Optional[int] = None,
+        poll_interval: Optional[float] = None,
+        retry_initial_backoff: float = 1,
+        retry_max_backoff: float = 60,
+        max_attempts: Optional[int] = None,
+        metrics: Optional[MetricsRegistry] = None,
+    ):
+        """
+        Args:
+            path (Optional[str]): The path of the SQLite spool file (defaults to OUTBOX_PATH). Events left in the spool by a previous process are sent once the drainer starts
+            publisher (Optional[Publisher]): The Publisher used to send events (defaults to a new Publisher, which is closed by close())
+            batch_size (Optional[int]): The maximum number of events sent in each batch (defaults to OUTBOX_BATCH_SIZE)
+            poll_interval (Optional[float]): The maximum time in seconds the drainer waits before checking the spool when idle (defaults to OUTBOX_POLL_INTERVAL)
+            retry_initial_backoff (float): The initial delay in seconds before retrying after a failed send
+            retry_max_backoff (float): The maximum delay in seconds before retrying after a failed send
+            max_attempts (Optional[int]): The number of attempts for an event that fails on its own before it is moved to the outbox_dead table (defaults to OUTBOX_MAX_ATTEMPTS)
+            metrics (Optional[MetricsRegistry]): The registry to record outbox metrics in
+        """
+        self._path = path or OUTBOX_PATH
+        self._publisher = publisher
+        self._owns_publisher = publisher is None
+        self._batch_size = batch_size or OUTBOX_BATCH_SIZE
+        self._poll_interval = poll_interval or OUTBOX_POLL_INTERVAL
+        self._retry_initial_backoff = retry_initial_backoff
+        self._retry_max_backoff = retry_max_backoff
+        self._max_attempts = max_attempts or OUTBOX_MAX_ATTEMPTS
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wake = None
+        self._drain_task = None
+        self._closed = False
+        self._rate_window_start = time.monotonic()
+        self._rate_window_count = 0
+        self.metrics = metrics or (publisher.metrics if publisher is not None else default_registry)
+
+        self._connection = sqlite3.connect(self._path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(f"PRAGMA synchronous={OUTBOX_SYNCHRONOUS}")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "message_id TEXT NOT NULL, "
+            "topic TEXT NOT NULL, "
+            "body TEXT NOT NULL, "
+            "spooled_at REAL NOT NULL, "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "event_type TEXT)"
+        )
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(outbox)").fetchall()]
+        if "event_type" not in columns:
+            # spool created before event types were recorded
+            self._connection.execute("ALTER TABLE outbox ADD COLUMN event_type TEXT")
+        # events that couldn't be sent after max_attempts (kept for inspection, e.g. to fix and re-publish)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS outbox_dead ("
+            "id INTEGER PRIMARY KEY, "
+            "message_id TEXT NOT NULL, "
+            "topic TEXT NOT NULL, "
+            "body TEXT NOT NULL, "
+            "spooled_at REAL NOT NULL, "
+            "attempts INTEGER NOT NULL, "
+            "event_type TEXT, "
+            "failed_at REAL NOT NULL, "
+            "error TEXT)"
+        )
+        self._depth = self._connection.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+        if self._depth > 0:
+            _logger.info(f"📦 Found {self._depth} event(s) in outbox spool {self._path}")
+        self.metrics.set_gauge("outbox_depth", self._depth)
+
+    @property
+    def depth(self) -> int:
+        """The number of events in the spool waiting to be sent"""
+        return self._depth
+
+    def publish(self, message: StateChangeEventBase) -> str:
+        """Append an event to the spool and return the message_id it will be sent with
+
+        Safe to call from any thread. The event is durable once this returns (see OUTBOX_SYNCHRONOUS)
+        """
+        topic_name = get_topic_name_from_event_class(type(message))
+        message_id = str(uuid.uuid4())
+        with self._lock:
+            if self._closed:
+                raise Exception("OutboxPublisher has been closed")
+            self._connection.execute(
+                "INSERT INTO outbox (message_id, topic, body, spooled_at, event_type) VALUES (?, ?, ?, ?, ?)",
+                (message_id, topic_name, message.json(), time.time(), event_registry.get_event_type(type(message))),
+            )
+            self._depth += 1
+            depth = self._depth
+        self.metrics.set_gauge("outbox_depth", depth)
+        self.metrics.increment("outbox_spooled_total", topic=topic_name)
+        self._wake_drainer()
+        return message_id
+
+    def _wake_drainer(self):
+        loop = self._loop
+        if loop is None or self._wake.is_set():
+            return
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is loop:
+            self._wake.set()
+        else:
+            try:
+                loop.call_soon_threadsafe(self._wake.set)
+            except RuntimeError:
+                # the drainer loop has been closed
+                pass
+
+    def _get_event_class(self, topic_name: str, event_type: Optional[str]):
+        event_class = event_registry.get_event_class(topic_name, event_type)
+        if event_class is None:
+            raise Exception(f"No event class found for topic '{topic_name}' and event type '{event_type}'")
+        return event_class
+
+    def _load_batch(self) -> list[tuple]:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT id, message_id, topic, body, spooled_at, event_type FROM outbox ORDER BY id LIMIT ?",
+                (self._batch_size,),
+            ).fetchall()
+
+    def _get_publisher(self) -> Publisher:
+        if self._publisher is None:
+            self._publisher = Publisher(metrics=self.metrics)
+        return self._publisher
+
+    async def drain_once(self) -> int:
+        """Send the next batch of events from the spool. Returns the number of events sent
+
+        Events are sent per topic in spool order. If a send fails, the exception is raised and the
+        events for that topic (and any later topics in the batch) remain in the spool. Events that fail on their own
+        are skipped (see _record_event_failure)
+        """
+        rows = self._load_batch()
+        if len(rows) == 0:
+            self.metrics.set_gauge("outbox_oldest_event_age_seconds", 0)
+            return 0
+        self.metrics.set_gauge("outbox_oldest_event_age_seconds", max(time.time() - rows[0][4], 0))
+
+        rows_by_topic = {}  # key: topic name, value: list of rows
+        for row in rows:
+            rows_by_topic.setdefault(row[2], []).append(row)
+
+        sent_count = 0
+        for topic_name, topic_rows in rows_by_topic.items():
+            events = []
+            event_rows = []
+            for row in topic_rows:
+                try:
+                    events.append(self._get_event_class(topic_name, row[5]).parse_raw(row[3]))
+                    event_rows.append(row)
+                except Exception as e:
+                    self._record_event_failure(row, e)
+            if len(event_rows) == 0:
+                continue
+            try:
+                sent_count += await self._send_rows(topic_name, event_rows, events)
+            except ValueError:
+                # e.g. MessageSizeExceededError: send the events one at a time to find the event(s) that can't be sent
+                for row, event in zip(event_rows, events):
+                    try:
+                        sent_count += await self._send_rows(topic_name, [row], [event])
+                    except ValueError as e:
+                        self._record_event_failure(row, e)
+        self._record_drain_rate(sent_count)
+        return sent_count
+
+    async def _send_rows(self, topic_name: str, rows: list[tuple], events: list[StateChangeEventBase]) -> int:
+        """Send the events for rows and remove them from the spool
+
+        ValueErrors (i.e. invalid events) are raised without recording a failure so that the caller can find the
+        events that can't be sent. Other failures are for the whole batch (e.g. the broker is unavailable), so they
+        are raised without counting towards the events' attempts (which only count failures of an event on its own)
+        """
+        try:
+            await self._get_publisher().publish_batch(events, message_ids=[row[1] for row in rows])
+        except ValueError:
+            raise
+        except Exception:
+            self.metrics.increment("outbox_send_failures_total", topic=topic_name)
+            raise
+        with self._lock:
+            self._connection.executemany("DELETE FROM outbox WHERE id = ?", [(row[0],) for row in rows])
+            self._depth -= len(rows)
+            depth = self._depth
+        self.metrics.set_gauge("outbox_depth", depth)
+        self.metrics.increment("outbox_drained_total", len(rows), topic=topic_name)
+        return len(rows)
+
+    def _record_event_failure(self, row: tuple, error: Exception):
+        """Record a failed attempt for an event that can't be sent on its own (it is skipped until the next drain)
+
+        Once the event has had max_attempts attempts, it is moved to the outbox_dead table so that it doesn't keep
+        delaying the events behind it
+        """
+        topic_name = row[2]
+        self.metrics.increment("outbox_send_failures_total", topic=topic_name)
+        with self._lock:
+            self._connection.execute("UPDATE outbox SET attempts = attempts + 1 WHERE id = ?", (row[0],))
+            attempts = self._connection.execute("SELECT attempts FROM outbox WHERE id = ?", (row[0],)).fetchone()[0]
+            if attempts >= self._max_attempts:
+                self._connection.execute("BEGIN")
+                self._connection.execute(
+                    "INSERT INTO outbox_dead "
+                    "(id, message_id, topic, body, spooled_at, attempts, event_type, failed_at, error) "
+                    "SELECT id, message_id, topic, body, spooled_at, attempts, event_type, ?, ? "
+                    "FROM outbox WHERE id = ?",
+                    (time.time(), repr(error), row[0]),
+                )
+                self._connection.execute("DELETE FROM outbox WHERE id = ?", (row[0],))
+                self._connection.execute("COMMIT")
+                self._depth -= 1
+            depth = self._depth
+        if attempts < self._max_attempts:
+            _logger.warning(
+                f"❌ Failed to send event {row[1]} from outbox (attempt {attempts} of {self._max_attempts}) - "
+                + f"skipping: {error!r}"
+            )
+            return
+        _logger.error(
+            f"☠️ Moved event {row[1]} for topic '{topic_name}' to outbox_dead after {attempts} attempt(s): "
+            + f"{error!r}"
+        )
+        self.metrics.set_gauge("outbox_depth", depth)
+        self.metrics.increment("outbox_dead_total", topic=topic_name)
+
+    def _record_drain_rate(self, sent_count: int):
+        self._rate_window_count += sent_count
+        now = time.monotonic()
+        elapsed = now - self._rate_window_start
+        if elapsed >= 1:
+            self.metrics.set_gauge("outbox_drain_rate", self._rate_window_count / elapsed)
+            self._rate_window_start = now
+            self._rate_window_count = 0
+
+    async def run(self):
+        """Drain the spool until close() is called"""
+        consecutive_failures = 0
+        while not self._closed:
+            try:
+                sent_count = await self.drain_once()
+                consecutive_failures = 0
+            except Exception as e:
+                consecutive_failures += 1
+                backoff = min(self._retry_initial_backoff * (2 ** (consecutive_failures - 1)), self._retry_max_backoff)
+                delay = random.uniform(backoff / 2, backoff)
+                _logger.warning(f"❌ Failed to send events from outbox - retrying in {delay:.1f}s: {e!r}")
+                await self._wait(delay)
+                continue
+
+            if sent_count == 0:
+                self._record_drain_rate(0)
+                await self._wait(self._poll_interval)
+
+    async def _wait(self, timeout: float):
+        self._wake.clear()
+        if self._closed:
+            return
+        try:
+            await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def start(self):
+        """Start the publisher and the background drainer on the current event loop"""
+        if self._drain_task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        await self._get_publisher().start()
+        self._drain_task = asyncio.create_task(self.run())
+
+    async def close(self, drain_timeout: Optional[float] = 5):
+        """Stop the drainer (after trying to send the events in the spool for up to drain_timeout seconds) and close the spool
+
+        Events that haven't been sent remain in the spool and are sent when a new OutboxPublisher is started for the same path
+        """
+        if self._drain_task is not None:
+            try:
+                deadline = time.monotonic() + (drain_timeout or 0)
+                while self._depth > 0 and time.monotonic() < deadline:
+                    await asyncio.sleep(0.01)
+            finally:
+                self._closed = True
+                self._wake.set()
+                try:
+                    await self._drain_task
+                except asyncio.CancelledError:
+                    pass
+                self._drain_task = None
+        with self._lock:
+            self._closed = True
+            self._connection.close()
+        if self._owns_publisher and self._publisher is not None:
+            await self._publisher.close()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
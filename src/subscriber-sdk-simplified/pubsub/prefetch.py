@@ -0,0 +1,184 @@
+import asyncio
+import collections
+import logging
+import math
+import os
+from datetime import datetime, timezone
+from typing import Callable, Optional
+
+from .metrics import MetricsRegistry, default_registry
+
+PREFETCH_LOCK_FRACTION = float(os.getenv("PREFETCH_LOCK_FRACTION", "0.5"))
+
+_logger = logging.getLogger(__name__)
+
+
+class PrefetchBuffer:
+    """PrefetchBuffer receives messages for a subscription ahead of demand into a bounded local buffer
+
+    While the handlers process a batch, a background task receives the next messages so that the next batch is
+    available as soon as the handlers finish, rather than after a receive round trip.
+
+    Messages are locked from the time they are received, so the buffer is kept to the number of messages the
+    handlers are expected to pick up within lock_fraction of the lock duration (based on the observed handler
+    throughput), up to max_count. Buffered messages are passed to on_received as they arrive (e.g. to register them
+    for lock renewal), and messages whose lock has expired by the time they are taken are dropped (they are
+    redelivered by the broker) and passed to on_discarded.
+
+    The Service Bus SDK prefetch (prefetch_count on the receiver) isn't used as the messages it buffers aren't
+    visible until they are received, so their locks can't be tracked.
+    """
+
+    _receiver: "ServiceBusReceiver"
+    _max_count: int
+    _get_settings: Callable  # returns the SubscriptionSettings for the next receive
+    _on_received: Optional[Callable[[list], None]]
+    _on_discarded: Optional[Callable]
+    _lock_fraction: float
+    _buffer: collections.deque
+    _available: asyncio.Event  # set when messages are added to the buffer (or the receive loop fails)
+    _space: asyncio.Event  # set when messages are taken from the buffer
+    _throughput: Optional[float]  # moving average of messages handled per second
+    _lock_duration: Optional[float]  # the remaining lock duration in seconds of the most recently received messages
+    _error: Optional[Exception]
+    _task: Optional[asyncio.Task]
+    _metrics: MetricsRegistry
+    _metric_labels: dict
+
+    def __init__(
+        self,
+        receiver: "ServiceBusReceiver",
+        max_count: int,
+        get_settings: Callable,
+        on_received: Optional[Callable[[list], None]] = None,
+        on_discarded: Optional[Callable] = None,
+        lock_fraction: Optional[float] = None,
+        metrics: Optional[MetricsRegistry] = None,
+        metric_labels: Optional[dict] = None,
+    ):
+        """
+        Args:
+            receiver (ServiceBusReceiver): The receiver to receive messages with
+            max_count (int): The maximum number of messages to buffer
+            get_settings (Callable): Function returning the SubscriptionSettings to use for each receive (max_message_count and max_wait_time)
+            on_received (Optional[Callable]): Called with each list of received messages as they are added to the buffer
+            on_discarded (Optional[Callable]): Called for each buffered message dropped as its lock expired
+            lock_fraction (Optional[float]): The fraction of the lock duration that messages should wait in the buffer at most (defaults to PREFETCH_LOCK_FRACTION)
+            metrics (Optional[MetricsRegistry]): The registry to record prefetch metrics in
+            metric_labels (Optional[dict]): Labels to add to the prefetch metrics (e.g. topic and subscription)
+        """
+        self._receiver = receiver
+        self._max_count = max_count
+        self._get_settings = get_settings
+        self._on_received = on_received
+        self._on_discarded = on_discarded
+        self._lock_fraction = lock_fraction if lock_fraction is not None else PREFETCH_LOCK_FRACTION
+        self._buffer = collections.deque()
+        self._available = asyncio.Event()
+        self._space = asyncio.Event()
+        self._throughput = None
+        self._lock_duration = None
+        self._error = None
+        self._task = None
+        self._metrics = metrics or default_registry
+        self._metric_labels = metric_labels or {}
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    @property
+    def target_depth(self) -> int:
+        """The number of messages to keep buffered: what the handlers get through in the lock budget, up to max_count"""
+        batch_size = self._get_settings().max_message_count
+        if self._throughput is None or self._lock_duration is None:
+            # until the handler throughput is known, stay one batch ahead
+            return min(batch_size, self._max_count)
+        depth = math.floor(self._throughput * self._lock_duration * self._lock_fraction)
+        return max(1, min(depth, self._max_count))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        try:
+            while True:
+                settings = self._get_settings()
+                target_depth = self.target_depth
+                self._metrics.set_gauge("prefetch_target_depth", target_depth, **self._metric_labels)
+                # refill once the buffer is down to half of the target (or there is room for a full batch), receiving
+                # enough to fill it in one round trip rather than topping it up with small receives
+                count = target_depth - len(self._buffer)
+                if count < min(max(settings.max_message_count, target_depth // 2), target_depth):
+                    self._space.clear()
+                    await self._space.wait()
+                    continue
+
+                msgs = await self._receiver.receive_messages(
+                    max_message_count=count, max_wait_time=settings.max_wait_time
+                )
+                if len(msgs) == 0:
+                    continue
+                self._lock_duration = _get_remaining_lock_duration(msgs[-1])
+                if self._on_received is not None:
+                    self._on_received(msgs)
+                self._buffer.extend(msgs)
+                self._available.set()
+                self._metrics.set_gauge("prefetch_buffer_size", len(self._buffer), **self._metric_labels)
+        except Exception as e:
+            # raised to the consumer from take() so that the subscription is restarted
+            self._error = e
+            self._available.set()
+
+    async def take(self, max_message_count: int, max_wait_time: float) -> list:
+        """Take up to max_message_count messages, waiting up to max_wait_time for messages if the buffer is empty"""
+        if len(self._buffer) == 0 and self._error is None:
+            self._available.clear()
+            try:
+                await asyncio.wait_for(self._available.wait(), timeout=max_wait_time)
+            except asyncio.TimeoutError:
+                pass
+        if self._error is not None:
+            raise self._error
+
+        now = datetime.now(timezone.utc)
+        msgs = []
+        while self._buffer and len(msgs) < max_message_count:
+            msg = self._buffer.popleft()
+            if msg.locked_until_utc is not None and msg.locked_until_utc <= now:
+                self._metrics.increment("prefetch_expired_total", **self._metric_labels)
+                if self._on_discarded is not None:
+                    self._on_discarded(msg)
+                continue
+            msgs.append(msg)
+        self._space.set()
+        self._metrics.set_gauge("prefetch_buffer_size", len(self._buffer), **self._metric_labels)
+        return msgs
+
+    def record_processed(self, count: int, duration: float):
+        """Record the time taken to handle a batch, to adapt the buffer depth to the handler throughput"""
+        if count == 0 or duration <= 0:
+            return
+        throughput = count / duration
+        self._throughput = throughput if self._throughput is None else 0.8 * self._throughput + 0.2 * throughput
+        # the target depth may have grown
+        self._space.set()
+
+    async def close(self) -> list:
+        """Stop receiving and return the messages left in the buffer (e.g. to abandon them)"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        msgs = list(self._buffer)
+        self._buffer.clear()
+        self._metrics.set_gauge("prefetch_buffer_size", 0, **self._metric_labels)
+        return msgs
+
+
+def _get_remaining_lock_duration(msg) -> Optional[float]:
+    if msg.locked_until_utc is None:
+        return None
+    return (msg.locked_until_utc - datetime.now(timezone.utc)).total_seconds()
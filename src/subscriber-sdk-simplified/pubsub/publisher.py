@@ -1,78 +1,404 @@
+import asyncio
 import logging
 import os
+import uuid
+from typing import Callable, Optional
 
-from azure.identity.aio import WorkloadIdentityCredential
-from azure.servicebus import ServiceBusMessage
-from azure.servicebus.aio import ServiceBusClient
+from .claim_check import CLAIM_CHECK_PROPERTY, BlobStore
+from .client_pool import ServiceBusClientPool
+from .codecs import Codec, get_codec
+from .compression import CONTENT_ENCODING_PROPERTY, compress, validate_compression
+from .config import (
+    AZURE_AUTHORITY_HOST,
+    AZURE_CLIENT_ID,
+    AZURE_FEDERATED_TOKEN_FILE,
+    AZURE_TENANT_ID,
+    CONNECTION_STR,
+    SERVICE_BUS_CLIENT_POOL_SIZE,
+    SERVICE_BUS_CLIENT_POOL_STRATEGY,
+    SERVICE_BUS_NAMESPACE,
+)
+from .events import EVENT_TYPE_PROPERTY, StateChangeEventBase, event_registry
+from .events import get_topic_name_from_event_class
+from .filters import to_property_value
+from .metrics import MetricsRegistry, default_registry
+from .tracing import NOOP_TRACE, TRACEPARENT_PROPERTY, Tracer, get_default_tracer
 
-from .consumer_app import StateChangeEventBase
-from .consumer_app import get_topic_name_from_event_class
+PUBLISHER_HEALTH_CHECK_INTERVAL = float(os.getenv("PUBLISHER_HEALTH_CHECK_INTERVAL", "30"))
+PUBLISHER_CODEC = os.getenv("PUBLISHER_CODEC", "json")
+PUBLISHER_COMPRESSION = os.getenv("PUBLISHER_COMPRESSION", "none")
+PUBLISHER_COMPRESSION_THRESHOLD = int(os.getenv("PUBLISHER_COMPRESSION_THRESHOLD", "16384"))
+PUBLISHER_CLAIM_CHECK_THRESHOLD = int(os.getenv("PUBLISHER_CLAIM_CHECK_THRESHOLD", str(192 * 1024)))
+PUBLISHER_SESSION_IDS = os.getenv("PUBLISHER_SESSION_IDS", "true").lower() == "true"
 
-from dotenv import load_dotenv
 
-# TODO - refactor config storage/handling
-load_dotenv()
+_logger = logging.getLogger(__name__)
 
-CONNECTION_STR = os.environ.get("SERVICE_BUS_CONNECTION_STRING")
-AZURE_CLIENT_ID = os.getenv("AZURE_CLIENT_ID", "")
-AZURE_TENANT_ID = os.getenv("AZURE_TENANT_ID", "")
-AZURE_AUTHORITY_HOST = os.getenv("AZURE_AUTHORITY_HOST", "")
-AZURE_FEDERATED_TOKEN_FILE = os.getenv("AZURE_FEDERATED_TOKEN_FILE", "")
-SERVICE_BUS_NAMESPACE = os.getenv("SERVICE_BUS_NAMESPACE", "")
 
+class Publisher:
+    """Publisher publishes state change events to the Service Bus topic for the event type
 
-_logger = logging.getLogger(__name__)
+    Calling start() creates and opens a sender for every known StateChangeEventBase subclass topic,
+    so the first publish for a topic doesn't pay the cost of connecting, authenticating and attaching the link.
+    While started, a background task periodically checks the senders and reopens any that have been closed
+    (e.g. after a network failure). Senders that fail during a publish are replaced and the send is retried once.
 
-_servicebus_client = None
-# dict keyed on topic name, value is ServiceBusSender
-_topic_senders = {}
+    A Publisher can also be used without calling start(), in which case senders are created on first use.
+    Call close() (or use "async with") to close the senders and clients.
+    """
 
-# TODO - do we want to initialise the service bus client up-front? (i.e. to validate connection prior to publishing)
+    _client_pool: Optional[ServiceBusClientPool]
+    _client_pool_size: int
+    _client_pool_strategy: str
+    _credential: Optional["WorkloadIdentityCredential"]
+    _topic_senders: dict  # key: topic name, value: ServiceBusSender
+    _topics: Optional[list[str]]
+    _health_check_interval: float
+    _health_check_task: Optional[asyncio.Task]
+    _codec: Codec
+    _compression: str
+    _compression_threshold: int
+    _blob_store: Optional[BlobStore]
+    _claim_check_threshold: int
+    _tracer: Tracer
+    _session_ids: bool
+    _client_factory: Optional[Callable]
+    metrics: MetricsRegistry
 
+    def __init__(
+        self,
+        topics: Optional[list[str]] = None,
+        client_pool_size: Optional[int] = None,
+        client_pool_strategy: Optional[str] = None,
+        health_check_interval: Optional[float] = None,
+        metrics: Optional[MetricsRegistry] = None,
+        codec: Optional[str] = None,
+        compression: Optional[str] = None,
+        compression_threshold: Optional[int] = None,
+        blob_store: Optional[BlobStore] = None,
+        claim_check_threshold: Optional[int] = None,
+        tracer: Optional[Tracer] = None,
+        session_ids: Optional[bool] = None,
+        client_factory: Optional[Callable] = None,
+    ):
+        """
+        Args:
+            topics (Optional[list[str]]): The topics to open senders for in start(). Defaults to the topics for all StateChangeEventBase subclasses
+            client_pool_size (Optional[int]): The number of Service Bus clients to spread senders across (defaults to SERVICE_BUS_CLIENT_POOL_SIZE)
+            client_pool_strategy (Optional[str]): How topics are assigned to clients in the pool (defaults to SERVICE_BUS_CLIENT_POOL_STRATEGY)
+            health_check_interval (Optional[float]): The time in seconds between sender health checks (defaults to PUBLISHER_HEALTH_CHECK_INTERVAL)
+            metrics (Optional[MetricsRegistry]): The registry to record publisher metrics in
+            codec (Optional[str]): The name of the codec used to encode events, e.g. "json", "orjson" or "msgpack" (defaults to PUBLISHER_CODEC)
+            compression (Optional[str]): The compression to apply to large events: "none", "gzip" or "zstd" (defaults to PUBLISHER_COMPRESSION)
+            compression_threshold (Optional[int]): The encoded size in bytes at or above which events are compressed (defaults to PUBLISHER_COMPRESSION_THRESHOLD)
+            blob_store (Optional[BlobStore]): The store to offload large event bodies to (claim-check). If not set, bodies are never offloaded
+            claim_check_threshold (Optional[int]): The size in bytes (after compression) at or above which bodies are offloaded to blob_store (defaults to PUBLISHER_CLAIM_CHECK_THRESHOLD)
+            tracer (Optional[Tracer]): The tracer used to add trace context to messages (defaults to the tracer configured from the environment, see pubsub.tracing)
+            session_ids (Optional[bool]): Whether to set the session id of messages to the event's entity_id, so that session-enabled subscriptions receive each entity's events in order (defaults to PUBLISHER_SESSION_IDS)
+            client_factory (Optional[Callable]): Function that creates the Service Bus clients (defaults to creating clients from the environment config), e.g. to publish to a local fake transport (see pubsub.loadgen)
+        """
+        self._client_pool = None
+        self._client_pool_size = client_pool_size or SERVICE_BUS_CLIENT_POOL_SIZE
+        self._client_pool_strategy = client_pool_strategy or SERVICE_BUS_CLIENT_POOL_STRATEGY
+        self._credential = None
+        self._topic_senders = {}
+        self._topics = topics
+        self._health_check_interval = health_check_interval or PUBLISHER_HEALTH_CHECK_INTERVAL
+        self._health_check_task = None
+        self._codec = get_codec(codec or PUBLISHER_CODEC)
+        self._compression = compression or PUBLISHER_COMPRESSION
+        validate_compression(self._compression)
+        self._compression_threshold = (
+            compression_threshold if compression_threshold is not None else PUBLISHER_COMPRESSION_THRESHOLD
+        )
+        self._blob_store = blob_store
+        self._claim_check_threshold = (
+            claim_check_threshold if claim_check_threshold is not None else PUBLISHER_CLAIM_CHECK_THRESHOLD
+        )
+        self._tracer = tracer or get_default_tracer()
+        self._session_ids = session_ids if session_ids is not None else PUBLISHER_SESSION_IDS
+        self._client_factory = client_factory
+        self.metrics = metrics or default_registry
 
-def _get_servicebus_client():
-    global _servicebus_client
-    if _servicebus_client is None:
-        workload_identity_credential = None
+    def _create_servicebus_client(self):
+        # imported on first use as the azure packages are slow to import (see benchmarks/bench_startup.py)
+        from azure.identity.aio import WorkloadIdentityCredential
+        from azure.servicebus.aio import ServiceBusClient
 
         _logger.info("Connecting to service bus...")
         if AZURE_CLIENT_ID and AZURE_TENANT_ID and AZURE_AUTHORITY_HOST and AZURE_FEDERATED_TOKEN_FILE:
             _logger.info("Using workload identity credentials")
-            workload_identity_credential = WorkloadIdentityCredential(
-                client_id=AZURE_CLIENT_ID,
-                tenant_id=AZURE_TENANT_ID,
-                token_file_path=AZURE_FEDERATED_TOKEN_FILE,
-            )
-            _servicebus_client = ServiceBusClient(
+            if self._credential is None:
+                self._credential = WorkloadIdentityCredential(
+                    client_id=AZURE_CLIENT_ID,
+                    tenant_id=AZURE_TENANT_ID,
+                    token_file_path=AZURE_FEDERATED_TOKEN_FILE,
+                )
+            return ServiceBusClient(
                 fully_qualified_namespace=SERVICE_BUS_NAMESPACE,
-                credential=workload_identity_credential,
+                credential=self._credential,
             )
         else:
             _logger.info("No workload identity credentials found, using connection string")
-            _servicebus_client = ServiceBusClient.from_connection_string(conn_str=CONNECTION_STR)
-    return _servicebus_client
+            return ServiceBusClient.from_connection_string(conn_str=CONNECTION_STR)
+
+    def _get_client_pool(self) -> ServiceBusClientPool:
+        if self._client_pool is None:
+            self._client_pool = ServiceBusClientPool(
+                self._client_factory or self._create_servicebus_client,
+                size=self._client_pool_size,
+                strategy=self._client_pool_strategy,
+            )
+        return self._client_pool
+
+    def _get_topic_sender(self, topic_name: str):
+        topic_sender = self._topic_senders.get(topic_name)
+        if topic_sender is None:
+            _logger.debug(f"Creating service bus sender for topic '{topic_name}'")
+            topic_sender = self._get_client_pool().get_client(topic_name).get_topic_sender(topic_name=topic_name)
+            self._topic_senders[topic_name] = topic_sender
+        return topic_sender
+
+    async def _open_sender(self, topic_name: str):
+        # entering the sender context opens the connection/link (and is a no-op if it is already open)
+        await self._get_topic_sender(topic_name).__aenter__()
+
+    async def _replace_sender(self, topic_name: str, failed_sender):
+        """Replace a failed sender with a new one (unless it has already been replaced)"""
+        if self._topic_senders.get(topic_name) is not failed_sender:
+            return
+        _logger.warning(f"Recreating service bus sender for topic '{topic_name}'")
+        del self._topic_senders[topic_name]
+        self._get_topic_sender(topic_name)
+        self.metrics.increment("publisher_sender_reconnects_total", topic=topic_name)
+        try:
+            await failed_sender.close()
+        except Exception as e:
+            _logger.debug(f"Error closing failed sender for topic '{topic_name}': {e!r}")
+
+    def _get_known_topics(self) -> list[str]:
+        if self._topics is not None:
+            return self._topics
+        return event_registry.get_topics()
+
+    async def start(self):
+        """Open senders for the known topics and start the background sender health check"""
+        topics = self._get_known_topics()
+        _logger.info(f"Opening senders for {len(topics)} topic(s)...")
+        await asyncio.gather(*[self._ensure_sender_open(topic_name) for topic_name in topics])
+        if self._health_check_task is None:
+            self._health_check_task = asyncio.create_task(self._run_health_check())
+
+    async def _ensure_sender_open(self, topic_name: str):
+        sender = self._get_topic_sender(topic_name)
+        try:
+            await self._open_sender(topic_name)
+        except Exception as e:
+            _logger.warning(f"Failed to open sender for topic '{topic_name}': {e!r}")
+            await self._replace_sender(topic_name, sender)
+
+    async def _run_health_check(self):
+        while True:
+            await asyncio.sleep(self._health_check_interval)
+            await asyncio.gather(
+                *[self._ensure_sender_open(topic_name) for topic_name in list(self._topic_senders.keys())]
+            )
+
+    async def _to_servicebus_message(
+        self, message: StateChangeEventBase, message_id: Optional[str] = None, trace=NOOP_TRACE
+    ) -> "ServiceBusMessage":
+        from azure.servicebus import ServiceBusMessage
+
+        body = self._codec.encode(message)
+        application_properties = {}
+        # the event type identifies the event class for topics with several event classes
+        event_type = event_registry.get_event_type(type(message))
+        if event_type is not None:
+            application_properties[EVENT_TYPE_PROPERTY] = event_type
+        # W3C trace context so that consumers continue the trace
+        if trace.traceparent is not None:
+            application_properties[TRACEPARENT_PROPERTY] = trace.traceparent
+        # promoted fields are sent as application properties so that subscription rules can filter on them
+        for name in event_registry.get_promoted_fields(event_registry.get_topic(type(message))):
+            value = to_property_value(getattr(message, name, None))
+            if value is not None:
+                application_properties[name] = value
+        if isinstance(body, str) and (self._compression != "none" or self._blob_store is not None):
+            # the thresholds are in bytes (len of a str counts characters, which undercounts multi-byte text)
+            body = body.encode("utf-8")
+        if self._compression != "none" and len(body) >= self._compression_threshold:
+            body = compress(body, self._compression)
+            application_properties[CONTENT_ENCODING_PROPERTY] = self._compression
+        if self._blob_store is not None and len(body) >= self._claim_check_threshold:
+            # offload the body and send a reference to it (the content type/encoding describe the stored body)
+            topic_name = get_topic_name_from_event_class(type(message))
+            key = f"{topic_name}-{uuid.uuid4()}"
+            await self._blob_store.put(key, body)
+            self.metrics.increment("claim_check_offloaded_total", topic=topic_name)
+            body = b""
+            application_properties[CLAIM_CHECK_PROPERTY] = key
+        return ServiceBusMessage(
+            body,
+            content_type=self._codec.content_type,
+            message_id=message_id,
+            # the session id is ignored by subscriptions that don't have sessions enabled
+            session_id=message.entity_id if self._session_ids else None,
+            application_properties=application_properties or None,
+        )
+
+    async def publish(self, message: StateChangeEventBase, message_id: Optional[str] = None):
+        """Publish an event to the topic for its type
+
+        Args:
+            message (StateChangeEventBase): The event to publish
+            message_id (Optional[str]): The message id to use (e.g. for duplicate detection). If not set, the id is generated by Service Bus
+        """
+        # Determine topic to publish to from message type
+        topic_name = get_topic_name_from_event_class(type(message))
+
+        _logger.info(f"Publishing message to topic '{topic_name}'")
+        trace = self._tracer.start_publish_trace(topic_name)
+        try:
+            await self._send(topic_name, [await self._to_servicebus_message(message, message_id, trace)])
+        except Exception:
+            trace.end(error=True)
+            raise
+        trace.end()
 
+    async def publish_batch(self, messages: list[StateChangeEventBase], message_ids: Optional[list[str]] = None):
+        """Publish a list of events, sending the events for each topic in a single call
 
-def _get_topic_sender(topic_name: str):
-    topic_sender = _topic_senders.get(topic_name)
-    if topic_sender is None:
-        _logger.debug(f"Creating service bus sender for topic '{topic_name}'")
-        topic_sender = _get_servicebus_client().get_topic_sender(topic_name=topic_name)
-        _topic_senders[topic_name] = topic_sender
+        Args:
+            messages (list[StateChangeEventBase]): The events to publish
+            message_ids (Optional[list[str]]): The message id to use for each event (see publish)
+        """
+        if message_ids is None:
+            message_ids = [None] * len(messages)
+        topic_names = [get_topic_name_from_event_class(type(message)) for message in messages]
+        traces = [self._tracer.start_publish_trace(topic_name) for topic_name in topic_names]
+        try:
+            # convert concurrently so that claim-check bodies are offloaded in parallel
+            servicebus_messages = await asyncio.gather(
+                *[
+                    self._to_servicebus_message(message, message_id, trace)
+                    for message, message_id, trace in zip(messages, message_ids, traces)
+                ]
+            )
+            messages_by_topic = {}  # key: topic name, value: list of ServiceBusMessage
+            for topic_name, servicebus_message in zip(topic_names, servicebus_messages):
+                messages_by_topic.setdefault(topic_name, []).append(servicebus_message)
+
+            for topic_name, servicebus_messages in messages_by_topic.items():
+                _logger.debug(f"Publishing {len(servicebus_messages)} message(s) to topic '{topic_name}'")
+                await self._send(topic_name, servicebus_messages)
+        except Exception:
+            for trace in traces:
+                trace.end(error=True)
+            raise
+        for trace in traces:
+            trace.end()
+
+    async def _send(self, topic_name: str, servicebus_messages: list["ServiceBusMessage"]):
+        """Send messages to a topic, packing a list into as few batches as fit the sender's maximum batch size"""
+        if len(servicebus_messages) == 1:
+            # send a single message directly rather than in a batch to avoid the SDK batching overhead
+            await self._call_sender(topic_name, lambda sender: sender.send_messages(servicebus_messages[0]))
+        else:
+            batches = await self._call_sender(
+                topic_name, lambda sender: self._create_batches(sender, servicebus_messages)
+            )
+            for batch in batches:
+                await self._call_sender(topic_name, lambda sender: sender.send_messages(batch))
+        self.metrics.increment("messages_published_total", len(servicebus_messages), topic=topic_name)
+
+    async def _create_batches(
+        self, sender: "ServiceBusSender", servicebus_messages: list["ServiceBusMessage"]
+    ) -> list["ServiceBusMessageBatch"]:
+        from azure.servicebus.exceptions import MessageSizeExceededError
+
+        batches = [await sender.create_message_batch()]
+        for servicebus_message in servicebus_messages:
+            try:
+                batches[-1].add_message(servicebus_message)
+            except MessageSizeExceededError:
+                if len(batches[-1]) == 0:
+                    # the message is too large to send on its own
+                    raise
+                batches.append(await sender.create_message_batch())
+                batches[-1].add_message(servicebus_message)
+        return batches
+
+    async def _call_sender(self, topic_name: str, operation: Callable):
+        """Call operation with the sender for a topic, replacing the sender and retrying once if it fails"""
+        topic_sender = self._get_topic_sender(topic_name)
+        try:
+            return await operation(topic_sender)
+        except ValueError:
+            # e.g. MessageSizeExceededError: the sender is fine and a retry would fail the same way
+            self.metrics.increment("publish_failures_total", topic=topic_name)
+            raise
+        except Exception as e:
+            # the sender may have failed (e.g. the link was detached), so replace it and retry once
+            _logger.warning(f"Failed to publish message(s) to topic '{topic_name}' - retrying with new sender: {e!r}")
+            self.metrics.increment("publish_failures_total", topic=topic_name)
+            await self._replace_sender(topic_name, topic_sender)
+            return await operation(self._get_topic_sender(topic_name))
+
+    async def close(self):
+        """Stop the health check and close the senders and clients"""
+        if self._health_check_task is not None:
+            self._health_check_task.cancel()
+            self._health_check_task = None
+        senders = list(self._topic_senders.values())
+        self._topic_senders = {}
+        for sender in senders:
+            await sender.close()
+        if self._client_pool is not None:
+            await self._client_pool.close()
+            self._client_pool = None
+        if self._credential is not None:
+            await self._credential.close()
+            self._credential = None
+        if self._tracer.enabled:
+            await asyncio.to_thread(self._tracer.flush)
 
-    return topic_sender
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+
+_default_publisher = None
+
+
+def get_default_publisher() -> Publisher:
+    """Get the Publisher used by the module-level publish function (see close_default_publisher)"""
+    global _default_publisher
+    if _default_publisher is None:
+        _default_publisher = Publisher()
+    return _default_publisher
+
+
+async def close_default_publisher():
+    """Close the Publisher used by the module-level publish function (a new one is created by the next publish)
+
+    ConsumerApp.run calls this when it stops, so handlers can use publish without managing a Publisher.
+    Other apps that use publish should call this before exiting
+    """
+    global _default_publisher
+    publisher, _default_publisher = _default_publisher, None
+    if publisher is not None:
+        await publisher.close()
 
 
 # TODO - do we want publish to be async? Feels like it could be easy to make a mistake and not await it (resulting in not publishing)
 
 
 async def publish(message: StateChangeEventBase):
-    # Determine topic to publish to from message type
-    topic_name = get_topic_name_from_event_class(type(message))
-
-    # Get topic sender
-    topic_sender = _get_topic_sender(topic_name)
+    """Publish an event using the default Publisher (senders are created on first use)
 
-    # Send message
-    _logger.info(f"Publishing message to topic '{topic_name}'")
-    await topic_sender.send_messages(ServiceBusMessage(message.json()))
+    For apps that publish frequently, prefer creating a Publisher and calling start() so that senders are opened up-front
+    """
+    await get_default_publisher().publish(message)
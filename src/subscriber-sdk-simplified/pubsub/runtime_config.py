@@ -0,0 +1,103 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Optional
+
+SUBSCRIPTION_SETTING_NAMES = ["max_message_count", "max_wait_time", "max_lock_renewal_duration", "max_concurrency"]
+
+_logger = logging.getLogger(__name__)
+
+
+SUBSCRIPTION_COUNT_SETTING_NAMES = ["max_message_count", "max_concurrency"]
+"""Settings that must be whole numbers (they are passed to receive_messages and asyncio.Semaphore)"""
+
+
+def validate_subscription_settings(settings: dict):
+    """Raise an exception if settings contains unknown setting names or invalid values
+
+    Counts must be positive integers (max_concurrency can also be 0, to process the whole batch concurrently),
+    and durations must be positive numbers.
+    """
+    for name, value in settings.items():
+        if name not in SUBSCRIPTION_SETTING_NAMES:
+            raise Exception(f"Unknown subscription setting '{name}'")
+        if value is None:
+            continue
+        if name in SUBSCRIPTION_COUNT_SETTING_NAMES:
+            valid = isinstance(value, int) and not isinstance(value, bool)
+            valid = valid and (value >= 0 if name == "max_concurrency" else value > 0)
+        else:
+            valid = isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0
+        if not valid:
+            raise Exception(f"Invalid value for subscription setting '{name}': {value}")
+
+
+class RuntimeConfigWatcher:
+    """RuntimeConfigWatcher watches a JSON file and applies the settings in it to a running ConsumerApp
+
+    The file is in the form:
+
+        {
+            "defaults": {"max_message_count": 20},
+            "subscriptions": {
+                "task-created|my-subscription": {"max_message_count": 50, "max_wait_time": 5, "max_concurrency": 10}
+            }
+        }
+
+    Each time the file changes, the full set of overrides is re-applied so removing a value reverts
+    to the value passed to the consume decorator (or the app default).
+    """
+
+    _app: "ConsumerApp"
+    _path: str
+    _poll_interval: float
+    _last_mtime: Optional[float]
+
+    def __init__(self, app: "ConsumerApp", path: str, poll_interval: float = 5):
+        self._app = app
+        self._path = path
+        self._poll_interval = poll_interval
+        self._last_mtime = None
+
+    def load(self) -> bool:
+        """Apply the config file if it has changed since it was last loaded. Returns True if the config was applied"""
+        try:
+            mtime = os.stat(self._path).st_mtime
+        except FileNotFoundError:
+            _logger.debug(f"Runtime config file not found: {self._path}")
+            return False
+
+        if mtime == self._last_mtime:
+            return False
+        self._last_mtime = mtime
+
+        try:
+            with open(self._path) as f:
+                config = json.load(f)
+            defaults = config.get("defaults", {})
+            subscriptions = config.get("subscriptions", {})
+            # Validate everything before applying anything so that a bad edit leaves the previous config in place
+            validate_subscription_settings(defaults)
+            for subscription_key, settings in subscriptions.items():
+                validate_subscription_settings(settings)
+        except Exception as e:
+            _logger.error(f"❌ Failed to load runtime config from {self._path} - keeping previous config: {e}")
+            return False
+
+        self._app.update_subscription_settings(None, **defaults)
+        for subscription_key in self._app.get_subscription_keys():
+            settings = subscriptions.get(subscription_key, {})
+            self._app.update_subscription_settings(subscription_key, **settings)
+        for subscription_key in subscriptions:
+            if subscription_key not in self._app.get_subscription_keys():
+                _logger.warning(f"Runtime config contains settings for unknown subscription '{subscription_key}'")
+
+        _logger.info(f"🔧 Applied runtime config from {self._path}")
+        return True
+
+    async def run(self):
+        """Poll the config file for changes until the app is cancelled"""
+        while not self._app.is_cancelled:
+            await asyncio.sleep(self._poll_interval)
+            self.load()
@@ -0,0 +1,195 @@
+import asyncio
+import concurrent.futures
+import logging
+import os
+import queue
+import threading
+from typing import Callable, Optional
+
+from .event_loop import new_event_loop
+from .events import StateChangeEventBase
+from .publisher import Publisher
+
+SYNC_PUBLISHER_MAX_QUEUE_SIZE = int(os.getenv("SYNC_PUBLISHER_MAX_QUEUE_SIZE", "10000"))
+SYNC_PUBLISHER_MAX_BATCH_SIZE = int(os.getenv("SYNC_PUBLISHER_MAX_BATCH_SIZE", "100"))
+
+_logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class SyncPublisher:
+    """SyncPublisher is a thread-safe, synchronous facade over Publisher for use from non-async code (e.g. Flask/WSGI apps)
+
+    Events are queued to a single background thread running an asyncio event loop that owns the Publisher.
+    Queued events are sent in batches (grouped by topic), so many threads publishing concurrently share
+    the same senders and round trips.
+
+    The queue is bounded: when it is full, publish()/publish_nowait() block until there is space
+    (or raise queue.Full if enqueue_timeout is set and elapses).
+    """
+
+    _publisher_factory: Callable[[], Publisher]
+    _max_batch_size: int
+    _enqueue_timeout: Optional[float]
+    _event_loop: Optional[str]
+    _slots: threading.BoundedSemaphore  # limits the number of queued/in-flight events
+    _loop: Optional[asyncio.AbstractEventLoop]
+    _queue: Optional[asyncio.Queue]
+    _thread: Optional[threading.Thread]
+    _ready: threading.Event
+    _start_error: Optional[BaseException]
+    _lock: threading.Lock
+    _closed: bool
+
+    def __init__(
+        self,
+        publisher_factory: Optional[Callable[[], Publisher]] = None,
+        max_queue_size: Optional[int] = None,
+        max_batch_size: Optional[int] = None,
+        enqueue_timeout: Optional[float] = None,
+        event_loop: Optional[str] = None,
+    ):
+        """
+        Args:
+            publisher_factory (Optional[Callable[[], Publisher]]): Creates the Publisher on the background loop (defaults to Publisher())
+            max_queue_size (Optional[int]): The maximum number of events waiting to be sent (defaults to SYNC_PUBLISHER_MAX_QUEUE_SIZE)
+            max_batch_size (Optional[int]): The maximum number of events sent in a single batch (defaults to SYNC_PUBLISHER_MAX_BATCH_SIZE)
+            enqueue_timeout (Optional[float]): How long to wait in seconds for space in the queue before raising queue.Full (defaults to waiting indefinitely)
+            event_loop (Optional[str]): The background event loop: "auto" (uvloop if installed), "uvloop" or "asyncio" (defaults to EVENT_LOOP)
+        """
+        self._publisher_factory = publisher_factory or Publisher
+        self._max_batch_size = max_batch_size or SYNC_PUBLISHER_MAX_BATCH_SIZE
+        self._enqueue_timeout = enqueue_timeout
+        self._event_loop = event_loop
+        self._slots = threading.BoundedSemaphore(max_queue_size or SYNC_PUBLISHER_MAX_QUEUE_SIZE)
+        self._loop = None
+        self._queue = None
+        self._thread = None
+        self._ready = threading.Event()
+        self._start_error = None
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def start(self):
+        """Start the background event loop and open the publisher senders (called automatically on first publish)"""
+        with self._lock:
+            if self._closed:
+                raise Exception("SyncPublisher has been closed")
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run_loop, name="pubsub-sync-publisher", daemon=True)
+            self._thread.start()
+        self._ready.wait()
+        if self._start_error is not None:
+            raise self._start_error
+
+    def _run_loop(self):
+        self._loop = new_event_loop(self._event_loop)
+        try:
+            self._loop.run_until_complete(self._main())
+        finally:
+            self._loop.close()
+
+    async def _main(self):
+        self._queue = asyncio.Queue()
+        try:
+            publisher = self._publisher_factory()
+            await publisher.start()
+        except BaseException as e:
+            self._start_error = e
+            self._ready.set()
+            return
+        self._ready.set()
+
+        try:
+            stopping = False
+            while not (stopping and self._queue.empty()):
+                batch = [await self._queue.get()]
+                while len(batch) < self._max_batch_size and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                if _STOP in batch:
+                    # keep draining until the queue is empty so that events queued before close() are sent
+                    stopping = True
+                    batch = [item for item in batch if item is not _STOP]
+                if len(batch) > 0:
+                    await self._send_batch(publisher, batch)
+        finally:
+            self._fail_queued()
+            await publisher.close()
+
+    def _fail_queued(self):
+        """Fail the futures for any events still queued when the loop stops (so that publish() doesn't block)"""
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is _STOP:
+                continue
+            _, future = item
+            if not future.done():
+                future.set_exception(Exception("SyncPublisher has been closed"))
+            self._slots.release()
+
+    async def _send_batch(self, publisher: Publisher, batch: list):
+        # send per topic so that a failure for one topic doesn't fail the events for other topics
+        batch_by_topic = {}  # key: event type, value: list of (message, future)
+        for message, future in batch:
+            batch_by_topic.setdefault(type(message), []).append((message, future))
+
+        for topic_batch in batch_by_topic.values():
+            try:
+                await publisher.publish_batch([message for message, _ in topic_batch])
+                for _, future in topic_batch:
+                    future.set_result(None)
+            except Exception as e:
+                _logger.error(f"❌ Failed to publish batch of {len(topic_batch)} message(s): {e!r}")
+                for _, future in topic_batch:
+                    future.set_exception(e)
+            finally:
+                for _ in topic_batch:
+                    self._slots.release()
+
+    def publish_nowait(self, message: StateChangeEventBase) -> concurrent.futures.Future:
+        """Queue an event for publishing and return a Future that completes when the event has been sent
+
+        Blocks if the queue is full (see enqueue_timeout)
+        """
+        self.start()
+        if not self._slots.acquire(timeout=self._enqueue_timeout):
+            raise queue.Full("SyncPublisher queue is full")
+        future = concurrent.futures.Future()
+        # enqueue under the lock so that the event is queued ahead of the stop marker queued by close()
+        with self._lock:
+            if self._closed:
+                self._slots.release()
+                raise Exception("SyncPublisher has been closed")
+            try:
+                self._loop.call_soon_threadsafe(self._queue.put_nowait, (message, future))
+            except RuntimeError:
+                # the loop has been closed
+                self._slots.release()
+                raise Exception("SyncPublisher has been closed")
+        return future
+
+    def publish(self, message: StateChangeEventBase, timeout: Optional[float] = None):
+        """Publish an event and block until it has been sent (raises if the send fails)"""
+        self.publish_nowait(message).result(timeout=timeout)
+
+    def close(self, timeout: Optional[float] = None):
+        """Send any queued events, then close the publisher and stop the background loop"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+            if thread is None:
+                return
+            if self._start_error is None:
+                self._loop.call_soon_threadsafe(self._queue.put_nowait, _STOP)
+        thread.join(timeout=timeout)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
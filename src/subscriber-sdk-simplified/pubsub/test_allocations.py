@@ -0,0 +1,43 @@
+import asyncio
+from unittest.mock import patch
+
+from .allocations import stop_allocation_tracing
+from .consumer_app import ConsumerApp, StateChangeEventBase
+from .metrics import MetricsRegistry
+from .test_helpers import MockServiceBusClientBuilder, run_app_with_timeout
+
+
+class SampleAllocationsStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+retained = []
+
+
+def test_allocation_report_attributes_allocations_to_subscriptions():
+    mock_sb_client = (
+        MockServiceBusClientBuilder()
+        .add_messages_for_topic_subscription(
+            "sample-allocations", "TEST_SUB", messages=['{"entity_id": "1"}', '{"entity_id": "2"}']
+        )
+        .build()
+    )
+    try:
+        with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+            app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=MetricsRegistry(), allocation_tracing=True)
+
+            @app.consume(max_wait_time=0.1)
+            async def on_sample_allocations(message: SampleAllocationsStateChangeEvent):
+                retained.append(bytearray(100_000))
+
+            asyncio.run(run_app_with_timeout(app))
+            report = app.get_allocation_report(limit=3)
+    finally:
+        stop_allocation_tracing()
+        retained.clear()
+
+    sites = report["subscriptions"]["sample-allocations|TEST_SUB"]
+    assert sites[0]["site"].endswith(f"test_allocations.py:{on_sample_allocations.__code__.co_firstlineno + 2}")
+    assert sites[0]["size_bytes"] >= 200_000
+    assert sites[0]["count"] >= 2
+    assert report["traced_bytes"] >= 200_000
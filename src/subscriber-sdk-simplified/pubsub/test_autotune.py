@@ -0,0 +1,118 @@
+import asyncio
+import logging
+from unittest.mock import patch
+
+from .autotune import AutotuneConfig, AutotuneController, percentile
+from .consumer_app import ConsumerApp, StateChangeEventBase
+from .metrics import MetricsRegistry
+from .test_helpers import MockServiceBusClientBuilder, run_app_with_timeout
+
+
+class SampleAutotuneStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+def create_controller(config: AutotuneConfig, initial_batch_size: int = 10):
+    metrics = MetricsRegistry()
+    controller = AutotuneController(config, initial_batch_size, metrics, metric_labels={"topic": "t"})
+    return controller, metrics
+
+
+def test_percentile():
+    assert percentile([], 99) == 0
+    assert percentile([1, 2, 3, 4], 50) == 2
+    assert percentile(list(range(1, 101)), 99) == 99
+
+
+def test_increases_batch_size_when_batch_full():
+    controller, metrics = create_controller(AutotuneConfig(max_batch_size=20))
+
+    decision = controller.record_batch(
+        received_count=10, requested_count=10, duration=1, latencies=[0.1] * 10, error_count=0
+    )
+
+    assert decision.direction == "increase"
+    assert controller.batch_size == 11
+    assert metrics.get("autotune_batch_size", topic="t") == 11
+    assert metrics.get("autotune_decisions_total", topic="t", direction="increase") == 1
+
+
+def test_holds_batch_size_when_batch_not_full():
+    controller, _ = create_controller(AutotuneConfig())
+
+    decision = controller.record_batch(
+        received_count=3, requested_count=10, duration=1, latencies=[0.1] * 3, error_count=0
+    )
+
+    assert decision.direction == "hold"
+    assert controller.batch_size == 10
+
+
+def test_holds_batch_size_at_upper_bound():
+    controller, _ = create_controller(AutotuneConfig(max_batch_size=10))
+
+    decision = controller.record_batch(
+        received_count=10, requested_count=10, duration=1, latencies=[0.1] * 10, error_count=0
+    )
+
+    assert decision.direction == "hold"
+    assert controller.batch_size == 10
+
+
+def test_decreases_batch_size_when_p99_above_target():
+    controller, _ = create_controller(AutotuneConfig(target_p99_latency=0.5, tune_concurrency=True))
+
+    decision = controller.record_batch(
+        received_count=10, requested_count=10, duration=1, latencies=[0.1] * 9 + [2], error_count=0
+    )
+
+    assert decision.direction == "decrease"
+    assert controller.batch_size == 5
+    assert controller.concurrency == 5
+
+
+def test_decreases_batch_size_when_error_rate_high():
+    controller, _ = create_controller(AutotuneConfig(max_error_rate=0.1, min_batch_size=8))
+
+    decision = controller.record_batch(
+        received_count=10, requested_count=10, duration=1, latencies=[0.1] * 10, error_count=5
+    )
+
+    assert decision.direction == "decrease"
+    assert controller.batch_size == 8, "Batch size should not go below min_batch_size"
+
+
+def test_steps_back_when_increase_reduces_throughput():
+    controller, _ = create_controller(AutotuneConfig())
+    controller.record_batch(received_count=10, requested_count=10, duration=1, latencies=[0.1] * 10, error_count=0)
+    assert controller.batch_size == 11
+
+    decision = controller.record_batch(
+        received_count=11, requested_count=11, duration=2, latencies=[0.1] * 11, error_count=0
+    )
+
+    assert decision.direction == "decrease"
+    assert controller.batch_size == 10
+
+
+def test_consumer_app_uses_autotuned_batch_size():
+    messages = ['{"entity_id": "1"}', '{"entity_id": "2"}']
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.add_messages_for_topic_subscription(
+        "sample-autotune", "TEST_SUB", messages=messages
+    ).build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        metrics = MetricsRegistry()
+        app = ConsumerApp(default_subscription_name="TEST_SUB", max_message_count=2, metrics=metrics)
+
+        @app.consume(max_wait_time=0.1, autotune=AutotuneConfig(max_batch_size=5))
+        async def on_sample_autotune(message: SampleAutotuneStateChangeEvent):
+            logging.info("In on_sample_autotune")
+
+        asyncio.run(run_app_with_timeout(app))
+
+    subscription = app._subscriptions[0]
+    # the full batch of 2 messages should have increased the batch size
+    assert subscription.autotune_controller.batch_size == 3
+    assert app._get_subscription_settings(subscription).max_message_count == 3
+    assert metrics.get("autotune_batch_size", topic="sample-autotune", subscription="TEST_SUB") == 3
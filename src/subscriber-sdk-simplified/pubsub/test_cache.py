@@ -0,0 +1,109 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from .cache import AsyncCache
+from .consumer_app import ConsumerApp, StateChangeEventBase
+from .metrics import MetricsRegistry
+from .test_helpers import MockServiceBusClientBuilder, run_app_with_timeout
+
+
+class SampleCacheStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+def test_cache_coalesces_concurrent_loads_and_evicts():
+    loads = []
+
+    async def loader(key):
+        loads.append(key)
+        await asyncio.sleep(0.01)
+        return f"value-{key}"
+
+    async def run():
+        metrics = MetricsRegistry()
+        cache = AsyncCache("sample", loader=loader, max_size=2, metrics=metrics)
+        values = await asyncio.gather(*[cache.get("a") for _ in range(5)])
+        assert values == ["value-a"] * 5
+        assert loads == ["a"], "Expected concurrent misses to share one load"
+
+        assert await cache.get("a") == "value-a"
+        await cache.get("b")
+        await cache.get("c")  # evicts "a", the least recently used
+        assert len(cache) == 2
+        await cache.get("a")
+        assert loads == ["a", "b", "c", "a"]
+        return metrics
+
+    metrics = asyncio.run(run())
+    assert metrics.get("cache_misses_total", cache="sample") == 4
+    assert metrics.get("cache_coalesced_total", cache="sample") == 4
+    assert metrics.get("cache_hits_total", cache="sample") == 1
+    assert metrics.get("cache_evictions_total", cache="sample") == 2
+
+
+def test_cache_load_errors_are_shared_and_not_cached():
+    calls = 0
+
+    async def loader(key):
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        if calls == 1:
+            raise Exception("Lookup failed")
+        return key
+
+    async def run():
+        cache = AsyncCache("sample", loader=loader, metrics=MetricsRegistry())
+        results = await asyncio.gather(cache.get("a"), cache.get("a"), return_exceptions=True)
+        assert [str(result) for result in results] == ["Lookup failed", "Lookup failed"]
+        assert await cache.get("a") == "a"
+
+    asyncio.run(run())
+    assert calls == 2
+
+
+def test_handlers_are_injected_with_batch_loaded_cache():
+    mock_sb_client = (
+        MockServiceBusClientBuilder()
+        .add_messages_for_topic_subscription(
+            "sample-cache",
+            "TEST_SUB",
+            messages=['{"entity_id": "1"}', '{"entity_id": "2"}', '{"entity_id": "1"}', '{"entity_id": "3"}'],
+        )
+        .build()
+    )
+    batches = []
+    received = []
+
+    async def load_entities(keys):
+        batches.append(sorted(keys))
+        return {key: {"id": key} for key in keys}
+
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=MetricsRegistry())
+        app.add_cache("entities", batch_loader=load_entities)
+
+        @app.consume(max_wait_time=0.1)
+        async def on_sample_cache(message: SampleCacheStateChangeEvent, entities: AsyncCache):
+            received.append(await entities.get(message.entity_id))
+
+        asyncio.run(run_app_with_timeout(app))
+
+    assert batches == [["1", "2", "3"]], "Expected one bulk lookup for the batch"
+    assert sorted(entity["id"] for entity in received) == ["1", "1", "2", "3"]
+    assert app.metrics.get("cache_coalesced_total", cache="entities") == 1
+
+
+def test_missing_dependency_raises():
+    mock_sb_client = MockServiceBusClientBuilder().build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=MetricsRegistry())
+
+        @app.consume
+        async def on_sample_cache(message: SampleCacheStateChangeEvent, entities):
+            pass
+
+        with pytest.raises(Exception, match="No dependency registered for argument 'entities'"):
+            asyncio.run(app.run())
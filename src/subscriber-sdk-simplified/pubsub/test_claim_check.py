@@ -0,0 +1,131 @@
+import asyncio
+import json
+
+import pytest
+
+from .claim_check import CLAIM_CHECK_PROPERTY, BlobStore, ClaimCheckResolver, LocalFileBlobStore
+from .codecs import JsonCodec, register_codec
+from .consumer_app import StateChangeEventBase
+from .metrics import MetricsRegistry
+from .test_helpers import MockServiceBusClientBuilder, publish_and_consume
+
+
+class SampleClaimCheckStateChangeEvent(StateChangeEventBase):
+    snapshot: str = ""
+
+
+class Utf8JsonCodec(JsonCodec):
+    """JSON codec that doesn't escape non-ASCII characters (so the body is shorter in characters than in bytes)"""
+
+    name = "utf8-json"
+
+    def encode(self, message):
+        return json.dumps(message.dict(), ensure_ascii=False)
+
+
+register_codec(Utf8JsonCodec(), decode_content_type=False)
+
+
+class CountingBlobStore(BlobStore):
+    """In-memory blob store that counts the calls to get"""
+
+    def __init__(self, blobs: dict):
+        self.blobs = blobs
+        self.get_count = 0
+
+    async def get(self, key: str) -> bytes:
+        self.get_count += 1
+        await asyncio.sleep(0.01)
+        return self.blobs[key]
+
+
+def test_large_event_is_offloaded_and_fetched_by_consumer(tmp_path):
+    blob_store = LocalFileBlobStore(str(tmp_path))
+    message = SampleClaimCheckStateChangeEvent(entity_id="123", snapshot="x" * 10000)
+    sent_message, received_message = publish_and_consume(
+        message,
+        publisher_args={"blob_store": blob_store, "claim_check_threshold": 1000},
+        consumer_args={"blob_store": blob_store},
+    )
+
+    key = sent_message.application_properties[CLAIM_CHECK_PROPERTY]
+    assert b"".join(sent_message.body) == b"", "Expected the body to be offloaded"
+    assert (tmp_path / key).read_text() == message.json()
+    assert received_message == message
+
+
+def test_threshold_is_compared_with_the_encoded_size(tmp_path):
+    blob_store = LocalFileBlobStore(str(tmp_path))
+    # under the threshold in characters, but over it in UTF-8 bytes
+    message = SampleClaimCheckStateChangeEvent(entity_id="123", snapshot="é" * 600)
+    sent_message, received_message = publish_and_consume(
+        message,
+        publisher_args={"blob_store": blob_store, "claim_check_threshold": 1000, "codec": "utf8-json"},
+        consumer_args={"blob_store": blob_store},
+    )
+
+    assert CLAIM_CHECK_PROPERTY in sent_message.application_properties, "Expected the body to be offloaded"
+    assert received_message == message
+
+
+def test_body_is_deleted_once_message_is_completed(tmp_path):
+    blob_store = LocalFileBlobStore(str(tmp_path))
+    message = SampleClaimCheckStateChangeEvent(entity_id="123", snapshot="x" * 10000)
+    metrics = MetricsRegistry()
+    sent_message, received_message = publish_and_consume(
+        message,
+        publisher_args={"blob_store": blob_store, "claim_check_threshold": 1000},
+        consumer_args={"blob_store": blob_store, "claim_check_delete_on_complete": True, "metrics": metrics},
+    )
+
+    key = sent_message.application_properties[CLAIM_CHECK_PROPERTY]
+    assert received_message == message
+    assert not (tmp_path / key).exists(), "Expected the body to be deleted once the message was completed"
+    assert metrics.get("claim_check_deletes_total") == 1
+
+
+def test_consumer_without_blob_store_abandons_claim_check_message(tmp_path):
+    blob_store = LocalFileBlobStore(str(tmp_path))
+    message = SampleClaimCheckStateChangeEvent(entity_id="123", snapshot="x" * 10000)
+    mock_client_builder = MockServiceBusClientBuilder()
+    _, received_message = publish_and_consume(
+        message,
+        publisher_args={"blob_store": blob_store, "claim_check_threshold": 1000},
+        mock_client_builder=mock_client_builder,
+    )
+
+    assert received_message is None
+    receiver = mock_client_builder._topic_subscription_receivers["sample-claim-check|TEST_SUB"]
+    assert receiver.abandon_message.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_resolver_shares_fetches_and_caches_bodies():
+    blob_store = CountingBlobStore({"a": b"a" * 10, "b": b"b" * 10, "c": b"c" * 10})
+    resolver = ClaimCheckResolver(blob_store, cache_max_bytes=20, metrics=MetricsRegistry())
+
+    bodies = await asyncio.gather(*[resolver.get_body("a") for _ in range(5)])
+    assert bodies == [b"a" * 10] * 5
+    assert blob_store.get_count == 1, "Expected concurrent requests for a key to share a fetch"
+
+    await resolver.get_body("a")
+    assert blob_store.get_count == 1, "Expected body to be cached"
+
+    await resolver.get_body("b")
+    await resolver.get_body("c")  # evicts "a" (the least recently used)
+    await resolver.get_body("b")
+    assert blob_store.get_count == 3
+    await resolver.get_body("a")
+    assert blob_store.get_count == 4, "Expected least recently used body to be evicted"
+
+
+@pytest.mark.asyncio
+async def test_local_file_blob_store_rejects_invalid_keys(tmp_path):
+    blob_store = LocalFileBlobStore(str(tmp_path))
+    await blob_store.put("valid-key", b"data")
+    assert await blob_store.get("valid-key") == b"data"
+    with pytest.raises(Exception):
+        await blob_store.get("../outside")
+    await blob_store.delete("valid-key")
+    await blob_store.delete("valid-key")  # deleting a missing key is not an error
+    assert not (tmp_path / "valid-key").exists()
@@ -0,0 +1,83 @@
+import asyncio
+from unittest.mock import AsyncMock, Mock, patch
+
+from azure.servicebus.aio import ServiceBusClient
+
+from .client_pool import ServiceBusClientPool
+from .consumer_app import ConsumerApp, StateChangeEventBase
+from .test_helpers import MockServiceBusClientBuilder, run_app_with_timeout
+
+
+class SamplePool1StateChangeEvent(StateChangeEventBase):
+    pass
+
+
+class SamplePool2StateChangeEvent(StateChangeEventBase):
+    pass
+
+
+def create_client_factory():
+    return Mock(side_effect=lambda: AsyncMock(spec=ServiceBusClient))
+
+
+def test_hash_strategy_is_stable_for_key():
+    pool = ServiceBusClientPool(create_client_factory(), size=4, strategy="hash")
+    other_pool = ServiceBusClientPool(create_client_factory(), size=4, strategy="hash")
+
+    for key in ["task-created|sub", "task-updated|sub", "user-created|sub"]:
+        assert pool.get_client(key) is pool.get_client(key)
+        assert pool._get_slot(key) == other_pool._get_slot(key), "Hash assignment should not depend on process"
+
+
+def test_load_strategy_spreads_keys_evenly():
+    pool = ServiceBusClientPool(create_client_factory(), size=3, strategy="load")
+
+    clients = [pool.get_client(f"topic-{i}") for i in range(6)]
+
+    assert pool.get_slot_loads() == [2, 2, 2]
+    assert len({id(client) for client in clients}) == 3
+
+
+def test_reset_client_replaces_slot_client():
+    client_factory = create_client_factory()
+    pool = ServiceBusClientPool(client_factory, size=2, strategy="load")
+    failed_client = pool.get_client("a")
+
+    assert pool.reset_client(failed_client)
+    assert pool.get_client("a") is not failed_client, "Key should use the replacement client"
+    assert not pool.reset_client(failed_client), "Client already replaced"
+    assert client_factory.call_count == 3
+
+
+def test_consumer_assigns_subscriptions_across_pool():
+    mock_client_builder = MockServiceBusClientBuilder()
+    (
+        mock_client_builder.add_messages_for_topic_subscription(
+            "sample-pool1", "TEST_SUB", messages=['{"entity_id": "123"}']
+        ).add_messages_for_topic_subscription("sample-pool2", "TEST_SUB", messages=['{"entity_id": "456"}'])
+    )
+    clients = []
+
+    def build_client(conn_str):
+        client = mock_client_builder.build()
+        clients.append(client)
+        return client
+
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", side_effect=build_client):
+        app = ConsumerApp(default_subscription_name="TEST_SUB", client_pool_size=2, client_pool_strategy="load")
+        received = []
+
+        @app.consume(max_wait_time=0.1)
+        async def on_sample_pool1(message: SamplePool1StateChangeEvent):
+            received.append(message.entity_id)
+
+        @app.consume(max_wait_time=0.1)
+        async def on_sample_pool2(message: SamplePool2StateChangeEvent):
+            received.append(message.entity_id)
+
+        asyncio.run(run_app_with_timeout(app))
+
+    assert sorted(received) == ["123", "456"]
+    assert len(clients) == 2
+    assert [client.get_subscription_receiver.call_count for client in clients] == [1, 1]
+    assert all(client.close.call_count == 1 for client in clients), "Expected all pool clients to be closed"
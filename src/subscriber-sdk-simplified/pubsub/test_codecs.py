@@ -0,0 +1,75 @@
+import datetime
+
+import pytest
+
+from .codecs import Codec, JsonCodec, get_codec, get_codec_for_content_type, register_codec
+from .consumer_app import StateChangeEventBase
+from .test_helpers import publish_and_consume
+
+
+class SampleCodecStateChangeEvent(StateChangeEventBase):
+    changed_at: datetime.datetime = datetime.datetime(2024, 1, 2, 3, 4, 5)
+
+
+class PrefixedJsonCodec(Codec):
+    """Test codec with a body format that only it can decode"""
+
+    name = "prefixed-json"
+    content_type = "application/x-prefixed+json"
+
+    def encode(self, message):
+        return b"PREFIX:" + message.json().encode("utf-8")
+
+    def decode(self, body: bytes) -> dict:
+        assert body.startswith(b"PREFIX:")
+        return JsonCodec().decode(body[len(b"PREFIX:") :])
+
+
+register_codec(PrefixedJsonCodec())
+
+
+def test_json_codec_is_default_and_stamps_content_type():
+    sent_message, received_message = publish_and_consume(
+        SampleCodecStateChangeEvent(entity_id="123"), publisher_args={"codec": "json"}
+    )
+
+    assert sent_message.content_type == "application/json"
+    assert received_message == SampleCodecStateChangeEvent(entity_id="123")
+
+
+def test_consumer_picks_codec_from_content_type():
+    sent_message, received_message = publish_and_consume(
+        SampleCodecStateChangeEvent(entity_id="123"), publisher_args={"codec": "prefixed-json"}
+    )
+
+    assert sent_message.content_type == "application/x-prefixed+json"
+    assert received_message == SampleCodecStateChangeEvent(entity_id="123")
+
+
+def test_orjson_codec_round_trip():
+    pytest.importorskip("orjson")
+    sent_message, received_message = publish_and_consume(
+        SampleCodecStateChangeEvent(entity_id="123"), publisher_args={"codec": "orjson"}
+    )
+
+    assert sent_message.content_type == "application/json"
+    assert received_message == SampleCodecStateChangeEvent(entity_id="123")
+
+
+def test_msgpack_codec_round_trip():
+    pytest.importorskip("msgpack")
+    sent_message, received_message = publish_and_consume(
+        SampleCodecStateChangeEvent(entity_id="123"), publisher_args={"codec": "msgpack"}
+    )
+
+    assert sent_message.content_type == "application/msgpack"
+    assert received_message == SampleCodecStateChangeEvent(entity_id="123")
+
+
+def test_content_type_without_codec():
+    assert isinstance(get_codec_for_content_type(None), JsonCodec), "Expected messages without content type to be JSON"
+    assert isinstance(get_codec_for_content_type("Application/JSON; charset=utf-8"), JsonCodec)
+    with pytest.raises(Exception):
+        get_codec_for_content_type("application/unknown")
+    with pytest.raises(Exception):
+        get_codec("unknown")
@@ -0,0 +1,54 @@
+import pytest
+
+from .compression import CONTENT_ENCODING_PROPERTY, compress, decompress
+from .consumer_app import StateChangeEventBase
+from .publisher import Publisher
+from .test_helpers import publish_and_consume
+
+
+class SampleCompressionStateChangeEvent(StateChangeEventBase):
+    snapshot: str = ""
+
+
+def test_large_event_is_compressed_and_flagged():
+    message = SampleCompressionStateChangeEvent(entity_id="123", snapshot="x" * 10000)
+    sent_message, received_message = publish_and_consume(
+        message, publisher_args={"compression": "gzip", "compression_threshold": 1000}
+    )
+
+    assert sent_message.application_properties[CONTENT_ENCODING_PROPERTY] == "gzip"
+    assert len(b"".join(sent_message.body)) < 1000, "Expected body to be compressed"
+    assert received_message == message
+
+
+def test_small_event_is_not_compressed():
+    message = SampleCompressionStateChangeEvent(entity_id="123")
+    sent_message, received_message = publish_and_consume(
+        message, publisher_args={"compression": "gzip", "compression_threshold": 1000}
+    )
+
+    assert (
+        CONTENT_ENCODING_PROPERTY not in sent_message.application_properties
+    ), "Expected no content encoding for small event"
+    assert str(sent_message) == message.json()
+    assert received_message == message
+
+
+def test_zstd_compression():
+    pytest.importorskip("zstandard")
+    message = SampleCompressionStateChangeEvent(entity_id="123", snapshot="x" * 10000)
+    sent_message, received_message = publish_and_consume(
+        message, publisher_args={"compression": "zstd", "compression_threshold": 1000}
+    )
+
+    assert sent_message.application_properties[CONTENT_ENCODING_PROPERTY] == "zstd"
+    assert received_message == message
+
+
+def test_compression_round_trip():
+    body = b'{"entity_id": "123"}' * 100
+    assert decompress(compress(body, "gzip"), "gzip") == body
+    with pytest.raises(Exception):
+        decompress(body, "unknown")
+    with pytest.raises(Exception):
+        Publisher(compression="unknown")
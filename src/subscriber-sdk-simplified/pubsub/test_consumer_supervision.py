@@ -0,0 +1,148 @@
+import asyncio
+from unittest.mock import patch
+
+from .consumer_app import ConsumerApp, StateChangeEventBase
+from .metrics import MetricsRegistry
+from .test_helpers import MockServiceBusClientBuilder, run_app_with_timeout
+
+
+class SampleSupervised1StateChangeEvent(StateChangeEventBase):
+    pass
+
+
+class SampleSupervised2StateChangeEvent(StateChangeEventBase):
+    pass
+
+
+def fail_first_receives(receiver, failure_count: int):
+    receive_messages = receiver.receive_messages
+    failures = 0
+
+    async def failing_receive_messages(max_message_count=None, max_wait_time=None):
+        nonlocal failures
+        if failures < failure_count:
+            failures += 1
+            raise Exception("link detached")
+        return await receive_messages(max_message_count=max_message_count, max_wait_time=max_wait_time)
+
+    receiver.receive_messages = failing_receive_messages
+
+
+def test_failing_subscription_is_restarted_without_stopping_others():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = (
+        mock_client_builder.add_messages_for_topic_subscription(
+            "sample-supervised1", "TEST_SUB", messages=['{"entity_id": "123"}']
+        )
+        .add_messages_for_topic_subscription("sample-supervised2", "TEST_SUB", messages=['{"entity_id": "456"}'])
+        .build()
+    )
+    fail_first_receives(mock_client_builder.get_subscription_receiver("sample-supervised1", "TEST_SUB"), 1)
+
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        metrics = MetricsRegistry()
+        app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=metrics, reconnect_initial_backoff=0.01)
+
+        received_message1 = None
+        received_message2 = None
+
+        @app.consume(max_wait_time=0.1)
+        async def on_sample_supervised1(message: SampleSupervised1StateChangeEvent):
+            nonlocal received_message1
+            received_message1 = message
+
+        @app.consume(max_wait_time=0.1)
+        async def on_sample_supervised2(message: SampleSupervised2StateChangeEvent):
+            nonlocal received_message2
+            received_message2 = message
+
+        asyncio.run(run_app_with_timeout(app, timeout_seconds=0.2))
+
+    assert received_message1.entity_id == "123", "Failed subscription was not restarted"
+    assert received_message2.entity_id == "456", "Other subscription was affected by failure"
+    labels = {"topic": "sample-supervised1", "subscription": "TEST_SUB"}
+    assert metrics.get("subscription_restarts_total", **labels) == 1
+    assert metrics.get("subscription_downtime_seconds_total", **labels) > 0
+    assert metrics.get("subscription_restarts_total", topic="sample-supervised2", subscription="TEST_SUB") is None
+    assert mock_sb_client.get_subscription_receiver.call_count == 3, "Expected receiver to be recreated on restart"
+
+
+def test_client_is_recreated_after_repeated_failures():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.add_messages_for_topic_subscription(
+        "sample-supervised1", "TEST_SUB", messages=['{"entity_id": "123"}']
+    ).build()
+    fail_first_receives(mock_client_builder.get_subscription_receiver("sample-supervised1", "TEST_SUB"), 2)
+
+    with patch(
+        "azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client
+    ) as from_connection_string, patch("pubsub.consumer_app.CLIENT_RESET_AFTER_FAILURES", 2):
+        metrics = MetricsRegistry()
+        app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=metrics, reconnect_initial_backoff=0.01)
+
+        received_message = None
+
+        @app.consume(max_wait_time=0.1)
+        async def on_sample_supervised1(message: SampleSupervised1StateChangeEvent):
+            nonlocal received_message
+            received_message = message
+
+        asyncio.run(run_app_with_timeout(app, timeout_seconds=0.2))
+
+    assert received_message.entity_id == "123"
+    assert metrics.get("servicebus_client_resets_total") == 1
+    assert from_connection_string.call_count == 2, "Expected a new client to be created after repeated failures"
+
+
+def test_client_reset_after_failures_can_be_set_on_the_app():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.add_messages_for_topic_subscription(
+        "sample-supervised2", "TEST_SUB", messages=['{"entity_id": "123"}']
+    ).build()
+    fail_first_receives(mock_client_builder.get_subscription_receiver("sample-supervised2", "TEST_SUB"), 3)
+
+    with patch(
+        "azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client
+    ) as from_connection_string:
+        metrics = MetricsRegistry()
+        app = ConsumerApp(
+            default_subscription_name="TEST_SUB",
+            metrics=metrics,
+            reconnect_initial_backoff=0.01,
+            client_reset_after_failures=3,
+        )
+
+        received_message = None
+
+        @app.consume(max_wait_time=0.1)
+        async def on_sample_supervised2(message: SampleSupervised2StateChangeEvent):
+            nonlocal received_message
+            received_message = message
+
+        asyncio.run(run_app_with_timeout(app, timeout_seconds=0.3))
+
+    assert received_message.entity_id == "123"
+    assert metrics.get("servicebus_client_resets_total") == 1
+    assert from_connection_string.call_count == 2
+
+
+def test_cancel_interrupts_reconnect_backoff():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.add_messages_for_topic_subscription(
+        "sample-supervised1", "TEST_SUB", messages=[]
+    ).build()
+    fail_first_receives(mock_client_builder.get_subscription_receiver("sample-supervised1", "TEST_SUB"), 1)
+
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        app = ConsumerApp(
+            default_subscription_name="TEST_SUB", metrics=MetricsRegistry(), reconnect_initial_backoff=60
+        )
+
+        @app.consume(max_wait_time=0.1)
+        async def on_sample_supervised1(message: SampleSupervised1StateChangeEvent):
+            pass
+
+        async def run():
+            await asyncio.wait_for(run_app_with_timeout(app, timeout_seconds=0.1), timeout=5)
+
+        asyncio.run(run())
@@ -0,0 +1,175 @@
+import asyncio
+from unittest.mock import patch
+
+from .consumer_app import ConsumerApp, StateChangeEventBase
+from .dlq import DLQ_RESUBMIT_COUNT_PROPERTY, DeadLetterReprocessor
+from .dlq import register_transform
+from .message_properties import DLQ_TARGET_SUBSCRIPTION_PROPERTY, get_application_property
+from .metrics import MetricsRegistry
+from .test_helpers import MockServiceBusClientBuilder, run_app_with_timeout
+
+
+class SampleDlqStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+@register_transform()
+def upgrade_sample_dlq(body: dict):
+    if body["entity_id"] == "skip":
+        return None
+    return {**body, "entity_id": body["entity_id"] + "-fixed"}
+
+
+def build_dead_letter_queue() -> MockServiceBusClientBuilder:
+    return (
+        MockServiceBusClientBuilder()
+        .add_dead_lettered_messages_for_topic_subscription(
+            "sample-dlq",
+            "TEST_SUB",
+            messages=['{"entity_id": "1"}', '{"entity_id": "2"}', '{"entity_id": "skip"}'],
+        )
+        .add_dead_lettered_messages_for_topic_subscription(
+            "sample-dlq", "TEST_SUB", messages=['{"entity_id": "3"}'], reason="MaxDeliveryCountExceeded"
+        )
+    )
+
+
+def reprocess(builder: MockServiceBusClientBuilder, **kwargs):
+    kwargs.setdefault("concurrency", 2)
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=builder.build()):
+        reprocessor = DeadLetterReprocessor(
+            "sample-dlq",
+            "TEST_SUB",
+            batch_size=2,
+            max_wait_time=0.05,
+            metrics=MetricsRegistry(),
+            on_progress=lambda result: None,
+            **kwargs,
+        )
+        return asyncio.run(reprocessor.run())
+
+
+def test_resubmits_messages_matching_reason():
+    builder = build_dead_letter_queue()
+    result = reprocess(builder, reason="^dropped by subscriber$")
+
+    assert result.received == 4
+    assert result.resubmitted == 3
+    assert result.skipped == 1
+    assert result.failed == 0
+    sent_messages = [sent_message.message for sent_message in builder.sentMessages]
+    assert sorted(b"".join(message.body) for message in sent_messages) == [
+        b'{"entity_id": "1"}',
+        b'{"entity_id": "2"}',
+        b'{"entity_id": "skip"}',
+    ]
+    assert all(sent_message.topic_name == "sample-dlq" for sent_message in builder.sentMessages)
+    properties = sent_messages[0].application_properties
+    assert properties[DLQ_TARGET_SUBSCRIPTION_PROPERTY] == "TEST_SUB"
+    assert properties[DLQ_RESUBMIT_COUNT_PROPERTY] == 1
+    assert "DeadLetterReason" not in properties
+
+    receiver = builder._topic_subscription_receivers["sample-dlq|TEST_SUB/$DeadLetterQueue"]
+    assert receiver.complete_message.call_count == 3, "Expected the resubmitted messages to be completed"
+
+
+def test_transform_and_max_messages():
+    builder = build_dead_letter_queue()
+    result = reprocess(builder, transform=upgrade_sample_dlq, max_messages=2, concurrency=1)
+
+    assert result.resubmitted == 2
+    assert sorted(b"".join(message.message.body) for message in builder.sentMessages) == [
+        b'{"entity_id": "1-fixed"}',
+        b'{"entity_id": "2-fixed"}',
+    ]
+
+
+def test_dry_run_and_age_filter_do_not_resubmit():
+    builder = build_dead_letter_queue()
+    result = reprocess(builder, transform=upgrade_sample_dlq, dry_run=True)
+    assert result.dry_run
+    assert result.received == 4
+    assert result.resubmitted == 3
+    assert result.skipped == 1, "Expected the message the transform returned None for to be skipped"
+    assert builder.sentMessages == []
+    receiver = builder._topic_subscription_receivers["sample-dlq|TEST_SUB/$DeadLetterQueue"]
+    assert receiver.complete_message.call_count == 0
+
+    builder = build_dead_letter_queue()
+    result = reprocess(builder, older_than=3600)
+    assert result.resubmitted == 0
+    assert result.skipped == 4
+    assert builder.sentMessages == []
+
+
+def test_resubmitted_messages_are_only_handled_by_the_original_subscription():
+    builder = build_dead_letter_queue()
+    reprocess(builder, reason="MaxDeliveryCountExceeded")
+    sent_messages = [sent_message.message for sent_message in builder.sentMessages]
+    assert get_application_property(sent_messages[0], DLQ_TARGET_SUBSCRIPTION_PROPERTY) == "TEST_SUB"
+
+    # the resubmitted message is delivered to every subscription for the topic
+    builder = MockServiceBusClientBuilder()
+    builder.add_messages_for_topic_subscription("sample-dlq", "TEST_SUB", messages=sent_messages)
+    builder.add_messages_for_topic_subscription("sample-dlq", "OTHER_SUB", messages=sent_messages)
+    received = []
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=builder.build()):
+        app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=MetricsRegistry())
+
+        @app.consume(max_wait_time=0.1)
+        async def on_sample_dlq(message: SampleDlqStateChangeEvent):
+            received.append(("TEST_SUB", message.entity_id))
+
+        @app.consume(topic_name="sample-dlq", subscription_name="OTHER_SUB", max_wait_time=0.1)
+        async def on_sample_dlq_other(message: SampleDlqStateChangeEvent):
+            received.append(("OTHER_SUB", message.entity_id))
+
+        asyncio.run(run_app_with_timeout(app))
+
+    assert received == [("TEST_SUB", "3")]
+    other_receiver = builder._topic_subscription_receivers["sample-dlq|OTHER_SUB"]
+    assert other_receiver.complete_message.call_count == 1
+
+
+def test_messages_returned_again_after_their_locks_expire_are_skipped_without_ending_the_run():
+    builder = build_dead_letter_queue()
+    builder.build()
+    receiver = builder.get_subscription_receiver("sample-dlq", "TEST_SUB", sub_queue="deadletter")
+    receive_messages = receiver.receive_messages
+    receive_count = 0
+    first_batch = None
+
+    async def receive_messages_with_expired_locks(max_message_count=None, max_wait_time=None):
+        nonlocal receive_count, first_batch
+        receive_count += 1
+        if receive_count == 2:
+            # the skipped messages from the first batch are returned again once their locks expire
+            return first_batch
+        msgs = await receive_messages(max_message_count=max_message_count, max_wait_time=max_wait_time)
+        if receive_count == 1:
+            first_batch = msgs
+        return msgs
+
+    receiver.receive_messages = receive_messages_with_expired_locks
+    result = reprocess(builder, reason="MaxDeliveryCountExceeded", concurrency=1)
+
+    assert result.resubmitted == 1, "Expected the rest of the queue to be scanned"
+    assert result.skipped == 3
+    assert [b"".join(sent_message.message.body) for sent_message in builder.sentMessages] == [b'{"entity_id": "3"}']
+
+
+def test_failure_to_complete_a_resubmitted_message_does_not_abort_the_run():
+    builder = build_dead_letter_queue()
+    builder.build()
+    receiver = builder.get_subscription_receiver("sample-dlq", "TEST_SUB", sub_queue="deadletter")
+
+    async def complete_message(msg):
+        if msg.sequence_number == 1:
+            raise Exception("lock lost")
+
+    receiver.complete_message.side_effect = complete_message
+    result = reprocess(builder, reason="^dropped by subscriber$", rate_limit=1000)
+
+    assert len(builder.sentMessages) == 3
+    assert result.resubmitted == 2
+    assert result.failed == 1, "Expected the message that couldn't be completed to be reported as failed"
@@ -0,0 +1,42 @@
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import pytest
+
+from . import event_loop
+
+
+def test_asyncio_event_loop():
+    assert event_loop.resolve_event_loop("asyncio") == "asyncio"
+    assert event_loop.get_loop_factory("asyncio") is asyncio.new_event_loop
+
+
+def test_uvloop_falls_back_to_asyncio_when_not_installed():
+    with patch("pubsub.event_loop.uvloop", None):
+        assert event_loop.resolve_event_loop("auto") == "asyncio"
+        assert event_loop.resolve_event_loop("uvloop") == "asyncio"
+        assert event_loop.get_loop_factory("uvloop") is asyncio.new_event_loop
+
+
+def test_uvloop_used_when_installed():
+    created_loops = []
+
+    def new_uvloop_event_loop():
+        loop = asyncio.new_event_loop()
+        created_loops.append(loop)
+        return loop
+
+    with patch("pubsub.event_loop.uvloop", SimpleNamespace(new_event_loop=new_uvloop_event_loop)):
+        assert event_loop.resolve_event_loop("auto") == "uvloop"
+        assert event_loop.resolve_event_loop("asyncio") == "asyncio"
+
+        async def get_running_loop():
+            return asyncio.get_running_loop()
+
+        assert event_loop.run(get_running_loop(), event_loop="auto") is created_loops[0]
+
+
+def test_unknown_event_loop():
+    with pytest.raises(Exception, match="Unknown event loop"):
+        event_loop.resolve_event_loop("trio")
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+from typing import Union
+from unittest.mock import patch
+
+from azure.servicebus import ServiceBusMessage
+
+from .consumer_app import ConsumerApp, StateChangeEventBase
+from .events import EVENT_TYPE_PROPERTY, EventRegistry, event_registry
+from .metrics import MetricsRegistry
+from .publisher import Publisher
+from .test_helpers import MockServiceBusClientBuilder, run_app_with_timeout
+
+
+class SampleVersionedStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+class SampleVersionedV2StateChangeEvent(StateChangeEventBase, topic="sample-versioned", event_type="sample.v2"):
+    title: str
+
+
+def publish_messages(messages: list) -> list:
+    """Publish events and return the sent ServiceBusMessages"""
+    mock_client_builder = MockServiceBusClientBuilder()
+    with patch(
+        "azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_client_builder.build()
+    ):
+
+        async def publish():
+            async with Publisher(topics=["sample-versioned"], metrics=MetricsRegistry()) as publisher:
+                await publisher.publish_batch(messages)
+
+        asyncio.run(publish())
+    return [sent_message.message for sent_message in mock_client_builder.sentMessages]
+
+
+def consume_messages(messages: list, handler):
+    """Deliver messages to handler (registered for the sample-versioned topic) and return the receiver"""
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.add_messages_for_topic_subscription(
+        "sample-versioned", "TEST_SUB", messages=messages
+    ).build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=MetricsRegistry())
+        app.consume(handler, topic_name="sample-versioned", max_wait_time=0.1)
+        asyncio.run(run_app_with_timeout(app))
+    return mock_client_builder._topic_subscription_receivers["sample-versioned|TEST_SUB"]
+
+
+def test_registry_indexes_event_types_per_topic():
+    assert event_registry.get_event_classes_for_topic("sample-versioned") == [
+        SampleVersionedStateChangeEvent,
+        SampleVersionedV2StateChangeEvent,
+    ]
+    assert event_registry.get_event_class("sample-versioned") is SampleVersionedStateChangeEvent
+    assert event_registry.get_event_class("sample-versioned", "sample.v2") is SampleVersionedV2StateChangeEvent
+    assert (
+        event_registry.get_event_class("sample-versioned", "SampleVersionedStateChangeEvent")
+        is SampleVersionedStateChangeEvent
+    )
+    assert event_registry.get_event_class("sample-versioned", "unknown") is None
+
+
+def test_classes_defined_after_app_is_created_are_registered():
+    app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=MetricsRegistry())
+
+    class SampleLateStateChangeEvent(StateChangeEventBase):
+        pass
+
+    assert app._topic_to_event_class_map.get("sample-late") is SampleLateStateChangeEvent
+
+
+def test_redefined_class_replaces_registration():
+    registry = EventRegistry()
+
+    class SampleRedefinedStateChangeEvent:
+        pass
+
+    first = SampleRedefinedStateChangeEvent
+    registry.register(first)
+
+    class SampleRedefinedStateChangeEvent:
+        pass
+
+    registry.register(SampleRedefinedStateChangeEvent)
+    assert registry.get_event_classes() == [SampleRedefinedStateChangeEvent]
+    assert registry.get_event_class("sample-redefined") is SampleRedefinedStateChangeEvent
+
+
+def test_messages_are_dispatched_by_event_type():
+    sent_messages = publish_messages(
+        [SampleVersionedStateChangeEvent(entity_id="1"), SampleVersionedV2StateChangeEvent(entity_id="2", title="t")]
+    )
+    assert sent_messages[1].application_properties[EVENT_TYPE_PROPERTY] == "sample.v2"
+
+    received_messages = []
+
+    async def on_sample_versioned(message):
+        logging.info("In on_sample_versioned")
+        received_messages.append(message)
+
+    consume_messages(sent_messages, on_sample_versioned)
+
+    assert received_messages == [
+        SampleVersionedStateChangeEvent(entity_id="1"),
+        SampleVersionedV2StateChangeEvent(entity_id="2", title="t"),
+    ]
+
+
+def test_handler_only_receives_annotated_event_types():
+    sent_messages = publish_messages(
+        [SampleVersionedStateChangeEvent(entity_id="1"), SampleVersionedV2StateChangeEvent(entity_id="2", title="t")]
+    )
+
+    received_messages = []
+
+    async def on_sample_versioned(message: SampleVersionedV2StateChangeEvent):
+        received_messages.append(message)
+
+    receiver = consume_messages(sent_messages, on_sample_versioned)
+
+    assert received_messages == [SampleVersionedV2StateChangeEvent(entity_id="2", title="t")]
+    assert receiver.complete_message.call_count == 2, "Expected the skipped message to be completed"
+
+    received_messages = []
+
+    async def on_sample_versioned(message: Union[SampleVersionedStateChangeEvent, SampleVersionedV2StateChangeEvent]):
+        received_messages.append(message)
+
+    consume_messages(sent_messages, on_sample_versioned)
+
+    assert len(received_messages) == 2
+
+
+def test_message_without_event_type_or_with_unknown_event_type_uses_default_class():
+    messages = [
+        '{"entity_id": "1"}',
+        ServiceBusMessage('{"entity_id": "2"}', application_properties={EVENT_TYPE_PROPERTY: "unknown"}),
+    ]
+    received_messages = []
+
+    async def on_sample_versioned(message):
+        received_messages.append(message)
+
+    receiver = consume_messages(messages, on_sample_versioned)
+
+    assert received_messages == [
+        SampleVersionedStateChangeEvent(entity_id="1"),
+        SampleVersionedStateChangeEvent(entity_id="2"),
+    ]
+    assert receiver.complete_message.call_count == 2
+    assert receiver.dead_letter_message.call_count == 0, "Expected unknown event types not to be dead-lettered"
@@ -0,0 +1,126 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from .autotune import AutotuneConfig
+from .consumer_app import ConsumerApp, ConsumerResult, StateChangeEventBase
+from .metrics import MetricsRegistry
+from .test_helpers import MockServiceBusClientBuilder, run_app_with_timeout
+
+
+class SampleFanOutStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+def run_handlers(handler_results: list):
+    """Register a handler for each item in handler_results on one subscription, and process a single message
+
+    Each item is the value the handler returns (or an exception to raise).
+    Returns the received messages for each handler, the receiver and the app.
+    """
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.add_messages_for_topic_subscription(
+        "sample-fan-out", "TEST_SUB", messages=['{"entity_id": "123"}']
+    ).build()
+    received_messages = [[] for _ in handler_results]
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=MetricsRegistry())
+
+        def create_handler(index, handler_result):
+            async def on_sample_fan_out(message: SampleFanOutStateChangeEvent):
+                received_messages[index].append(message)
+                if isinstance(handler_result, Exception):
+                    raise handler_result
+                return handler_result
+
+            return on_sample_fan_out
+
+        for index, handler_result in enumerate(handler_results):
+            app.consume(create_handler(index, handler_result), max_wait_time=0.1)
+
+        asyncio.run(run_app_with_timeout(app))
+    receiver = mock_client_builder._topic_subscription_receivers["sample-fan-out|TEST_SUB"]
+    return received_messages, receiver, app
+
+
+def test_handlers_on_a_subscription_share_a_receiver():
+    received_messages, receiver, app = run_handlers([ConsumerResult.SUCCESS, None])
+
+    assert len(app._subscriptions) == 1
+    assert len(app._subscriptions[0].handlers) == 2
+    assert received_messages == [[SampleFanOutStateChangeEvent(entity_id="123")]] * 2
+    assert received_messages[0][0] is received_messages[1][0], "Expected the message to be parsed once"
+    assert receiver.complete_message.call_count == 1
+
+
+@pytest.mark.parametrize(
+    "handler_results,settle_method",
+    [
+        ([ConsumerResult.SUCCESS, ConsumerResult.DROP], "dead_letter_message"),
+        ([ConsumerResult.DROP, ConsumerResult.RETRY], "abandon_message"),
+        ([ConsumerResult.SUCCESS, Exception("handler failed")], "abandon_message"),
+    ],
+)
+def test_handler_results_are_combined(handler_results, settle_method):
+    received_messages, receiver, _ = run_handlers(handler_results)
+
+    assert all(len(messages) == 1 for messages in received_messages), "Expected every handler to be called"
+    for method in ["complete_message", "abandon_message", "dead_letter_message"]:
+        expected_count = 1 if method == settle_method else 0
+        assert getattr(receiver, method).call_count == expected_count, method
+
+
+def test_conflicting_settings_for_a_subscription_are_rejected():
+    app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=MetricsRegistry())
+
+    @app.consume(max_message_count=10)
+    async def on_sample_fan_out(message: SampleFanOutStateChangeEvent):
+        pass
+
+    @app.consume(topic_name="sample-fan-out", max_wait_time=5)
+    async def on_sample_fan_out_audit(message: SampleFanOutStateChangeEvent):
+        pass
+
+    assert app._subscriptions[0].max_message_count == 10
+    assert app._subscriptions[0].max_wait_time == 5
+
+    with pytest.raises(Exception):
+
+        @app.consume(topic_name="sample-fan-out", max_message_count=20)
+        async def on_sample_fan_out_other(message: SampleFanOutStateChangeEvent):
+            pass
+
+
+def test_autotune_settings_for_a_shared_subscription():
+    app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=MetricsRegistry())
+
+    @app.consume(autotune=True)
+    async def on_sample_fan_out(message: SampleFanOutStateChangeEvent):
+        pass
+
+    # the default config is equal for each handler
+    @app.consume(topic_name="sample-fan-out", autotune=True)
+    async def on_sample_fan_out_audit(message: SampleFanOutStateChangeEvent):
+        pass
+
+    assert app._get_autotune_config(app._subscriptions[0]) == AutotuneConfig()
+
+    with pytest.raises(Exception, match="Conflicting autotune"):
+
+        @app.consume(topic_name="sample-fan-out", autotune=False)
+        async def on_sample_fan_out_other(message: SampleFanOutStateChangeEvent):
+            pass
+
+    # autotune=False on one of the handlers disables the app's default
+    app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=MetricsRegistry(), autotune=AutotuneConfig())
+
+    @app.consume
+    async def on_sample_fan_out(message: SampleFanOutStateChangeEvent):
+        pass
+
+    @app.consume(topic_name="sample-fan-out", autotune=False)
+    async def on_sample_fan_out_audit(message: SampleFanOutStateChangeEvent):
+        pass
+
+    assert app._get_autotune_config(app._subscriptions[0]) is None
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+from unittest.mock import patch
+
+from azure.servicebus import ServiceBusMessage
+from azure.servicebus.management import CorrelationRuleFilter, SqlRuleFilter, TrueRuleFilter
+
+from .consumer_app import ConsumerApp, StateChangeEventBase
+from .filters import field, get_rule_name, to_filter
+from .metrics import MetricsRegistry
+from .publisher import Publisher
+from .test_helpers import MockServiceBusClientBuilder, run_app_with_timeout
+
+
+class SampleFilteredStateChangeEvent(StateChangeEventBase, promoted_fields=["status"]):
+    status: str
+    priority: int = 0
+
+
+class SampleRankedStateChangeEvent(StateChangeEventBase, promoted_fields=["status", "priority"]):
+    status: str
+    priority: int = 0
+
+
+def test_filter_sql_and_correlation_properties():
+    open_filter = field("status") == "open"
+    assert open_filter.to_sql() == "user.status = 'open'"
+    assert open_filter.get_correlation_properties() == {"status": "open"}
+
+    combined_filter = (field("priority") >= 3) & ~field("region").is_in(["uk", "o'brien"])
+    assert combined_filter.to_sql() == "(user.priority >= 3) AND (NOT (user.region IN ('uk', 'o''brien')))"
+    assert combined_filter.get_correlation_properties() is None
+    assert combined_filter.get_fields() == {"priority", "region"}
+
+    assert to_filter({"status": "open", "priority": 1}).get_correlation_properties() == {
+        "status": "open",
+        "priority": 1,
+    }
+
+
+def test_filter_evaluation_treats_missing_values_as_unknown():
+    assert (field("status") == "open").evaluate({"status": "open"})
+    assert not (field("status") == "open").evaluate({"status": "closed"})
+    # comparisons with a missing value are unknown, and NOT unknown is still unknown (as in the broker's SQL)
+    assert not (field("status") == "open").evaluate({})
+    assert not (~(field("status") == "open")).evaluate({})
+    assert ((field("status") == "open") | (field("priority") > 1)).evaluate({"priority": 2})
+    assert (~field("status").exists()).evaluate({})
+
+
+def test_consumer_applies_rule_for_promoted_fields():
+    # publish one matching and one non-matching event (status is promoted to an application property)
+    mock_client_builder = MockServiceBusClientBuilder()
+    with patch(
+        "azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_client_builder.build()
+    ):
+
+        async def publish():
+            async with Publisher(topics=["sample-filtered"], metrics=MetricsRegistry()) as publisher:
+                await publisher.publish_batch(
+                    [
+                        SampleFilteredStateChangeEvent(entity_id="1", status="open"),
+                        SampleFilteredStateChangeEvent(entity_id="2", status="closed"),
+                    ]
+                )
+
+        asyncio.run(publish())
+    sent_messages = [sent_message.message for sent_message in mock_client_builder.sentMessages]
+    assert sent_messages[0].application_properties["status"] == "open"
+
+    # the mock receiver applies the rule, so the non-matching message and the message without the application
+    # property (e.g. from an older publisher) aren't delivered
+    mock_sb_client = mock_client_builder.add_messages_for_topic_subscription(
+        "sample-filtered", "TEST_SUB", messages=sent_messages + ['{"entity_id": "3", "status": "open"}']
+    ).build()
+    mock_admin_client = mock_client_builder.build_administration_client()
+    received_messages = []
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client), patch(
+        "azure.servicebus.aio.management.ServiceBusAdministrationClient.from_connection_string",
+        return_value=mock_admin_client,
+    ):
+        metrics = MetricsRegistry()
+        app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=metrics)
+        status_filter = field("status") == "open"
+
+        @app.consume(max_wait_time=0.1, filter=status_filter)
+        async def on_sample_filtered(message: SampleFilteredStateChangeEvent):
+            logging.info("In on_sample_filtered")
+            received_messages.append(message)
+
+        asyncio.run(run_app_with_timeout(app))
+
+    assert [message.entity_id for message in received_messages] == ["1"]
+    assert metrics.get("messages_filtered_total", topic="sample-filtered", subscription="TEST_SUB") is None
+
+    rules = mock_client_builder.rules["sample-filtered|TEST_SUB"]
+    assert list(rules.keys()) == [get_rule_name(status_filter)], "Expected the $Default rule to be replaced"
+    assert isinstance(rules[get_rule_name(status_filter)], CorrelationRuleFilter)
+
+
+def test_rule_for_shared_subscription_matches_any_handler_filter():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.add_messages_for_topic_subscription(
+        "sample-ranked",
+        "TEST_SUB",
+        messages=[
+            ServiceBusMessage(
+                '{"entity_id": "1", "status": "open", "priority": 5}',
+                application_properties={"status": "open", "priority": 5},
+            ),
+            ServiceBusMessage(
+                '{"entity_id": "2", "status": "open", "priority": 1}',
+                application_properties={"status": "open", "priority": 1},
+            ),
+        ],
+    ).build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client), patch(
+        "azure.servicebus.aio.management.ServiceBusAdministrationClient.from_connection_string",
+        return_value=mock_client_builder.build_administration_client(),
+    ):
+        app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=MetricsRegistry())
+        received = []
+
+        @app.consume(max_wait_time=0.1, filter={"status": "closed"})
+        async def on_sample_ranked(message: SampleRankedStateChangeEvent):
+            received.append(("closed", message.entity_id))
+
+        @app.consume(topic_name="sample-ranked", filter=field("priority") > 3)
+        async def on_sample_ranked_urgent(message: SampleRankedStateChangeEvent):
+            received.append(("urgent", message.entity_id))
+
+        asyncio.run(run_app_with_timeout(app))
+
+    assert received == [("urgent", "1")]
+    rules = mock_client_builder.rules["sample-ranked|TEST_SUB"]
+    assert len(rules) == 1
+    rule_filter = list(rules.values())[0]
+    assert isinstance(rule_filter, SqlRuleFilter)
+    assert rule_filter.sql_expression == "(user.status = 'closed') OR (user.priority > 3)"
+
+
+def test_filter_on_unpromoted_field_is_evaluated_locally(caplog):
+    # priority isn't in promoted_fields, so publishers in other processes don't send it as an application property
+    # and a rule on it would drop every message
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.add_messages_for_topic_subscription(
+        "sample-filtered",
+        "TEST_SUB",
+        messages=[
+            ServiceBusMessage(
+                '{"entity_id": "1", "status": "open", "priority": 5}', application_properties={"status": "open"}
+            ),
+            '{"entity_id": "2", "status": "open", "priority": 1}',
+        ],
+    ).build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client), patch(
+        "azure.servicebus.aio.management.ServiceBusAdministrationClient.from_connection_string",
+        return_value=mock_client_builder.build_administration_client(),
+    ):
+        metrics = MetricsRegistry()
+        app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=metrics)
+        received = []
+
+        @app.consume(max_wait_time=0.1, filter=(field("status") == "open") & (field("priority") > 3))
+        async def on_sample_filtered(message: SampleFilteredStateChangeEvent):
+            received.append(message.entity_id)
+
+        with caplog.at_level(logging.WARNING):
+            asyncio.run(run_app_with_timeout(app))
+
+    assert received == ["1"]
+    assert metrics.get("messages_filtered_total", topic="sample-filtered", subscription="TEST_SUB") == 1
+    rules = mock_client_builder.rules.get("sample-filtered|TEST_SUB", {"$Default": TrueRuleFilter()})
+    assert list(rules.keys()) == ["$Default"], "Expected the rules to be left unchanged"
+    assert "aren't promoted (priority)" in caplog.text
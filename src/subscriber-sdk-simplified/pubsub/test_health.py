@@ -0,0 +1,97 @@
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from .consumer_app import ConsumerApp, StateChangeEventBase
+from .health import SubscriptionHealth
+from .metrics import MetricsRegistry
+from .test_helpers import MockServiceBusClientBuilder
+
+
+class SampleHealthStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+async def http_get(port: int, path: str) -> tuple:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode("latin-1"))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, body = response.split(b"\r\n\r\n", 1)
+    status = int(head.split(b" ")[1])
+    return status, body.decode("utf-8")
+
+
+def test_subscription_health_lag_and_in_flight_age():
+    health = SubscriptionHealth(throughput_window=10)
+    now = datetime.now(timezone.utc)
+    msgs = [
+        SimpleNamespace(enqueued_time_utc=now - timedelta(seconds=30)),
+        SimpleNamespace(enqueued_time_utc=now - timedelta(seconds=5)),
+    ]
+
+    batch_id = health.batch_started(msgs)
+    assert health.in_flight_count == 2
+    assert 30 <= health.oldest_in_flight_age_seconds < 31
+    assert health.lag_seconds is None
+
+    health.batch_completed(batch_id)
+    assert 30 <= health.lag_seconds < 31
+    assert 5 <= health.min_lag_seconds < 6
+    assert health.oldest_in_flight_age_seconds is None
+    assert health.completed_total == 2
+    assert health.throughput == 0.2
+
+    health.receive_empty()
+    assert health.lag_seconds == 0
+
+
+def test_health_endpoint():
+    mock_sb_client = (
+        MockServiceBusClientBuilder()
+        .add_messages_for_topic_subscription(
+            "sample-health", "TEST_SUB", messages=['{"entity_id": "1"}', '{"entity_id": "2"}']
+        )
+        .build()
+    )
+    responses = {}
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=MetricsRegistry(), health_port=0)
+        handled = asyncio.Event()
+
+        @app.consume(max_wait_time=0.1)
+        async def on_sample_health(message: SampleHealthStateChangeEvent):
+            await asyncio.sleep(0.05)
+            handled.set()
+
+        async def probe():
+            await handled.wait()
+            await asyncio.sleep(0.05)  # let the batch complete
+            port = app.health_server.port
+            for path in ["/live", "/ready", "/lag", "/metrics", "/unknown"]:
+                responses[path] = await http_get(port, path)
+            app.cancel()
+            await asyncio.sleep(0.3)  # let the receive loop exit
+            responses["/ready (cancelled)"] = (app.is_ready, None)
+
+        async def run():
+            await asyncio.gather(app.run(), probe())
+
+        asyncio.run(asyncio.wait_for(run(), timeout=5))
+
+    assert responses["/live"][0] == 200
+    status, body = responses["/ready"]
+    assert status == 200
+    assert json.loads(body)["subscriptions"] == {"sample-health|TEST_SUB": True}
+    status, body = responses["/lag"]
+    lag = json.loads(body)["subscriptions"]["sample-health|TEST_SUB"]
+    assert lag["completed_total"] == 2
+    assert lag["lag_seconds"] >= 0.05
+    assert lag["receiver_attached"]
+    status, body = responses["/metrics"]
+    assert 'subscription_lag_seconds{subscription="TEST_SUB",topic="sample-health"}' in body
+    assert responses["/unknown"][0] == 404
+    assert responses["/ready (cancelled)"][0] is False
@@ -1,15 +1,29 @@
 import asyncio
 import logging
+import re
+import sqlite3
 from datetime import timedelta
-from typing import Optional
-from unittest.mock import AsyncMock, Mock
+from types import SimpleNamespace
+from typing import Optional, Union
+from unittest.mock import AsyncMock, MagicMock, Mock, patch
 
 from azure.servicebus.aio import ServiceBusClient, ServiceBusReceiver, ServiceBusSender
-from azure.servicebus.amqp import AmqpAnnotatedMessage
-from azure.servicebus import ServiceBusReceivedMessage, ServiceBusMessage
+from azure.servicebus.aio.management import ServiceBusAdministrationClient
+from azure.servicebus.management import CorrelationRuleFilter, SqlRuleFilter, TrueRuleFilter
+from azure.servicebus.amqp import AmqpAnnotatedMessage, AmqpMessageProperties
+from azure.servicebus import (
+    NEXT_AVAILABLE_SESSION,
+    ServiceBusReceivedMessage,
+    ServiceBusMessage,
+    ServiceBusMessageBatch,
+)
+from azure.servicebus.exceptions import OperationTimeoutError, SessionLockLostError
 from azure.servicebus._common.utils import utc_now
 
 from .consumer_app import ConsumerApp
+from .events import StateChangeEventBase, get_topic_name_from_event_class
+from .metrics import MetricsRegistry
+from .publisher import Publisher
 
 
 # Based on https://github.com/Azure/azure-sdk-for-python/blob/1356c85959f4ba182a92491f6d99d016411c8ab1/sdk/servicebus/azure-servicebus/tests/mocks.py#L18
@@ -21,13 +35,32 @@ class MockReceivedMessage(ServiceBusReceivedMessage):
         # https://github.com/Azure/azure-sdk-for-python/blob/28e19bd7d8221479b9091f70aa6a84d40c3549a0/sdk/servicebus/azure-servicebus/samples/async_samples/send_and_receive_amqp_annotated_message_async.py#L49-L60
         # value_body = kwargs.pop("value_body", None)
         data_body = kwargs.pop("data_body", None)
+        self._received_timestamp_utc = utc_now()
+        # the broker sets the enqueued time as an annotation (defaults to the time the message is received)
+        enqueued_time_utc = kwargs.pop("enqueued_time_utc", None) or self._received_timestamp_utc
+        annotations = {b"x-opt-enqueued-time": int(enqueued_time_utc.timestamp() * 1000)}
+        sequence_number = kwargs.pop("sequence_number", None)
+        if sequence_number is not None:
+            annotations[b"x-opt-sequence-number"] = sequence_number
+        application_properties = kwargs.pop("application_properties", None)
+        dead_letter_reason = kwargs.pop("dead_letter_reason", None)
+        if dead_letter_reason is not None:
+            # the broker adds the reason as a (bytes) application property when a message is dead-lettered
+            application_properties = {
+                **(application_properties or {}),
+                b"DeadLetterReason": dead_letter_reason.encode(),
+            }
         value_message = AmqpAnnotatedMessage(
             data_body=data_body,
+            properties=AmqpMessageProperties(
+                content_type=kwargs.pop("content_type", None), group_id=kwargs.pop("session_id", None)
+            ),
+            application_properties=application_properties,
+            annotations=annotations,
         )
         self._raw_amqp_message = value_message
-        self.message_id = "todo-message-id"
+        self.message_id = kwargs.pop("message_id", None) or "todo-message-id"
 
-        self._received_timestamp_utc = utc_now()
         self.locked_until_utc = self._received_timestamp_utc + timedelta(seconds=self._lock_duration)
         self._settled = False
         self._receiver = kwargs.pop("receiver", None)
@@ -59,17 +92,98 @@ class SentMessage:
         self.message = message
 
 
+def create_received_message(
+    message: Union[str, ServiceBusMessage], receiver, sequence_number: Optional[int] = None, **kwargs
+) -> MockReceivedMessage:
+    if isinstance(message, ServiceBusMessage):
+        return MockReceivedMessage(
+            data_body=b"".join(message.body),
+            content_type=message.content_type,
+            application_properties=message.application_properties,
+            message_id=message.message_id,
+            session_id=message.session_id,
+            receiver=receiver,
+            sequence_number=sequence_number,
+            **kwargs,
+        )
+    return MockReceivedMessage(data_body=message, receiver=receiver, sequence_number=sequence_number, **kwargs)
+
+
+_SQL_FILTER_TOKEN = re.compile(r"'(?:[^']|'')*'|EXISTS\(user\.(\w+)\)|user\.(\w+)")
+
+
+def _get_rule_properties(message) -> dict:
+    if not isinstance(message, ServiceBusMessage) or message.application_properties is None:
+        return {}
+    return {
+        (name.decode() if isinstance(name, bytes) else name): (value.decode() if isinstance(value, bytes) else value)
+        for name, value in message.application_properties.items()
+    }
+
+
+def _matches_sql_filter(sql_expression: str, properties: dict) -> bool:
+    """Evaluate a SQL filter (as generated by pubsub.filters) against application properties using SQLite
+
+    SQLite has the same three-valued logic as the broker's SQL filters (comparisons with a missing property are unknown)
+    """
+    names = set()
+
+    def replace(match):
+        if match.group(1):
+            names.add(match.group(1))
+            return f"(:{match.group(1)} IS NOT NULL)"
+        if match.group(2):
+            names.add(match.group(2))
+            return f":{match.group(2)}"
+        return match.group(0)  # string literal
+
+    expression = _SQL_FILTER_TOKEN.sub(replace, sql_expression)
+    with sqlite3.connect(":memory:") as connection:
+        row = connection.execute(
+            f"SELECT 1 WHERE {expression}", {name: properties.get(name) for name in names}
+        ).fetchone()
+    return row is not None
+
+
+def matches_rule_filter(rule_filter, message) -> bool:
+    """Whether a message (as added to MockServiceBusClientBuilder) matches a subscription rule filter"""
+    if isinstance(rule_filter, TrueRuleFilter):
+        return True
+    properties = _get_rule_properties(message)
+    if isinstance(rule_filter, CorrelationRuleFilter):
+        return all(properties.get(name) == value for name, value in rule_filter.properties.items())
+    if isinstance(rule_filter, SqlRuleFilter):
+        return _matches_sql_filter(rule_filter.sql_expression, properties)
+    raise Exception(f"Unsupported rule filter: {rule_filter!r}")
+
+
 class MockServiceBusClientBuilder:
     _topics: dict  # key: topic name, value: (dict keyed on subscription name, value: list of messages)
     _topic_subscription_receivers = dict[str, ServiceBusReceiver]  # keyed on <topic_name>|<subscription_name>
     sentMessages: list[SentMessage]
+    rules: dict  # key: <topic_name>|<subscription_name>, value: dict of rule filters keyed on rule name
+    _sessions: dict  # key: <topic_name>|<subscription_name>, value: dict of pending messages keyed on session id
+    _locked_sessions: set  # <topic_name>|<subscription_name>|<session_id> for the sessions accepted by a receiver
+    session_receivers: list[ServiceBusReceiver]  # the session receivers in the order they were created
+    max_batch_size_in_bytes: int  # the maximum size of a batch (or single message) for the senders
 
     def __init__(self):
         self._topics = {}
         self._topic_subscription_receivers = {}
         self.sentMessages = []
-
-    def add_messages_for_topic_subscription(self, topic_name: str, subscription_name: str, messages: list[str]):
+        self.rules = {}
+        self._sessions = {}
+        self._locked_sessions = set()
+        self.session_receivers = []
+        self.max_batch_size_in_bytes = 256 * 1024  # the limit for the Standard tier
+
+    def add_messages_for_topic_subscription(
+        self, topic_name: str, subscription_name: str, messages: list[Union[str, ServiceBusMessage]]
+    ):
+        """Add messages to be received for a topic/subscription
+
+        Messages can be strings (JSON bodies) or ServiceBusMessages (e.g. from sentMessages) to also deliver the content type and application properties
+        """
         topic = self._topics.get(topic_name)
         if topic is None:
             topic = {}
@@ -82,7 +196,26 @@ class MockServiceBusClientBuilder:
         topic[subscription_name] = messages
         return self
 
-    def get_subscription_receiver(self, topic_name, subscription_name, auto_lock_renewer=None):
+    def add_dead_lettered_messages_for_topic_subscription(
+        self,
+        topic_name: str,
+        subscription_name: str,
+        messages: list[Union[str, ServiceBusMessage]],
+        reason: str = "dropped by subscriber",
+    ):
+        """Add messages to the dead-letter queue for a topic/subscription (can be called several times, e.g. for different reasons)"""
+        topic = self._topics.setdefault(topic_name, {})
+        dead_letter_messages = topic.setdefault(f"{subscription_name}/$DeadLetterQueue", [])
+        dead_letter_messages.extend((message, {"dead_letter_reason": reason}) for message in messages)
+        return self
+
+    def get_subscription_receiver(
+        self, topic_name, subscription_name, auto_lock_renewer=None, sub_queue=None, session_id=None, **kwargs
+    ):
+        if session_id is not None:
+            return self._get_session_receiver(topic_name, subscription_name, session_id, kwargs.get("max_wait_time"))
+        if sub_queue is not None:
+            subscription_name = f"{subscription_name}/$DeadLetterQueue"
         key = f"{topic_name}|{subscription_name}"
         receiver = self._topic_subscription_receivers.get(key)
         if not receiver is None:
@@ -99,35 +232,202 @@ class MockServiceBusClientBuilder:
         receiver = AsyncMock(spec=ServiceBusReceiver)
         receiver._running = False
 
+        # messages are (sequence number, message, received message kwargs)
+        messages = [
+            (sequence_number, *(message if isinstance(message, tuple) else (message, {})))
+            for sequence_number, message in enumerate(messages, start=1)
+        ]
+
         async def receive_messages(max_message_count=None, max_wait_time=None):
             nonlocal messages
             logging.info("In receive_messages")
+            # the broker only delivers messages that match one of the subscription's rules (see
+            # build_administration_client), which are checked when the messages are received
+            rules = self.rules.get(key)
+            if rules is not None:
+                messages = [
+                    message
+                    for message in messages
+                    if any(matches_rule_filter(rule_filter, message[1]) for rule_filter in rules.values())
+                ]
             if messages == []:
                 logging.info(f"No messages to return - sleeping (max_wait_time: {max_wait_time})")
                 await asyncio.sleep(max_wait_time or 1)
                 return []
 
-            messages_to_return = [MockReceivedMessage(data_body=message, receiver=receiver) for message in messages]
-            messages = []
-            logging.info(f"returning messages: {messages_to_return}")
+            batch = messages[:max_message_count] if max_message_count else messages
+            messages = messages[len(batch) :]
+            messages_to_return = [
+                create_received_message(message, receiver, sequence_number, **kwargs)
+                for sequence_number, message, kwargs in batch
+            ]
+            logging.info(f"returning {len(messages_to_return)} message(s)")
             return messages_to_return
 
         receiver.receive_messages = receive_messages
 
+        async def peek_messages(max_message_count=1, sequence_number=0, **kwargs):
+            # peeked messages aren't locked or removed
+            return [
+                create_received_message(message, receiver, message_sequence_number, **message_kwargs)
+                for message_sequence_number, message, message_kwargs in messages
+                if message_sequence_number >= sequence_number
+            ][:max_message_count]
+
+        receiver.peek_messages = peek_messages
+
+        async def renew_message_lock(message, timeout=None):
+            message.locked_until_utc = utc_now() + timedelta(seconds=message._lock_duration)
+            return message.locked_until_utc
+
+        receiver.renew_message_lock = AsyncMock(side_effect=renew_message_lock)
+
         # save receiver (enables us to retrieve the receiver in the test code to make assertions on it)
         self._topic_subscription_receivers[key] = receiver
 
         return receiver
 
-    def get_topic_sender(self, topic_name):
-        sender = Mock(spec=ServiceBusSender)
+    def _get_pending_sessions(self, topic_name: str, subscription_name: str) -> dict:
+        """The pending messages for a session-enabled subscription, grouped by the session id of the messages"""
+        key = f"{topic_name}|{subscription_name}"
+        sessions = self._sessions.get(key)
+        if sessions is None:
+            messages = self._topics.get(topic_name, {}).get(subscription_name)
+            if messages is None:
+                raise Exception(f"No messages added for topic {topic_name} and subscription {subscription_name}")
+            sessions = {}
+            for sequence_number, message in enumerate(messages, start=1):
+                if not isinstance(message, ServiceBusMessage) or message.session_id is None:
+                    raise Exception(
+                        "Messages for session-enabled subscriptions must be ServiceBusMessages with a session_id"
+                    )
+                sessions.setdefault(message.session_id, []).append((sequence_number, message))
+            self._sessions[key] = sessions
+        return sessions
+
+    def _get_session_receiver(self, topic_name: str, subscription_name: str, session_id, max_wait_time=None):
+        """Create a mock session receiver: the session is accepted when the receiver is opened ("async with")
+
+        With NEXT_AVAILABLE_SESSION, the first unlocked session with pending messages is accepted, or
+        OperationTimeoutError is raised after max_wait_time if there isn't one (as for the real receiver).
+        """
+        sessions = self._get_pending_sessions(topic_name, subscription_name)
+        receiver = AsyncMock(spec=ServiceBusReceiver)
+        receiver.session = None
+        lock_key = None
+
+        async def open_receiver():
+            nonlocal lock_key
+            if session_id == NEXT_AVAILABLE_SESSION:
+                available = [
+                    pending_session_id
+                    for pending_session_id, messages in sessions.items()
+                    if messages
+                    and f"{topic_name}|{subscription_name}|{pending_session_id}" not in self._locked_sessions
+                ]
+                if len(available) == 0:
+                    await asyncio.sleep(max_wait_time or 1)
+                    raise OperationTimeoutError(message="No sessions available")
+                accepted_session_id = available[0]
+            else:
+                accepted_session_id = session_id
+            lock_key = f"{topic_name}|{subscription_name}|{accepted_session_id}"
+            if lock_key in self._locked_sessions:
+                raise SessionLockLostError(message=f"Session {accepted_session_id} is locked by another receiver")
+            self._locked_sessions.add(lock_key)
+            receiver.session = MagicMock()
+            receiver.session.session_id = accepted_session_id
+            receiver.session.locked_until_utc = utc_now() + timedelta(seconds=30)
+            receiver.session.renew_lock = AsyncMock()
+            return receiver
+
+        async def close_receiver(*args):
+            self._locked_sessions.discard(lock_key)
 
-        async def send_messages(message: ServiceBusMessage):
-            self.sentMessages.append(SentMessage(topic_name, message))
+        receiver.__aenter__ = AsyncMock(side_effect=open_receiver)
+        receiver.__aexit__ = AsyncMock(side_effect=close_receiver)
+
+        delivered = {}  # key: id of the received message, value: (sequence number, message)
+
+        async def receive_messages(max_message_count=None, max_wait_time=None):
+            messages = sessions.setdefault(receiver.session.session_id, [])
+            if messages == []:
+                await asyncio.sleep(max_wait_time or 1)
+                return []
+            batch = messages[:max_message_count] if max_message_count else messages[:]
+            del messages[: len(batch)]
+            received_messages = []
+            for sequence_number, message in batch:
+                received_message = create_received_message(message, receiver, sequence_number)
+                delivered[id(received_message)] = (sequence_number, message)
+                received_messages.append(received_message)
+            return received_messages
+
+        async def abandon_message(message, **kwargs):
+            # abandoned messages are returned to the session and redelivered in sequence order
+            messages = sessions.setdefault(receiver.session.session_id, [])
+            messages.append(delivered.pop(id(message)))
+            messages.sort(key=lambda item: item[0])
+
+        receiver.receive_messages = receive_messages
+        receiver.abandon_message = AsyncMock(side_effect=abandon_message)
+        self.session_receivers.append(receiver)
+        return receiver
+
+    def get_topic_sender(self, topic_name):
+        # MagicMock (rather than Mock) so that the sender supports "async with"
+        sender = MagicMock(spec=ServiceBusSender)
+
+        async def send_messages(message):
+            # send_messages accepts a single message, a list of messages or a batch
+            if isinstance(message, ServiceBusMessageBatch):
+                messages = message._messages
+            else:
+                messages = message if isinstance(message, list) else [message]
+                # the SDK packs a list into a single batch, which must fit the maximum batch size
+                batch = ServiceBusMessageBatch(max_size_in_bytes=self.max_batch_size_in_bytes)
+                for message in messages:
+                    batch.add_message(message)
+            for message in messages:
+                self.sentMessages.append(SentMessage(topic_name, message))
+
+        async def create_message_batch(max_size_in_bytes=None):
+            return ServiceBusMessageBatch(max_size_in_bytes=max_size_in_bytes or self.max_batch_size_in_bytes)
 
         sender.send_messages = AsyncMock(side_effect=send_messages)
+        sender.create_message_batch = AsyncMock(side_effect=create_message_batch)
         return sender
 
+    def build_administration_client(self):
+        """Build a mock ServiceBusAdministrationClient that records the subscription rules in self.rules
+
+        Subscriptions start with the $Default rule. Messages that don't match any of the rules aren't returned by
+        the (non-session) receivers, as the broker would drop them
+        """
+        admin_client = MagicMock(spec=ServiceBusAdministrationClient)
+        admin_client.__aenter__.return_value = admin_client
+
+        def get_rules(topic_name, subscription_name):
+            return self.rules.setdefault(f"{topic_name}|{subscription_name}", {"$Default": TrueRuleFilter()})
+
+        def list_rules(topic_name, subscription_name):
+            async def iterate_rules():
+                for name in list(get_rules(topic_name, subscription_name).keys()):
+                    yield SimpleNamespace(name=name)
+
+            return iterate_rules()
+
+        async def create_rule(topic_name, subscription_name, rule_name, filter=None):
+            get_rules(topic_name, subscription_name)[rule_name] = filter
+
+        async def delete_rule(topic_name, subscription_name, rule_name):
+            del get_rules(topic_name, subscription_name)[rule_name]
+
+        admin_client.list_rules = Mock(side_effect=list_rules)
+        admin_client.create_rule = AsyncMock(side_effect=create_rule)
+        admin_client.delete_rule = AsyncMock(side_effect=delete_rule)
+        return admin_client
+
     def build(self):
         mock_sb_client = AsyncMock(spec=ServiceBusClient)
         mock_sb_client.get_subscription_receiver = Mock(side_effect=self.get_subscription_receiver)
@@ -142,3 +442,49 @@ async def run_app_with_timeout(app: ConsumerApp, timeout_seconds: int = 0.1, fil
 
     logging.info("Calling app.run...")
     await asyncio.gather(app.run(filter=filter), cancel_after_n_seconds(timeout_seconds))
+
+
+def publish_and_consume(
+    message: StateChangeEventBase,
+    publisher_args: Optional[dict] = None,
+    consumer_args: Optional[dict] = None,
+    mock_client_builder: Optional[MockServiceBusClientBuilder] = None,
+):
+    """Publish an event, then deliver the sent message to a consumer and return the sent message and received event
+
+    Args:
+        message: The event to publish
+        publisher_args: Extra arguments for the Publisher (e.g. codec or compression)
+        consumer_args: Extra arguments for the ConsumerApp (e.g. blob_store or metrics)
+        mock_client_builder: The builder for the mock client (pass one to inspect the sent/settled messages)
+    """
+    mock_client_builder = mock_client_builder or MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.build()
+    topic_name = get_topic_name_from_event_class(type(message))
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+
+        async def publish():
+            async with Publisher(
+                topics=[topic_name], metrics=MetricsRegistry(), **(publisher_args or {})
+            ) as publisher:
+                await publisher.publish(message)
+
+        asyncio.run(publish())
+
+    sent_message = mock_client_builder.sentMessages[-1].message
+    mock_client_builder.add_messages_for_topic_subscription(topic_name, "TEST_SUB", messages=[sent_message])
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        consumer_args = {"metrics": MetricsRegistry(), **(consumer_args or {})}
+        app = ConsumerApp(default_subscription_name="TEST_SUB", **consumer_args)
+
+        received_message = None
+
+        @app.consume(topic_name=topic_name, max_wait_time=0.1)
+        async def on_message(message):
+            nonlocal received_message
+            logging.info(f"In on_message for {topic_name}")
+            received_message = message
+
+        asyncio.run(run_app_with_timeout(app))
+
+    return sent_message, received_message
@@ -0,0 +1,51 @@
+import asyncio
+
+from .events import StateChangeEventBase
+from .loadgen import FakeServiceBusClient, LatencyHistogram, LoadGenerator
+from .metrics import MetricsRegistry
+from .publisher import Publisher
+
+
+class SampleLoadgenStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+class SampleLoadgenOtherStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+def test_latency_histogram_percentiles():
+    histogram = LatencyHistogram()
+    for i in range(1, 1001):
+        histogram.record(i / 1000)
+
+    assert histogram.count == 1000
+    assert abs(histogram.percentile(50) - 0.5) <= 0.5 * 0.01
+    assert abs(histogram.percentile(99) - 0.99) <= 0.99 * 0.01
+    assert histogram.percentile(100) == 1
+    counts = histogram.get_buckets([0.1, 0.5])
+    assert sum(counts) == 1000
+    assert abs(counts[0] - 100) <= 2 and abs(counts[2] - 500) <= 2
+
+
+async def generate_load(client: FakeServiceBusClient, **kwargs):
+    topics = {"sample-loadgen": 3, "sample-loadgen-other": 1}
+    async with Publisher(topics=list(topics), metrics=MetricsRegistry(), client_factory=lambda: client) as publisher:
+        return await LoadGenerator(publisher, topics, payload_sizes={10: 1, 1000: 1}, seed=1, **kwargs).run()
+
+
+def test_open_loop_latency_includes_sends_delayed_by_a_stall():
+    # the first send stalls, holding up the sends scheduled during the stall (which a closed loop wouldn't measure)
+    client = FakeServiceBusClient(latency=0, stall_every=1000, stall_time=0.2)
+    client.sent = 999
+
+    report = asyncio.run(generate_load(client, rate=200, concurrency=1, duration=0.5))
+
+    assert 95 <= report.sent <= 101
+    assert report.failed == 0
+    assert set(report.latency_by_topic) == {"sample-loadgen", "sample-loadgen-other"}
+    assert sum(histogram.count for histogram in report.latency_by_topic.values()) == report.sent
+    # about 40 sends are scheduled during the stall, so over 10% of the latencies are at least 0.1s
+    assert report.latency.percentile(90) >= 0.1
+    assert report.service_time.percentile(90) < 0.05
+    assert report.max_schedule_lag >= 0.15
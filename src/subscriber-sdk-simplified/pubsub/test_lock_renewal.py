@@ -0,0 +1,157 @@
+import asyncio
+from datetime import timedelta
+from unittest.mock import AsyncMock, MagicMock
+
+from azure.servicebus._common.utils import utc_now
+
+from .lock_renewal import LockRenewalScheduler
+from .metrics import MetricsRegistry
+from .test_helpers import MockReceivedMessage, MockServiceBusClientBuilder
+
+
+def create_receiver():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_client_builder.add_messages_for_topic_subscription("sample-lock", "TEST_SUB", messages=[])
+    return mock_client_builder.get_subscription_receiver("sample-lock", "TEST_SUB")
+
+
+async def run_scheduler(scheduler: LockRenewalScheduler, body):
+    task = asyncio.create_task(scheduler.run())
+    try:
+        await body()
+    finally:
+        scheduler.close()
+        await task
+
+
+def test_settled_message_is_not_renewed():
+    receiver = create_receiver()
+    scheduler = LockRenewalScheduler(metrics=MetricsRegistry())
+
+    async def body():
+        message = MockReceivedMessage(data_body="{}", lock_duration=0.2)
+        scheduler.register(receiver, message, max_lock_renewal_duration=10)
+        await asyncio.sleep(0.01)
+        scheduler.settle(message)
+        await asyncio.sleep(0.2)
+
+    asyncio.run(run_scheduler(scheduler, body))
+
+    assert receiver.renew_message_lock.call_count == 0, "Settled message should not be renewed"
+    assert scheduler.tracked_count == 0
+
+
+def test_long_running_messages_are_renewed_together():
+    receiver = create_receiver()
+    metrics = MetricsRegistry()
+    scheduler = LockRenewalScheduler(metrics=metrics)
+    messages = [MockReceivedMessage(data_body="{}", lock_duration=0.2) for _ in range(3)]
+
+    async def body():
+        for message in messages:
+            scheduler.register(receiver, message, max_lock_renewal_duration=10)
+        await asyncio.sleep(0.15)
+        assert scheduler.tracked_count == 3
+        for message in messages:
+            scheduler.settle(message)
+
+    asyncio.run(run_scheduler(scheduler, body))
+
+    renewed_messages = [call.args[0] for call in receiver.renew_message_lock.call_args_list]
+    assert len(renewed_messages) == 3, "Expected each in-flight message to be renewed once"
+    assert set(map(id, renewed_messages)) == set(map(id, messages))
+    assert metrics.get("lock_renewals_total") == 3
+
+
+def test_renewal_stops_after_max_lock_renewal_duration():
+    receiver = create_receiver()
+    metrics = MetricsRegistry()
+    scheduler = LockRenewalScheduler(metrics=metrics)
+
+    async def body():
+        message = MockReceivedMessage(data_body="{}", lock_duration=0.1)
+        scheduler.register(receiver, message, max_lock_renewal_duration=0.01)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run_scheduler(scheduler, body))
+
+    assert receiver.renew_message_lock.call_count == 0
+    assert scheduler.tracked_count == 0
+    assert metrics.get("lock_renewal_expired_total") == 1
+
+
+def test_failed_renewal_stops_tracking_message():
+    receiver = create_receiver()
+    receiver.renew_message_lock = AsyncMock(side_effect=Exception("lock lost"))
+    metrics = MetricsRegistry()
+    scheduler = LockRenewalScheduler(metrics=metrics)
+
+    async def body():
+        message = MockReceivedMessage(data_body="{}", lock_duration=0.1)
+        scheduler.register(receiver, message, max_lock_renewal_duration=10)
+        await asyncio.sleep(0.1)
+
+    asyncio.run(run_scheduler(scheduler, body))
+
+    assert receiver.renew_message_lock.call_count == 1
+    assert scheduler.tracked_count == 0
+    assert metrics.get("lock_renewal_failures_total") == 1
+
+
+def test_session_lock_is_renewed_until_settled():
+    receiver = create_receiver()
+    receiver.session = MagicMock()
+    receiver.session.locked_until_utc = utc_now() + timedelta(seconds=0.2)
+    receiver.session.renew_lock = AsyncMock()
+    metrics = MetricsRegistry()
+    scheduler = LockRenewalScheduler(metrics=metrics)
+
+    async def body():
+        scheduler.register_session(receiver, max_lock_renewal_duration=10)
+        await asyncio.sleep(0.15)
+        scheduler.settle(receiver.session)
+
+    asyncio.run(run_scheduler(scheduler, body))
+
+    assert receiver.session.renew_lock.call_count == 1
+    assert receiver.renew_message_lock.call_count == 0, "Messages in a session are covered by the session lock"
+    assert scheduler.tracked_count == 0
+
+
+def test_settled_entries_are_removed_from_heap_and_release_messages():
+    receiver = create_receiver()
+    scheduler = LockRenewalScheduler(metrics=MetricsRegistry())
+    messages = [MockReceivedMessage(data_body="{}", lock_duration=60) for _ in range(10)]
+    for message in messages:
+        scheduler.register(receiver, message, max_lock_renewal_duration=300)
+
+    for message in messages[:6]:
+        scheduler.settle(message)
+
+    assert len(scheduler._heap) < 10, "Expected the heap to be rebuilt once most of it was settled entries"
+    assert all(entry.message is not None for _, _, entry in scheduler._heap if not entry.settled)
+    assert all(entry.message is None for _, _, entry in scheduler._heap if entry.settled)
+    assert scheduler.tracked_count == 4
+
+
+def test_slow_renewal_does_not_delay_other_renewals():
+    slow_receiver = create_receiver()
+    renewed = asyncio.Event()
+
+    async def slow_renew_message_lock(message, timeout=None):
+        await asyncio.sleep(1)
+
+    slow_receiver.renew_message_lock = AsyncMock(side_effect=slow_renew_message_lock)
+    other_receiver = create_receiver()
+    other_receiver.renew_message_lock = AsyncMock(side_effect=lambda message, timeout=None: renewed.set())
+    scheduler = LockRenewalScheduler(metrics=MetricsRegistry())
+
+    async def body():
+        scheduler.register(slow_receiver, MockReceivedMessage(data_body="{}", lock_duration=0.1), 10)
+        await asyncio.sleep(0.07)
+        scheduler.register(other_receiver, MockReceivedMessage(data_body="{}", lock_duration=0.1), 10)
+        await asyncio.wait_for(renewed.wait(), timeout=0.5)
+
+    asyncio.run(run_scheduler(scheduler, body))
+
+    assert other_receiver.renew_message_lock.call_count == 1
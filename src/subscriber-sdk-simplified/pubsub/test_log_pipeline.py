@@ -0,0 +1,71 @@
+import logging
+import threading
+
+from .log_pipeline import LogSampler, QueueLogging
+
+
+class RecordingHandler(logging.Handler):
+    """Handler that records the formatted messages and the thread they were handled on"""
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.threads = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+        self.threads.append(threading.current_thread())
+
+
+class FormatTracker:
+    """Log argument that records the thread it is formatted on"""
+
+    def __init__(self):
+        self.formatted_on = None
+
+    def __str__(self):
+        self.formatted_on = threading.current_thread()
+        return "tracked"
+
+
+def test_sampler_rate_limits_and_counts_suppressed_records():
+    sampler = LogSampler(sample_rate=1, rate_limit=5)
+    results = [sampler.allow() for _ in range(8)]
+    assert results == [True] * 5 + [False] * 3
+    assert sampler.take_suppressed_count() == 3
+    assert sampler.take_suppressed_count() == 0
+
+
+def test_sampler_only_samples_sampled_records():
+    sampler = LogSampler(sample_rate=0, rate_limit=0)
+    assert not sampler.allow()
+    assert sampler.allow(sampled=False)
+
+
+def test_queue_logging_formats_records_off_the_calling_thread():
+    root_logger = logging.getLogger()
+    handler = RecordingHandler()
+    root_logger.addHandler(handler)
+    logger = logging.getLogger("pubsub.test_log_pipeline")
+    logger.setLevel(logging.INFO)
+    queue_logging = QueueLogging(logger_name="pubsub.test_log_pipeline")
+    try:
+        queue_logging.start()
+        tracker = FormatTracker()
+        logger.info("message %s", tracker, extra={"message_id": "123"})
+        queue_logging.stop()
+    finally:
+        root_logger.removeHandler(handler)
+        logger.setLevel(logging.NOTSET)
+
+    assert handler.messages == ["message tracked"]
+    assert handler.threads[0] is not threading.current_thread()
+    assert tracker.formatted_on is handler.threads[0], "Expected the message to be formatted on the listener thread"
+    assert logger.propagate, "Expected propagate to be restored"
+
+
+def test_sampler_does_not_rate_limit_unsampled_records():
+    sampler = LogSampler(sample_rate=1, rate_limit=1)
+    assert sampler.allow()
+    assert not sampler.allow()
+    assert all(sampler.allow(sampled=False) for _ in range(5)), "Expected errors to be logged under load"
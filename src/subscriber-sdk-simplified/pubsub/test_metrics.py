@@ -0,0 +1,39 @@
+from .metrics import MetricsRegistry
+
+
+def test_counters_are_tracked_per_label_set():
+    metrics = MetricsRegistry()
+    metrics.increment("messages_total", topic="a")
+    metrics.increment("messages_total", 2, topic="a")
+    metrics.increment("messages_total", topic="b")
+
+    assert metrics.get("messages_total", topic="a") == 3
+    assert metrics.get("messages_total", topic="b") == 1
+    assert metrics.get("messages_total", topic="c") is None
+
+
+def test_histogram_observations():
+    metrics = MetricsRegistry()
+    metrics.observe("latency_seconds", 0.2, buckets=[0.1, 1])
+    metrics.observe("latency_seconds", 5, buckets=[0.1, 1])
+
+    histogram = metrics.get("latency_seconds")
+    assert histogram.count == 2
+    assert histogram.sum == 5.2
+    assert histogram.bucket_counts == [0, 1, 1]
+
+
+def test_render_prometheus():
+    metrics = MetricsRegistry()
+    metrics.increment("messages_total", topic="a")
+    metrics.set_gauge("batch_size", 10, topic="a")
+    metrics.observe("latency_seconds", 0.2, buckets=[0.1, 1])
+
+    output = metrics.render_prometheus()
+
+    assert "# TYPE messages_total counter" in output
+    assert 'messages_total{topic="a"} 1' in output
+    assert 'batch_size{topic="a"} 10' in output
+    assert 'latency_seconds_bucket{le="1"} 1' in output
+    assert 'latency_seconds_bucket{le="+Inf"} 1' in output
+    assert "latency_seconds_count 1" in output
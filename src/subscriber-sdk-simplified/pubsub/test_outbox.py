@@ -0,0 +1,125 @@
+import asyncio
+import sqlite3
+from unittest.mock import patch
+
+import pytest
+
+from .consumer_app import StateChangeEventBase
+from .metrics import MetricsRegistry
+from .outbox import OutboxPublisher
+from .publisher import Publisher
+from .test_helpers import MockServiceBusClientBuilder
+
+
+class SampleOutboxStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+class SampleOutboxLargeStateChangeEvent(StateChangeEventBase):
+    data: str
+
+
+def create_publisher():
+    return Publisher(topics=["sample-outbox"], metrics=MetricsRegistry())
+
+
+@pytest.mark.asyncio
+async def test_publish_spools_and_drains_with_message_ids(tmp_path):
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        outbox = OutboxPublisher(path=str(tmp_path / "outbox.db"), publisher=create_publisher())
+        message_ids = [outbox.publish(SampleOutboxStateChangeEvent(entity_id=str(i))) for i in range(5)]
+        assert outbox.depth == 5
+        assert outbox.metrics.get("outbox_depth") == 5
+        assert len(mock_client_builder.sentMessages) == 0, "Expected publish to only write to the spool"
+
+        async with outbox:
+            for _ in range(100):
+                if outbox.depth == 0:
+                    break
+                await asyncio.sleep(0.01)
+
+    assert outbox.depth == 0
+    assert [message.message.message_id for message in mock_client_builder.sentMessages] == message_ids
+    assert [str(message.message) for message in mock_client_builder.sentMessages][0] == '{"entity_id": "0"}'
+    assert outbox.metrics.get("outbox_drained_total", topic="sample-outbox") == 5
+
+
+@pytest.mark.asyncio
+async def test_spooled_events_survive_restart(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    first_outbox = OutboxPublisher(path=path, publisher=create_publisher())
+    message_id = first_outbox.publish(SampleOutboxStateChangeEvent(entity_id="123"))
+    # simulate a crash by closing without starting the drainer
+    await first_outbox.close()
+
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        second_outbox = OutboxPublisher(path=path, publisher=create_publisher())
+        assert second_outbox.depth == 1
+        assert await second_outbox.drain_once() == 1
+        await second_outbox.close()
+
+    assert len(mock_client_builder.sentMessages) == 1
+    assert mock_client_builder.sentMessages[0].message.message_id == message_id
+
+
+@pytest.mark.asyncio
+async def test_failed_send_keeps_events_and_retries_with_same_message_id(tmp_path):
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        publisher = create_publisher()
+        outbox = OutboxPublisher(path=str(tmp_path / "outbox.db"), publisher=publisher)
+        message_id = outbox.publish(SampleOutboxStateChangeEvent(entity_id="123"))
+
+        original_publish_batch = publisher.publish_batch
+
+        async def failing_publish_batch(*args, **kwargs):
+            raise Exception("broker unavailable")
+
+        publisher.publish_batch = failing_publish_batch
+        for _ in range(2):
+            with pytest.raises(Exception):
+                await outbox.drain_once()
+        assert outbox.depth == 1
+        assert outbox.metrics.get("outbox_send_failures_total", topic="sample-outbox") == 2
+        attempts = outbox._connection.execute("SELECT attempts FROM outbox").fetchone()[0]
+        assert attempts == 0, "Expected failures for the whole batch not to count towards the event's attempts"
+
+        publisher.publish_batch = original_publish_batch
+        assert await outbox.drain_once() == 1
+        await outbox.close()
+
+    assert outbox.depth == 0
+    assert [message.message.message_id for message in mock_client_builder.sentMessages] == [message_id]
+
+
+@pytest.mark.asyncio
+async def test_events_that_fail_on_their_own_are_moved_to_dead_table(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_client_builder.max_batch_size_in_bytes = 10 * 1024
+    mock_sb_client = mock_client_builder.build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        outbox = OutboxPublisher(path=path, publisher=create_publisher(), max_attempts=2)
+        unparseable_id = outbox.publish(SampleOutboxStateChangeEvent(entity_id="unparseable"))
+        outbox._connection.execute("UPDATE outbox SET body = '{' WHERE message_id = ?", (unparseable_id,))
+        oversized_id = outbox.publish(SampleOutboxLargeStateChangeEvent(entity_id="oversized", data="x" * 20000))
+        message_ids = [outbox.publish(SampleOutboxStateChangeEvent(entity_id=str(i))) for i in range(3)]
+
+        # the events behind the failed events are still sent
+        assert await outbox.drain_once() == 3
+        assert outbox.depth == 2
+        assert await outbox.drain_once() == 0
+        assert outbox.depth == 0
+        await outbox.close()
+
+    assert [message.message.message_id for message in mock_client_builder.sentMessages] == message_ids
+    assert outbox.metrics.get("outbox_dead_total", topic="sample-outbox") == 1
+    assert outbox.metrics.get("outbox_dead_total", topic="sample-outbox-large") == 1
+    with sqlite3.connect(path) as connection:
+        dead_rows = connection.execute("SELECT message_id, attempts FROM outbox_dead ORDER BY id").fetchall()
+    assert dead_rows == [(unparseable_id, 2), (oversized_id, 2)]
@@ -0,0 +1,98 @@
+import asyncio
+from unittest.mock import patch
+
+from .consumer_app import ConsumerApp, StateChangeEventBase, SubscriptionSettings
+from .metrics import MetricsRegistry
+from .prefetch import PrefetchBuffer
+from .test_helpers import MockServiceBusClientBuilder, run_app_with_timeout
+
+
+class SamplePrefetchStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+def test_prefetch_receives_while_handlers_are_busy():
+    builder = MockServiceBusClientBuilder().add_messages_for_topic_subscription(
+        "sample-prefetch", "TEST_SUB", messages=[f'{{"entity_id": "{i}"}}' for i in range(30)]
+    )
+    receiver = builder.get_subscription_receiver("sample-prefetch", "TEST_SUB")
+    receive_messages = receiver.receive_messages
+    active_handlers = 0
+    receives_while_busy = 0
+
+    async def tracked_receive_messages(max_message_count=None, max_wait_time=None):
+        nonlocal receives_while_busy
+        await asyncio.sleep(0.02)  # the receive round trip
+        if active_handlers > 0:
+            receives_while_busy += 1
+        return await receive_messages(max_message_count=max_message_count, max_wait_time=max_wait_time)
+
+    receiver.receive_messages = tracked_receive_messages
+
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=builder.build()):
+        app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=MetricsRegistry())
+
+        @app.consume(max_message_count=5, max_wait_time=0.05, prefetch_count=20)
+        async def on_sample_prefetch(message: SamplePrefetchStateChangeEvent):
+            nonlocal active_handlers
+            active_handlers += 1
+            await asyncio.sleep(0.02)
+            active_handlers -= 1
+
+        asyncio.run(run_app_with_timeout(app, timeout_seconds=0.5))
+
+    assert receiver.complete_message.call_count == 30
+    assert receiver.abandon_message.call_count == 0
+    assert receives_while_busy > 0, "Expected messages to be received while the handlers were running"
+    assert app.metrics.get("prefetch_buffer_size", topic="sample-prefetch", subscription="TEST_SUB") == 0
+
+
+def test_prefetch_buffer_drops_expired_messages_and_adapts_depth():
+    builder = MockServiceBusClientBuilder().add_messages_for_topic_subscription(
+        "sample-prefetch",
+        "TEST_SUB",
+        messages=[('{"entity_id": "expired"}', {"lock_duration": -1})] * 2
+        + [('{"entity_id": "locked"}', {"lock_duration": 10})] * 40,
+    )
+    receiver = builder.get_subscription_receiver("sample-prefetch", "TEST_SUB")
+    metrics = MetricsRegistry()
+    discarded = []
+
+    async def run():
+        prefetch = PrefetchBuffer(
+            receiver,
+            max_count=50,
+            get_settings=lambda: SubscriptionSettings(
+                max_message_count=5, max_wait_time=0.05, max_lock_renewal_duration=60
+            ),
+            on_discarded=discarded.append,
+            lock_fraction=0.2,
+            metrics=metrics,
+        )
+        prefetch.start()
+        assert prefetch.target_depth == 5, "Expected to stay one batch ahead until the throughput is known"
+
+        msgs = await prefetch.take(5, max_wait_time=1)
+        assert [msg.sequence_number for msg in msgs] == [3, 4, 5]
+
+        # 10 messages/sec with a 10 second lock: 20 messages are handled in 20% of the lock duration
+        prefetch.record_processed(10, 1)
+        await asyncio.sleep(0.01)
+        assert 19 <= prefetch.target_depth <= 20
+        assert len(prefetch) == prefetch.target_depth, "Expected the buffer to be filled up to the target depth"
+        return await prefetch.close()
+
+    remaining = asyncio.run(run())
+    assert len(discarded) == 2
+    assert metrics.get("prefetch_expired_total") == 2
+    assert 19 <= len(remaining) <= 20
+
+
+def test_prefetch_count_zero_disables_prefetch_enabled_for_the_app():
+    app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=MetricsRegistry(), prefetch_count=20)
+
+    @app.consume(prefetch_count=0)
+    async def on_sample_prefetch(message: SamplePrefetchStateChangeEvent):
+        pass
+
+    assert app._create_prefetch_buffer(app._subscriptions[0], receiver=None) is None
@@ -1,10 +1,16 @@
 from typing import Optional
 import asyncio
+import json
 import logging
 import pytest
 from unittest.mock import patch
 
-from .publisher import publish
+from azure.servicebus.exceptions import MessageSizeExceededError
+
+from .metrics import MetricsRegistry
+from . import publisher as publisher_module
+from .consumer_app import ConsumerApp
+from .publisher import Publisher, close_default_publisher, publish
 from .consumer_app import StateChangeEventBase
 from .test_helpers import MockServiceBusClientBuilder, run_app_with_timeout
 
@@ -13,15 +19,140 @@ class SamplePublisherStateChangeEvent(StateChangeEventBase):
     pass
 
 
+class SampleLargePublisherStateChangeEvent(StateChangeEventBase):
+    data: str
+
+
 @pytest.mark.asyncio
 async def test_publish():
     mock_client_builder = MockServiceBusClientBuilder()
     mock_sb_client = mock_client_builder.build()
     with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
         await publish(SamplePublisherStateChangeEvent(entity_id="123"))
+        await close_default_publisher()
 
     assert len(mock_client_builder.sentMessages) == 1, "Expected a single message to be sent"
     message = mock_client_builder.sentMessages[0]
 
     assert message.topic_name == "sample-publisher", "Unexpected topic name"
     assert str(message.message) == '{"entity_id": "123"}', "Unexpected message body"
+
+
+@pytest.mark.asyncio
+async def test_publisher_start_opens_senders_up_front():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        publisher = Publisher(topics=["sample-publisher"], metrics=MetricsRegistry())
+        await publisher.start()
+
+        assert mock_sb_client.get_topic_sender.call_count == 1, "Expected sender to be created in start()"
+        sender = publisher._topic_senders["sample-publisher"]
+        assert sender.__aenter__.call_count == 1, "Expected sender to be opened in start()"
+
+        await publisher.publish(SamplePublisherStateChangeEvent(entity_id="123"))
+        await publisher.close()
+
+    assert mock_sb_client.get_topic_sender.call_count == 1, "Expected publish to reuse the pre-opened sender"
+    assert len(mock_client_builder.sentMessages) == 1, "Expected a single message to be sent"
+    assert sender.close.call_count == 1, "Expected sender to be closed"
+    assert mock_sb_client.close.call_count == 1, "Expected client to be closed"
+
+
+@pytest.mark.asyncio
+async def test_publisher_opens_senders_for_known_event_classes():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        async with Publisher(metrics=MetricsRegistry()) as publisher:
+            topics = set(publisher._topic_senders.keys())
+
+    assert "sample-publisher" in topics
+
+
+@pytest.mark.asyncio
+async def test_publisher_replaces_failed_sender_and_retries():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        metrics = MetricsRegistry()
+        publisher = Publisher(topics=["sample-publisher"], metrics=metrics)
+        await publisher.start()
+        failed_sender = publisher._topic_senders["sample-publisher"]
+        failed_sender.send_messages.side_effect = Exception("link detached")
+
+        await publisher.publish(SamplePublisherStateChangeEvent(entity_id="123"))
+        await publisher.close()
+
+    assert len(mock_client_builder.sentMessages) == 1, "Expected message to be sent with replacement sender"
+    assert failed_sender.close.call_count == 1, "Expected failed sender to be closed"
+    assert metrics.get("publisher_sender_reconnects_total", topic="sample-publisher") == 1
+
+
+@pytest.mark.asyncio
+async def test_publisher_health_check_reopens_senders():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        publisher = Publisher(topics=["sample-publisher"], health_check_interval=0.01, metrics=MetricsRegistry())
+        await publisher.start()
+        sender = publisher._topic_senders["sample-publisher"]
+        await asyncio.sleep(0.05)
+        await publisher.close()
+
+    assert sender.__aenter__.call_count > 1, "Expected health check to re-open sender"
+
+
+@pytest.mark.asyncio
+async def test_publish_batch_splits_messages_that_do_not_fit_in_one_batch():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_client_builder.max_batch_size_in_bytes = 10 * 1024
+    mock_sb_client = mock_client_builder.build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        metrics = MetricsRegistry()
+        async with Publisher(topics=["sample-large-publisher"], metrics=metrics) as publisher:
+            sender = publisher._topic_senders["sample-large-publisher"]
+            events = [SampleLargePublisherStateChangeEvent(entity_id=str(i), data="x" * 3000) for i in range(10)]
+            await publisher.publish_batch(events)
+
+            # a message that is too large on its own fails without replacing the (healthy) sender
+            with pytest.raises(MessageSizeExceededError):
+                await publisher.publish_batch(
+                    [
+                        SampleLargePublisherStateChangeEvent(entity_id="small", data=""),
+                        SampleLargePublisherStateChangeEvent(entity_id="large", data="x" * 20000),
+                    ]
+                )
+            assert publisher._topic_senders["sample-large-publisher"] is sender
+
+    assert [str(i) for i in range(10)] == [
+        json.loads(str(sent_message.message))["entity_id"] for sent_message in mock_client_builder.sentMessages
+    ]
+    assert sender.send_messages.call_count == 4, "Expected 3 events per 10KiB batch"
+    assert metrics.get("publisher_sender_reconnects_total", topic="sample-large-publisher") is None
+
+
+@pytest.mark.asyncio
+async def test_default_publisher_is_closed_when_consumer_app_stops():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.add_messages_for_topic_subscription(
+        "sample-publisher", "TEST_SUB", messages=['{"entity_id": "123"}']
+    ).build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        app = ConsumerApp(default_subscription_name="TEST_SUB", metrics=MetricsRegistry())
+        default_publisher = None
+
+        @app.consume(max_wait_time=0.1)
+        async def on_sample_publisher(message: SamplePublisherStateChangeEvent):
+            # publish from a handler with the module-level publish function
+            nonlocal default_publisher
+            await publish(SamplePublisherStateChangeEvent(entity_id="456"))
+            default_publisher = publisher_module.get_default_publisher()
+
+        await run_app_with_timeout(app)
+
+    assert len(mock_client_builder.sentMessages) == 1
+    assert publisher_module._default_publisher is None, "Expected the default publisher to be closed"
+    assert default_publisher._client_pool is None, "Expected the default publisher's clients to be closed"
+    # closing again (e.g. when no default publisher has been created) does nothing
+    await close_default_publisher()
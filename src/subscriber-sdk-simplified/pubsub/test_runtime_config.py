@@ -0,0 +1,130 @@
+import asyncio
+import json
+import os
+from unittest.mock import patch
+
+import pytest
+
+from .consumer_app import ConsumerApp, StateChangeEventBase
+from .runtime_config import RuntimeConfigWatcher
+from .test_helpers import MockServiceBusClientBuilder, run_app_with_timeout
+
+
+class SampleRuntimeConfigStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+def create_app():
+    app = ConsumerApp(default_subscription_name="TEST_SUB", max_message_count=10, max_wait_time=30)
+
+    @app.consume(max_wait_time=5)
+    async def on_sample_runtime_config(message: SampleRuntimeConfigStateChangeEvent):
+        pass
+
+    return app
+
+
+def write_config(path, config: dict):
+    with open(path, "w") as f:
+        json.dump(config, f)
+    # ensure the mtime changes even on file systems with coarse timestamps
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+
+
+def test_subscription_settings_use_decorator_values_then_defaults():
+    app = create_app()
+    settings = app._get_subscription_settings(app._subscriptions[0])
+    assert settings.max_message_count == 10
+    assert settings.max_wait_time == 5
+
+
+def test_runtime_config_overrides_subscription_and_defaults(tmp_path):
+    app = create_app()
+    config_path = tmp_path / "config.json"
+    write_config(
+        config_path,
+        {
+            "defaults": {"max_message_count": 20},
+            "subscriptions": {"sample-runtime-config|TEST_SUB": {"max_wait_time": 1, "max_concurrency": 2}},
+        },
+    )
+
+    assert RuntimeConfigWatcher(app, config_path).load()
+
+    settings = app._get_subscription_settings(app._subscriptions[0])
+    assert settings.max_message_count == 20
+    assert settings.max_wait_time == 1
+    assert settings.max_concurrency == 2
+
+
+def test_runtime_config_removed_values_revert(tmp_path):
+    app = create_app()
+    config_path = tmp_path / "config.json"
+    watcher = RuntimeConfigWatcher(app, config_path)
+    write_config(config_path, {"subscriptions": {"sample-runtime-config|TEST_SUB": {"max_wait_time": 1}}})
+    watcher.load()
+
+    write_config(config_path, {})
+    watcher.load()
+
+    settings = app._get_subscription_settings(app._subscriptions[0])
+    assert settings.max_wait_time == 5
+
+
+def test_runtime_config_invalid_file_keeps_previous_config(tmp_path):
+    app = create_app()
+    config_path = tmp_path / "config.json"
+    watcher = RuntimeConfigWatcher(app, config_path)
+    write_config(config_path, {"subscriptions": {"sample-runtime-config|TEST_SUB": {"max_wait_time": 1}}})
+    watcher.load()
+
+    write_config(config_path, {"subscriptions": {"sample-runtime-config|TEST_SUB": {"max_wait_time": -1}}})
+    assert not watcher.load()
+
+    settings = app._get_subscription_settings(app._subscriptions[0])
+    assert settings.max_wait_time == 1
+
+
+def test_runtime_override_of_zero_removes_concurrency_limit():
+    app = create_app()
+    app.update_subscription_settings(None, max_concurrency=5)
+    app.update_subscription_settings("sample-runtime-config|TEST_SUB", max_concurrency=0)
+
+    settings = app._get_subscription_settings(app._subscriptions[0])
+    assert settings.max_concurrency == 0
+
+
+def test_count_settings_must_be_integers():
+    app = create_app()
+    for settings in [{"max_message_count": 2.5}, {"max_concurrency": 1.5}, {"max_message_count": 0}]:
+        with pytest.raises(Exception, match="Invalid value"):
+            app.update_subscription_settings(None, **settings)
+    app.update_subscription_settings(None, max_wait_time=0.5, max_concurrency=0)
+
+
+def test_max_concurrency_limits_concurrent_handlers():
+    messages = ['{"entity_id": "1"}', '{"entity_id": "2"}', '{"entity_id": "3"}']
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.add_messages_for_topic_subscription(
+        "sample-runtime-config", "TEST_SUB", messages=messages
+    ).build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        app = ConsumerApp(default_subscription_name="TEST_SUB")
+
+        in_flight = 0
+        max_in_flight = 0
+
+        @app.consume(max_wait_time=0.1, max_concurrency=1)
+        async def on_sample_runtime_config(message: SampleRuntimeConfigStateChangeEvent):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+
+        asyncio.run(run_app_with_timeout(app))
+
+    mock_receiver = mock_client_builder.get_subscription_receiver("sample-runtime-config", "TEST_SUB")
+    assert mock_receiver.complete_message.call_count == 3, "Messages not completed"
+    assert max_in_flight == 1, "Handlers ran concurrently despite max_concurrency=1"
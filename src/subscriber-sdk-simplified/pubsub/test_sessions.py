@@ -0,0 +1,120 @@
+import asyncio
+from unittest.mock import patch
+
+from .consumer_app import ConsumerApp, ConsumerResult, StateChangeEventBase
+from .metrics import MetricsRegistry
+from .publisher import Publisher
+from .test_helpers import MockServiceBusClientBuilder
+
+
+class SampleSessionStateChangeEvent(StateChangeEventBase):
+    sequence: int
+
+
+async def publish_events(builder: MockServiceBusClientBuilder, events: list, session_ids=None):
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=builder.build()):
+        async with Publisher(topics=[], metrics=MetricsRegistry(), session_ids=session_ids) as publisher:
+            await publisher.publish_batch(events)
+    return [sent_message.message for sent_message in builder.sentMessages]
+
+
+def test_publisher_sets_session_id_from_entity_id():
+    events = [SampleSessionStateChangeEvent(entity_id="a", sequence=1)]
+    messages = asyncio.run(publish_events(MockServiceBusClientBuilder(), events))
+    assert messages[0].session_id == "a"
+
+    messages = asyncio.run(publish_events(MockServiceBusClientBuilder(), events, session_ids=False))
+    assert messages[0].session_id is None
+
+
+def test_sessions_are_processed_concurrently_and_in_order():
+    # interleave the events for the entities as they would be published
+    events = [
+        SampleSessionStateChangeEvent(entity_id=entity_id, sequence=sequence)
+        for sequence in range(4)
+        for entity_id in ["a", "b", "c"]
+    ]
+    messages = asyncio.run(publish_events(MockServiceBusClientBuilder(), events))
+
+    builder = MockServiceBusClientBuilder()
+    builder.add_messages_for_topic_subscription("sample-session", "TEST_SUB", messages=messages)
+    received = []
+    active_entities = set()
+    max_active_entities = 0
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=builder.build()):
+        app = ConsumerApp(
+            default_subscription_name="TEST_SUB",
+            max_message_count=2,
+            max_wait_time=0.05,
+            session_idle_timeout=0.05,
+            metrics=MetricsRegistry(),
+        )
+
+        @app.consume(sessions=True, max_concurrent_sessions=2)
+        async def on_sample_session(message: SampleSessionStateChangeEvent):
+            nonlocal max_active_entities
+            active_entities.add(message.entity_id)
+            max_active_entities = max(max_active_entities, len(active_entities))
+            await asyncio.sleep(0.01)
+            received.append((message.entity_id, message.sequence))
+            active_entities.discard(message.entity_id)
+
+        async def run():
+            async def cancel_when_done():
+                while len(received) < len(events):
+                    await asyncio.sleep(0.01)
+                app.cancel()
+
+            await asyncio.gather(app.run(), cancel_when_done())
+
+        asyncio.run(asyncio.wait_for(run(), timeout=5))
+
+    assert len(received) == len(events)
+    for entity_id in ["a", "b", "c"]:
+        sequences = [sequence for received_entity_id, sequence in received if received_entity_id == entity_id]
+        assert sequences == [0, 1, 2, 3], f"Expected the events for entity {entity_id} to be handled in order"
+    assert max_active_entities == 2, "Expected two sessions to be processed at the same time"
+
+    accepted = [receiver for receiver in builder.session_receivers if receiver.session is not None]
+    assert sorted(receiver.session.session_id for receiver in accepted) == ["a", "b", "c"]
+    assert sum(receiver.complete_message.call_count for receiver in accepted) == len(events)
+    assert all(receiver.__aexit__.call_count == 1 for receiver in accepted), "Expected idle sessions to be released"
+    assert app.metrics.get("sessions_accepted_total", topic="sample-session", subscription="TEST_SUB") == 3
+
+
+def test_session_retry_stops_the_batch_to_preserve_order():
+    events = [SampleSessionStateChangeEvent(entity_id="a", sequence=sequence) for sequence in range(3)]
+    messages = asyncio.run(publish_events(MockServiceBusClientBuilder(), events))
+
+    builder = MockServiceBusClientBuilder()
+    builder.add_messages_for_topic_subscription("sample-session", "TEST_SUB", messages=messages)
+    handled = []
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=builder.build()):
+        app = ConsumerApp(
+            default_subscription_name="TEST_SUB",
+            max_message_count=3,
+            max_wait_time=0.05,
+            session_idle_timeout=0.05,
+            metrics=MetricsRegistry(),
+        )
+
+        @app.consume(sessions=True, max_concurrent_sessions=1)
+        async def on_sample_session(message: SampleSessionStateChangeEvent):
+            handled.append(message.sequence)
+            if message.sequence == 1 and handled.count(1) == 1:
+                return ConsumerResult.RETRY
+
+        async def run():
+            async def cancel_when_done():
+                while handled[-1:] != [2]:
+                    await asyncio.sleep(0.01)
+                app.cancel()
+
+            await asyncio.gather(app.run(), cancel_when_done())
+
+        asyncio.run(asyncio.wait_for(run(), timeout=5))
+
+    # the message after the retried message is redelivered with it rather than handled first
+    assert handled == [0, 1, 1, 2]
+    assert sum(receiver.complete_message.call_count for receiver in builder.session_receivers) == 3
+    assert sum(receiver.abandon_message.call_count for receiver in builder.session_receivers) == 2
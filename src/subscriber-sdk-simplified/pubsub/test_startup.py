@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+
+import pubsub
+
+
+def test_import_does_not_load_heavy_modules():
+    # run in a new interpreter as other tests have already imported the azure packages
+    code = (
+        "import sys, pubsub; "
+        "loaded = [m for m in ['azure.servicebus', 'azure.identity', 'pydantic', 'pubsub.consumer_app'] if m in sys.modules]; "
+        "print(','.join(loaded))"
+    )
+    # run from the project directory so that pubsub can be imported wherever pytest is run from
+    project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run(
+        [sys.executable, "-c", code], check=True, capture_output=True, text=True, cwd=project_dir
+    ).stdout
+    assert output.strip() == "", f"Expected modules to be loaded on first use, but import loaded: {output.strip()}"
+
+
+def test_lazy_exports():
+    for name in pubsub.__all__:
+        assert getattr(pubsub, name) is not None, f"Expected pubsub.{name} to be importable"
@@ -0,0 +1,140 @@
+import asyncio
+import queue
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from .consumer_app import StateChangeEventBase
+from .metrics import MetricsRegistry
+from .publisher import Publisher
+from .sync_publisher import SyncPublisher
+from .test_helpers import MockServiceBusClientBuilder
+
+
+class SampleSyncPublisherStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+def create_publisher():
+    return Publisher(topics=["sample-sync-publisher"], metrics=MetricsRegistry())
+
+
+def test_publish_from_many_threads():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        with SyncPublisher(publisher_factory=create_publisher) as publisher:
+
+            def publish_messages(thread_index):
+                for i in range(50):
+                    publisher.publish(SampleSyncPublisherStateChangeEvent(entity_id=f"{thread_index}-{i}"))
+
+            threads = [threading.Thread(target=publish_messages, args=(i,)) for i in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+    assert len(mock_client_builder.sentMessages) == 200
+    assert all(message.topic_name == "sample-sync-publisher" for message in mock_client_builder.sentMessages)
+
+
+def test_publish_nowait_batches_queued_messages():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        publisher = SyncPublisher(publisher_factory=create_publisher, max_batch_size=10)
+        futures = [publisher.publish_nowait(SampleSyncPublisherStateChangeEvent(entity_id=str(i))) for i in range(30)]
+        for future in futures:
+            future.result(timeout=5)
+        publisher.close()
+
+    assert len(mock_client_builder.sentMessages) == 30
+    entity_ids = [str(message.message) for message in mock_client_builder.sentMessages]
+    assert entity_ids[0] == '{"entity_id": "0"}', "Expected messages to be sent in order"
+
+
+def test_close_sends_queued_messages():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        publisher = SyncPublisher(publisher_factory=create_publisher)
+        futures = [publisher.publish_nowait(SampleSyncPublisherStateChangeEvent(entity_id=str(i))) for i in range(5)]
+        publisher.close()
+
+    assert all(future.done() for future in futures)
+    assert len(mock_client_builder.sentMessages) == 5
+
+
+def test_publish_nowait_applies_backpressure_when_queue_full():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.build()
+    release_send = threading.Event()
+
+    def create_blocked_publisher():
+        publisher = create_publisher()
+        send = publisher._send
+
+        async def blocked_send(topic_name, servicebus_messages):
+            while not release_send.is_set():
+                await asyncio.sleep(0.001)
+            await send(topic_name, servicebus_messages)
+
+        publisher._send = blocked_send
+        return publisher
+
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        publisher = SyncPublisher(publisher_factory=create_blocked_publisher, max_queue_size=2, enqueue_timeout=0.05)
+        futures = [publisher.publish_nowait(SampleSyncPublisherStateChangeEvent(entity_id=str(i))) for i in range(2)]
+
+        with pytest.raises(queue.Full):
+            publisher.publish_nowait(SampleSyncPublisherStateChangeEvent(entity_id="2"))
+
+        release_send.set()
+        for future in futures:
+            future.result(timeout=5)
+        # space is available again once the queued messages have been sent
+        publisher.publish(SampleSyncPublisherStateChangeEvent(entity_id="3"), timeout=5)
+        publisher.close()
+
+    assert len(mock_client_builder.sentMessages) == 3
+
+
+def test_publish_raises_when_send_fails():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.build()
+
+    def create_failing_publisher():
+        publisher = create_publisher()
+
+        async def failing_send(topic_name, servicebus_messages):
+            raise Exception("Service Bus unavailable")
+
+        publisher._send = failing_send
+        return publisher
+
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        with SyncPublisher(publisher_factory=create_failing_publisher) as publisher:
+            with pytest.raises(Exception, match="Service Bus unavailable"):
+                publisher.publish(SampleSyncPublisherStateChangeEvent(entity_id="1"), timeout=5)
+
+
+def test_publish_racing_with_close_raises_rather_than_blocking():
+    mock_client_builder = MockServiceBusClientBuilder()
+    mock_sb_client = mock_client_builder.build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        publisher = SyncPublisher(publisher_factory=create_publisher)
+        start = publisher.start
+
+        def start_then_close():
+            start()
+            # close() runs between start() and the event being queued (e.g. from another thread)
+            publisher.close(timeout=0)
+
+        publisher.start = start_then_close
+        with pytest.raises(Exception, match="closed"):
+            publisher.publish(SampleSyncPublisherStateChangeEvent(entity_id="1"), timeout=5)
+        publisher._thread.join(timeout=5)
+
+    assert mock_client_builder.sentMessages == []
@@ -0,0 +1,175 @@
+import asyncio
+from unittest.mock import patch
+
+from .consumer_app import ConsumerApp, StateChangeEventBase
+from .metrics import MetricsRegistry
+from .publisher import Publisher
+from .test_helpers import MockServiceBusClientBuilder, run_app_with_timeout
+from .tracing import (
+    TRACEPARENT_PROPERTY,
+    InMemorySpanExporter,
+    OtlpHttpSpanExporter,
+    Span,
+    Tracer,
+    format_traceparent,
+    parse_traceparent,
+)
+
+
+class SampleTracedStateChangeEvent(StateChangeEventBase):
+    pass
+
+
+def publish_and_consume(publish_tracer: Tracer, consume_tracer: Tracer, handler):
+    mock_client_builder = MockServiceBusClientBuilder()
+    with patch(
+        "azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_client_builder.build()
+    ):
+
+        async def publish():
+            async with Publisher(
+                topics=["sample-traced"], metrics=MetricsRegistry(), tracer=publish_tracer
+            ) as publisher:
+                await publisher.publish(SampleTracedStateChangeEvent(entity_id="1"))
+
+        asyncio.run(publish())
+    sent_messages = [sent_message.message for sent_message in mock_client_builder.sentMessages]
+
+    mock_sb_client = mock_client_builder.add_messages_for_topic_subscription(
+        "sample-traced", "TEST_SUB", messages=sent_messages
+    ).build()
+    with patch("azure.servicebus.aio.ServiceBusClient.from_connection_string", return_value=mock_sb_client):
+        app = ConsumerApp(
+            default_subscription_name="TEST_SUB",
+            metrics=MetricsRegistry(),
+            manage_subscription_rules=False,
+            tracer=consume_tracer,
+        )
+        app.consume(max_wait_time=0.1)(handler)
+        asyncio.run(run_app_with_timeout(app))
+    return sent_messages
+
+
+def test_traceparent_round_trip():
+    traceparent = format_traceparent("0af7651916cd43dd8448eb211c80319c", "b7ad6b7169203331", True)
+    assert traceparent == "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+    assert parse_traceparent(traceparent) == ("0af7651916cd43dd8448eb211c80319c", "b7ad6b7169203331", True)
+    assert parse_traceparent("00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-00")[2] is False
+    assert parse_traceparent("not-a-traceparent") is None
+    assert parse_traceparent("00-00000000000000000000000000000000-b7ad6b7169203331-01") is None
+
+
+def test_trace_continues_from_publish_to_handler():
+    exporter = InMemorySpanExporter()
+    tracer = Tracer(exporter, sample_rate=1, tail_latency_threshold=0)
+
+    async def on_sample_traced(message: SampleTracedStateChangeEvent):
+        await asyncio.sleep(0.01)
+
+    sent_messages = publish_and_consume(tracer, tracer, on_sample_traced)
+
+    [publish_span] = exporter.get_spans("publish sample-traced")
+    assert sent_messages[0].application_properties[TRACEPARENT_PROPERTY] == format_traceparent(
+        publish_span.trace_id, publish_span.span_id, True
+    )
+    [process_span] = exporter.get_spans("process sample-traced")
+    assert process_span.trace_id == publish_span.trace_id
+    assert process_span.parent_span_id == publish_span.span_id
+    assert process_span.attributes["pubsub.result"] == "SUCCESS"
+    for stage in ["decode", "handler", "settle"]:
+        [stage_span] = exporter.get_spans(stage)
+        assert stage_span.parent_span_id == process_span.span_id
+        assert stage_span.trace_id == process_span.trace_id
+    assert exporter.get_spans("handler")[0].duration >= 0.01
+
+
+def test_unsampled_messages_are_not_exported():
+    exporter = InMemorySpanExporter()
+    tracer = Tracer(exporter, sample_rate=0, tail_latency_threshold=0)
+    handled = []
+
+    async def on_sample_traced(message: SampleTracedStateChangeEvent):
+        handled.append(message)
+
+    sent_messages = publish_and_consume(tracer, tracer, on_sample_traced)
+
+    assert len(handled) == 1
+    assert parse_traceparent(sent_messages[0].application_properties[TRACEPARENT_PROPERTY])[2] is False
+    assert exporter.spans == []
+
+
+def test_tail_sampling_exports_failed_messages():
+    exporter = InMemorySpanExporter()
+    tracer = Tracer(exporter, sample_rate=0, tail_latency_threshold=60)
+
+    async def on_sample_traced(message: SampleTracedStateChangeEvent):
+        raise Exception("Handler failed")
+
+    publish_and_consume(Tracer(), tracer, on_sample_traced)
+
+    process_spans = exporter.get_spans("process sample-traced")
+    assert len(process_spans) > 0, "Expected the failed (retried) messages to be traced"
+    assert all(span.error for span in process_spans)
+    assert process_spans[0].parent_span_id is None, "Expected a new trace when the message has no traceparent"
+
+
+def test_otlp_json():
+    exporter = OtlpHttpSpanExporter("http://localhost:4318/v1/traces", service_name="sample")
+    try:
+        span = Span(
+            "process sample-traced",
+            "0af7651916cd43dd8448eb211c80319c",
+            "b7ad6b7169203331",
+            None,
+            5,
+            1000,
+            2000,
+            {"messaging.destination.name": "sample-traced", "retry": 1},
+        )
+        request = exporter.to_otlp_json([span])
+    finally:
+        exporter.shutdown()
+
+    resource_spans = request["resourceSpans"][0]
+    assert resource_spans["resource"]["attributes"] == [{"key": "service.name", "value": {"stringValue": "sample"}}]
+    [otlp_span] = resource_spans["scopeSpans"][0]["spans"]
+    assert otlp_span["traceId"] == "0af7651916cd43dd8448eb211c80319c"
+    assert otlp_span["parentSpanId"] == ""
+    assert otlp_span["kind"] == 5
+    assert otlp_span["startTimeUnixNano"] == "1000"
+    assert {"key": "retry", "value": {"intValue": "1"}} in otlp_span["attributes"]
+
+
+def test_otlp_exporter_flush_sends_queued_spans():
+    exporter = OtlpHttpSpanExporter("http://localhost:4318/v1/traces", flush_interval=60)
+    sent = []
+    exporter._send = sent.extend
+    try:
+        spans = [
+            Span(f"span {i}", "0af7651916cd43dd8448eb211c80319c", "b7ad6b7169203331", None, 1, 0, 1) for i in range(3)
+        ]
+        exporter.export(spans)
+        assert exporter.flush(timeout=5), "Expected the queued spans to be sent without waiting for the flush interval"
+        assert sent == spans
+    finally:
+        exporter.shutdown()
+
+
+class FlushCountingSpanExporter(InMemorySpanExporter):
+    flush_count = 0
+
+    def flush(self, timeout: float = 10) -> bool:
+        self.flush_count += 1
+        return True
+
+
+def test_tracer_is_flushed_when_consumer_app_and_publisher_stop():
+    exporter = FlushCountingSpanExporter()
+    tracer = Tracer(exporter, sample_rate=1)
+
+    async def on_sample_traced(message: SampleTracedStateChangeEvent):
+        pass
+
+    publish_and_consume(tracer, tracer, on_sample_traced)
+    assert len(exporter.get_spans()) > 0
+    assert exporter.flush_count == 2, "Expected a flush when the Publisher is closed and when ConsumerApp.run exits"
@@ -0,0 +1,630 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+from datetime import datetime
+from typing import Optional
+
+#
+# Lightweight tracing with W3C trace context propagation (https://www.w3.org/TR/trace-context/)
+#
+# The publisher adds a "traceparent" application property to each message, and ConsumerApp continues the trace
+# with a span for processing the message and child spans for each stage (broker dwell, claim-check fetch, decode,
+# handlers and settle). Spans are exported with a SpanExporter, e.g. OtlpHttpSpanExporter (OTLP/HTTP JSON) or
+# InMemorySpanExporter (for tests). Tracing is disabled unless an exporter is configured.
+#
+# Sampling:
+# - head sampling: a trace is sampled if the traceparent flags it as sampled, or (for new traces) with probability
+#   TRACING_SAMPLE_RATE. Sampled messages record and export their spans.
+# - tail sampling: for messages that aren't head sampled, only the stage timestamps are recorded, and the spans are
+#   exported if processing took longer than TRACING_TAIL_LATENCY_THRESHOLD or failed. Otherwise they are discarded.
+#
+
+TRACEPARENT_PROPERTY = "traceparent"
+
+TRACING_SAMPLE_RATE = float(os.getenv("TRACING_SAMPLE_RATE", "0.01"))
+TRACING_TAIL_LATENCY_THRESHOLD = float(os.getenv("TRACING_TAIL_LATENCY_THRESHOLD", "1"))
+OTEL_EXPORTER_OTLP_TRACES_ENDPOINT = os.getenv("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT", None)
+OTEL_EXPORTER_OTLP_HEADERS = os.getenv("OTEL_EXPORTER_OTLP_HEADERS", "")
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "pubsub")
+
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_PRODUCER = 4
+SPAN_KIND_CONSUMER = 5
+
+_logger = logging.getLogger(__name__)
+
+_TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+# the traceparent for the message being handled (so that events published by a handler continue the trace)
+_current_traceparent = contextvars.ContextVar("pubsub_traceparent", default=None)
+
+
+def _new_trace_id() -> str:
+    return f"{random.getrandbits(128):032x}"
+
+
+def _new_span_id() -> str:
+    return f"{random.getrandbits(64):016x}"
+
+
+def parse_traceparent(value) -> Optional[tuple]:
+    """Parse a traceparent header value into (trace_id, parent_span_id, sampled), or None if it isn't valid"""
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    match = _TRACEPARENT.match(value.strip().lower()) if isinstance(value, str) else None
+    if match is None or match.group(1) == "0" * 32 or match.group(2) == "0" * 16:
+        return None
+    return match.group(1), match.group(2), (int(match.group(3), 16) & 1) == 1
+
+
+def format_traceparent(trace_id: str, span_id: str, sampled: bool) -> str:
+    return f"00-{trace_id}-{span_id}-{'01' if sampled else '00'}"
+
+
+def get_current_traceparent() -> Optional[str]:
+    """Get the traceparent for the message currently being handled (or None outside a handler)"""
+    return _current_traceparent.get()
+
+
+class Span:
+    """Span is a finished span, ready to export"""
+
+    name: str
+    trace_id: str
+    span_id: str
+    parent_span_id: Optional[str]
+    kind: int
+    start_time_ns: int
+    end_time_ns: int
+    attributes: dict
+    error: bool
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        span_id: str,
+        parent_span_id: Optional[str],
+        kind: int,
+        start_time_ns: int,
+        end_time_ns: int,
+        attributes: Optional[dict] = None,
+        error: bool = False,
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.parent_span_id = parent_span_id
+        self.kind = kind
+        self.start_time_ns = start_time_ns
+        self.end_time_ns = end_time_ns
+        self.attributes = attributes or {}
+        self.error = error
+
+    @property
+    def duration(self) -> float:
+        """The duration of the span in seconds"""
+        return (self.end_time_ns - self.start_time_ns) / 1e9
+
+    def __repr__(self) -> str:
+        return f"Span({self.name}, trace_id={self.trace_id}, span_id={self.span_id}, duration={self.duration:.6f}s)"
+
+
+class SpanExporter:
+    """SpanExporter is the interface for exporting finished spans"""
+
+    def export(self, spans: list[Span]):
+        raise NotImplementedError()
+
+    def flush(self, timeout: float = 10) -> bool:
+        """Send any buffered spans, returning False if they couldn't be sent within timeout seconds"""
+        return True
+
+    def shutdown(self):
+        pass
+
+
+class InMemorySpanExporter(SpanExporter):
+    """InMemorySpanExporter keeps exported spans in memory (e.g. for tests)"""
+
+    spans: list[Span]
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans: list[Span]):
+        self.spans.extend(spans)
+
+    def get_spans(self, name: Optional[str] = None) -> list[Span]:
+        return [span for span in self.spans if name is None or span.name == name]
+
+    def clear(self):
+        self.spans = []
+
+
+def _to_otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _to_otlp_attributes(attributes: dict) -> list:
+    return [{"key": key, "value": _to_otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class OtlpHttpSpanExporter(SpanExporter):
+    """OtlpHttpSpanExporter sends spans to an OpenTelemetry collector using OTLP/HTTP with JSON encoding
+
+    Spans are queued and sent in batches by a background thread, so export() never blocks the event loop.
+    Spans are dropped if the queue is full (e.g. the collector is unavailable). Call flush() (or shutdown()) before
+    exiting to send the queued spans, as the thread doesn't keep the process running.
+    """
+
+    _endpoint: str
+    _headers: dict
+    _service_name: str
+    _max_batch_size: int
+    _flush_interval: float
+    _queue: queue.Queue
+    _thread: Optional[threading.Thread]
+    dropped_count: int
+
+    def __init__(
+        self,
+        endpoint: str,
+        headers: Optional[dict] = None,
+        service_name: Optional[str] = None,
+        max_batch_size: int = 512,
+        flush_interval: float = 5,
+        max_queue_size: int = 2048,
+    ):
+        """
+        Args:
+            endpoint (str): The OTLP traces endpoint, e.g. http://localhost:4318/v1/traces
+            headers (Optional[dict]): Headers to send with each request (e.g. for authentication)
+            service_name (Optional[str]): The service.name resource attribute (defaults to OTEL_SERVICE_NAME)
+            max_batch_size (int): The maximum number of spans to send in one request
+            flush_interval (float): The maximum time in seconds that spans wait before being sent
+            max_queue_size (int): The maximum number of spans waiting to be sent
+        """
+        self._endpoint = endpoint
+        self._headers = {"Content-Type": "application/json", **(headers or {})}
+        self._service_name = service_name or OTEL_SERVICE_NAME
+        self._max_batch_size = max_batch_size
+        self._flush_interval = flush_interval
+        self._queue = queue.Queue(max_queue_size)
+        self._thread = None
+        self.dropped_count = 0
+
+    def export(self, spans: list[Span]):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="pubsub-otlp-exporter", daemon=True)
+            self._thread.start()
+        for span in spans:
+            try:
+                self._queue.put_nowait(span)
+            except queue.Full:
+                self.dropped_count += 1
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            flushed = None
+            deadline = time.monotonic() + self._flush_interval
+            while len(batch) < self._max_batch_size:
+                try:
+                    span = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if span is None:
+                    stopping = True
+                    break
+                if isinstance(span, threading.Event):
+                    # flush requested: send the spans queued before it
+                    flushed = span
+                    break
+                batch.append(span)
+            if batch:
+                self._send(batch)
+            if flushed is not None:
+                flushed.set()
+
+    def to_otlp_json(self, spans: list[Span]) -> dict:
+        """Convert spans to an OTLP ExportTraceServiceRequest (JSON encoding)"""
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": _to_otlp_attributes({"service.name": self._service_name})},
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "pubsub"},
+                            "spans": [
+                                {
+                                    "traceId": span.trace_id,
+                                    "spanId": span.span_id,
+                                    "parentSpanId": span.parent_span_id or "",
+                                    "name": span.name,
+                                    "kind": span.kind,
+                                    "startTimeUnixNano": str(span.start_time_ns),
+                                    "endTimeUnixNano": str(span.end_time_ns),
+                                    "attributes": _to_otlp_attributes(span.attributes),
+                                    "status": {"code": 2 if span.error else 1},
+                                }
+                                for span in spans
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def _send(self, spans: list[Span]):
+        body = json.dumps(self.to_otlp_json(spans)).encode("utf-8")
+        request = urllib.request.Request(self._endpoint, data=body, headers=self._headers, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                response.read()
+        except Exception as e:
+            _logger.warning(f"Failed to export {len(spans)} span(s) to {self._endpoint}: {e!r}")
+
+    def flush(self, timeout: float = 10) -> bool:
+        if self._thread is None:
+            return True
+        flushed = threading.Event()
+        try:
+            self._queue.put(flushed, timeout=timeout)
+        except queue.Full:
+            return False
+        return flushed.wait(timeout)
+
+    def shutdown(self):
+        """Send the queued spans and stop the background thread"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=30)
+            self._thread = None
+
+
+class _NoopTrace:
+    """Trace used when tracing is disabled (or a message isn't sampled and tail sampling is disabled)"""
+
+    traceparent = None
+
+    def stage(self, name: str):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def end(self, error: bool = False, **attributes):
+        pass
+
+
+NOOP_TRACE = _NoopTrace()
+
+
+class PublishTrace(_NoopTrace):
+    """PublishTrace is the span for publishing a message, whose context is injected into the message"""
+
+    _tracer: "Tracer"
+    _trace_id: str
+    _span_id: str
+    _parent_span_id: Optional[str]
+    _sampled: bool
+    _topic: str
+    _start_time_ns: int
+
+    def __init__(self, tracer: "Tracer", topic: str, parent: Optional[tuple]):
+        self._tracer = tracer
+        self._topic = topic
+        if parent is not None:
+            self._trace_id, self._parent_span_id, self._sampled = parent
+        else:
+            self._trace_id, self._parent_span_id, self._sampled = _new_trace_id(), None, tracer.head_sample()
+        self._span_id = _new_span_id()
+        self._start_time_ns = time.time_ns()
+
+    @property
+    def traceparent(self) -> str:
+        return format_traceparent(self._trace_id, self._span_id, self._sampled)
+
+    def end(self, error: bool = False, **attributes):
+        if not self._sampled:
+            return
+        attributes = {"messaging.system": "servicebus", "messaging.destination.name": self._topic, **attributes}
+        span = Span(
+            f"publish {self._topic}",
+            self._trace_id,
+            self._span_id,
+            self._parent_span_id,
+            SPAN_KIND_PRODUCER,
+            self._start_time_ns,
+            time.time_ns(),
+            attributes,
+            error,
+        )
+        self._tracer.export([span])
+
+
+class _Stage:
+    """The timestamps for a stage of a MessageTrace (a context manager that ends the stage on exit)"""
+
+    __slots__ = ("name", "start_perf_ns", "end_perf_ns")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start_perf_ns = time.perf_counter_ns()
+        self.end_perf_ns = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.end_perf_ns = time.perf_counter_ns()
+        return False
+
+
+class MessageTrace(_NoopTrace):
+    """MessageTrace records the stages of processing a received message
+
+    Stages are recorded as (name, start, end) timestamps, and spans are only created (and exported) in end() if
+    the trace is sampled, or kept by tail sampling.
+    """
+
+    _tracer: "Tracer"
+    _trace_id: str
+    _span_id: str
+    _parent_span_id: Optional[str]
+    _sampled: bool
+    _name: str
+    _attributes: dict
+    _enqueued_time: Optional[datetime]
+    _received_time_ns: Optional[int]
+    _start_time_ns: int
+    _start_perf_ns: int
+    _stages: list[_Stage]
+
+    def __init__(
+        self,
+        tracer: "Tracer",
+        name: str,
+        trace_id: str,
+        parent_span_id: Optional[str],
+        sampled: bool,
+        attributes: dict,
+        enqueued_time: Optional[datetime] = None,
+        received_time_ns: Optional[int] = None,
+    ):
+        self._tracer = tracer
+        self._trace_id = trace_id
+        self._parent_span_id = parent_span_id
+        self._sampled = sampled
+        self._span_id = _new_span_id()
+        self._name = name
+        self._attributes = attributes
+        self._enqueued_time = enqueued_time
+        self._received_time_ns = received_time_ns
+        self._start_time_ns = time.time_ns()
+        self._start_perf_ns = time.perf_counter_ns()
+        self._stages = []
+
+    @property
+    def traceparent(self) -> str:
+        return format_traceparent(self._trace_id, self._span_id, self._sampled)
+
+    def stage(self, name: str):
+        """Start a stage (use as a context manager to end it)"""
+        stage = _Stage(name)
+        self._stages.append(stage)
+        return stage
+
+    def end(self, error: bool = False, **attributes):
+        end_perf_ns = time.perf_counter_ns()
+        duration = (end_perf_ns - self._start_perf_ns) / 1e9
+        if not (self._sampled or error or duration >= self._tracer.tail_latency_threshold):
+            return
+
+        def to_time_ns(perf_ns: int) -> int:
+            return self._start_time_ns + (perf_ns - self._start_perf_ns)
+
+        spans = [
+            Span(
+                self._name,
+                self._trace_id,
+                self._span_id,
+                self._parent_span_id,
+                SPAN_KIND_CONSUMER,
+                self._start_time_ns,
+                to_time_ns(end_perf_ns),
+                {**self._attributes, **attributes, "pubsub.sampled": "head" if self._sampled else "tail"},
+                error,
+            )
+        ]
+        # dwell: from the broker accepting the message to it being received (broker time and the receive)
+        # queued: from being received to processing starting (e.g. waiting for max_concurrency)
+        received_time_ns = min(self._received_time_ns or self._start_time_ns, self._start_time_ns)
+        enqueued_time_ns = int(self._enqueued_time.timestamp() * 1e9) if self._enqueued_time is not None else None
+        if enqueued_time_ns is not None and enqueued_time_ns < received_time_ns:
+            spans.append(
+                Span(
+                    "dwell",
+                    self._trace_id,
+                    _new_span_id(),
+                    self._span_id,
+                    SPAN_KIND_INTERNAL,
+                    enqueued_time_ns,
+                    received_time_ns,
+                )
+            )
+        if received_time_ns < self._start_time_ns:
+            spans.append(
+                Span(
+                    "queued",
+                    self._trace_id,
+                    _new_span_id(),
+                    self._span_id,
+                    SPAN_KIND_INTERNAL,
+                    received_time_ns,
+                    self._start_time_ns,
+                )
+            )
+        for stage in self._stages:
+            spans.append(
+                Span(
+                    stage.name,
+                    self._trace_id,
+                    _new_span_id(),
+                    self._span_id,
+                    SPAN_KIND_INTERNAL,
+                    to_time_ns(stage.start_perf_ns),
+                    to_time_ns(stage.end_perf_ns or end_perf_ns),
+                )
+            )
+        self._tracer.export(spans)
+
+
+class Tracer:
+    """Tracer creates the traces for publishing and processing messages (see the comments at the top of tracing.py)"""
+
+    exporter: Optional[SpanExporter]
+    sample_rate: float
+    tail_latency_threshold: float
+    exported_count: int
+
+    def __init__(
+        self,
+        exporter: Optional[SpanExporter] = None,
+        sample_rate: Optional[float] = None,
+        tail_latency_threshold: Optional[float] = None,
+    ):
+        """
+        Args:
+            exporter (Optional[SpanExporter]): The exporter for finished spans. Tracing is disabled if not set
+            sample_rate (Optional[float]): The probability of sampling a new trace (defaults to TRACING_SAMPLE_RATE)
+            tail_latency_threshold (Optional[float]): The processing time in seconds at or above which unsampled messages are traced, or 0 to disable tail sampling (defaults to TRACING_TAIL_LATENCY_THRESHOLD)
+        """
+        self.exporter = exporter
+        self.sample_rate = sample_rate if sample_rate is not None else TRACING_SAMPLE_RATE
+        tail_latency_threshold = (
+            tail_latency_threshold if tail_latency_threshold is not None else TRACING_TAIL_LATENCY_THRESHOLD
+        )
+        self.tail_latency_threshold = tail_latency_threshold if tail_latency_threshold > 0 else float("inf")
+        self.exported_count = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    def head_sample(self) -> bool:
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def export(self, spans: list[Span]):
+        self.exported_count += len(spans)
+        try:
+            self.exporter.export(spans)
+        except Exception as e:
+            _logger.warning(f"Failed to export spans: {e!r}")
+
+    def start_publish_trace(self, topic: str):
+        """Start the trace for publishing a message to topic (continuing the trace of the message being handled)"""
+        if not self.enabled:
+            return NOOP_TRACE
+        current_traceparent = _current_traceparent.get()
+        return PublishTrace(self, topic, parse_traceparent(current_traceparent) if current_traceparent else None)
+
+    def start_message_trace(
+        self,
+        traceparent: Optional[str],
+        topic: str,
+        subscription: str,
+        message_id: Optional[str],
+        enqueued_time: Optional[datetime] = None,
+        received_time_ns: Optional[int] = None,
+    ):
+        """Start the trace for processing a received message (continuing the trace from its traceparent)"""
+        if not self.enabled:
+            return NOOP_TRACE
+        parent = parse_traceparent(traceparent) if traceparent else None
+        trace_id, parent_span_id, sampled = (
+            parent if parent is not None else (_new_trace_id(), None, self.head_sample())
+        )
+        if not sampled and self.tail_latency_threshold == float("inf"):
+            # not sampled and no tail sampling - don't record anything
+            return NOOP_TRACE
+        return MessageTrace(
+            self,
+            f"process {topic}",
+            trace_id,
+            parent_span_id,
+            sampled,
+            {
+                "messaging.system": "servicebus",
+                "messaging.destination.name": topic,
+                "messaging.servicebus.subscription": subscription,
+                "messaging.message.id": message_id,
+            },
+            enqueued_time=enqueued_time,
+            received_time_ns=received_time_ns,
+        )
+
+    def flush(self, timeout: float = 10) -> bool:
+        """Send the spans buffered by the exporter (blocks, so call from a thread when on the event loop)"""
+        if self.exporter is None:
+            return True
+        return self.exporter.flush(timeout)
+
+    def shutdown(self):
+        if self.exporter is not None:
+            self.exporter.shutdown()
+
+
+def set_current_traceparent(traceparent: Optional[str]) -> contextvars.Token:
+    return _current_traceparent.set(traceparent)
+
+
+def reset_current_traceparent(token: contextvars.Token):
+    _current_traceparent.reset(token)
+
+
+def _parse_headers(value: str) -> dict:
+    headers = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, header_value = item.split("=", 1)
+            headers[name.strip()] = header_value.strip()
+    return headers
+
+
+_default_tracer = None
+
+
+def get_default_tracer() -> Tracer:
+    """Get the default Tracer, which exports to OTEL_EXPORTER_OTLP_TRACES_ENDPOINT if it is set (and is disabled if not)"""
+    global _default_tracer
+    if _default_tracer is None:
+        exporter = None
+        if OTEL_EXPORTER_OTLP_TRACES_ENDPOINT:
+            exporter = OtlpHttpSpanExporter(
+                OTEL_EXPORTER_OTLP_TRACES_ENDPOINT, headers=_parse_headers(OTEL_EXPORTER_OTLP_HEADERS)
+            )
+        _default_tracer = Tracer(exporter)
+        if exporter is not None:
+            # send the spans still queued when the process exits
+            atexit.register(_default_tracer.shutdown)
+    return _default_tracer